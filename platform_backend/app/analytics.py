@@ -0,0 +1,229 @@
+"""
+Market analytics over traded volume: volume-weighted GHG intensity, production-mix
+shares and prices by GHG intensity band, per region and period.
+
+The matching engine adds every trade to the TradeAnalytics counters (one row per
+day, region, production method, feedstock, energy source and intensity band) in the
+transaction that creates it (record_trades). Queries roll those rows up per region
+and day, month or the whole window, so they read a few hundred rows rather than the
+trade history. `flask rebuild-analytics` recomputes the counters from trades with a
+single INSERT ... SELECT, e.g. after a backfill or when listing attributes change.
+"""
+import logging
+from collections import defaultdict
+from datetime import date
+from decimal import Decimal
+
+import click
+from flask import Blueprint, jsonify, request
+from flask.cli import with_appcontext
+from flask_jwt_extended import jwt_required
+from sqlalchemy import case, delete, func, insert, literal, select
+
+from . import db
+from .counters import increment
+from .db_routing import read_only
+from .models import HydrogenProduct, Trade, TradeAnalytics
+
+bp = Blueprint('analytics', __name__)
+logger = logging.getLogger(__name__)
+
+UNKNOWN = 'unknown'
+# Upper bounds of the GHG intensity bands in kgCO2e/kgH2 (the US 45V credit tiers).
+INTENSITY_BAND_EDGES = (Decimal('0.45'), Decimal('1.5'), Decimal('2.5'), Decimal('4'))
+INTENSITY_BANDS = (
+    [f"<{INTENSITY_BAND_EDGES[0]}"]
+    + [f"{low}-{high}" for low, high in zip(INTENSITY_BAND_EDGES, INTENSITY_BAND_EDGES[1:])]
+    + [f">={INTENSITY_BAND_EDGES[-1]}", UNKNOWN]
+)
+PERIODS = ('day', 'month', 'total')
+KEYS = ('trade_date', 'region', 'production_method', 'feedstock', 'energy_source', 'intensity_band')
+_SHARE = Decimal('0.0001')
+_PRICE = Decimal('0.01')
+
+
+def intensity_band(ghg_intensity):
+    """The band label of a GHG intensity in kgCO2e/kgH2 (None is 'unknown')."""
+    if ghg_intensity is None:
+        return UNKNOWN
+    for edge, label in zip(INTENSITY_BAND_EDGES, INTENSITY_BANDS):
+        if ghg_intensity < edge:
+            return label
+    return INTENSITY_BANDS[-2]
+
+
+def _intensity_band_sql(column):
+    return case(
+        (column.is_(None), UNKNOWN),
+        *[(column < edge, label) for edge, label in zip(INTENSITY_BAND_EDGES, INTENSITY_BANDS)],
+        else_=INTENSITY_BANDS[-2],
+    )
+
+
+def record_trades(trades):
+    """
+    Adds newly created (flushed) trades to the analytics counters in the current transaction.
+    Each trade counts on the day of its own trade_timestamp, as in rebuild_trade_analytics().
+    """
+    # The database-assigned timestamps and the listing attributes of all trades in one SELECT
+    attributes = {row.id: row for row in db.session.execute(
+        select(Trade.id, Trade.trade_timestamp, HydrogenProduct.location_region, HydrogenProduct.production_method,
+               HydrogenProduct.feedstock, HydrogenProduct.energy_source, HydrogenProduct.ghg_intensity_kgco2e_per_kgh2)
+        .join(HydrogenProduct, HydrogenProduct.id == Trade.hydrogen_product_id)
+        .where(Trade.id.in_([trade.id for trade in trades]))
+    )}
+    deltas = {}
+    for trade in trades:
+        listed = attributes[trade.id]
+        intensity = listed.ghg_intensity_kgco2e_per_kgh2
+        key = (listed.trade_timestamp.date(), listed.location_region, listed.production_method,
+               listed.feedstock or UNKNOWN, listed.energy_source or UNKNOWN, intensity_band(intensity))
+        row = deltas.setdefault(key, dict(zip(KEYS, key), trade_count=0, volume_kg=Decimal(0), notional=Decimal(0),
+                                          intensity_volume_kg=Decimal(0), emissions_kgco2e=Decimal(0)))
+        row['trade_count'] += 1
+        row['volume_kg'] += trade.quantity_traded_kg
+        row['notional'] += trade.quantity_traded_kg * trade.price_per_kg_agreed
+        if intensity is not None:
+            row['intensity_volume_kg'] += trade.quantity_traded_kg
+            row['emissions_kgco2e'] += trade.quantity_traded_kg * intensity
+    increment(TradeAnalytics, list(deltas.values()), keys=KEYS)
+
+
+def rebuild_trade_analytics():
+    """Recomputes all analytics counters from the trades table; returns the number of rows written."""
+    intensity = HydrogenProduct.ghg_intensity_kgco2e_per_kgh2
+    known = intensity.isnot(None)
+    keys = (
+        func.date(Trade.trade_timestamp),
+        HydrogenProduct.location_region,
+        HydrogenProduct.production_method,
+        func.coalesce(HydrogenProduct.feedstock, UNKNOWN),
+        func.coalesce(HydrogenProduct.energy_source, UNKNOWN),
+        _intensity_band_sql(intensity),
+    )
+    source = select(
+        *keys,
+        func.count(Trade.id),
+        func.sum(Trade.quantity_traded_kg),
+        func.sum(Trade.quantity_traded_kg * Trade.price_per_kg_agreed),
+        func.sum(case((known, Trade.quantity_traded_kg), else_=literal(0))),
+        func.sum(case((known, Trade.quantity_traded_kg * intensity), else_=literal(0))),
+    ).join(HydrogenProduct, HydrogenProduct.id == Trade.hydrogen_product_id).group_by(*keys)
+    db.session.execute(delete(TradeAnalytics))
+    result = db.session.execute(insert(TradeAnalytics).from_select(
+        [*KEYS, 'trade_count', 'volume_kg', 'notional', 'intensity_volume_kg', 'emissions_kgco2e'], source
+    ))
+    db.session.commit()
+    return result.rowcount
+
+
+def _period_start(trade_date, period, start):
+    if period == 'day':
+        return trade_date
+    if period == 'month':
+        return trade_date.replace(day=1)
+    return start
+
+
+def _ratio(numerator, denominator, quantum):
+    return str((Decimal(numerator) / Decimal(denominator)).quantize(quantum)) if denominator else None
+
+
+def _shares(volumes, total):
+    return {name: _ratio(volume, total, _SHARE) for name, volume in sorted(volumes.items(), key=lambda item: -item[1])}
+
+
+def market_analytics(region=None, start=None, end=None, period='month'):
+    """
+    Rolls the counters up per region and period.
+
+    Args:
+        region (str, optional): Only this region.
+        start (date, optional): Inclusive first trade date.
+        end (date, optional): Exclusive last trade date.
+        period (str): 'day', 'month' or 'total' (one entry per region for the whole window).
+
+    Returns:
+        list[dict]: One entry per region and period, oldest first.
+    """
+    stmt = select(*TradeAnalytics.__table__.columns)
+    if region:
+        stmt = stmt.where(TradeAnalytics.region == region)
+    if start:
+        stmt = stmt.where(TradeAnalytics.trade_date >= start)
+    if end:
+        stmt = stmt.where(TradeAnalytics.trade_date < end)
+
+    buckets = defaultdict(lambda: {
+        'trade_count': 0, 'volume_kg': Decimal(0), 'notional': Decimal(0), 'intensity_volume_kg': Decimal(0),
+        'emissions_kgco2e': Decimal(0), 'production_method': defaultdict(Decimal), 'feedstock': defaultdict(Decimal),
+        'energy_source': defaultdict(Decimal), 'bands': defaultdict(lambda: [Decimal(0), Decimal(0)]),
+    })
+    for row in db.session.execute(stmt):
+        bucket = buckets[(row.region, _period_start(row.trade_date, period, start))]
+        volume = Decimal(row.volume_kg)
+        bucket['trade_count'] += row.trade_count
+        bucket['volume_kg'] += volume
+        bucket['notional'] += Decimal(row.notional)
+        bucket['intensity_volume_kg'] += Decimal(row.intensity_volume_kg)
+        bucket['emissions_kgco2e'] += Decimal(row.emissions_kgco2e)
+        for dimension in ('production_method', 'feedstock', 'energy_source'):
+            bucket[dimension][getattr(row, dimension)] += volume
+        band = bucket['bands'][row.intensity_band]
+        band[0] += volume
+        band[1] += Decimal(row.notional)
+
+    series = []
+    for (bucket_region, period_start), bucket in sorted(buckets.items(), key=lambda item: (item[0][1] or date.min, item[0][0])):
+        volume = bucket['volume_kg']
+        series.append({
+            'region': bucket_region,
+            'period_start': period_start.isoformat() if period_start else None,
+            'trade_count': bucket['trade_count'],
+            'volume_kg': str(volume),
+            'vwap_price_per_kg': _ratio(bucket['notional'], volume, _PRICE),
+            'volume_weighted_ghg_intensity': _ratio(bucket['emissions_kgco2e'], bucket['intensity_volume_kg'], _SHARE),
+            'ghg_intensity_coverage': _ratio(bucket['intensity_volume_kg'], volume, _SHARE), # Share of volume with a known intensity
+            'production_method_mix': _shares(bucket['production_method'], volume),
+            'feedstock_mix': _shares(bucket['feedstock'], volume),
+            'energy_source_mix': _shares(bucket['energy_source'], volume),
+            'price_by_intensity_band': [
+                {'band': label, 'volume_kg': str(bucket['bands'][label][0]),
+                 'vwap_price_per_kg': _ratio(bucket['bands'][label][1], bucket['bands'][label][0], _PRICE)}
+                for label in INTENSITY_BANDS if label in bucket['bands']
+            ],
+        })
+    return series
+
+
+@bp.route('/market', methods=['GET'])
+@jwt_required()
+@read_only
+def market():
+    """
+    Traded-volume analytics per region and period.
+    Query parameters: region, start and end (YYYY-MM-DD, end exclusive), period (day|month|total).
+    """
+    period = request.args.get('period', 'month')
+    if period not in PERIODS:
+        return jsonify({"msg": f"Invalid period. Must be one of: {', '.join(PERIODS)}."}), 400
+    try:
+        start = date.fromisoformat(request.args['start']) if request.args.get('start') else None
+        end = date.fromisoformat(request.args['end']) if request.args.get('end') else None
+    except ValueError as ve:
+        return jsonify({"msg": f"Date format error: {str(ve)}"}), 400
+    region = request.args.get('region')
+    return jsonify({
+        'region': region,
+        'period': period,
+        'intensity_bands': INTENSITY_BANDS,
+        'series': market_analytics(region, start, end, period),
+    }), 200
+
+
+@click.command('rebuild-analytics')
+@with_appcontext
+def rebuild_analytics_command():
+    """Recompute the trade analytics counters from the full trade history."""
+    rows = rebuild_trade_analytics()
+    click.echo(f"Rebuilt trade analytics: {rows} row(s).")
@@ -0,0 +1,26 @@
+"""
+Command group for the app's `flask` CLI commands that imports each command only
+when it is invoked (or listed by --help), so starting a web worker does not pay for
+the modules the commands pull in.
+"""
+from flask.cli import AppGroup
+from werkzeug.utils import import_string
+
+
+class LazyAppGroup(AppGroup):
+    """AppGroup whose commands can be registered as 'module:attribute' import paths."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lazy_commands = {}
+
+    def add_lazy_command(self, name, import_path):
+        self._lazy_commands[name] = import_path
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self._lazy_commands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in self._lazy_commands and cmd_name not in self.commands:
+            self.add_command(import_string(self._lazy_commands[cmd_name]), cmd_name)
+        return super().get_command(ctx, cmd_name)
@@ -0,0 +1,83 @@
+"""
+Running totals kept in ordinary tables (credit balances, trade analytics, ...).
+
+increment() adds deltas to counter rows with one INSERT ... ON CONFLICT DO UPDATE
+statement executed for all rows, so totals are maintained in the writing transaction
+without reading them first and concurrent writers never lose an update.
+
+Counters kept from session hooks (positions, platform statistics) need the values a
+changed instance had in the database; committed_values() reads them from the
+attribute history, falling back to one query for instances overwritten unloaded.
+"""
+from sqlalchemy import inspect, select
+
+from . import db
+
+
+def _dialect_insert(table):
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+
+def increment(model, rows, keys, connection=None):
+    """
+    Adds rows of deltas to the counters of model.
+
+    Args:
+        model: Mapped class whose primary key (or a unique constraint) is `keys`.
+        rows (list[dict]): Key values plus the deltas of the counter columns to add; keys must be
+            distinct, as PostgreSQL rejects a statement that updates one row twice.
+        keys (tuple[str]): Names of the key columns; every other column in the rows is summed.
+        connection (Connection, optional): Execute on this connection instead of the session.
+    """
+    if not rows:
+        return
+    table = model.__table__
+    stmt = _dialect_insert(table)
+    counters = [name for name in rows[0] if name not in keys]
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c[name] for name in keys],
+        set_={name: table.c[name] + stmt.excluded[name] for name in counters},
+    )
+    (connection or db.session).execute(stmt, rows)
+
+
+def insert_missing(model, rows, keys, connection=None):
+    """Inserts the rows whose keys are not present yet (INSERT ... ON CONFLICT DO NOTHING)."""
+    if not rows:
+        return
+    table = model.__table__
+    stmt = _dialect_insert(table).on_conflict_do_nothing(index_elements=[table.c[name] for name in keys])
+    (connection or db.session).execute(stmt, rows)
+
+
+def committed_values(model, instances, fields):
+    """
+    The database values of fields for changed (or deleted) instances, before the pending flush.
+
+    Returns:
+        dict: Primary key -> tuple of the values of fields.
+    """
+    values, unknown = {}, []
+    for instance in instances:
+        state = inspect(instance)
+        committed = []
+        for name in fields:
+            history = state.attrs[name].history
+            if history.deleted:
+                committed.append(history.deleted[0])
+            elif history.added: # Overwritten before the old value was loaded
+                unknown.append(state.identity[0])
+                break
+            else:
+                committed.append(getattr(instance, name))
+        else:
+            values[state.identity[0]] = tuple(committed)
+    if unknown:
+        key = model.__mapper__.primary_key[0]
+        for row in db.session.execute(select(key, *(getattr(model, name) for name in fields)).where(key.in_(unknown))):
+            values[row[0]] = tuple(row[1:])
+    return values
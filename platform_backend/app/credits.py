@@ -0,0 +1,465 @@
+"""
+Environmental credit registry (RECs, GOs, carbon and LCFS credits).
+
+Every credit is one row in environmental_credits, but the registry works on lots:
+issuance writes a whole lot with chunked multi-row INSERTs, and transfer, retirement
+and bundling select an owner's credits first-in first-out (or by serial number) and
+move them with chunked bulk UPDATEs. No ORM objects are loaded per credit.
+
+Each operation is recorded as one CreditTransaction per lot and applied to the
+CreditBalance running totals (owner, type, vintage, status) in the same transaction,
+through app/counters.py, so a balance query reads a handful of rows however many
+credits an owner holds.
+
+Credits are bundled with a trade by its seller: they are set aside ('bundled') and
+delivered to the buyer when the settlement batch marks the trade completed, or
+returned to the seller if it fails (settle_bundled_credits, app/settlement.py).
+
+The functions below never commit; callers commit or roll back the whole operation.
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from flask import Blueprint, jsonify, request
+from flask_jwt_extended import get_jwt_identity, jwt_required
+from sqlalchemy import Integer, insert, literal, select, update
+
+from . import db
+from .counters import increment
+from .db_routing import read_only
+from .idempotency import idempotent
+from .models import CreditBalance, CreditTransaction, EnvironmentalCredit, Trade, User
+
+bp = Blueprint('credits', __name__)
+logger = logging.getLogger(__name__)
+
+# Credit types of data_models.md and their default unit of measure.
+CREDIT_TYPES = {
+    'REC': 'MWh',
+    'GO': 'MWh',
+    'CarbonCredit_Avoidance': 'tCO2e',
+    'CarbonCredit_Removal': 'tCO2e',
+    'LowCarbonFuelStandard_Credit': 'tCO2e',
+}
+MAX_ISSUANCE_COUNT = 1_000_000
+MAX_LISTED_CREDITS = 1000
+# Rows per multi-row INSERT and ids per bulk UPDATE (kept well below SQLite's bound parameter limit).
+INSERT_CHUNK_SIZE = 5000
+UPDATE_CHUNK_SIZE = 10000
+
+
+class CreditRegistryError(ValueError):
+    """An operation the registry refuses (unknown type, not enough credits, ...)."""
+
+    status_code = 400
+
+
+class CreditConflict(CreditRegistryError):
+    """Selected credits were moved by a concurrent operation before this one updated them."""
+
+    status_code = 409
+
+
+def _chunks(values, size):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _apply_balance_deltas(deltas):
+    """Adds {(owner_id, credit_type, vintage, status): [count, quantity]} to the running totals."""
+    increment(CreditBalance, [
+        {'owner_id': owner_id, 'credit_type': credit_type, 'vintage': vintage, 'status': status,
+         'credit_count': count, 'quantity': quantity}
+        for (owner_id, credit_type, vintage, status), (count, quantity) in deltas.items()
+        if count or quantity
+    ], keys=('owner_id', 'credit_type', 'vintage', 'status'))
+
+
+def _log(action, credit_type, vintage, count, quantity, from_user_id=None, to_user_id=None, trade_id=None, now=None):
+    transaction = CreditTransaction(
+        action=action, credit_type=credit_type, vintage=vintage, credit_count=count, quantity=quantity,
+        from_user_id=from_user_id, to_user_id=to_user_id, trade_id=trade_id, created_at=now or datetime.utcnow(),
+    )
+    db.session.add(transaction)
+    return transaction
+
+
+def issue_credits(issuer_id, owner_id, credit_type, vintage, count, quantity=Decimal('1'), unit_of_measure=None,
+                  hydrogen_product_id=None, region=None, project_id_reference=None, expiry_date=None):
+    """
+    Issues a lot of `count` credits of `quantity` each to owner_id.
+
+    Serial numbers are '{credit_type}-{vintage}-{transaction id}-{n}'. Returns the
+    issuance CreditTransaction.
+    """
+    if credit_type not in CREDIT_TYPES:
+        raise CreditRegistryError(f"Unknown credit_type '{credit_type}'. Must be one of: {', '.join(CREDIT_TYPES)}.")
+    if not 0 < count <= MAX_ISSUANCE_COUNT:
+        raise CreditRegistryError(f"count must be between 1 and {MAX_ISSUANCE_COUNT}.")
+    if quantity <= 0:
+        raise CreditRegistryError("quantity must be positive.")
+
+    now = datetime.utcnow()
+    transaction = _log('issue', credit_type, vintage, count, quantity * count, to_user_id=owner_id, now=now)
+    db.session.flush()
+    prefix = f"{credit_type}-{vintage}-{transaction.id:08d}"
+    common = {
+        'issuing_organization_id': issuer_id,
+        'hydrogen_product_id': hydrogen_product_id,
+        'credit_type': credit_type,
+        'vintage': vintage,
+        'quantity': quantity,
+        'unit_of_measure': unit_of_measure or CREDIT_TYPES[credit_type],
+        'owner_id': owner_id,
+        'status': 'active',
+        'issuance_date': now,
+        'expiry_date': expiry_date,
+        'region': region,
+        'project_id_reference': project_id_reference,
+        'issuance_transaction_id': transaction.id,
+    }
+    for start in range(0, count, INSERT_CHUNK_SIZE):
+        db.session.execute(insert(EnvironmentalCredit), [
+            dict(common, credit_id=f"{prefix}-{n:06d}") for n in range(start + 1, min(start + INSERT_CHUNK_SIZE, count) + 1)
+        ])
+    _apply_balance_deltas({(owner_id, credit_type, vintage, 'active'): [count, quantity * count]})
+    logger.info(f"Issued {count} {credit_type} credit(s) of vintage {vintage} to user {owner_id} (transaction {transaction.id}).")
+    return transaction
+
+
+def _select_credits(owner_id, status, new_owner_id, credit_type=None, vintage=None, count=None, credit_ids=None):
+    """
+    Locks and returns the credits an operation applies to: `count` of the owner's credits
+    of one type (and optionally vintage), oldest first, or the given serial numbers.
+    """
+    columns = (
+        EnvironmentalCredit.id, EnvironmentalCredit.owner_id, EnvironmentalCredit.credit_type,
+        EnvironmentalCredit.vintage, EnvironmentalCredit.quantity, EnvironmentalCredit.status,
+        literal(new_owner_id, Integer).label('new_owner_id'),
+    )
+    base = select(*columns).where(EnvironmentalCredit.owner_id == owner_id, EnvironmentalCredit.status == status)
+    if credit_ids:
+        credit_ids = list(dict.fromkeys(credit_ids))
+        rows = []
+        for chunk in _chunks(credit_ids, UPDATE_CHUNK_SIZE):
+            rows.extend(db.session.execute(
+                base.where(EnvironmentalCredit.credit_id.in_(chunk)).with_for_update()
+            ).all())
+        if len(rows) != len(credit_ids):
+            raise CreditRegistryError(f"{len(credit_ids) - len(rows)} of the given credit(s) are not {status} credits you own.")
+        return rows
+
+    if credit_type not in CREDIT_TYPES:
+        raise CreditRegistryError("Provide credit_ids, or a valid credit_type and a count.")
+    if not count or count <= 0:
+        raise CreditRegistryError("count must be a positive integer.")
+    stmt = base.where(EnvironmentalCredit.credit_type == credit_type)
+    if vintage is not None:
+        stmt = stmt.where(EnvironmentalCredit.vintage == vintage)
+    rows = db.session.execute(stmt.order_by(EnvironmentalCredit.id).limit(count).with_for_update()).all()
+    if len(rows) < count:
+        raise CreditRegistryError(
+            f"Only {len(rows)} {status} {credit_type} credit(s){f' of vintage {vintage}' if vintage is not None else ''} available."
+        )
+    return rows
+
+
+def _update_credits(ids, expected_status, expected_owner_id=None, **values):
+    """
+    Moves the selected credits, only where they still have the status (and owner) they
+    were selected with: with_for_update() is ignored on SQLite, so a concurrent operation
+    may have moved some of them in between. Raises CreditConflict if so; the caller rolls
+    back the whole operation and the client may retry it.
+    """
+    updated = 0
+    for chunk in _chunks(ids, UPDATE_CHUNK_SIZE):
+        stmt = update(EnvironmentalCredit).where(EnvironmentalCredit.id.in_(chunk),
+                                                 EnvironmentalCredit.status == expected_status)
+        if expected_owner_id is not None:
+            stmt = stmt.where(EnvironmentalCredit.owner_id == expected_owner_id)
+        updated += db.session.execute(
+            stmt.values(**values).execution_options(synchronize_session=False)
+        ).rowcount
+    if updated != len(ids):
+        raise CreditConflict(
+            f"{len(ids) - updated} of the selected credit(s) were changed by another operation. Retry."
+        )
+
+
+def _book(rows, action, to_status, trade_id=None):
+    """Applies moved credits to the balances and logs one transaction per lot; returns the transactions."""
+    now = datetime.utcnow()
+    deltas = defaultdict(lambda: [0, Decimal(0)])
+    lots = defaultdict(lambda: [0, Decimal(0)])
+    for row in rows:
+        new_owner_id = row.new_owner_id if row.new_owner_id is not None else row.owner_id
+        for key, sign in (((row.owner_id, row.credit_type, row.vintage, row.status), -1),
+                          ((new_owner_id, row.credit_type, row.vintage, to_status), 1)):
+            deltas[key][0] += sign
+            deltas[key][1] += sign * row.quantity
+        lot = lots[(row.owner_id, new_owner_id, row.credit_type, row.vintage, getattr(row, 'trade_id', trade_id))]
+        lot[0] += 1
+        lot[1] += row.quantity
+    _apply_balance_deltas(deltas)
+    return [
+        _log(action, credit_type, vintage, count, quantity, from_user_id=from_user_id, to_user_id=to_user_id,
+             trade_id=lot_trade_id, now=now)
+        for (from_user_id, to_user_id, credit_type, vintage, lot_trade_id), (count, quantity) in lots.items()
+    ]
+
+
+def transfer_credits(owner_id, to_owner_id, credit_type=None, vintage=None, count=None, credit_ids=None):
+    """Transfers active credits to another account; returns the CreditTransactions."""
+    if to_owner_id == owner_id:
+        raise CreditRegistryError("Cannot transfer credits to yourself.")
+    rows = _select_credits(owner_id, 'active', to_owner_id, credit_type, vintage, count, credit_ids)
+    _update_credits([row.id for row in rows], 'active', owner_id, owner_id=to_owner_id)
+    return _book(rows, 'transfer', 'active')
+
+
+def retire_credits(owner_id, beneficiary_id=None, credit_type=None, vintage=None, count=None, credit_ids=None):
+    """Retires active credits on behalf of beneficiary_id (the owner by default); returns the CreditTransactions."""
+    rows = _select_credits(owner_id, 'active', None, credit_type, vintage, count, credit_ids)
+    _update_credits([row.id for row in rows], 'active', owner_id, status='retired',
+                    beneficiary_id=beneficiary_id or owner_id, retirement_date=datetime.utcnow())
+    return _book(rows, 'retire', 'retired')
+
+
+def bundle_credits(trade, seller_id, credit_type=None, vintage=None, count=None, credit_ids=None):
+    """Sets the seller's active credits aside for delivery with a pending trade; returns the CreditTransactions."""
+    if trade.seller_id != seller_id:
+        raise CreditRegistryError("Only the seller of a trade can bundle credits with it.")
+    if trade.settlement_status != 'pending':
+        raise CreditRegistryError(f"Cannot bundle credits with a trade whose settlement is '{trade.settlement_status}'.")
+    rows = _select_credits(seller_id, 'active', None, credit_type, vintage, count, credit_ids)
+    _update_credits([row.id for row in rows], 'active', seller_id, status='bundled', trade_id=trade.id)
+    return _book(rows, 'bundle', 'bundled', trade_id=trade.id)
+
+
+def settle_bundled_credits(completed_trade_ids, failed_trade_ids=()):
+    """
+    Delivers the credits bundled with completed trades to their buyers and returns those
+    bundled with failed trades to the seller. Returns the number of credits moved.
+    """
+    moved = 0
+    for trade_ids, action in ((list(completed_trade_ids), 'settle'), (list(failed_trade_ids), 'unbundle')):
+        for chunk in _chunks(trade_ids, UPDATE_CHUNK_SIZE):
+            new_owner = Trade.buyer_id if action == 'settle' else EnvironmentalCredit.owner_id
+            rows = db.session.execute(
+                select(EnvironmentalCredit.id, EnvironmentalCredit.owner_id, EnvironmentalCredit.credit_type,
+                       EnvironmentalCredit.vintage, EnvironmentalCredit.quantity, EnvironmentalCredit.status,
+                       EnvironmentalCredit.trade_id, new_owner.label('new_owner_id'))
+                .join(Trade, Trade.id == EnvironmentalCredit.trade_id)
+                .where(EnvironmentalCredit.trade_id.in_(chunk), EnvironmentalCredit.status == 'bundled')
+                .with_for_update()
+            ).all()
+            if not rows:
+                continue
+            if action == 'settle':
+                # The trade_id stays on delivered credits as their provenance
+                buyer = select(Trade.buyer_id).where(Trade.id == EnvironmentalCredit.trade_id).scalar_subquery()
+                _update_credits([row.id for row in rows], 'bundled', owner_id=buyer, status='active')
+            else:
+                _update_credits([row.id for row in rows], 'bundled', status='active', trade_id=None)
+            _book(rows, action, 'active')
+            moved += len(rows)
+    return moved
+
+
+def get_balances(owner_id):
+    """An owner's running totals per credit type and vintage, keyed by status."""
+    rows = db.session.execute(
+        select(CreditBalance.credit_type, CreditBalance.vintage, CreditBalance.status,
+               CreditBalance.credit_count, CreditBalance.quantity)
+        .where(CreditBalance.owner_id == owner_id, CreditBalance.credit_count != 0)
+        .order_by(CreditBalance.credit_type, CreditBalance.vintage)
+    ).all()
+    balances = {}
+    for credit_type, vintage, status, count, quantity in rows:
+        balance = balances.setdefault((credit_type, vintage), {
+            'credit_type': credit_type, 'vintage': vintage, 'unit_of_measure': CREDIT_TYPES.get(credit_type),
+        })
+        balance[status] = {'count': count, 'quantity': str(quantity)}
+    return list(balances.values())
+
+
+# Registry Endpoints
+
+def get_current_user():
+    """Helper function to get the current authenticated user."""
+    user_identity = get_jwt_identity()
+    username = user_identity.get('username')
+    return User.query.filter_by(username=username).first()
+
+
+def _is_admin():
+    return 'admin' in get_jwt_identity().get('roles', [])
+
+
+def _selection(data):
+    """The credit selection of a transfer, retire or bundle request."""
+    credit_ids = data.get('credit_ids')
+    if credit_ids is not None and (not isinstance(credit_ids, list) or not all(isinstance(c, str) for c in credit_ids)):
+        raise CreditRegistryError("credit_ids must be a list of credit serial numbers.")
+    try:
+        count = int(data['count']) if data.get('count') is not None else None
+        vintage = int(data['vintage']) if data.get('vintage') is not None else None
+    except (TypeError, ValueError):
+        raise CreditRegistryError("count and vintage must be integers.")
+    return {'credit_type': data.get('credit_type'), 'vintage': vintage, 'count': count, 'credit_ids': credit_ids}
+
+
+def _commit_transactions(transactions):
+    db.session.commit()
+    return jsonify({"transactions": [transaction.to_dict() for transaction in transactions]}), 200
+
+
+@bp.route('/issue', methods=['POST'])
+@jwt_required()
+@idempotent
+def issue():
+    """Issue a lot of credits to an account (admin only; the registry acts as issuing body)."""
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({"msg": "User not found or token invalid"}), 401
+    if not _is_admin():
+        return jsonify({"msg": "Admin access required to issue credits."}), 403
+
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({"msg": "Missing JSON in request"}), 400
+    for field in ('owner_id', 'credit_type', 'vintage', 'count'):
+        if data.get(field) is None:
+            return jsonify({"msg": f"Missing required field: {field}"}), 400
+
+    try:
+        owner_id, vintage, count = int(data['owner_id']), int(data['vintage']), int(data['count'])
+        if not db.session.get(User, owner_id):
+            return jsonify({"msg": f"User with id {owner_id} not found."}), 404
+        transaction = issue_credits(
+            current_user.id, owner_id, data['credit_type'], vintage, count,
+            quantity=Decimal(str(data.get('quantity', '1'))),
+            unit_of_measure=data.get('unit_of_measure'),
+            hydrogen_product_id=data.get('hydrogen_product_id'),
+            region=data.get('region'),
+            project_id_reference=data.get('project_id_reference'),
+            expiry_date=datetime.fromisoformat(data['expiry_date']) if data.get('expiry_date') else None,
+        )
+        db.session.commit()
+    except CreditRegistryError as e:
+        db.session.rollback()
+        return jsonify({"msg": str(e)}), e.status_code
+    except (InvalidOperation, TypeError, ValueError):
+        db.session.rollback()
+        return jsonify({"msg": "Invalid owner_id, vintage, count, quantity or expiry_date."}), 400
+    prefix = f"{transaction.credit_type}-{transaction.vintage}-{transaction.id:08d}"
+    return jsonify({
+        "transaction": transaction.to_dict(),
+        "first_credit_id": f"{prefix}-{1:06d}",
+        "last_credit_id": f"{prefix}-{transaction.credit_count:06d}",
+    }), 201
+
+
+@bp.route('/transfer', methods=['POST'])
+@jwt_required()
+@idempotent
+def transfer():
+    """Transfer active credits to another account, by count (oldest first) or serial number."""
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({"msg": "User not found or token invalid"}), 401
+    data = request.get_json(silent=True)
+    if not data or data.get('to_user_id') is None:
+        return jsonify({"msg": "Missing required field: to_user_id"}), 400
+    if not isinstance(data['to_user_id'], int) or not db.session.get(User, data['to_user_id']):
+        return jsonify({"msg": f"User with id {data['to_user_id']} not found."}), 404
+    try:
+        transactions = transfer_credits(current_user.id, data['to_user_id'], **_selection(data))
+    except CreditRegistryError as e:
+        db.session.rollback()
+        return jsonify({"msg": str(e)}), e.status_code
+    return _commit_transactions(transactions)
+
+
+@bp.route('/retire', methods=['POST'])
+@jwt_required()
+@idempotent
+def retire():
+    """Retire active credits, optionally on behalf of a beneficiary."""
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({"msg": "User not found or token invalid"}), 401
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({"msg": "Missing JSON in request"}), 400
+    beneficiary_id = data.get('beneficiary_id')
+    if beneficiary_id is not None and (not isinstance(beneficiary_id, int) or not db.session.get(User, beneficiary_id)):
+        return jsonify({"msg": f"User with id {beneficiary_id} not found."}), 404
+    try:
+        transactions = retire_credits(current_user.id, beneficiary_id, **_selection(data))
+    except CreditRegistryError as e:
+        db.session.rollback()
+        return jsonify({"msg": str(e)}), e.status_code
+    return _commit_transactions(transactions)
+
+
+@bp.route('/bundle', methods=['POST'])
+@jwt_required()
+@idempotent
+def bundle():
+    """Bundle active credits with one of your pending trades; they reach the buyer on settlement."""
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({"msg": "User not found or token invalid"}), 401
+    data = request.get_json(silent=True)
+    if not data or data.get('trade_id') is None:
+        return jsonify({"msg": "Missing required field: trade_id"}), 400
+    trade = db.session.get(Trade, data['trade_id'], with_for_update=True) if isinstance(data['trade_id'], int) else None
+    if not trade:
+        return jsonify({"msg": "Trade not found"}), 404
+    try:
+        transactions = bundle_credits(trade, current_user.id, **_selection(data))
+    except CreditRegistryError as e:
+        db.session.rollback()
+        return jsonify({"msg": str(e)}), e.status_code
+    return _commit_transactions(transactions)
+
+
+@bp.route('/balances', methods=['GET'])
+@jwt_required()
+@read_only
+def balances():
+    """Credit balances of the authenticated user (admins may pass ?owner_id=)."""
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({"msg": "User not found or token invalid"}), 401
+    owner_id = request.args.get('owner_id', type=int) or current_user.id
+    if owner_id != current_user.id and not _is_admin():
+        return jsonify({"msg": "Not authorized to view another account's balances"}), 403
+    return jsonify({"owner_id": owner_id, "balances": get_balances(owner_id)}), 200
+
+
+@bp.route('', methods=['GET'])
+@jwt_required()
+@read_only
+def list_credits():
+    """
+    List the authenticated user's credits, filtered by credit_type, vintage and status,
+    in pages of `limit` (max 1000) continuing after `after_id`.
+    """
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({"msg": "User not found or token invalid"}), 401
+    limit = max(1, min(request.args.get('limit', 100, type=int), MAX_LISTED_CREDITS))
+    query = EnvironmentalCredit.query.filter_by(owner_id=current_user.id)
+    for field in ('credit_type', 'status'):
+        if request.args.get(field):
+            query = query.filter(getattr(EnvironmentalCredit, field) == request.args[field])
+    if request.args.get('vintage', type=int) is not None:
+        query = query.filter(EnvironmentalCredit.vintage == request.args.get('vintage', type=int))
+    if request.args.get('after_id', type=int) is not None:
+        query = query.filter(EnvironmentalCredit.id > request.args.get('after_id', type=int))
+    credits = query.order_by(EnvironmentalCredit.id).limit(limit).all()
+    return jsonify([credit.to_dict() for credit in credits]), 200
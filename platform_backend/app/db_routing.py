@@ -0,0 +1,144 @@
+"""
+Read-replica routing for db.session.
+
+Views decorated with @read_only send their queries to the 'replica' bind (when one
+is configured); everything else, including the matching engine, uses the primary.
+A client that committed a write within DB_REPLICA_MAX_LAG_SECONDS is kept on the
+primary so it always reads its own writes.
+
+The response to a request that committed a write carries a last-write marker (the
+commit's wall-clock time) in the X-Last-Write header and the ghx_last_write cookie.
+Browsers send the cookie back on their own, and API clients can echo the header. Any
+worker then serves the client's reads from the primary until the marker is older
+than the lag window. Markers further than that from the worker's clock are ignored,
+so a forged one cannot pin a client to the primary. Clients that send neither back
+fall back to a per-username record of the last write. That record is a dict in this
+process, so it only covers reads served by the worker that took the write.
+"""
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+REPLICA_BIND_KEY = 'replica'
+DEFAULT_REPLICA_MAX_LAG_SECONDS = 5.0
+LAST_WRITE_HEADER = 'X-Last-Write'
+LAST_WRITE_COOKIE = 'ghx_last_write'
+
+# username -> time.monotonic() of the user's last committed write. Per process only: with
+# several workers, the client's last-write marker is what keeps its reads on the primary.
+_last_write = {}
+_last_write_lock = threading.Lock()
+
+
+class RoutingSession(Session):
+    """Session that routes reads from @read_only views to the replica bind."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self._use_replica():
+            return self._db.engines[REPLICA_BIND_KEY]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _use_replica(self):
+        if not has_request_context() or not g.get('db_read_only'):
+            return False
+        if self._flushing or self.new or self.dirty or self.deleted:
+            return False # Writes always go to the primary
+        return REPLICA_BIND_KEY in self._db.engines
+
+
+def _current_username():
+    """Username of the JWT identity on this request, if any (never raises)."""
+    try:
+        verify_jwt_in_request(optional=True)
+        identity = get_jwt_identity()
+    except Exception:
+        return None
+    return identity.get('username') if isinstance(identity, dict) else None
+
+
+def _max_lag():
+    return current_app.config.get('DB_REPLICA_MAX_LAG_SECONDS', DEFAULT_REPLICA_MAX_LAG_SECONDS)
+
+
+def recently_wrote(username):
+    """True if the user committed a write within the configured replica lag window."""
+    if username is None:
+        return False
+    with _last_write_lock:
+        last = _last_write.get(username)
+    return last is not None and time.monotonic() - last < _max_lag()
+
+
+def client_recently_wrote():
+    """True if the request carries a last-write marker within the replica lag window."""
+    marker = request.headers.get(LAST_WRITE_HEADER) or request.cookies.get(LAST_WRITE_COOKIE)
+    try:
+        written = float(marker)
+    except (TypeError, ValueError):
+        return False
+    return abs(time.time() - written) < _max_lag()
+
+
+def attach_write_marker(response):
+    """after_request hook: hands the client the marker of the write its request committed."""
+    written = g.get('db_last_write')
+    if written is not None:
+        marker = f"{written:.6f}"
+        response.headers[LAST_WRITE_HEADER] = marker
+        response.set_cookie(LAST_WRITE_COOKIE, marker, max_age=max(1, int(_max_lag() + 0.5)),
+                            httponly=True, samesite='Lax')
+    return response
+
+
+def record_write(username):
+    """Remembers that the user just committed a write, pruning expired entries."""
+    now = time.monotonic()
+    max_lag = _max_lag()
+    with _last_write_lock:
+        _last_write[username] = now
+        if len(_last_write) > 10000:
+            for name, last in list(_last_write.items()):
+                if now - last >= max_lag:
+                    del _last_write[name]
+
+
+def read_only(view):
+    """Marks a view as read-only so its queries may be served by the replica."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = not (client_recently_wrote() or recently_wrote(_current_username()))
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_session_wrote(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _mark_bulk_write(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _clear_session_wrote(session):
+    if session.in_nested_transaction(): # Only a savepoint: the outer transaction still wrote
+        return
+    session.info.pop('wrote', None)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _track_committed_write(session):
+    if not session.info.pop('wrote', False) or not has_request_context():
+        return
+    g.db_last_write = time.time()
+    username = _current_username()
+    if username is not None:
+        record_write(username)
@@ -0,0 +1,270 @@
+"""
+Streaming bulk export of trade and order history.
+
+Rows are read as plain column tuples from a server-side cursor (`yield_per`) and
+serialized chunk by chunk, so memory stays constant regardless of how many rows
+are exported. CSV and NDJSON are always available; Parquet requires pyarrow.
+"""
+import csv
+import io
+import json
+import sys
+from datetime import date, datetime
+from decimal import Decimal
+
+import click
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from flask.cli import with_appcontext
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from sqlalchemy import select
+
+from .models import User, Trade, Order, db
+from .db_routing import read_only
+
+bp = Blueprint('exports', __name__)
+
+# Rows fetched from the cursor and serialized per chunk.
+EXPORT_CHUNK_SIZE = 5000
+
+EXPORT_COLUMNS = {
+    'trades': [
+        Trade.id, Trade.trade_timestamp, Trade.hydrogen_product_id, Trade.buy_order_id,
+        Trade.sell_order_id, Trade.buyer_id, Trade.seller_id, Trade.quantity_traded_kg,
+        Trade.price_per_kg_agreed, Trade.settlement_status,
+    ],
+    'orders': [
+        Order.id, Order.created_timestamp, Order.hydrogen_product_id, Order.user_id,
+        Order.order_type, Order.quantity_kg, Order.price_per_kg, Order.status,
+        Order.updated_timestamp, Order.expiration_timestamp,
+    ],
+}
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def get_current_user():
+    """Helper function to get the current authenticated user."""
+    user_identity = get_jwt_identity()
+    username = user_identity.get('username')
+    return User.query.filter_by(username=username).first()
+
+
+def build_export_query(kind, user_id=None, start=None, end=None, product_id=None):
+    """
+    Builds the SELECT for an export.
+
+    Args:
+        kind (str): 'trades' or 'orders'.
+        user_id (int, optional): Restrict to rows the user is party to.
+        start (datetime, optional): Inclusive lower bound on the row timestamp.
+        end (datetime, optional): Exclusive upper bound on the row timestamp.
+        product_id (int, optional): Restrict to one HydrogenProduct.
+    """
+    model = Trade if kind == 'trades' else Order
+    timestamp = Trade.trade_timestamp if kind == 'trades' else Order.created_timestamp
+
+    stmt = select(*EXPORT_COLUMNS[kind])
+    if user_id is not None:
+        if kind == 'trades':
+            stmt = stmt.where((Trade.buyer_id == user_id) | (Trade.seller_id == user_id))
+        else:
+            stmt = stmt.where(Order.user_id == user_id)
+    if start is not None:
+        stmt = stmt.where(timestamp >= start)
+    if end is not None:
+        stmt = stmt.where(timestamp < end)
+    if product_id is not None:
+        stmt = stmt.where(model.hydrogen_product_id == product_id)
+    return stmt.order_by(model.id)
+
+
+def iter_row_chunks(stmt, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yields lists of row tuples from a server-side cursor."""
+    result = db.session.execute(stmt.execution_options(yield_per=chunk_size))
+    for rows in result.partitions():
+        yield rows
+
+
+def _to_text(value):
+    if value is None:
+        return None
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def iter_csv(columns, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column.name for column in columns])
+    for rows in chunks:
+        writer.writerows([_to_text(value) for value in row] for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def iter_ndjson(columns, chunks):
+    names = [column.name for column in columns]
+    for rows in chunks:
+        yield ''.join(json.dumps(dict(zip(names, map(_to_text, row)))) + '\n' for row in rows)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object that hands written bytes back to a generator."""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def _arrow_schema(columns):
+    import pyarrow as pa
+
+    fields = []
+    for column in columns:
+        python_type = column.type.python_type
+        if python_type is int:
+            arrow_type = pa.int64()
+        elif python_type is Decimal:
+            arrow_type = pa.decimal128(column.type.precision, column.type.scale)
+        elif python_type is datetime:
+            arrow_type = pa.timestamp('us')
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(column.name, arrow_type))
+    return pa.schema(fields)
+
+
+def iter_parquet(columns, chunks, sink=None):
+    """Writes one Parquet row group per chunk; yields the encoded bytes as they are produced."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _arrow_schema(columns)
+    sink = sink or _ChunkSink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for rows in chunks:
+            arrays = [pa.array([row[i] for row in rows], type=field.type) for i, field in enumerate(schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            if isinstance(sink, _ChunkSink):
+                yield sink.drain()
+    if isinstance(sink, _ChunkSink):
+        yield sink.drain()
+
+
+def _parquet_available():
+    try:
+        import pyarrow.parquet # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+SERIALIZERS = {'csv': iter_csv, 'ndjson': iter_ndjson, 'parquet': iter_parquet}
+
+
+def _parse_datetime(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+# Export Endpoints
+
+@bp.route('/<string:kind>', methods=['GET'])
+@jwt_required()
+@read_only
+def export_history(kind):
+    """
+    Stream trade or order history as CSV, NDJSON or Parquet.
+    Admins export all rows; other users only rows they are party to.
+    Query params: format, start, end (ISO dates), product_id.
+    """
+    if kind not in EXPORT_COLUMNS:
+        return jsonify({"msg": f"Unknown export '{kind}'. Must be 'trades' or 'orders'."}), 404
+
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({"msg": "User not found or token invalid"}), 401
+
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"msg": "Invalid format. Must be 'csv', 'ndjson' or 'parquet'."}), 400
+    if export_format == 'parquet' and not _parquet_available():
+        return jsonify({"msg": "Parquet export requires pyarrow to be installed on the server."}), 400
+
+    try:
+        start = _parse_datetime(request.args.get('start'))
+        end = _parse_datetime(request.args.get('end'))
+    except ValueError as ve:
+        return jsonify({"msg": f"Date format error: {str(ve)}"}), 400
+    try:
+        product_id = int(request.args['product_id']) if request.args.get('product_id') else None
+    except ValueError:
+        return jsonify({"msg": "product_id must be an integer."}), 400
+
+    user_identity = get_jwt_identity()
+    is_admin = 'admin' in user_identity.get('roles', [])
+
+    stmt = build_export_query(kind, None if is_admin else current_user.id, start, end, product_id)
+    body = SERIALIZERS[export_format](EXPORT_COLUMNS[kind], iter_row_chunks(stmt))
+    return Response(
+        stream_with_context(body),
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={'Content-Disposition': f'attachment; filename={kind}.{export_format}'},
+    )
+
+
+@click.command('export')
+@click.argument('kind', type=click.Choice(sorted(EXPORT_COLUMNS)))
+@click.option('--format', 'export_format', type=click.Choice(sorted(EXPORT_FORMATS)), default='csv', show_default=True)
+@click.option('--start', type=click.DateTime(), default=None, help='Inclusive start of the export window.')
+@click.option('--end', type=click.DateTime(), default=None, help='Exclusive end of the export window.')
+@click.option('--product-id', type=int, default=None)
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), default=None, help='Output file (defaults to stdout; required for parquet).')
+@click.option('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, show_default=True)
+@with_appcontext
+def export_command(kind, export_format, start, end, product_id, output, chunk_size):
+    """Export full trade or order history."""
+    if export_format == 'parquet' and not output:
+        raise click.UsageError('--output is required for parquet exports.')
+    if export_format == 'parquet' and not _parquet_available():
+        raise click.UsageError('Parquet export requires pyarrow.')
+
+    columns = EXPORT_COLUMNS[kind]
+    chunks = iter_row_chunks(build_export_query(kind, None, start, end, product_id), chunk_size)
+
+    if export_format == 'parquet':
+        with open(output, 'wb') as fh:
+            for _ in iter_parquet(columns, chunks, sink=fh):
+                pass
+        return
+
+    fh = open(output, 'w', newline='') if output else sys.stdout
+    try:
+        for part in SERIALIZERS[export_format](columns, chunks):
+            fh.write(part)
+    finally:
+        if output:
+            fh.close()
@@ -0,0 +1,313 @@
+"""
+Pre-trade credit limits, checked against in-memory open-order exposure.
+
+An account's exposure is the notional of its open (pending or partially filled)
+orders, both sides: remaining quantity * limit price. Order entry
+checks every new order, and every amendment that raises an order's notional,
+against the account's limits (a CreditLimit row, or the CREDIT_MAX_OPEN_NOTIONAL /
+CREDIT_MAX_ORDER_NOTIONAL defaults): the order's own notional against
+max_order_notional, and the exposure it brings the account to against
+max_open_notional.
+
+The open-order notional is tracked in one place: the Position counters of
+app/positions.py (open_buy_notional + open_sell_notional, per user and product).
+Criteria buys, which name no listing and so have no Position row, are summed from
+the orders table. Summing with SQL on every order would still cost queries per
+order, so ExposureLedger caches each account's total in memory per application
+process, like the inventory ledger:
+  * An account is loaded with one query over its Position rows, one over its open
+    criteria buys and one for its limits, the first time it places or amends an order.
+  * The positions hook hands the open-notional deltas of every flush to
+    record_exposure_changes(); they are added to the cached totals when the
+    transaction commits (dropped on rollback), whichever code path changed the orders.
+  * create_order and update_order reserve the notional an order adds under the
+    ledger's lock, which is where the limits are checked. The reservation is held
+    until the transaction ends, when the committed deltas take its place.
+
+The totals are exact for a single order-entry process. A background thread
+reconciles the loaded accounts with their Position rows every
+CREDIT_RECONCILE_INTERVAL_SECONDS (default 300), without holding the lock, and
+keeps the in-memory value of any account or limit that changed during the read. It
+logs and corrects any drift, such as orders committed by another process or limits
+edited elsewhere. Changes made behind the Position counters too are repaired by
+`flask rebuild-positions`.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from decimal import Decimal
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, select
+
+from . import db
+from .db_routing import RoutingSession
+from .inventory import OPEN_ORDER_STATUSES
+from .models import CreditLimit, Order, Position
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RECONCILE_INTERVAL_SECONDS = 300.0
+RECONCILE_CHUNK_SIZE = 500 # Accounts per IN (...) query
+
+
+class CreditLimitExceeded(Exception):
+    """Raised when an order would take its account over its order or open notional limit."""
+
+    def __init__(self, user_id, limit_name, limit, notional):
+        subject = 'Order notional' if limit_name == 'max_order_notional' else 'Open order notional'
+        super().__init__(f"{subject} ({notional:f}) would exceed the account's credit limit ({limit:f}).")
+        self.user_id = user_id
+        self.limit_name = limit_name
+        self.limit = limit
+        self.notional = notional
+
+
+def _optional_decimal(value):
+    return Decimal(str(value)) if value is not None else None
+
+
+class _Account:
+    __slots__ = ('exposure', 'reserved', 'max_open_notional', 'max_order_notional')
+
+    def __init__(self, exposure, max_open_notional, max_order_notional):
+        self.exposure = exposure # Committed open-order notional, as in the account's Position rows
+        self.reserved = Decimal('0') # Notional added by transactions not yet ended
+        self.max_open_notional = max_open_notional
+        self.max_order_notional = max_order_notional
+
+
+class ExposureLedger:
+    """In-memory open-order exposure and limits per account for one application (see module docstring)."""
+
+    def __init__(self, app):
+        self.app = app
+        self.default_limits = (_optional_decimal(app.config.get('CREDIT_MAX_OPEN_NOTIONAL')),
+                               _optional_decimal(app.config.get('CREDIT_MAX_ORDER_NOTIONAL')))
+        self.reconcile_interval = app.config.get('CREDIT_RECONCILE_INTERVAL_SECONDS', DEFAULT_RECONCILE_INTERVAL_SECONDS)
+        self._lock = threading.Lock()
+        self._reconcile_lock = threading.Lock()
+        self._accounts = {} # user_id -> _Account
+        # Account ids whose exposure or limits changed while a reconciliation reads the database (None otherwise)
+        self._touched_exposure = None
+        self._touched_limits = None
+        self._reconciler = None
+
+    # --- Loading ---
+
+    def _read(self, execute, user_ids):
+        """Open-order notional (user_id -> Decimal) and limits (user_id -> tuple) of accounts, from the database."""
+        exposures, limits = {}, {}
+        for start in range(0, len(user_ids), RECONCILE_CHUNK_SIZE):
+            chunk = user_ids[start:start + RECONCILE_CHUNK_SIZE]
+            for user_id, notional in execute(
+                select(Position.user_id, func.sum(Position.open_buy_notional + Position.open_sell_notional))
+                .where(Position.user_id.in_(chunk)).group_by(Position.user_id)
+            ):
+                exposures[user_id] = Decimal(notional or 0)
+            for user_id, notional in execute(
+                select(Order.user_id, func.sum(Order.quantity_kg * Order.price_per_kg)).where(
+                    Order.user_id.in_(chunk), Order.hydrogen_product_id.is_(None), Order.status.in_(OPEN_ORDER_STATUSES)
+                ).group_by(Order.user_id)
+            ):
+                exposures[user_id] = exposures.get(user_id, Decimal('0')) + Decimal(notional or 0)
+            for user_id, max_open, max_order in execute(
+                select(CreditLimit.user_id, CreditLimit.max_open_notional, CreditLimit.max_order_notional).where(
+                    CreditLimit.user_id.in_(chunk)
+                )
+            ):
+                limits[user_id] = (_optional_decimal(max_open), _optional_decimal(max_order))
+        return exposures, limits
+
+    def _account(self, user_id):
+        """The account's counters, loaded from the database on first use."""
+        account = self._accounts.get(user_id)
+        if account is not None:
+            return account
+        # The queries run under the lock so no commit applied meanwhile is lost for this account.
+        # They always read the primary, like the order book mirror.
+        with self._lock:
+            account = self._accounts.get(user_id)
+            if account is not None:
+                return account
+            exposures, limits = self._read(
+                lambda statement: db.session.execute(statement, bind_arguments={'bind': db.engine}), [user_id]
+            )
+            account = self._accounts[user_id] = _Account(exposures.get(user_id, Decimal('0')),
+                                                         *limits.get(user_id, self.default_limits))
+        self._ensure_reconciler()
+        return account
+
+    def load(self, user_id):
+        """Loads an account's counters; call before an order of the account is created or modified."""
+        self._account(user_id)
+
+    # --- Order lifecycle ---
+
+    @staticmethod
+    def _check(user_id, account, notional, added):
+        """Raises CreditLimitExceeded if an order of `notional` adding `added` to the exposure breaks a limit. Lock held."""
+        if added <= 0:
+            return # Orders may always shrink, even under a limit lowered since they were placed
+        if account.max_order_notional is not None and notional > account.max_order_notional:
+            raise CreditLimitExceeded(user_id, 'max_order_notional', account.max_order_notional, notional)
+        exposure = account.exposure + account.reserved + added
+        if account.max_open_notional is not None and exposure > account.max_open_notional:
+            raise CreditLimitExceeded(user_id, 'max_open_notional', account.max_open_notional, exposure)
+
+    def check(self, user_id, notional):
+        """Checks an order that never rests (IOC/FOK) against the limits; raises CreditLimitExceeded."""
+        notional = Decimal(notional)
+        account = self._account(user_id)
+        with self._lock:
+            self._check(user_id, account, notional, notional)
+
+    def reserve(self, user_id, notional, previous=None):
+        """
+        Holds the notional a new order (or an amendment from `previous`) adds to its account
+        until the session's transaction ends; raises CreditLimitExceeded.
+        """
+        notional = Decimal(notional)
+        added = notional - Decimal(previous or 0)
+        account = self._account(user_id)
+        with self._lock:
+            self._check(user_id, account, notional, added)
+            account.reserved += added
+        db.session.info.setdefault('exposure_reserved', defaultdict(Decimal))[user_id] += added
+
+    def apply(self, changes, reserved=None):
+        """
+        Ends a transaction: adds its committed open-notional deltas (user id -> Decimal) and
+        drops its reservations (likewise), under one lock so nothing is counted twice.
+        """
+        with self._lock:
+            for user_id, delta in changes.items():
+                account = self._accounts.get(user_id)
+                if account is not None:
+                    account.exposure += delta
+                if self._touched_exposure is not None:
+                    self._touched_exposure.add(user_id)
+            for user_id, delta in (reserved or {}).items():
+                account = self._accounts.get(user_id)
+                if account is not None:
+                    account.reserved -= delta
+
+    # --- Limits and reads ---
+
+    def set_limits(self, user_id, max_open_notional, max_order_notional):
+        """Updates a loaded account's limits after its CreditLimit row was committed (None: unlimited)."""
+        with self._lock:
+            account = self._accounts.get(user_id)
+            if account is not None:
+                account.max_open_notional = _optional_decimal(max_open_notional)
+                account.max_order_notional = _optional_decimal(max_order_notional)
+            if self._touched_limits is not None:
+                self._touched_limits.add(user_id)
+
+    def clear_limits(self, user_id):
+        """Puts an account back on the default limits after its CreditLimit row was deleted."""
+        self.set_limits(user_id, *self.default_limits)
+
+    def exposure(self, user_id):
+        """The account's open-order notional and limits, as a dict of Decimals (None: unlimited)."""
+        account = self._account(user_id)
+        with self._lock:
+            return {'open_notional': account.exposure + account.reserved, 'max_open_notional': account.max_open_notional,
+                    'max_order_notional': account.max_order_notional}
+
+    def reset(self):
+        """Discards all counters (e.g. after the database was wiped)."""
+        with self._lock:
+            self._accounts.clear()
+
+    # --- Reconciliation ---
+
+    def reconcile(self):
+        """Re-reads the loaded accounts from the database and corrects any drift; returns the accounts corrected."""
+        with self._reconcile_lock:
+            with self._lock:
+                user_ids = list(self._accounts)
+                self._touched_exposure, self._touched_limits = set(), set()
+            try:
+                if user_ids:
+                    with self.app.app_context():
+                        with db.engine.connect() as connection:
+                            exposures, limits = self._read(connection.execute, user_ids)
+            finally:
+                with self._lock:
+                    touched_exposure, touched_limits = self._touched_exposure, self._touched_limits
+                    self._touched_exposure = self._touched_limits = None
+            if not user_ids:
+                return 0
+
+            corrected = 0
+            with self._lock:
+                for user_id in user_ids:
+                    account = self._accounts.get(user_id)
+                    if account is None:
+                        continue # Reset while the database was read
+                    # Accounts that changed since the read began keep their in-memory value
+                    exposure = exposures.get(user_id, Decimal('0'))
+                    exposure_drift = user_id not in touched_exposure and exposure != account.exposure
+                    limits_drift = user_id not in touched_limits and limits.get(user_id, self.default_limits) != (
+                        account.max_open_notional, account.max_order_notional)
+                    if not exposure_drift and not limits_drift:
+                        continue
+                    logger.warning(f"Credit exposure of user {user_id} drifted: held {account.exposure}, database "
+                                   f"{exposure}; exposure {'reloaded' if exposure_drift else 'unchanged'}, limits "
+                                   f"{'reloaded' if limits_drift else 'unchanged'}.")
+                    if exposure_drift:
+                        account.exposure = exposure
+                    if limits_drift:
+                        account.max_open_notional, account.max_order_notional = limits.get(user_id, self.default_limits)
+                    corrected += 1
+            logger.debug(f"Reconciled credit exposure of {len(user_ids)} account(s), {corrected} corrected.")
+            return corrected
+
+    def _ensure_reconciler(self):
+        if not self.reconcile_interval or (self._reconciler is not None and self._reconciler.is_alive()):
+            return
+        with self._lock:
+            if self._reconciler is not None and self._reconciler.is_alive():
+                return
+            self._reconciler = threading.Thread(target=self._run_reconciler, name='exposure-reconciler', daemon=True)
+            self._reconciler.start()
+
+    def _run_reconciler(self):
+        while True:
+            time.sleep(self.reconcile_interval)
+            try:
+                self.reconcile()
+            except Exception as e:
+                logger.error(f"Failed to reconcile credit exposure: {e}")
+
+
+def get_exposure_ledger():
+    """The credit exposure ledger of the current application."""
+    return current_app.extensions['exposure_ledger']
+
+
+def record_exposure_changes(session, changes):
+    """Adds open-notional deltas (user id -> Decimal) of the session's transaction, applied on commit."""
+    pending = session.info.setdefault('exposure_changes', defaultdict(Decimal))
+    for user_id, delta in changes.items():
+        pending[user_id] += delta
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _discard_exposure_changes(session):
+    if session.in_nested_transaction(): # A savepoint rollback; the reservations belong to the outer transaction
+        return
+    session.info.pop('exposure_changes', None)
+    reserved = session.info.pop('exposure_reserved', None)
+    if reserved and has_app_context() and 'exposure_ledger' in current_app.extensions:
+        current_app.extensions['exposure_ledger'].apply({}, reserved)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _apply_exposure_changes(session):
+    changes = session.info.pop('exposure_changes', None)
+    reserved = session.info.pop('exposure_reserved', None)
+    if (changes or reserved) and has_app_context() and 'exposure_ledger' in current_app.extensions:
+        current_app.extensions['exposure_ledger'].apply(changes or {}, reserved)
@@ -0,0 +1,221 @@
+"""
+Idempotency-Key support for create endpoints.
+
+A client that retries a POST with the same Idempotency-Key header gets the original
+response back (with an Idempotent-Replayed: true header) instead of a second order
+or listing: the view, including its validation, insert and matching, runs once.
+
+Keys are scoped to the authenticated user, the method and the path. While the
+first request is still running, a concurrent retry gets 409; reusing a key with a
+different request body gets 422. Responses with a 5xx status are not stored, so
+those requests can be retried normally.
+
+Two stores are available (IDEMPOTENCY_BACKEND):
+    memory   - bounded, expiring in-process store (default; per process)
+    database - the idempotency_keys table, shared by every process using the database
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import current_app, jsonify, make_response, request
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import delete
+from sqlalchemy.exc import IntegrityError
+
+from . import db
+from .models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_MAX_KEYS = 10000
+# How long an in-flight claim blocks retries before it is considered abandoned (e.g. a crashed worker).
+DEFAULT_IN_FLIGHT_SECONDS = 60
+
+# Outcomes of IdempotencyStore.begin()
+CLAIMED = 'claimed'
+REPLAY = 'replay'
+IN_PROGRESS = 'in_progress'
+MISMATCH = 'mismatch'
+
+
+class StoredResponse:
+    __slots__ = ('status_code', 'body', 'mimetype')
+
+    def __init__(self, status_code, body, mimetype):
+        self.status_code = status_code
+        self.body = body
+        self.mimetype = mimetype
+
+
+class MemoryIdempotencyStore:
+    """In-process store bounded to max_keys entries (least recently used evicted first)."""
+
+    def __init__(self, ttl_seconds=DEFAULT_TTL_SECONDS, max_keys=DEFAULT_MAX_KEYS, in_flight_seconds=DEFAULT_IN_FLIGHT_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.max_keys = max_keys
+        self.in_flight_seconds = in_flight_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> [fingerprint, StoredResponse or None, expires_at]
+
+    def begin(self, key, fingerprint):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._entries[key] = [fingerprint, None, now + self.in_flight_seconds]
+                while len(self._entries) > self.max_keys:
+                    self._entries.popitem(last=False)
+                return CLAIMED, None
+            self._entries.move_to_end(key)
+            if entry[0] != fingerprint:
+                return MISMATCH, None
+            if entry[1] is None:
+                return IN_PROGRESS, None
+            return REPLAY, entry[1]
+
+    def complete(self, key, status_code, body, mimetype):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[1] = StoredResponse(status_code, body, mimetype)
+                entry[2] = time.monotonic() + self.ttl_seconds
+
+    def abandon(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class DatabaseIdempotencyStore:
+    """Store backed by the idempotency_keys table; expired rows are purged as keys are claimed."""
+
+    PURGE_EVERY = 100 # Claims between purges of expired rows
+
+    def __init__(self, ttl_seconds=DEFAULT_TTL_SECONDS, in_flight_seconds=DEFAULT_IN_FLIGHT_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.in_flight_seconds = in_flight_seconds
+        self._claims = 0
+        self._claims_lock = threading.Lock()
+
+    def begin(self, key, fingerprint):
+        now = datetime.utcnow()
+        record = db.session.get(IdempotencyKey, key, populate_existing=True)
+        if record is not None and record.expires_at <= now:
+            db.session.delete(record)
+            db.session.commit()
+            record = None
+        if record is None:
+            db.session.add(IdempotencyKey(
+                key=key, request_fingerprint=fingerprint, created_at=now,
+                expires_at=now + timedelta(seconds=self.in_flight_seconds)
+            ))
+            try:
+                db.session.commit()
+            except IntegrityError: # Another process claimed the key first
+                db.session.rollback()
+                record = db.session.get(IdempotencyKey, key, populate_existing=True)
+                if record is None:
+                    return IN_PROGRESS, None
+            else:
+                self._maybe_purge(now)
+                return CLAIMED, None
+        if record.request_fingerprint != fingerprint:
+            return MISMATCH, None
+        if record.status_code is None:
+            return IN_PROGRESS, None
+        return REPLAY, StoredResponse(record.status_code, record.response_body, record.response_mimetype)
+
+    def complete(self, key, status_code, body, mimetype):
+        record = db.session.get(IdempotencyKey, key)
+        if record is None:
+            return
+        record.status_code = status_code
+        record.response_body = body
+        record.response_mimetype = mimetype
+        record.expires_at = datetime.utcnow() + timedelta(seconds=self.ttl_seconds)
+        db.session.commit()
+
+    def abandon(self, key):
+        db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.key == key))
+        db.session.commit()
+
+    def purge_expired(self, now=None):
+        result = db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at <= (now or datetime.utcnow())))
+        db.session.commit()
+        return result.rowcount
+
+    def _maybe_purge(self, now):
+        with self._claims_lock:
+            self._claims += 1
+            due = self._claims % self.PURGE_EVERY == 0
+        if due:
+            self.purge_expired(now)
+
+
+def create_idempotency_store(config):
+    """Builds the store selected by IDEMPOTENCY_BACKEND."""
+    ttl_seconds = config.get('IDEMPOTENCY_TTL_SECONDS', DEFAULT_TTL_SECONDS)
+    if config.get('IDEMPOTENCY_BACKEND', 'memory') == 'database':
+        return DatabaseIdempotencyStore(ttl_seconds=ttl_seconds)
+    return MemoryIdempotencyStore(ttl_seconds=ttl_seconds, max_keys=config.get('IDEMPOTENCY_MAX_KEYS', DEFAULT_MAX_KEYS))
+
+
+def get_idempotency_store():
+    """The idempotency store of the current application."""
+    return current_app.extensions['idempotency_store']
+
+
+def _scoped_key(client_key):
+    identity = get_jwt_identity()
+    username = identity.get('username') if isinstance(identity, dict) else None
+    scope = f"{username}\n{request.method}\n{request.path}\n{client_key}"
+    return hashlib.sha256(scope.encode('utf-8')).hexdigest()
+
+
+def idempotent(view):
+    """Replays the stored response for a repeated Idempotency-Key (apply below @jwt_required)."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        client_key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not client_key:
+            return view(*args, **kwargs)
+        if len(client_key) > MAX_KEY_LENGTH:
+            return jsonify({"msg": f"{IDEMPOTENCY_HEADER} must be at most {MAX_KEY_LENGTH} characters."}), 400
+
+        store = get_idempotency_store()
+        key = _scoped_key(client_key)
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        outcome, stored = store.begin(key, fingerprint)
+        if outcome == REPLAY:
+            response = make_response(stored.body, stored.status_code)
+            response.mimetype = stored.mimetype
+            response.headers[REPLAYED_HEADER] = 'true'
+            return response
+        if outcome == IN_PROGRESS:
+            return jsonify({"msg": f"A request with this {IDEMPOTENCY_HEADER} is still being processed. Retry later."}), 409
+        if outcome == MISMATCH:
+            return jsonify({"msg": f"{IDEMPOTENCY_HEADER} was already used with a different request body."}), 422
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            store.abandon(key)
+            raise
+        if response.status_code >= 500 or response.is_streamed:
+            store.abandon(key) # Let the client retry failed requests
+        else:
+            store.complete(key, response.status_code, response.get_data(), response.mimetype)
+        return response
+    return wrapper
@@ -0,0 +1,386 @@
+"""
+Inventory reservation ledger for hydrogen product listings.
+
+A sell order reserves its quantity against the product when it is placed, so open
+sell orders can never over-commit a listing. The reservation is released when the
+order is cancelled or expires, and converted (reserved and on-hand quantity both
+decrease) when the matching engine fills it.
+
+Counters live in memory per application process and are guarded by one lock, so
+reserve/release/convert are cheap and atomic. Fills no longer rewrite the product
+row on every trade: their on-hand deltas are accumulated and persisted in batches
+(one UPDATE per touched product) by a background flusher, when a batch fills up,
+and at shutdown. A product's counters are loaded lazily from the database the
+first time it is touched (on-hand quantity plus its open sell orders).
+
+The counters are authoritative for a single order-entry process; run one process
+that accepts orders (or route orders for a product to one process) when scaling out.
+That process also expires orders itself: once the ledger is in use, a background
+thread runs expire_due_orders() every ORDER_EXPIRY_INTERVAL_SECONDS, so expired sell
+orders give their quantity back without waiting for `flask expire-orders`. The same
+thread releases the reservations of orders that another process closed (e.g. the CLI
+command or a worker cancelling), read from the database by order id.
+"""
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam, select, update
+
+from . import db
+from .models import HydrogenProduct, Order
+from .notifications import enqueue_order_event
+from .order_book import get_order_book
+
+logger = logging.getLogger(__name__)
+
+OPEN_ORDER_STATUSES = ('pending', 'partially_filled')
+DEFAULT_FLUSH_INTERVAL_SECONDS = 1.0
+DEFAULT_FLUSH_BATCH_SIZE = 500
+DEFAULT_EXPIRY_INTERVAL_SECONDS = 30.0
+RELEASE_CHUNK_SIZE = 500 # Order ids per IN (...) query when releasing closed orders
+
+
+class InsufficientInventory(Exception):
+    """Raised when a reservation would exceed a product's unreserved quantity."""
+
+    def __init__(self, product_id, requested, available):
+        super().__init__(f"Sell order quantity ({requested}kg) cannot exceed available product quantity ({available}kg).")
+        self.product_id = product_id
+        self.requested = requested
+        self.available = available
+
+
+class _Position:
+    __slots__ = ('on_hand', 'reserved', 'unflushed')
+
+    def __init__(self, on_hand):
+        self.on_hand = on_hand
+        self.reserved = Decimal('0')
+        self.unflushed = Decimal('0') # On-hand delta not yet written to hydrogen_products
+
+    @property
+    def available(self):
+        return self.on_hand - self.reserved
+
+
+class InventoryLedger:
+    """In-memory reservation counters for one application (see module docstring)."""
+
+    def __init__(self, app):
+        self.app = app
+        self.flush_interval = app.config.get('INVENTORY_FLUSH_INTERVAL_SECONDS', DEFAULT_FLUSH_INTERVAL_SECONDS)
+        self.flush_batch_size = app.config.get('INVENTORY_FLUSH_BATCH_SIZE', DEFAULT_FLUSH_BATCH_SIZE)
+        self.expiry_interval = app.config.get('ORDER_EXPIRY_INTERVAL_SECONDS', DEFAULT_EXPIRY_INTERVAL_SECONDS)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock() # Serialises flushes so deltas are applied once, in order
+        self._positions = {} # product_id -> _Position
+        self._reservations = {} # order_id -> (product_id, reserved quantity)
+        self._dirty = set() # product ids with unflushed deltas
+        self._wakeup = threading.Event()
+        self._flusher = None
+        self._expirer = None
+        atexit.register(self._flush_at_exit)
+
+    # --- Loading ---
+
+    def _position(self, product_id):
+        """The product's counters, loaded from the database on first use."""
+        position = self._positions.get(product_id)
+        if position is not None:
+            return position
+        # Read outside the lock; if another thread got there first its position wins.
+        on_hand = db.session.execute(
+            select(HydrogenProduct.quantity_kg).where(HydrogenProduct.id == product_id)
+        ).scalar()
+        if on_hand is None:
+            return None
+        open_orders = db.session.execute(
+            select(Order.id, Order.quantity_kg).where(
+                Order.hydrogen_product_id == product_id,
+                Order.order_type == 'sell',
+                Order.status.in_(OPEN_ORDER_STATUSES)
+            )
+        ).all()
+        with self._lock:
+            if product_id in self._positions:
+                return self._positions[product_id]
+            position = _Position(Decimal(on_hand))
+            for order_id, quantity in open_orders:
+                self._reservations[order_id] = (product_id, Decimal(quantity))
+                position.reserved += Decimal(quantity)
+            self._positions[product_id] = position
+        self._ensure_expirer()
+        return position
+
+    def load(self, product_id):
+        """Loads a product's counters; call before flushing a new sell order for it."""
+        self._position(product_id)
+
+    # --- Reservation lifecycle ---
+
+    def reserve(self, order_id, product_id, quantity):
+        """Reserves quantity for a resting sell order; raises InsufficientInventory."""
+        quantity = Decimal(quantity)
+        position = self._position(product_id)
+        if position is None:
+            raise InsufficientInventory(product_id, quantity, Decimal('0'))
+        with self._lock:
+            previous = self._reservations.get(order_id, (product_id, Decimal('0')))[1]
+            if quantity - previous > position.available:
+                raise InsufficientInventory(product_id, quantity, position.available + previous)
+            position.reserved += quantity - previous
+            self._reservations[order_id] = (product_id, quantity)
+
+    def release(self, order_id):
+        """Releases an order's remaining reservation (cancel/expiry); returns the quantity."""
+        with self._lock:
+            product_id, quantity = self._reservations.pop(order_id, (None, Decimal('0')))
+            position = self._positions.get(product_id)
+            if position is not None:
+                position.reserved -= quantity
+        return quantity
+
+    def convert(self, order_id, product_id, quantity):
+        """Converts part of a reservation into a fill: reserved and on-hand both decrease."""
+        quantity = Decimal(quantity)
+        position = self._position(product_id)
+        if position is None:
+            return
+        with self._lock:
+            _, reserved = self._reservations.get(order_id, (product_id, Decimal('0')))
+            consumed = min(reserved, quantity)
+            if reserved - consumed > 0:
+                self._reservations[order_id] = (product_id, reserved - consumed)
+            else:
+                self._reservations.pop(order_id, None)
+            position.reserved -= consumed
+            position.on_hand -= quantity
+            position.unflushed -= quantity
+            self._dirty.add(product_id)
+            batch_full = len(self._dirty) >= self.flush_batch_size
+        self._ensure_flusher()
+        if batch_full:
+            self._wakeup.set()
+
+    def release_closed(self):
+        """Releases the reservations of orders committed as closed by any process; returns how many."""
+        with self._lock:
+            held = list(self._reservations)
+        closed = []
+        # Only rows visible as closed count: an order reserved but not yet committed is not released
+        for start in range(0, len(held), RELEASE_CHUNK_SIZE):
+            closed += db.session.execute(
+                select(Order.id).where(Order.id.in_(held[start:start + RELEASE_CHUNK_SIZE]),
+                                       Order.status.not_in(OPEN_ORDER_STATUSES))
+            ).scalars().all()
+        for order_id in closed:
+            self.release(order_id)
+        if closed:
+            logger.info(f"Released the reservations of {len(closed)} order(s) closed elsewhere.")
+        return len(closed)
+
+    def forget(self, product_id):
+        """Drops a product's counters (after its quantity was edited or it was deleted)."""
+        self.flush()
+        with self._lock:
+            self._positions.pop(product_id, None)
+            self._dirty.discard(product_id)
+            for order_id in [o for o, (p, _) in self._reservations.items() if p == product_id]:
+                del self._reservations[order_id]
+
+    def reserved(self, product_id):
+        """Quantity reserved by open sell orders for the product."""
+        position = self._position(product_id)
+        return position.reserved if position is not None else Decimal('0')
+
+    def available(self, product_id):
+        """Quantity not reserved by open sell orders (what an immediate sell order may fill)."""
+        position = self._position(product_id)
+        if position is None:
+            return Decimal('0')
+        with self._lock:
+            return position.available
+
+    def reserved_for(self, order_id, product_id):
+        """Quantity currently reserved by one sell order."""
+        self._position(product_id)
+        with self._lock:
+            return self._reservations.get(order_id, (product_id, Decimal('0')))[1]
+
+    def overlay(self, product_dict):
+        """Applies unflushed fills and reservation totals to a serialized product."""
+        with self._lock:
+            position = self._positions.get(product_dict['id'])
+            if position is None:
+                return product_dict
+            on_hand, reserved = position.on_hand, position.reserved
+        product_dict['quantity_kg'] = str(on_hand)
+        product_dict['quantity_reserved_kg'] = str(reserved)
+        product_dict['quantity_available_kg'] = str(on_hand - reserved)
+        if on_hand == 0 and product_dict.get('status') == 'active':
+            product_dict['status'] = 'sold'
+        return product_dict
+
+    def reset(self):
+        """Discards all counters without flushing (e.g. after the database was wiped)."""
+        with self._lock:
+            self._positions.clear()
+            self._reservations.clear()
+            self._dirty.clear()
+
+    # --- Batched persistence ---
+
+    def flush(self):
+        """Writes accumulated on-hand deltas to the database; returns the number of products."""
+        with self._flush_lock:
+            with self._lock:
+                batch = []
+                for product_id in self._dirty:
+                    position = self._positions[product_id]
+                    batch.append({'product_id': product_id, 'delta': position.unflushed})
+                    position.unflushed = Decimal('0')
+                self._dirty.clear()
+            if not batch:
+                return 0
+            table = HydrogenProduct.__table__
+            statement = (
+                update(table)
+                .where(table.c.id == bindparam('product_id'))
+                .values(quantity_kg=table.c.quantity_kg + bindparam('delta'))
+            )
+            try:
+                with self.app.app_context():
+                    with db.engine.begin() as connection:
+                        # Write first: on SQLite a read before the first write would hold a shared
+                        # lock while waiting for the write lock, deadlocking with concurrent matches
+                        connection.execute(statement, batch)
+                        sold_out = self._mark_sold_out(connection, [row['product_id'] for row in batch])
+                    if sold_out:
+                        from .platform_stats import record_sold_out_listings # Imports OPEN_ORDER_STATUSES from here
+                        record_sold_out_listings(sold_out)
+            except Exception:
+                with self._lock: # Put the deltas back so the next flush retries them
+                    for row in batch:
+                        position = self._positions.get(row['product_id'])
+                        if position is not None:
+                            position.unflushed += row['delta']
+                            self._dirty.add(row['product_id'])
+                raise
+            logger.debug(f"Flushed inventory deltas for {len(batch)} product(s).")
+            return len(batch)
+
+    @staticmethod
+    def _mark_sold_out(connection, product_ids):
+        """Marks listings without stock left 'sold'; returns their previous statuses (for the admin statistics)."""
+        table = HydrogenProduct.__table__
+        exhausted = (table.c.id.in_(product_ids), table.c.quantity_kg <= 0, table.c.status != 'sold')
+        statuses = connection.execute(select(table.c.status).where(*exhausted)).scalars().all()
+        if statuses:
+            connection.execute(update(table).where(*exhausted).values(status='sold'))
+        return statuses
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._run_flusher, name='inventory-flusher', daemon=True)
+            self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush inventory deltas: {e}")
+
+    def run_expiry(self):
+        """One pass of the expiry thread: expires due orders, then releases orders closed elsewhere."""
+        with self.app.app_context():
+            try:
+                expire_due_orders()
+                self.release_closed()
+            finally:
+                db.session.remove()
+
+    def _ensure_expirer(self):
+        if not self.expiry_interval or (self._expirer is not None and self._expirer.is_alive()):
+            return
+        with self._lock:
+            if self._expirer is not None and self._expirer.is_alive():
+                return
+            self._expirer = threading.Thread(target=self._run_expirer, name='order-expirer', daemon=True)
+            self._expirer.start()
+
+    def _run_expirer(self):
+        while True:
+            time.sleep(self.expiry_interval)
+            try:
+                self.run_expiry()
+            except Exception as e:
+                logger.error(f"Failed to expire orders: {e}")
+
+    def _flush_at_exit(self):
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Failed to flush inventory deltas at exit: {e}")
+
+
+def get_inventory_ledger():
+    """The reservation ledger of the current application."""
+    return current_app.extensions['inventory_ledger']
+
+
+def expire_due_orders(now=None):
+    """Marks open orders past their expiration_timestamp as 'expired' and releases their reservations."""
+    now = now or datetime.utcnow()
+    due_statuses = dict(db.session.execute(
+        select(Order.id, Order.status).where(
+            Order.status.in_(OPEN_ORDER_STATUSES),
+            Order.expiration_timestamp.is_not(None),
+            Order.expiration_timestamp <= now
+        )
+    ).all())
+    due = list(due_statuses)
+    if not due:
+        return 0
+    db.session.execute(
+        update(Order).where(Order.id.in_(due), Order.status.in_(OPEN_ORDER_STATUSES))
+        .values(status='expired', version_id=Order.version_id + 1), # Bump so an in-flight match retries
+        execution_options={'synchronize_session': False}
+    )
+    from .platform_stats import record_status_changes # Both import this module's OPEN_ORDER_STATUSES
+    from .positions import record_closed_orders
+    expired = [order for order in db.session.scalars(select(Order).where(Order.id.in_(due)).execution_options(populate_existing=True))
+               if order.status == 'expired']
+    for order in expired:
+        enqueue_order_event(order)
+    record_closed_orders(expired)
+    record_status_changes((due_statuses[order.id], 'expired') for order in expired)
+    db.session.commit()
+    ledger = get_inventory_ledger()
+    for order_id in due:
+        ledger.release(order_id)
+    get_order_book().remove(due) # The bulk update bypasses the session's change tracking
+    logger.info(f"Expired {len(due)} order(s).")
+    return len(due)
+
+
+@click.command('expire-orders')
+@with_appcontext
+def expire_orders_command():
+    """Expires orders past their expiration time and releases reserved inventory."""
+    count = expire_due_orders()
+    get_inventory_ledger().flush()
+    click.echo(f"Expired {count} order(s).")
@@ -0,0 +1,184 @@
+"""
+Depth charts and liquidity histograms computed from the in-memory order book.
+
+Drawing a depth chart from /api/trades/orderbook/<id> means downloading every resting
+order with all its fields. The views here reduce the book on the server instead,
+with NumPy over the integer arrays of the order book mirror (app/order_book.py), so
+they neither query the orders table nor build ORM objects:
+  * product_depth(): a product's bids and asks aggregated per price level, best
+    first, with the cumulative quantity a market order would sweep up to each
+    level (truncated to the `levels` nearest the spread), plus a histogram of the
+    resting quantity per price bin over both sides.
+  * grouped_depth(): the resting quantity of all active listings per price bin,
+    grouped by region or production method, with each group's best bid and ask.
+    Every group shares the same bin edges, so the histograms can be drawn on one axis.
+Prices and quantities are returned as JSON numbers (currency per kg and kg, at the
+two decimals of the orders table) sized for charts, not per-order detail.
+"""
+import numpy as np
+from sqlalchemy import select
+
+from . import db
+from .models import HydrogenProduct
+from .order_book import BUY, SCALE, SELL, get_order_book
+
+DEFAULT_LEVELS = 50
+MAX_LEVELS = 500
+DEFAULT_BINS = 20
+MAX_BINS = 200
+GROUP_BY = {'region': HydrogenProduct.location_region, 'production_method': HydrogenProduct.production_method}
+
+
+def _amounts(units):
+    """Integer 1 / SCALE units (or float bin edges in units) as a list of JSON numbers."""
+    return np.round(np.asarray(units, dtype=np.float64) / SCALE, 4).tolist()
+
+
+def _best(prices, side):
+    if not len(prices):
+        return None
+    return int(prices.max() if side == BUY else prices.min())
+
+
+def depth_curve(price, quantity, side, levels=DEFAULT_LEVELS):
+    """
+    Aggregates one side of a book per price level, best first.
+
+    Args:
+        price, quantity (np.ndarray): The side's orders in 1 / SCALE units, in any order.
+        side (int): BUY (best is highest) or SELL (best is lowest).
+        levels (int): How many levels nearest the spread to return.
+
+    Returns:
+        dict: 'price', 'quantity' and 'cumulative_quantity' lists, plus the total
+        'level_count' and 'quantity_kg' of the side, truncated levels included.
+    """
+    prices, inverse = np.unique(price, return_inverse=True) # Ascending
+    quantities = np.bincount(inverse, weights=quantity, minlength=len(prices))
+    if side == BUY:
+        prices, quantities = prices[::-1], quantities[::-1]
+    cumulative = np.cumsum(quantities)
+    return {
+        'price': _amounts(prices[:levels]),
+        'quantity': _amounts(quantities[:levels]),
+        'cumulative_quantity': _amounts(cumulative[:levels]),
+        'level_count': len(prices),
+        'quantity_kg': _amounts(cumulative[-1:])[0] if len(cumulative) else 0.0,
+    }
+
+
+def bin_edges(price, bins=DEFAULT_BINS, low=None, high=None):
+    """
+    `bins` equal-width price bins (bins + 1 edges, in 1 / SCALE units) from low to high,
+    by default the lowest and highest price in `price`. None if there is nothing to bin.
+    """
+    if low is None:
+        low = int(price.min()) if len(price) else None
+    if high is None:
+        high = int(price.max()) if len(price) else None
+    if low is None or high is None or high < low:
+        return None
+    if high == low: # A single price: one tick either side, so it sits mid-range
+        low, high = low - 1, high + 1
+    return np.linspace(low, high, bins + 1)
+
+
+def _histogram(price, quantity, edges):
+    # Orders outside [low, high] are left out; the last bin includes `high`
+    return np.histogram(price, bins=edges, weights=quantity)[0]
+
+
+def product_depth(product_id, levels=DEFAULT_LEVELS, bins=DEFAULT_BINS, low=None, high=None):
+    """The depth chart and liquidity histogram of one product's book (see module docstring)."""
+    bids, asks = get_order_book().snapshot(product_id)
+    best_bid, best_ask = _best(bids.price, BUY), _best(asks.price, SELL)
+    edges = bin_edges(np.concatenate((bids.price, asks.price)), bins, low, high)
+    spread = best_ask - best_bid if best_bid is not None and best_ask is not None else None
+    return {
+        'product_id': product_id,
+        'best_bid': _amounts([best_bid])[0] if best_bid is not None else None,
+        'best_ask': _amounts([best_ask])[0] if best_ask is not None else None,
+        'spread': _amounts([spread])[0] if spread is not None else None,
+        'bid_orders': len(bids.price),
+        'ask_orders': len(asks.price),
+        'bids': depth_curve(bids.price, bids.quantity, BUY, levels),
+        'asks': depth_curve(asks.price, asks.quantity, SELL, levels),
+        'histogram': None if edges is None else {
+            'bin_edges': _amounts(edges),
+            'bids': _amounts(_histogram(bids.price, bids.quantity, edges)),
+            'asks': _amounts(_histogram(asks.price, asks.quantity, edges)),
+        },
+    }
+
+
+def grouped_depth(group_by='region', bins=DEFAULT_BINS, low=None, high=None, region=None, production_method=None):
+    """
+    Resting liquidity of the active listings per group and price bin.
+
+    Args:
+        group_by (str): 'region' or 'production_method'.
+        bins, low, high: As for bin_edges(), shared by every group.
+        region, production_method (str, optional): Only listings with this attribute.
+
+    Returns:
+        dict: 'group_by', 'bin_edges' (None if no order rests) and 'groups', one per
+        group with at least one active listing, ordered by key.
+    """
+    column = GROUP_BY[group_by]
+    stmt = select(HydrogenProduct.id, column).where(HydrogenProduct.status == 'active')
+    if region:
+        stmt = stmt.where(HydrogenProduct.location_region == region)
+    if production_method:
+        stmt = stmt.where(HydrogenProduct.production_method == production_method)
+    listings = db.session.execute(stmt).all()
+    keys = sorted({key for _, key in listings})
+    index_of = {key: index for index, key in enumerate(keys)}
+    product_ids = np.array([product_id for product_id, _ in listings], dtype=np.int64)
+    group_of = np.array([index_of[key] for _, key in listings], dtype=np.int64)
+    orders = get_order_book().resting(product_ids.tolist())
+
+    # The group of each order, through its product's position in the sorted product ids
+    by_id = np.argsort(product_ids)
+    group = group_of[by_id[np.searchsorted(product_ids[by_id], orders['product_id'])]]
+    edges = bin_edges(orders['price'], bins, low, high)
+    if edges is not None:
+        # Bin index per order (-1 outside the edges), then one bincount per side over group * bins + bin
+        binned = np.digitize(orders['price'], edges[1:-1])
+        binned[(orders['price'] < edges[0]) | (orders['price'] > edges[-1])] = -1
+
+    sides = {}
+    for side in (BUY, SELL):
+        on_side = orders['side'] == side
+        sides[side] = {
+            'orders': np.bincount(group[on_side], minlength=len(keys)),
+            'quantity': np.bincount(group[on_side], weights=orders['quantity'][on_side], minlength=len(keys)),
+        }
+        best = np.full(len(keys), -1 if side == BUY else np.iinfo(np.int64).max, dtype=np.int64)
+        (np.maximum if side == BUY else np.minimum).at(best, group[on_side], orders['price'][on_side])
+        sides[side]['best'] = best
+        if edges is not None:
+            inside = on_side & (binned >= 0)
+            sides[side]['histogram'] = np.bincount(
+                group[inside] * bins + binned[inside], weights=orders['quantity'][inside], minlength=len(keys) * bins
+            ).reshape(len(keys), bins)
+
+    groups = []
+    for index, key in enumerate(keys):
+        bids, asks = sides[BUY], sides[SELL]
+        best_bid = int(bids['best'][index]) if bids['orders'][index] else None
+        best_ask = int(asks['best'][index]) if asks['orders'][index] else None
+        groups.append({
+            'key': key,
+            'product_count': int(np.count_nonzero(group_of == index)),
+            'bid_orders': int(bids['orders'][index]),
+            'ask_orders': int(asks['orders'][index]),
+            'bid_quantity_kg': _amounts([bids['quantity'][index]])[0],
+            'ask_quantity_kg': _amounts([asks['quantity'][index]])[0],
+            'best_bid': _amounts([best_bid])[0] if best_bid is not None else None,
+            'best_ask': _amounts([best_ask])[0] if best_ask is not None else None,
+            'histogram': None if edges is None else {
+                'bids': _amounts(bids['histogram'][index]),
+                'asks': _amounts(asks['histogram'][index]),
+            },
+        })
+    return {'group_by': group_by, 'bin_edges': None if edges is None else _amounts(edges), 'groups': groups}
@@ -1,27 +1,95 @@
-from .models import db, Order, Trade, HydrogenProduct
-from sqlalchemy import and_, or_
+from .models import db, Order, OrderAuditRecord, Trade, HydrogenProduct
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.exc import StaleDataError
+from datetime import datetime
 from decimal import Decimal
+from .inventory import get_inventory_ledger
+from .notifications import enqueue_order_event, enqueue_trade_confirmations
+from .analytics import record_trades
 import logging
+import random
+import time
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# The engine fills against a single counter-order per call (see the loop below), so only
+# that row is fetched and, on PostgreSQL, locked with FOR UPDATE SKIP LOCKED.
+MAX_COUNTER_ORDERS_PER_MATCH = 1
+# How many times a match is retried after losing a race for a counter-order.
+MAX_MATCH_ATTEMPTS = 5
+# Upper bound of the random pause before retry n, times n: immediate retries of all the
+# losers of a race collide again (on SQLite, with its single writer, repeatedly).
+MATCH_RETRY_BACKOFF_SECONDS = 0.005
+
+
+TIME_IN_FORCE = ('GTC', 'GTD', 'IOC', 'FOK')
+IMMEDIATE_TIME_IN_FORCE = ('IOC', 'FOK')
+
+
+def _not_expired(now):
+    """GTD orders stop matching at their expiration time, even before `flask expire-orders` runs."""
+    return or_(Order.expiration_timestamp.is_(None), Order.expiration_timestamp > now)
+
+
+def _is_retryable_conflict(exc):
+    """Optimistic-lock conflicts (SQLite/version column) and lock timeouts/deadlocks."""
+    if isinstance(exc, StaleDataError):
+        return True
+    if isinstance(exc, OperationalError):
+        message = str(exc.orig).lower()
+        return 'database is locked' in message or 'deadlock' in message
+    return False
+
+
+def _backoff(attempt):
+    time.sleep(random.uniform(0, MATCH_RETRY_BACKOFF_SECONDS * attempt))
+
+
 def attempt_match_order(incoming_order_id):
     """
     Attempts to match a newly placed order with existing orders in the order book.
     This function is the core of the matching engine for the POC.
 
+    Concurrency: on PostgreSQL the incoming order is locked FOR UPDATE and the
+    counter-order is selected FOR UPDATE SKIP LOCKED, so concurrent matches never
+    consume the same resting order and never wait on each other's candidates. On
+    SQLite (which has no row locks) the Order version column detects a concurrent
+    fill at flush time and the match is retried.
+
     Args:
         incoming_order_id (int): The ID of the newly placed order to match.
 
     Returns:
         list[Trade]: A list of Trade objects created, or an empty list if no matches.
     """
+    for attempt in range(1, MAX_MATCH_ATTEMPTS + 1):
+        try:
+            trades = _match_order_once(incoming_order_id)
+            if not trades:
+                # Early returns leave the outer transaction open; end it so the FOR UPDATE lock
+                # (or the SQLite write slot) is not held until the request finishes.
+                db.session.rollback()
+            return trades
+        except (StaleDataError, OperationalError) as e:
+            db.session.rollback()
+            if not _is_retryable_conflict(e):
+                raise
+            logger.warning(f"Concurrent update while matching order {incoming_order_id} (attempt {attempt}/{MAX_MATCH_ATTEMPTS}): {e}")
+            if attempt < MAX_MATCH_ATTEMPTS:
+                _backoff(attempt)
+    logger.error(f"Giving up matching order {incoming_order_id} after {MAX_MATCH_ATTEMPTS} conflicting attempts.")
+    return []
+
+
+def _match_order_once(incoming_order_id):
+    """Single matching pass; raises StaleDataError/OperationalError on a lost race."""
     trades_created = []
     
     with db.session.begin_nested(): # Use nested transaction for matching logic
-        incoming_order = db.session.get(Order, incoming_order_id)
+        incoming_order = db.session.get(Order, incoming_order_id, with_for_update=True, populate_existing=True)
 
         if not incoming_order or incoming_order.status != 'pending':
             logger.info(f"Order {incoming_order_id} not found or not in 'pending' state. No matching attempted.")
@@ -35,20 +103,26 @@ def attempt_match_order(incoming_order_id):
             logger.info(f"Incoming order {incoming_order.id} is a criteria-based buy order. Simple matching engine requires a specific product ID.")
             return trades_created
 
+        # Snapshot the product's reservations before any order in this match is modified
+        ledger = get_inventory_ledger()
+        ledger.load(incoming_order.hydrogen_product_id)
+
         if incoming_order.order_type == 'buy':
             # Incoming is a BUY order, look for SELL orders (asks)
             # Match criteria:
             # 1. Same HydrogenProduct ID
             # 2. Sell order price (ask_price) <= Buy order price (bid_price)
             # 3. Order status is 'pending'
-            # Order by price (lowest sell price first - best for buyer), then by time (oldest first)
+            # Order by price (lowest sell price first - best for buyer), then by time priority (oldest first)
             potential_matches = db.session.query(Order).filter(
                 Order.hydrogen_product_id == incoming_order.hydrogen_product_id,
                 Order.order_type == 'sell',
                 Order.price_per_kg <= incoming_order.price_per_kg,
                 Order.status == 'pending',
-                Order.user_id != incoming_order.user_id # Cannot match with own orders
-            ).order_by(Order.price_per_kg.asc(), Order.created_timestamp.asc()).all()
+                Order.user_id != incoming_order.user_id, # Cannot match with own orders
+                _not_expired(datetime.utcnow())
+            ).order_by(Order.price_per_kg.asc(), Order.priority_timestamp.asc(), Order.id.asc()) \
+             .limit(MAX_COUNTER_ORDERS_PER_MATCH).with_for_update(skip_locked=True).all()
 
         elif incoming_order.order_type == 'sell':
             # Incoming is a SELL order, look for BUY orders (bids)
@@ -56,14 +130,16 @@ def attempt_match_order(incoming_order_id):
             # 1. Same HydrogenProduct ID
             # 2. Buy order price (bid_price) >= Sell order price (ask_price)
             # 3. Order status is 'pending'
-            # Order by price (highest buy price first - best for seller), then by time (oldest first)
+            # Order by price (highest buy price first - best for seller), then by time priority (oldest first)
             potential_matches = db.session.query(Order).filter(
                 Order.hydrogen_product_id == incoming_order.hydrogen_product_id,
                 Order.order_type == 'buy',
                 Order.price_per_kg >= incoming_order.price_per_kg,
                 Order.status == 'pending',
-                Order.user_id != incoming_order.user_id # Cannot match with own orders
-            ).order_by(Order.price_per_kg.desc(), Order.created_timestamp.asc()).all()
+                Order.user_id != incoming_order.user_id, # Cannot match with own orders
+                _not_expired(datetime.utcnow())
+            ).order_by(Order.price_per_kg.desc(), Order.priority_timestamp.asc(), Order.id.asc()) \
+             .limit(MAX_COUNTER_ORDERS_PER_MATCH).with_for_update(skip_locked=True).all()
         else:
             logger.error(f"Unknown order type for order {incoming_order.id}: {incoming_order.order_type}")
             return trades_created # Should not happen
@@ -149,23 +225,9 @@ def attempt_match_order(incoming_order_id):
 
 
                 # --- Update HydrogenProduct Quantity ---
-                product = db.session.get(HydrogenProduct, incoming_order.hydrogen_product_id)
-                if product:
-                    if product.quantity_kg >= trade_quantity:
-                        product.quantity_kg -= trade_quantity
-                        logger.info(f"Product {product.id} quantity updated. New available quantity: {product.quantity_kg}")
-                        if product.quantity_kg == 0:
-                            product.status = 'sold' # Mark product as sold out
-                            logger.info(f"Product {product.id} marked as sold out.")
-                        db.session.add(product)
-                    else:
-                        logger.error(f"Not enough quantity for product {product.id} to fulfill trade of {trade_quantity}kg. Available: {product.quantity_kg}kg. This indicates a potential issue.")
-                        # This should ideally be caught earlier or handled with more robust quantity checks.
-                        # For POC, log and continue, but this trade might fail or be inconsistent.
-                        # Could raise an exception here to rollback the specific trade attempt.
-                        # db.session.rollback() # Rollback this specific trade attempt
-                        # trades_created.pop() # Remove the last trade
-                        # continue
+                # The product row is not touched here: once the trades commit, the sell order's
+                # inventory reservation is converted and the on-hand decrement is persisted in
+                # batches by the inventory ledger (see app/inventory.py).
                 
                 # For this POC, we assume one match is sufficient to process for the incoming order.
                 # A more complex engine would continue if the incoming order is 'partially_filled'.
@@ -176,15 +238,19 @@ def attempt_match_order(incoming_order_id):
         
         if trades_created:
             try:
+                db.session.flush() # Assigns the trade ids referenced by the confirmations
+                # Confirmations go to the outbox in this same transaction; the notification
+                # dispatcher delivers them in the background (see app/notifications.py).
+                enqueue_trade_confirmations(trades_created)
+                record_trades(trades_created) # Market analytics counters (see app/analytics.py)
                 db.session.commit() # Commit the transaction for all successful matches in this run
                 logger.info(f"Successfully committed {len(trades_created)} trade(s).")
-                # --- Placeholder for Notification System ---
-                # For each trade in trades_created:
-                #   - Notify buyer (trade.buyer_id)
-                #   - Notify seller (trade.seller_id)
-                #   Notification could be an email, an in-app message, or a webhook event.
-                #   Example: notification_service.send_trade_confirmation(trade)
-                logger.info("Placeholder: Notifications would be sent for successful trades here.")
+            except (StaleDataError, OperationalError) as e:
+                if _is_retryable_conflict(e):
+                    raise # Lost a race for a counter-order; attempt_match_order retries
+                db.session.rollback()
+                logger.error(f"Error committing trades to database: {e}")
+                return []
             except Exception as e:
                 db.session.rollback()
                 logger.error(f"Error committing trades to database: {e}")
@@ -194,10 +260,156 @@ def attempt_match_order(incoming_order_id):
             # (though there shouldn't be if no trades were appended)
             db.session.rollback()
 
+    # Convert the filled sell orders' inventory reservations now that the trades are durable
+    for trade in trades_created:
+        ledger.convert(trade.sell_order_id, trade.hydrogen_product_id, trade.quantity_traded_kg)
 
     return trades_created
 
 
+def execute_immediate_order(user_id, order_type, product_id, quantity_kg, price_per_kg, time_in_force):
+    """
+    Executes an IOC or FOK order against the book without ever resting it.
+
+    The order sweeps counter-orders in price/time priority up to its limit price. IOC
+    cancels whatever is left; FOK first checks the crossing depth with one aggregate
+    query (no rows are loaded or locked) and is killed unless it can fill completely.
+    An Order row is written only if the order traded, in its final state ('filled', or
+    'cancelled' with the unfilled remainder), together with its trades. Every order
+    gets an OrderAuditRecord.
+
+    Returns:
+        tuple[Order | None, list[Trade], OrderAuditRecord]
+    """
+    for attempt in range(1, MAX_MATCH_ATTEMPTS + 1):
+        try:
+            return _execute_immediate_once(user_id, order_type, product_id, quantity_kg, price_per_kg, time_in_force)
+        except (StaleDataError, OperationalError) as e:
+            db.session.rollback()
+            if not _is_retryable_conflict(e) or attempt == MAX_MATCH_ATTEMPTS:
+                raise
+            logger.warning(f"Concurrent update while executing {time_in_force} order (attempt {attempt}/{MAX_MATCH_ATTEMPTS}): {e}")
+            _backoff(attempt)
+
+
+def _execute_immediate_once(user_id, order_type, product_id, quantity_kg, price_per_kg, time_in_force):
+    counter_type = 'sell' if order_type == 'buy' else 'buy'
+    crosses = Order.price_per_kg <= price_per_kg if order_type == 'buy' else Order.price_per_kg >= price_per_kg
+    book = (
+        Order.hydrogen_product_id == product_id,
+        Order.order_type == counter_type,
+        Order.status == 'pending',
+        crosses,
+        Order.user_id != user_id, # Cannot match with own orders
+        _not_expired(datetime.utcnow()),
+    )
+    best_first = Order.price_per_kg.asc() if counter_type == 'sell' else Order.price_per_kg.desc()
+    audit = OrderAuditRecord(user_id=user_id, hydrogen_product_id=product_id, order_type=order_type,
+                             time_in_force=time_in_force, quantity_kg=quantity_kg, price_per_kg=price_per_kg)
+
+    fills = []
+    remaining = quantity_kg
+    if time_in_force == 'FOK':
+        depth = db.session.execute(select(func.coalesce(func.sum(Order.quantity_kg), 0)).where(*book)).scalar()
+        feasible = Decimal(depth) >= quantity_kg
+    else:
+        feasible = True
+    # The sweep runs in a savepoint, so a kill undoes only the fills and keeps the caller's transaction
+    sweep = db.session.begin_nested()
+    while feasible and remaining > 0:
+        counter_order = db.session.query(Order).filter(*book).order_by(best_first, Order.priority_timestamp.asc(), Order.id.asc()) \
+            .limit(1).with_for_update(skip_locked=True).first()
+        if counter_order is None:
+            break
+        fill = min(remaining, counter_order.quantity_kg)
+        if counter_order.quantity_kg == fill:
+            counter_order.status = 'filled'
+        else:
+            counter_order.status = 'partially_filled'
+            counter_order.quantity_kg -= fill # Remaining quantity
+        fills.append((counter_order, fill))
+        remaining -= fill
+        db.session.flush() # Takes the counter-order out of the book for the next lookup
+    if time_in_force == 'FOK' and remaining > 0:
+        # Killed (or the depth went away under us): nothing but the audit record is kept
+        sweep.rollback()
+        fills, remaining = [], quantity_kg
+    else:
+        sweep.commit()
+
+    order = None
+    trades = []
+    if fills:
+        order = Order(user_id=user_id, order_type=order_type, hydrogen_product_id=product_id,
+                      quantity_kg=remaining if remaining > 0 else quantity_kg, price_per_kg=price_per_kg,
+                      time_in_force=time_in_force, status='filled' if remaining == 0 else 'cancelled')
+        db.session.add(order)
+        db.session.flush()
+        for counter_order, fill in fills:
+            buy_order, sell_order = (order, counter_order) if order_type == 'buy' else (counter_order, order)
+            trade = Trade(buy_order_id=buy_order.id, sell_order_id=sell_order.id, hydrogen_product_id=product_id,
+                          quantity_traded_kg=fill, price_per_kg_agreed=counter_order.price_per_kg, # Resting order's price
+                          buyer_id=buy_order.user_id, seller_id=sell_order.user_id, settlement_status='pending')
+            db.session.add(trade)
+            trades.append(trade)
+        db.session.flush()
+        enqueue_trade_confirmations(trades)
+        record_trades(trades)
+        enqueue_order_event(order)
+
+    filled = quantity_kg - remaining
+    audit.order_id = order.id if order is not None else None
+    audit.filled_kg = filled
+    if filled == quantity_kg:
+        audit.outcome = 'filled'
+    elif filled > 0:
+        audit.outcome = 'partially_filled'
+    else:
+        audit.outcome = 'killed' if time_in_force == 'FOK' else 'cancelled'
+    db.session.add(audit)
+    db.session.commit()
+    logger.info(f"{time_in_force} {order_type} order by user {user_id}: {audit.outcome}, {filled}/{quantity_kg} kg in {len(trades)} trade(s).")
+
+    ledger = get_inventory_ledger()
+    for trade in trades:
+        ledger.convert(trade.sell_order_id, trade.hydrogen_product_id, trade.quantity_traded_kg)
+    return order, trades, audit
+
+
+def amend_order(order, quantity_kg=None, price_per_kg=None):
+    """
+    Applies a price and/or quantity amendment to a resting order in the current transaction.
+
+    Time priority follows the usual exchange rules: reducing the quantity at the same
+    price keeps the order's place in its price level, while a price change or a
+    quantity increase sends it to the back of its (new) level. Either way the order
+    is updated in place (its one row, loaded by primary key) rather than cancelled
+    and re-entered; the in-memory book (app/order_book.py) moves it to its new place
+    when the transaction commits, like any other order change.
+
+    Args:
+        order (Order): The resting order, loaded in the current session.
+        quantity_kg (Decimal, optional): New remaining quantity; must be positive.
+        price_per_kg (Decimal, optional): New limit price; must be positive.
+
+    Returns:
+        bool: True if the price changed, in which case the order may now cross the
+        book and should be re-matched with attempt_match_order once committed.
+    """
+    if (quantity_kg is not None and quantity_kg <= 0) or (price_per_kg is not None and price_per_kg <= 0):
+        raise ValueError("Amended quantity and price must be positive.")
+    repriced = price_per_kg is not None and price_per_kg != order.price_per_kg
+    loses_priority = repriced or (quantity_kg is not None and quantity_kg > order.quantity_kg)
+    if repriced:
+        order.price_per_kg = price_per_kg
+    if quantity_kg is not None:
+        order.quantity_kg = quantity_kg
+    if loses_priority:
+        order.priority_timestamp = datetime.utcnow()
+    logger.info(f"Amended order {order.id}: qty {order.quantity_kg}, price {order.price_per_kg}, priority {'reset' if loses_priority else 'kept'}.")
+    return repriced
+
+
 def get_order_book_for_product(product_id):
     """
     Retrieves the current order book (pending buy and sell orders) for a specific product.
@@ -207,13 +419,13 @@ def get_order_book_for_product(product_id):
         Order.hydrogen_product_id == product_id,
         Order.order_type == 'buy',
         Order.status == 'pending'
-    ).order_by(Order.price_per_kg.desc(), Order.created_timestamp.asc()).all()
+    ).order_by(Order.price_per_kg.desc(), Order.priority_timestamp.asc(), Order.id.asc()).all()
 
     sell_orders = Order.query.filter(
         Order.hydrogen_product_id == product_id,
         Order.order_type == 'sell',
         Order.status == 'pending'
-    ).order_by(Order.price_per_kg.asc(), Order.created_timestamp.asc()).all()
+    ).order_by(Order.price_per_kg.asc(), Order.priority_timestamp.asc(), Order.id.asc()).all()
 
     return {
         "product_id": product_id,
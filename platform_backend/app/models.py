@@ -1,3 +1,5 @@
+from datetime import datetime
+
 from . import db, bcrypt # Import db and bcrypt from the app package
 
 class User(db.Model):
@@ -122,13 +124,30 @@ class Order(db.Model):
     max_ghg_intensity_criteria = db.Column(db.Numeric(10, 4), nullable=True)
 
     status = db.Column(db.String(50), default='pending') # "pending", "partially_filled", "filled", "cancelled", "expired"
-    created_timestamp = db.Column(db.DateTime, server_default=db.func.now())
+    # Set by the application (microsecond resolution) so replay capture can order entries and cancels
+    created_timestamp = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now())
     updated_timestamp = db.Column(db.DateTime, server_default=db.func.now(), server_onupdate=db.func.now())
     expiration_timestamp = db.Column(db.DateTime, nullable=True)
+    cancelled_timestamp = db.Column(db.DateTime, nullable=True) # When the owner cancelled the order
+    # "GTC" (good till cancelled), "GTD" (good till expiration_timestamp), "IOC" (immediate or
+    # cancel) or "FOK" (fill or kill). IOC/FOK orders never rest; see execute_immediate_order.
+    time_in_force = db.Column(db.String(3), nullable=False, default='GTC')
+    # Time priority within a price level: set on entry and reset when an amendment loses
+    # priority (see amend_order in app/matching_engine.py). Microsecond resolution.
+    priority_timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Optimistic concurrency check: every UPDATE is guarded by the version it read, so two
+    # matching passes can never both fill the same resting order (SQLite has no row locks).
+    version_id = db.Column(db.Integer, nullable=False, default=1)
 
     user = db.relationship('User', backref=db.backref('orders', lazy=True))
     product = db.relationship('HydrogenProduct', backref=db.backref('orders', lazy=True))
 
+    __mapper_args__ = {'version_id_col': version_id}
+    # The book: best counter-order lookups by the matching engine are a single index seek
+    __table_args__ = (
+        db.Index('ix_orders_book', 'hydrogen_product_id', 'order_type', 'status', 'price_per_kg', 'priority_timestamp'),
+    )
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -145,13 +164,52 @@ class Order(db.Model):
             'status': self.status,
             'created_timestamp': self.created_timestamp.isoformat() if self.created_timestamp else None,
             'updated_timestamp': self.updated_timestamp.isoformat() if self.updated_timestamp else None,
-            'expiration_timestamp': self.expiration_timestamp.isoformat() if self.expiration_timestamp else None
+            'expiration_timestamp': self.expiration_timestamp.isoformat() if self.expiration_timestamp else None,
+            'time_in_force': self.time_in_force,
         }
 
     def __repr__(self):
         return f'<Order {self.id} ({self.order_type}) by User {self.user_id}>'
 
 
+class OrderAuditRecord(db.Model):
+    """
+    Outcome of an immediate (IOC/FOK) order. Such orders are never stored as resting rows:
+    an Order row exists only if they traded (order_id), so this is their only trace otherwise.
+    """
+    __tablename__ = 'order_audit_records'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=True)
+    hydrogen_product_id = db.Column(db.Integer, db.ForeignKey('hydrogen_products.id'), nullable=False)
+    order_type = db.Column(db.String(10), nullable=False)
+    time_in_force = db.Column(db.String(3), nullable=False)
+    quantity_kg = db.Column(db.Numeric(10, 2), nullable=False) # Requested
+    price_per_kg = db.Column(db.Numeric(10, 2), nullable=False)
+    filled_kg = db.Column(db.Numeric(10, 2), nullable=False)
+    outcome = db.Column(db.String(20), nullable=False) # "filled", "partially_filled" (rest cancelled), "cancelled", "killed"
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'order_id': self.order_id,
+            'hydrogen_product_id': self.hydrogen_product_id,
+            'order_type': self.order_type,
+            'time_in_force': self.time_in_force,
+            'quantity_kg': str(self.quantity_kg),
+            'price_per_kg': str(self.price_per_kg),
+            'filled_kg': str(self.filled_kg),
+            'outcome': self.outcome,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+        }
+
+    def __repr__(self):
+        return f'<OrderAuditRecord {self.id} {self.time_in_force} {self.order_type} by User {self.user_id}: {self.outcome}>'
+
+
 class Trade(db.Model):
     """
     Trade model based on data_models.md
@@ -207,5 +265,328 @@ class Trade(db.Model):
     def __repr__(self):
         return f'<Trade {self.id} - Product {self.hydrogen_product_id} - {self.quantity_traded_kg}kg @ {self.price_per_kg_agreed}/kg>'
 
-# Potential future models (based on data_models.md, not implemented in this subtask)
-# class EnvironmentalCredit(db.Model): ...
+class IdempotencyKey(db.Model):
+    """
+    Stored response for a request sent with an Idempotency-Key header (shared store
+    used when IDEMPOTENCY_BACKEND=database; see app/idempotency.py).
+    """
+    __tablename__ = 'idempotency_keys'
+
+    key = db.Column(db.String(64), primary_key=True) # sha256 of user, method, path and client key
+    request_fingerprint = db.Column(db.String(64), nullable=False) # sha256 of the request body
+    status_code = db.Column(db.Integer, nullable=True) # NULL while the original request is in flight
+    response_body = db.Column(db.LargeBinary, nullable=True)
+    response_mimetype = db.Column(db.String(100), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<IdempotencyKey {self.key[:12]} status={self.status_code}>'
+
+class OutboxMessage(db.Model):
+    """
+    Event for one user, written in the same transaction as the change it describes
+    (transactional outbox) and delivered in the background by app/notifications.py.
+    """
+    __tablename__ = 'outbox_messages'
+
+    id = db.Column(db.Integer, primary_key=True)
+    topic = db.Column(db.String(50), nullable=False) # e.g. "trade.executed"
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending') # "pending", "sent", "failed"
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+    next_attempt_at = db.Column(db.DateTime, nullable=True) # Claimed or backing off until then; NULL means due
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    dispatched_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (db.Index('ix_outbox_messages_status_id', 'status', 'id'),)
+
+    def __repr__(self):
+        return f'<OutboxMessage {self.id} {self.topic} for User {self.user_id} ({self.status})>'
+
+class WebhookSubscription(db.Model):
+    """
+    HTTPS endpoint registered by a user to receive order and trade events
+    (see app/webhooks.py).
+    """
+    __tablename__ = 'webhook_subscriptions'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    url = db.Column(db.String(500), nullable=False)
+    secret = db.Column(db.String(128), nullable=False) # HMAC-SHA256 signing key
+    event_types = db.Column(db.String(200), nullable=False) # Comma-separated, e.g. "order.updated,trade.executed"
+    is_active = db.Column(db.Boolean, nullable=False, default=True)
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+
+    user = db.relationship('User', backref=db.backref('webhook_subscriptions', lazy='dynamic'))
+
+    @property
+    def event_type_list(self):
+        return [event_type for event_type in self.event_types.split(',') if event_type]
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'url': self.url,
+            'event_types': self.event_type_list,
+            'is_active': self.is_active,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+        }
+
+    def __repr__(self):
+        return f'<WebhookSubscription {self.id} {self.url} for User {self.user_id}>'
+
+
+class WebhookDelivery(db.Model):
+    """One event queued for one subscription; status "dead" is the dead-letter queue."""
+    __tablename__ = 'webhook_deliveries'
+
+    id = db.Column(db.Integer, primary_key=True)
+    subscription_id = db.Column(db.Integer, db.ForeignKey('webhook_subscriptions.id'), nullable=False)
+    event_id = db.Column(db.Integer, nullable=False) # OutboxMessage id; lets receivers deduplicate retries
+    event_type = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending') # "pending", "delivered", "dead"
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    delivered_at = db.Column(db.DateTime, nullable=True)
+
+    subscription = db.relationship('WebhookSubscription', backref=db.backref('deliveries', lazy='dynamic'))
+
+    __table_args__ = (db.Index('ix_webhook_deliveries_status_next_attempt', 'status', 'next_attempt_at'),)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'subscription_id': self.subscription_id,
+            'event_id': self.event_id,
+            'event_type': self.event_type,
+            'payload': self.payload,
+            'status': self.status,
+            'attempts': self.attempts,
+            'last_error': self.last_error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'delivered_at': self.delivered_at.isoformat() if self.delivered_at else None,
+        }
+
+    def __repr__(self):
+        return f'<WebhookDelivery {self.id} {self.event_type} to Subscription {self.subscription_id} ({self.status})>'
+
+class EnvironmentalCredit(db.Model):
+    """
+    EnvironmentalCredit model based on data_models.md
+    One certificate (REC, GO, carbon or LCFS credit) held in the registry in app/credits.py.
+    """
+    __tablename__ = 'environmental_credits'
+
+    id = db.Column(db.Integer, primary_key=True)
+    credit_id = db.Column(db.String(100), unique=True, nullable=False) # Registry serial number
+    issuing_organization_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    hydrogen_product_id = db.Column(db.Integer, db.ForeignKey('hydrogen_products.id'), nullable=True) # Production batch
+    credit_type = db.Column(db.String(50), nullable=False) # "REC", "GO", "CarbonCredit_Avoidance", ...
+    vintage = db.Column(db.Integer, nullable=False) # Year of the underlying production
+    quantity = db.Column(db.Numeric(14, 3), nullable=False)
+    unit_of_measure = db.Column(db.String(20), nullable=False) # e.g. "MWh", "tCO2e"
+    owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    beneficiary_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True) # Set on retirement
+    status = db.Column(db.String(20), nullable=False, default='active') # "active", "bundled", "retired", "expired"
+    trade_id = db.Column(db.Integer, db.ForeignKey('trades.id'), nullable=True) # Trade the credit is bundled with
+    issuance_date = db.Column(db.DateTime, nullable=False)
+    expiry_date = db.Column(db.DateTime, nullable=True)
+    retirement_date = db.Column(db.DateTime, nullable=True)
+    region = db.Column(db.String(100), nullable=True)
+    project_id_reference = db.Column(db.String(100), nullable=True)
+    issuance_transaction_id = db.Column(db.Integer, db.ForeignKey('credit_transactions.id'), nullable=False)
+
+    __table_args__ = (
+        # FIFO selection of an owner's credits of one type and vintage
+        db.Index('ix_environmental_credits_owner_lot', 'owner_id', 'status', 'credit_type', 'vintage', 'id'),
+        db.Index('ix_environmental_credits_trade_id', 'trade_id'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'credit_id': self.credit_id,
+            'issuing_organization_id': self.issuing_organization_id,
+            'hydrogen_product_id': self.hydrogen_product_id,
+            'credit_type': self.credit_type,
+            'vintage': self.vintage,
+            'quantity': str(self.quantity),
+            'unit_of_measure': self.unit_of_measure,
+            'owner_id': self.owner_id,
+            'beneficiary_id': self.beneficiary_id,
+            'status': self.status,
+            'trade_id': self.trade_id,
+            'issuance_date': self.issuance_date.isoformat() if self.issuance_date else None,
+            'expiry_date': self.expiry_date.isoformat() if self.expiry_date else None,
+            'retirement_date': self.retirement_date.isoformat() if self.retirement_date else None,
+            'region': self.region,
+            'project_id_reference': self.project_id_reference,
+        }
+
+    def __repr__(self):
+        return f'<EnvironmentalCredit {self.credit_id} owned by User {self.owner_id} ({self.status})>'
+
+
+class CreditTransaction(db.Model):
+    """
+    One registry operation (issue, transfer, retire, bundle, settle, unbundle) over a
+    lot of credits of one type and vintage; the transaction history of data_models.md.
+    """
+    __tablename__ = 'credit_transactions'
+
+    id = db.Column(db.Integer, primary_key=True)
+    action = db.Column(db.String(20), nullable=False)
+    from_user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True) # NULL on issuance
+    to_user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    credit_type = db.Column(db.String(50), nullable=False)
+    vintage = db.Column(db.Integer, nullable=False)
+    credit_count = db.Column(db.Integer, nullable=False)
+    quantity = db.Column(db.Numeric(18, 3), nullable=False)
+    trade_id = db.Column(db.Integer, db.ForeignKey('trades.id'), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'action': self.action,
+            'from_user_id': self.from_user_id,
+            'to_user_id': self.to_user_id,
+            'credit_type': self.credit_type,
+            'vintage': self.vintage,
+            'credit_count': self.credit_count,
+            'quantity': str(self.quantity),
+            'trade_id': self.trade_id,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+        }
+
+    def __repr__(self):
+        return f'<CreditTransaction {self.id} {self.action} {self.credit_count} x {self.credit_type}/{self.vintage}>'
+
+
+class CreditBalance(db.Model):
+    """
+    Running totals of an owner's credits per type, vintage and status, updated in the
+    same transaction as every registry operation so balances are never summed on read.
+    """
+    __tablename__ = 'credit_balances'
+
+    owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    credit_type = db.Column(db.String(50), primary_key=True)
+    vintage = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20), primary_key=True)
+    credit_count = db.Column(db.Integer, nullable=False, default=0)
+    quantity = db.Column(db.Numeric(18, 3), nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<CreditBalance User {self.owner_id} {self.credit_type}/{self.vintage} {self.status}: {self.credit_count}>'
+
+
+class TradeAnalytics(db.Model):
+    """
+    Traded volume per day, region, production mix and GHG intensity band, maintained
+    incrementally by the matching engine and rebuildable from trades (app/analytics.py).
+    """
+    __tablename__ = 'trade_analytics'
+
+    trade_date = db.Column(db.Date, primary_key=True)
+    region = db.Column(db.String(100), primary_key=True)
+    production_method = db.Column(db.String(100), primary_key=True)
+    feedstock = db.Column(db.String(100), primary_key=True) # "unknown" when the listing has none
+    energy_source = db.Column(db.String(100), primary_key=True)
+    intensity_band = db.Column(db.String(20), primary_key=True) # e.g. "0.45-1.5", "unknown"
+    trade_count = db.Column(db.Integer, nullable=False, default=0)
+    volume_kg = db.Column(db.Numeric(18, 2), nullable=False, default=0)
+    notional = db.Column(db.Numeric(22, 4), nullable=False, default=0) # Sum of quantity * price
+    intensity_volume_kg = db.Column(db.Numeric(18, 2), nullable=False, default=0) # Volume with a known intensity
+    emissions_kgco2e = db.Column(db.Numeric(22, 4), nullable=False, default=0) # Sum of quantity * intensity
+
+    def __repr__(self):
+        return f'<TradeAnalytics {self.trade_date} {self.region} {self.production_method} {self.intensity_band}: {self.volume_kg}kg>'
+
+
+class Position(db.Model):
+    """
+    A user's traded and open-order totals per product, maintained on every flush that
+    adds a trade or changes an order and rebuildable from history (app/positions.py).
+    """
+    __tablename__ = 'positions'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    hydrogen_product_id = db.Column(db.Integer, db.ForeignKey('hydrogen_products.id'), primary_key=True)
+    trade_count = db.Column(db.Integer, nullable=False, default=0)
+    bought_kg = db.Column(db.Numeric(18, 2), nullable=False, default=0)
+    bought_notional = db.Column(db.Numeric(22, 4), nullable=False, default=0) # Sum of quantity * price
+    sold_kg = db.Column(db.Numeric(18, 2), nullable=False, default=0)
+    sold_notional = db.Column(db.Numeric(22, 4), nullable=False, default=0)
+    # Open (pending or partially filled) orders: remaining quantity and quantity * limit price
+    open_order_count = db.Column(db.Integer, nullable=False, default=0)
+    open_buy_kg = db.Column(db.Numeric(18, 2), nullable=False, default=0)
+    open_buy_notional = db.Column(db.Numeric(22, 4), nullable=False, default=0)
+    open_sell_kg = db.Column(db.Numeric(18, 2), nullable=False, default=0)
+    open_sell_notional = db.Column(db.Numeric(22, 4), nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<Position User {self.user_id} Product {self.hydrogen_product_id}: +{self.bought_kg}/-{self.sold_kg}kg>'
+
+
+class CreditLimit(db.Model):
+    """
+    Pre-trade limits of one account, enforced at order entry against the in-memory
+    exposure (app/exposure.py). Accounts without a row get the configured defaults;
+    a NULL limit in a row means unlimited.
+    """
+    __tablename__ = 'credit_limits'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    max_open_notional = db.Column(db.Numeric(22, 4), nullable=True) # Open orders: sum of remaining quantity * limit price
+    max_order_notional = db.Column(db.Numeric(22, 4), nullable=True) # One order: quantity * limit price
+    updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
+
+    def to_dict(self):
+        return {
+            'user_id': self.user_id,
+            'max_open_notional': str(self.max_open_notional) if self.max_open_notional is not None else None,
+            'max_order_notional': str(self.max_order_notional) if self.max_order_notional is not None else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+        }
+
+    def __repr__(self):
+        return f'<CreditLimit User {self.user_id}: open {self.max_open_notional}, order {self.max_order_notional}>'
+
+
+class PlatformStat(db.Model):
+    """
+    Platform-wide counters behind the admin statistics (app/platform_stats.py): gauges
+    such as listings or orders per status (period 'all'), and trade flows per day or
+    month, overall and per product. Maintained on every write and compacted periodically.
+    """
+    __tablename__ = 'platform_stats'
+
+    name = db.Column(db.String(40), primary_key=True) # e.g. "orders", "trades", "product_trades"
+    period = db.Column(db.String(5), primary_key=True) # "all", "day" or "month"
+    period_start = db.Column(db.Date, primary_key=True) # 1970-01-01 for "all"
+    dimension = db.Column(db.String(50), primary_key=True) # Status, product id or ""
+    count = db.Column(db.Integer, nullable=False, default=0)
+    volume_kg = db.Column(db.Numeric(18, 2), nullable=False, default=0)
+    notional = db.Column(db.Numeric(22, 4), nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<PlatformStat {self.name}/{self.period} {self.period_start} {self.dimension}: {self.count}>'
+
+
+class UserActivity(db.Model):
+    """One row per user and day on which the user placed an order or traded (for active user counts)."""
+    __tablename__ = 'user_activity'
+
+    activity_date = db.Column(db.Date, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+
+    def __repr__(self):
+        return f'<UserActivity {self.activity_date} User {self.user_id}>'
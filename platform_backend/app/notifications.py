@@ -0,0 +1,346 @@
+"""
+Trade confirmations and order events through a transactional outbox.
+
+The matching engine never sends anything itself: it adds one OutboxMessage per
+trade party in the same transaction as the Trade rows (enqueue_trade_confirmations),
+so a confirmation exists if and only if the trade was committed, and matching
+latency never includes notification I/O. Order endpoints record status changes the
+same way (enqueue_order_event).
+
+A NotificationDispatcher per application drains the outbox in the background. Each
+cycle claims a batch of due messages (FOR UPDATE SKIP LOCKED on PostgreSQL, so
+several dispatchers can run side by side) by pushing their next_attempt_at out by
+NOTIFICATION_CLAIM_TIMEOUT_SECONDS, and commits the claim before sending anything:
+no row lock is held while the sender does I/O, and a dispatcher that dies mid-cycle
+only delays its messages until the claim runs out. Claimed messages are coalesced
+per user, so that one user with many fills gets one notification, and each user's
+notification is handed to a worker pool. A second, short transaction then marks
+delivered messages sent and schedules failed ones for a retry with exponential
+backoff (NOTIFICATION_BACKOFF_BASE_SECONDS doubling per attempt, up to
+NOTIFICATION_BACKOFF_MAX_SECONDS), or marks them 'failed' after
+NOTIFICATION_MAX_ATTEMPTS. Delivery is at least once.
+
+Only trade confirmations are sent to users; every message is also offered once to
+the registered fan-outs (webhook deliveries, see app/webhooks.py), in the transaction
+that claims it.
+
+Committing a session that enqueued messages wakes the dispatcher; once running, it
+also polls every NOTIFICATION_POLL_INTERVAL_SECONDS to retry failures and pick up
+messages written by other processes.
+
+Sent messages stay in the outbox until `flask purge-outbox` (meant to run
+periodically, e.g. nightly from cron) deletes those dispatched more than
+OUTBOX_RETENTION_DAYS ago, in short batches. Failed messages are kept for inspection.
+"""
+import logging
+import random
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import delete, event, or_, select, update
+from sqlalchemy.orm.util import identity_key
+
+from . import db
+from .db_routing import RoutingSession
+from .metrics import registry
+from .models import Order, OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+TRADE_EXECUTED = 'trade.executed'
+ORDER_UPDATED = 'order.updated'
+NOTIFIED_TOPICS = (TRADE_EXECUTED,) # Topics delivered to users by the sender
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_WORKERS = 4
+DEFAULT_POLL_INTERVAL_SECONDS = 1.0
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BACKOFF_BASE_SECONDS = 1.0
+DEFAULT_BACKOFF_MAX_SECONDS = 300.0
+DEFAULT_CLAIM_TIMEOUT_SECONDS = 60.0 # Longest a claimed batch may take to send
+OUTBOX_RETENTION_DAYS = 7 # Sent messages kept before purge-outbox deletes them
+PURGE_BATCH_SIZE = 5000 # Rows per DELETE, so the purge never holds a long write transaction
+
+NOTIFICATIONS_SENT = registry.counter(
+    'ghx_notifications_sent_total', 'Coalesced notifications delivered, by topic.', ('topic',)
+)
+OUTBOX_MESSAGES = registry.counter(
+    'ghx_outbox_messages_total', 'Outbox messages processed by the dispatcher, by outcome.', ('outcome',)
+)
+
+
+def backoff_seconds(attempts, base, cap):
+    """Delay before retry number `attempts`: exponential, capped, with jitter so retries are not in lockstep."""
+    return min(cap, base * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+
+def _trade_orders(trades):
+    """The orders of `trades` by id: from the session if loaded, the others in one SELECT."""
+    orders, missing = {}, set()
+    for order_id in {trade.buy_order_id for trade in trades} | {trade.sell_order_id for trade in trades}:
+        order = db.session.identity_map.get(identity_key(Order, order_id))
+        if order is None:
+            missing.add(order_id)
+        else:
+            orders[order_id] = order
+    if missing:
+        orders.update((order.id, order) for order in db.session.scalars(select(Order).where(Order.id.in_(missing))))
+    return orders
+
+
+def enqueue_trade_confirmations(trades):
+    """Adds a confirmation for the buyer and the seller of each trade to the current transaction."""
+    orders = _trade_orders(trades) # Not trade.buy_order / sell_order: one lazy load per trade
+    for trade in trades:
+        for role, order in (('buyer', orders[trade.buy_order_id]), ('seller', orders[trade.sell_order_id])):
+            db.session.add(OutboxMessage(
+                topic=TRADE_EXECUTED,
+                user_id=order.user_id,
+                payload={
+                    'trade_id': trade.id,
+                    'role': role,
+                    'order_id': order.id,
+                    'order_status': order.status, # Fills change order status; no separate order event
+                    'order_remaining_kg': str(order.quantity_kg),
+                    'hydrogen_product_id': trade.hydrogen_product_id,
+                    'quantity_kg': str(trade.quantity_traded_kg),
+                    'price_per_kg': str(trade.price_per_kg_agreed),
+                },
+            ))
+    db.session.info['outbox_pending'] = True
+
+
+def enqueue_order_event(order):
+    """Records an order's new status (placed, amended, cancelled, expired) in the current transaction."""
+    db.session.add(OutboxMessage(
+        topic=ORDER_UPDATED,
+        user_id=order.user_id,
+        payload={
+            'order_id': order.id,
+            'order_type': order.order_type,
+            'status': order.status,
+            'hydrogen_product_id': order.hydrogen_product_id,
+            'quantity_kg': str(order.quantity_kg),
+            'price_per_kg': str(order.price_per_kg),
+        },
+    ))
+    db.session.info['outbox_pending'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _wake_dispatcher(session):
+    if session.info.pop('outbox_pending', False):
+        dispatcher = current_app.extensions.get('notification_dispatcher')
+        if dispatcher is not None:
+            dispatcher.wake()
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _discard_pending_flag(session):
+    if session.in_nested_transaction(): # Rows queued before the savepoint are still pending
+        return
+    session.info.pop('outbox_pending', None)
+
+
+def log_sender(user_id, topic, payloads):
+    """Default delivery channel: logs the coalesced confirmation."""
+    logger.info(f"Notification '{topic}' for user {user_id}: {len(payloads)} fill(s), trades {[p['trade_id'] for p in payloads]}")
+
+
+class NotificationDispatcher:
+    """Drains the outbox of one application (see module docstring)."""
+
+    def __init__(self, app, sender=None):
+        self.app = app
+        self.sender = sender or log_sender
+        self.enabled = app.config.get('NOTIFICATION_DISPATCH_ENABLED', True)
+        self.batch_size = app.config.get('NOTIFICATION_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+        self.workers = app.config.get('NOTIFICATION_WORKERS', DEFAULT_WORKERS)
+        self.poll_interval = app.config.get('NOTIFICATION_POLL_INTERVAL_SECONDS', DEFAULT_POLL_INTERVAL_SECONDS)
+        self.max_attempts = app.config.get('NOTIFICATION_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)
+        self.backoff_base = app.config.get('NOTIFICATION_BACKOFF_BASE_SECONDS', DEFAULT_BACKOFF_BASE_SECONDS)
+        self.backoff_max = app.config.get('NOTIFICATION_BACKOFF_MAX_SECONDS', DEFAULT_BACKOFF_MAX_SECONDS)
+        self.claim_timeout = app.config.get('NOTIFICATION_CLAIM_TIMEOUT_SECONDS', DEFAULT_CLAIM_TIMEOUT_SECONDS)
+        self._lock = threading.Lock()
+        self._dispatch_lock = threading.Lock() # One drain cycle at a time per process
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._executor = None
+        self._fanouts = []
+
+    def add_fanout(self, handler, on_commit=None):
+        """
+        Offers each message once to handler(messages), inside the claiming transaction;
+        on_commit() runs after that transaction commits.
+        """
+        self._fanouts.append((handler, on_commit))
+
+    def wake(self):
+        """Signals that new messages were committed; never blocks the caller."""
+        if not self.enabled:
+            return
+        self._ensure_thread()
+        self._wakeup.set()
+
+    def dispatch_pending(self):
+        """Drains the outbox batch by batch; returns the number of messages processed (sent or fanned out)."""
+        delivered = 0
+        with self._dispatch_lock:
+            while True:
+                claimed, sent = self._dispatch_batch()
+                delivered += sent
+                if claimed < self.batch_size or sent < claimed:
+                    return delivered # Drained, or failures to retry on the next cycle
+
+    def _dispatch_batch(self):
+        with self.app.app_context():
+            messages = self._claim()
+        if not messages:
+            return 0, 0
+        fresh = [message for message in messages if message.attempts == 0]
+        if fresh:
+            for _, on_commit in self._fanouts:
+                if on_commit is not None:
+                    on_commit()
+
+        # Coalesce: one notification per user and topic, carrying every fill in the batch.
+        # Sent outside any transaction: the claim is committed, no row stays locked meanwhile.
+        groups = defaultdict(list)
+        sent_ids, failures = [], {}
+        for message in messages:
+            if message.topic in NOTIFIED_TOPICS:
+                groups[(message.user_id, message.topic)].append(message)
+            else:
+                sent_ids.append(message.id) # Fan-out only
+        futures = {
+            key: self._pool().submit(self.sender, key[0], key[1], [m.payload for m in group])
+            for key, group in groups.items()
+        }
+        for key, future in futures.items():
+            try:
+                future.result()
+                sent_ids.extend(m.id for m in groups[key])
+                NOTIFICATIONS_SENT.inc(topic=key[1])
+            except Exception as e:
+                logger.warning(f"Delivering '{key[1]}' to user {key[0]} failed: {e}")
+                for m in groups[key]:
+                    failures[m.id] = (m.attempts + 1, str(e)) # The claim counted this attempt
+
+        with self.app.app_context():
+            self._record(sent_ids, failures)
+        OUTBOX_MESSAGES.inc(len(sent_ids), outcome='sent')
+        if failures:
+            OUTBOX_MESSAGES.inc(len(failures), outcome='error')
+        return len(messages), len(sent_ids)
+
+    def _claim(self):
+        """Claims a batch of due messages and offers the new ones to the fan-outs, in one short transaction."""
+        now = datetime.utcnow()
+        messages = db.session.execute(
+            select(OutboxMessage.id, OutboxMessage.user_id, OutboxMessage.topic, OutboxMessage.payload,
+                   OutboxMessage.attempts, OutboxMessage.created_at)
+            .where(OutboxMessage.status == 'pending',
+                   or_(OutboxMessage.next_attempt_at.is_(None), OutboxMessage.next_attempt_at <= now))
+            .order_by(OutboxMessage.id)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        ).all()
+        if not messages:
+            db.session.rollback()
+            return []
+        fresh = [message for message in messages if message.attempts == 0]
+        if fresh:
+            for handler, _ in self._fanouts:
+                handler(fresh)
+        # The claim: other dispatchers skip these until it runs out (e.g. this process died sending)
+        db.session.execute(
+            update(OutboxMessage).where(OutboxMessage.id.in_([message.id for message in messages]))
+            .values(attempts=OutboxMessage.attempts + 1,
+                    next_attempt_at=now + timedelta(seconds=self.claim_timeout)),
+            execution_options={'synchronize_session': False}
+        )
+        db.session.commit()
+        return messages
+
+    def _record(self, sent_ids, failures):
+        """Marks delivered messages sent and schedules the retry (or gives up on) failed ones."""
+        now = datetime.utcnow()
+        if sent_ids:
+            db.session.execute(
+                update(OutboxMessage).where(OutboxMessage.id.in_(sent_ids))
+                .values(status='sent', dispatched_at=now, next_attempt_at=None),
+                execution_options={'synchronize_session': False}
+            )
+        changes = []
+        for message_id, (attempts, error) in failures.items():
+            # Give up on messages that keep failing so they do not block the queue forever
+            given_up = attempts >= self.max_attempts
+            retry_in = 0 if given_up else backoff_seconds(attempts, self.backoff_base, self.backoff_max)
+            changes.append({
+                'id': message_id, 'status': 'failed' if given_up else 'pending', 'last_error': error[:1000],
+                'next_attempt_at': now + timedelta(seconds=retry_in),
+            })
+        if changes:
+            db.session.execute(update(OutboxMessage), changes) # ORM bulk UPDATE by primary key
+        db.session.commit()
+
+    def _pool(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='notification-worker')
+        return self._executor
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='notification-dispatcher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                self.dispatch_pending()
+            except Exception as e:
+                logger.error(f"Failed to dispatch outbox messages: {e}")
+
+
+def get_notification_dispatcher():
+    """The outbox dispatcher of the current application."""
+    return current_app.extensions['notification_dispatcher']
+
+
+def purge_sent_messages(keep_days=OUTBOX_RETENTION_DAYS, now=None, batch_size=PURGE_BATCH_SIZE):
+    """Deletes the messages sent more than keep_days ago, one batch per transaction; returns how many."""
+    cutoff = (now or datetime.utcnow()) - timedelta(days=keep_days)
+    purged = 0
+    while True:
+        batch = select(OutboxMessage.id).where(OutboxMessage.status == 'sent', OutboxMessage.dispatched_at < cutoff) \
+            .limit(batch_size)
+        deleted = db.session.execute(
+            delete(OutboxMessage).where(OutboxMessage.id.in_(batch)), execution_options={'synchronize_session': False}
+        ).rowcount
+        db.session.commit()
+        purged += deleted
+        if deleted < batch_size:
+            break
+    logger.info(f"Purged {purged} sent outbox message(s) dispatched before {cutoff:%Y-%m-%d %H:%M}.")
+    return purged
+
+
+@click.command('purge-outbox')
+@click.option('--keep-days', type=int, default=OUTBOX_RETENTION_DAYS, show_default=True,
+              help='Days to keep sent messages after their dispatch.')
+@with_appcontext
+def purge_outbox_command(keep_days):
+    """Delete old sent messages from the notification outbox (run periodically, e.g. nightly)."""
+    click.echo(f"Purged {purge_sent_messages(keep_days)} sent message(s).")
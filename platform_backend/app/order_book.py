@@ -0,0 +1,329 @@
+"""
+Compact in-memory mirror of the resting orders in the book.
+
+A resting order loaded through the ORM is expensive to hold: the Order instance, its
+instance state and attribute dicts, Decimal and datetime objects per column and an
+identity-map entry. RestingOrders instead keeps one slot per order across a set
+of NumPy columns (struct of arrays), with prices and quantities as integer
+hundredths (the Numeric(10, 2) precision of the orders table) and timestamps as
+integer microseconds. An order id maps to its slot through one dict, and the slots
+of removed orders go on a free list and are reused before the arrays grow, so a
+churning book does not fragment. A resting order takes about 160 bytes (49 of them
+in the arrays, the rest in the dict), over six million per GB, against some 1.6 kB
+per ORM instance (see benchmarks/order_book_memory.py).
+
+OrderBook holds one RestingOrders per application process. A product's resting
+orders are loaded with a single column query the first time they are asked for, and
+from then on every committed change is applied: Order rows flushed by the session
+are collected in after_flush and applied in after_commit (dropped on rollback), and
+the bulk expiry in app/inventory.py removes its orders explicitly. Like the
+inventory ledger, the mirror is exact for changes committed by its own process.
+NumPy is imported with the first product loaded, not with this module, so the order
+path (app/inventory.py imports it) does not add NumPy to every application start.
+"""
+import threading
+from datetime import datetime, timezone
+from itertools import chain
+from typing import TYPE_CHECKING, NamedTuple
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, select
+
+from . import db
+from .db_routing import RoutingSession
+from .models import Order
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Prices and quantities are stored as integer multiples of 1 / SCALE
+SCALE = 100
+BUY, SELL = 0, 1
+SIDES = {'buy': BUY, 'sell': SELL}
+RESTING_STATUS = 'pending' # The status the matching engine matches against
+_EPOCH = datetime(1970, 1, 1)
+_COLUMNS = (
+    ('order_id', 'int64'),
+    ('product_id', 'int32'), # 0 marks a free slot
+    ('user_id', 'int32'),
+    ('side', 'int8'),
+    ('price', 'int64'),
+    ('quantity', 'int64'),
+    ('priority', 'int64'), # Microseconds since the epoch
+    ('expires', 'int64'), # Microseconds since the epoch; 0 for no expiration
+)
+
+
+def to_units(value):
+    """A Decimal price or quantity as an integer number of 1 / SCALE units."""
+    return int(round(value * SCALE))
+
+
+def to_micros(moment):
+    """A naive UTC datetime as integer microseconds since the epoch (None is 0)."""
+    if moment is None:
+        return 0
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    delta = moment - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+class BookSide(NamedTuple):
+    """One side of a product's book as parallel arrays, best price first, then time priority."""
+    order_id: 'np.ndarray'
+    user_id: 'np.ndarray'
+    price: 'np.ndarray' # In 1 / SCALE units
+    quantity: 'np.ndarray' # In 1 / SCALE units
+    priority: 'np.ndarray'
+
+
+class RestingOrders:
+    """Struct-of-arrays store of resting orders keyed by order id, with free-slot reuse."""
+
+    def __init__(self, capacity=1024):
+        import numpy as np
+        self._columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in _COLUMNS}
+        self._slots = {} # order id -> slot
+        self._free = [] # Slots of removed orders, reused last-freed first
+        self._used = 0 # Slots ever handed out; the high-water mark of the arrays
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, order_id):
+        return order_id in self._slots
+
+    @property
+    def capacity(self):
+        return len(self._columns['order_id'])
+
+    @property
+    def nbytes(self):
+        """Bytes held by the column arrays (excluding the id -> slot dict)."""
+        return sum(column.nbytes for column in self._columns.values())
+
+    def _grow(self):
+        import numpy as np
+        capacity = self.capacity * 2
+        for name, column in self._columns.items():
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:len(column)] = column
+            self._columns[name] = grown
+
+    def put(self, order_id, product_id, user_id, side, price, quantity, priority, expires=0):
+        """Inserts or overwrites an order; side is BUY or SELL, price/quantity in 1 / SCALE units."""
+        slot = self._slots.get(order_id)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                if self._used == self.capacity:
+                    self._grow()
+                slot = self._used
+                self._used += 1
+            self._slots[order_id] = slot
+        columns = self._columns
+        columns['order_id'][slot] = order_id
+        columns['product_id'][slot] = product_id
+        columns['user_id'][slot] = user_id
+        columns['side'][slot] = side
+        columns['price'][slot] = price
+        columns['quantity'][slot] = quantity
+        columns['priority'][slot] = priority
+        columns['expires'][slot] = expires
+
+    def remove(self, order_id):
+        """Frees the order's slot; returns False if the order was not held."""
+        slot = self._slots.pop(order_id, None)
+        if slot is None:
+            return False
+        self._columns['product_id'][slot] = 0
+        self._free.append(slot)
+        return True
+
+    def get(self, order_id):
+        """The order's fields as a dict of ints, or None."""
+        slot = self._slots.get(order_id)
+        if slot is None:
+            return None
+        return {name: int(column[slot]) for name, column in self._columns.items()}
+
+    def remove_product(self, product_id):
+        """Frees the slots of all of a product's orders; returns how many were held."""
+        import numpy as np
+        slots = np.flatnonzero(self._columns['product_id'][:self._used] == product_id)
+        for order_id in self._columns['order_id'][slots].tolist():
+            self.remove(order_id)
+        return len(slots)
+
+    def clear(self):
+        self._columns['product_id'][:] = 0
+        self._slots.clear()
+        self._free.clear()
+        self._used = 0
+
+    def side(self, product_id, side, now=None):
+        """A product's bids (BUY) or asks (SELL) as a BookSide, skipping orders expired at `now` (µs)."""
+        import numpy as np
+        columns = {name: column[:self._used] for name, column in self._columns.items()}
+        live = (columns['product_id'] == product_id) & (columns['side'] == side)
+        if now is not None:
+            live &= (columns['expires'] == 0) | (columns['expires'] > now)
+        slots = np.flatnonzero(live)
+        price = columns['price'][slots]
+        # Best price first, then time priority, then id (the engine's tie-breaker)
+        order = np.lexsort((columns['order_id'][slots], columns['priority'][slots], price if side == SELL else -price))
+        slots = slots[order]
+        return BookSide(columns['order_id'][slots], columns['user_id'][slots], columns['price'][slots],
+                        columns['quantity'][slots], columns['priority'][slots])
+
+    def live(self, product_ids, now):
+        """The orders of the given products not expired at `now` (µs): product_id, side, price and quantity arrays."""
+        import numpy as np
+        product_id = self._columns['product_id'][:self._used]
+        expires = self._columns['expires'][:self._used]
+        slots = np.flatnonzero(np.isin(product_id, np.asarray(product_ids, dtype=np.int32))
+                               & ((expires == 0) | (expires > now)))
+        return {name: self._columns[name][slots] for name in ('product_id', 'side', 'price', 'quantity')}
+
+
+def _record(order):
+    """The fields of an Order that the mirror keeps, or None if it is not resting."""
+    if order.status != RESTING_STATUS or order.hydrogen_product_id is None:
+        return None
+    return (order.hydrogen_product_id, order.user_id, SIDES[order.order_type], to_units(order.price_per_kg),
+            to_units(order.quantity_kg), to_micros(order.priority_timestamp), to_micros(order.expiration_timestamp))
+
+
+class OrderBook:
+    """The resting-order mirror of one application process (see module docstring)."""
+
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()
+        self._orders = None # RestingOrders, created with the first product loaded
+        self._loaded = set() # Product ids whose resting orders are held
+
+    def __len__(self):
+        return len(self._orders) if self._orders is not None else 0
+
+    def load(self, product_id):
+        """Loads a product's resting orders from the database unless already held."""
+        self.load_many((product_id,))
+
+    def load_many(self, product_ids):
+        """Loads the resting orders of the products not yet held, with a single query."""
+        if self._loaded.issuperset(product_ids):
+            return
+        # The query runs under the lock so no commit applied meanwhile is lost for these products.
+        # It always reads the primary: a lagging replica would leave the mirror stale for good.
+        with self._lock:
+            missing = set(product_ids) - self._loaded
+            if not missing:
+                return
+            if self._orders is None:
+                self._orders = RestingOrders()
+            rows = db.session.execute(
+                select(Order.id, Order.hydrogen_product_id, Order.user_id, Order.order_type, Order.price_per_kg,
+                       Order.quantity_kg, Order.priority_timestamp, Order.expiration_timestamp).where(
+                    Order.hydrogen_product_id.in_(missing),
+                    Order.status == RESTING_STATUS,
+                ),
+                bind_arguments={'bind': db.engine},
+            )
+            for order_id, product_id, user_id, order_type, price, quantity, priority, expires in rows:
+                self._orders.put(order_id, product_id, user_id, SIDES[order_type], to_units(price),
+                                 to_units(quantity), to_micros(priority), to_micros(expires))
+            self._loaded.update(missing)
+
+    def apply(self, changes):
+        """Applies committed changes: order id -> _record() tuple, or None once the order stopped resting."""
+        with self._lock:
+            if self._orders is None: # Nothing loaded, so nothing held
+                return
+            for order_id, record in changes.items():
+                if record is None:
+                    self._orders.remove(order_id)
+                elif record[0] in self._loaded:
+                    self._orders.put(order_id, *record)
+
+    def remove(self, order_ids):
+        """Drops orders that stopped resting through a bulk update."""
+        with self._lock:
+            for order_id in order_ids if self._orders is not None else ():
+                self._orders.remove(order_id)
+
+    def get(self, order_id):
+        with self._lock:
+            return self._orders.get(order_id) if self._orders is not None else None
+
+    def snapshot(self, product_id, now=None):
+        """
+        The product's book as (bids, asks) BookSide arrays, loading it on first use.
+        Orders past their expiration at `now` (default: the current time) are left out,
+        as the matching engine skips them even before they are marked expired.
+        """
+        self.load(product_id)
+        now = to_micros(now or datetime.utcnow())
+        with self._lock:
+            return self._orders.side(product_id, BUY, now), self._orders.side(product_id, SELL, now)
+
+    def resting(self, product_ids, now=None):
+        """
+        The live resting orders of several products in one pass over the arrays, as a dict
+        of 'product_id', 'side', 'price' and 'quantity' arrays in no particular order.
+        The products are loaded on first use, together; expiry is handled as in snapshot().
+        """
+        product_ids = list(product_ids)
+        self.load_many(product_ids)
+        now = to_micros(now or datetime.utcnow())
+        with self._lock:
+            if self._orders is None: # No product asked for yet, so no order held
+                import numpy as np
+                return {name: np.empty(0, dtype=dtype) for name, dtype in _COLUMNS
+                        if name in ('product_id', 'side', 'price', 'quantity')}
+            return self._orders.live(product_ids, now)
+
+    def forget(self, product_id):
+        """Drops a product's orders (e.g. after the listing was deleted)."""
+        with self._lock:
+            self._loaded.discard(product_id)
+            if self._orders is not None:
+                self._orders.remove_product(product_id)
+
+    def reset(self):
+        """Discards everything (e.g. after the database was wiped)."""
+        with self._lock:
+            self._loaded.clear()
+            if self._orders is not None:
+                self._orders.clear()
+
+
+def get_order_book():
+    """The resting-order mirror of the current application."""
+    return current_app.extensions['order_book']
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _collect_book_changes(session, flush_context):
+    for instance in chain(session.new, session.dirty):
+        if isinstance(instance, Order):
+            session.info.setdefault('book_changes', {})[instance.id] = _record(instance)
+    for instance in session.deleted:
+        if isinstance(instance, Order):
+            session.info.setdefault('book_changes', {})[instance.id] = None
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _discard_book_changes(session):
+    if session.in_nested_transaction(): # Changes flushed before the savepoint are still committed later
+        return
+    session.info.pop('book_changes', None)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _apply_book_changes(session):
+    changes = session.info.pop('book_changes', None)
+    if changes and has_app_context() and 'order_book' in current_app.extensions:
+        current_app.extensions['order_book'].apply(changes)
@@ -3,7 +3,13 @@ from flask_jwt_extended import jwt_required, get_jwt_identity
 from .models import User, Order, HydrogenProduct, db, Trade # Added Trade
 from decimal import Decimal, InvalidOperation
 from datetime import datetime
-from .matching_engine import attempt_match_order # Import the matching engine
+from .matching_engine import (IMMEDIATE_TIME_IN_FORCE, TIME_IN_FORCE, amend_order, attempt_match_order,
+                              execute_immediate_order) # Import the matching engine
+from .inventory import get_inventory_ledger, InsufficientInventory
+from .exposure import get_exposure_ledger, CreditLimitExceeded
+from .idempotency import idempotent
+from .rate_limit import rate_limited
+from .notifications import enqueue_order_event
 import logging
 
 bp = Blueprint('orders', __name__)
@@ -19,6 +25,8 @@ def get_current_user():
 
 @bp.route('', methods=['POST'])
 @jwt_required()
+@idempotent
+@rate_limited('orders.create', group='orders')
 def create_order():
     """Create a new order (buy or sell)."""
     current_user = get_current_user()
@@ -51,6 +59,23 @@ def create_order():
         if order_type == 'sell' and product.seller_id != current_user.id:
             return jsonify({"msg": "You can only create sell orders for your own products."}), 403
 
+    # Orders with an expiration are good-till-date unless stated otherwise
+    time_in_force = (data.get('time_in_force') or ('GTD' if data.get('expiration_timestamp') else 'GTC')).upper()
+    if time_in_force not in TIME_IN_FORCE:
+        return jsonify({"msg": f"Invalid time_in_force. Must be one of: {', '.join(TIME_IN_FORCE)}."}), 400
+    if (time_in_force == 'GTD') != bool(data.get('expiration_timestamp')):
+        return jsonify({"msg": "expiration_timestamp is required for, and only allowed on, GTD orders."}), 400
+    if time_in_force in IMMEDIATE_TIME_IN_FORCE:
+        if not hydrogen_product_id:
+            return jsonify({"msg": f"{time_in_force} orders must specify a hydrogen_product_id."}), 400
+        return _create_immediate_order(current_user, order_type, product, data, time_in_force)
+
+    ledger = get_inventory_ledger()
+    if order_type == 'sell':
+        # Load the listing's counters before this order is flushed, so it is not counted twice
+        ledger.load(hydrogen_product_id)
+    exposure = get_exposure_ledger()
+    exposure.load(current_user.id) # Likewise for the account's credit exposure
 
     try:
         order = Order(
@@ -64,18 +89,37 @@ def create_order():
             purity_criteria=Decimal(data.get('purity_criteria')) if data.get('purity_criteria') else None,
             max_ghg_intensity_criteria=Decimal(data.get('max_ghg_intensity_criteria')) if data.get('max_ghg_intensity_criteria') else None,
             status=data.get('status', 'pending'),
-            expiration_timestamp=datetime.fromisoformat(data['expiration_timestamp']) if data.get('expiration_timestamp') else None
+            expiration_timestamp=datetime.fromisoformat(data['expiration_timestamp']) if data.get('expiration_timestamp') else None,
+            time_in_force=time_in_force
         )
         
-        # Basic validation for sell orders against product quantity
-        if order_type == 'sell' and product:
-            if order.quantity_kg > product.quantity_kg: # Assuming product.quantity_kg is what's available
-                 return jsonify({"msg": f"Sell order quantity ({order.quantity_kg}kg) cannot exceed available product quantity ({product.quantity_kg}kg)."}), 400
-
-
         db.session.add(order)
-        db.session.commit()
-        return jsonify(order.to_dict()), 201
+        db.session.flush()
+        # Hold the order's notional against the account's credit limits (checked in memory, not with SQL);
+        # the reservation ends with the transaction, committed or rolled back
+        try:
+            exposure.reserve(current_user.id, order.quantity_kg * order.price_per_kg)
+        except CreditLimitExceeded as e:
+            db.session.rollback()
+            return jsonify({"msg": str(e)}), 400
+        if order_type == 'sell':
+            # Reserve the quantity against the listing so open sell orders cannot over-commit it
+            try:
+                ledger.reserve(order.id, product.id, order.quantity_kg)
+            except InsufficientInventory as e:
+                db.session.rollback()
+                return jsonify({"msg": str(e)}), 400
+        enqueue_order_event(order)
+        try:
+            db.session.commit()
+        except Exception:
+            if order_type == 'sell':
+                ledger.release(order.id)
+            raise
+
+        trades = attempt_match_order(order.id)
+        db.session.refresh(order)
+        return jsonify({"order": order.to_dict(), "trades_made": [trade.to_dict() for trade in trades]}), 201
     except InvalidOperation:
         return jsonify({"msg": "Invalid decimal value for quantity, price, purity, or GHG intensity."}), 400
     except ValueError as ve: # For date parsing errors
@@ -85,6 +129,38 @@ def create_order():
         return jsonify({"msg": "Failed to create order", "error": str(e)}), 500
 
 
+def _create_immediate_order(current_user, order_type, product, data, time_in_force):
+    """Executes an IOC/FOK order; nothing rests in the book and only fills are stored."""
+    try:
+        quantity_kg = Decimal(data['quantity_kg'])
+        price_per_kg = Decimal(data['price_per_kg'])
+    except InvalidOperation:
+        return jsonify({"msg": "Invalid decimal value for quantity or price."}), 400
+    if quantity_kg <= 0 or price_per_kg <= 0:
+        return jsonify({"msg": "quantity_kg and price_per_kg must be positive."}), 400
+    if order_type == 'sell':
+        available = get_inventory_ledger().available(product.id)
+        if quantity_kg > available:
+            return jsonify({"msg": str(InsufficientInventory(product.id, quantity_kg, available))}), 400
+    try:
+        get_exposure_ledger().check(current_user.id, quantity_kg * price_per_kg)
+    except CreditLimitExceeded as e:
+        return jsonify({"msg": str(e)}), 400
+
+    try:
+        order, trades, execution = execute_immediate_order(
+            current_user.id, order_type, product.id, quantity_kg, price_per_kg, time_in_force
+        )
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"msg": "Failed to create order", "error": str(e)}), 500
+    return jsonify({
+        "order": order.to_dict() if order is not None else None,
+        "trades_made": [trade.to_dict() for trade in trades],
+        "execution": execution.to_dict(),
+    }), 201 if order is not None else 200
+
+
 @bp.route('', methods=['GET'])
 @jwt_required()
 def list_user_orders():
@@ -126,8 +202,13 @@ def get_order(order_id):
 
 @bp.route('/<int:order_id>', methods=['PUT'])
 @jwt_required()
+@rate_limited('orders.update', group='orders')
 def update_order(order_id):
-    """Update an order (e.g., change price, quantity), only if not yet matched."""
+    """
+    Update an order (e.g., change price, quantity), only if not yet matched.
+    Price and quantity changes are amendments (see amend_order): the order keeps its
+    time priority on a quantity decrease, and is re-matched if a new price crosses the book.
+    """
     current_user = get_current_user()
     order = Order.query.get_or_404(order_id)
 
@@ -142,25 +223,64 @@ def update_order(order_id):
     if not data:
         return jsonify({"msg": "Missing JSON in request"}), 400
 
+    ledger = get_inventory_ledger()
+    if order.order_type == 'sell' and order.hydrogen_product_id:
+        ledger.load(order.hydrogen_product_id) # Before the order is modified and autoflushed
+    exposure = get_exposure_ledger()
+    exposure.load(current_user.id)
+
     try:
-        if 'quantity_kg' in data: order.quantity_kg = Decimal(data['quantity_kg'])
-        if 'price_per_kg' in data: order.price_per_kg = Decimal(data['price_per_kg'])
-        if 'status' in data: # Be cautious allowing direct status updates - might be for cancellation
-            new_status = data['status'].lower()
-            if new_status == 'cancelled' and order.status == 'pending':
-                order.status = new_status
-            elif new_status != order.status: # Prevent arbitrary status changes
-                 return jsonify({"msg": f"Updating status to '{new_status}' is not allowed or invalid transition."}), 400
+        quantity_kg = Decimal(data['quantity_kg']) if 'quantity_kg' in data else None
+        price_per_kg = Decimal(data['price_per_kg']) if 'price_per_kg' in data else None
+        if (quantity_kg is not None and quantity_kg <= 0) or (price_per_kg is not None and price_per_kg <= 0):
+            return jsonify({"msg": "quantity_kg and price_per_kg must be positive."}), 400
+        # Be cautious allowing direct status updates - only cancellation; checked before anything is amended
+        new_status = str(data['status']).lower() if 'status' in data else None
+        if new_status is not None and new_status not in ('cancelled', order.status): # Prevent arbitrary status changes
+            return jsonify({"msg": f"Updating status to '{new_status}' is not allowed or invalid transition."}), 400
+        previous_notional = order.quantity_kg * order.price_per_kg # A pending order's exposure before the amendment
+        repriced = amend_order(order, quantity_kg, price_per_kg)
+        if new_status == 'cancelled':
+            order.status = new_status
+            order.cancelled_timestamp = datetime.utcnow()
         if 'expiration_timestamp' in data:
             order.expiration_timestamp = datetime.fromisoformat(data['expiration_timestamp']) if data.get('expiration_timestamp') else None
 
-        # Re-validate sell order quantity if it's a sell order and quantity changes
+        enqueue_order_event(order)
+        if order.order_type == 'sell' and order.status == 'cancelled':
+            db.session.commit()
+            ledger.release(order.id)
+            return jsonify(order.to_dict()), 200
+
+        # Hold the amended notional against the account's credit limits (an increase may be rejected)
+        if quantity_kg is not None or price_per_kg is not None:
+            try:
+                exposure.reserve(current_user.id, order.quantity_kg * order.price_per_kg, previous_notional)
+            except CreditLimitExceeded as e:
+                db.session.rollback()
+                return jsonify({"msg": str(e)}), 400
+
+        # Re-reserve sell order quantity if it's a sell order and quantity changes
+        previous_quantity = None
         if order.order_type == 'sell' and order.product and 'quantity_kg' in data:
-            if order.quantity_kg > order.product.quantity_kg: # Assuming product.quantity_kg is what's available
-                 return jsonify({"msg": f"Sell order quantity ({order.quantity_kg}kg) cannot exceed available product quantity ({order.product.quantity_kg}kg)."}), 400
+            previous_quantity = ledger.reserved_for(order.id, order.hydrogen_product_id)
+            try:
+                ledger.reserve(order.id, order.hydrogen_product_id, order.quantity_kg)
+            except InsufficientInventory as e:
+                db.session.rollback()
+                return jsonify({"msg": str(e)}), 400
 
+        try:
+            db.session.commit()
+        except Exception:
+            if previous_quantity is not None:
+                ledger.reserve(order.id, order.hydrogen_product_id, previous_quantity) # Undo the resize
+            raise
 
-        db.session.commit()
+        if repriced and order.status == 'pending':
+            # The new price may cross the book; match now rather than leave a crossed order resting
+            attempt_match_order(order.id)
+            db.session.refresh(order)
         return jsonify(order.to_dict()), 200
     except InvalidOperation:
         return jsonify({"msg": "Invalid decimal value for quantity or price."}), 400
@@ -173,6 +293,7 @@ def update_order(order_id):
 
 @bp.route('/<int:order_id>', methods=['DELETE'])
 @jwt_required()
+@rate_limited('orders.cancel', group='orders', priority=True) # Cancels are admitted ahead of new orders
 def cancel_order(order_id):
     """Cancel an order, only if not yet matched (changes status to 'cancelled')."""
     current_user = get_current_user()
@@ -186,8 +307,11 @@ def cancel_order(order_id):
     
     try:
         order.status = 'cancelled'
-        # Potentially, reverse any held quantities or credits here in a real system
+        order.cancelled_timestamp = datetime.utcnow()
+        enqueue_order_event(order)
         db.session.commit()
+        if order.order_type == 'sell':
+            get_inventory_ledger().release(order.id) # Return the reserved quantity to the listing
         return jsonify({"msg": "Order cancelled successfully", "order": order.to_dict()}), 200
     except Exception as e:
         db.session.rollback()
@@ -0,0 +1,392 @@
+"""
+Platform statistics for administrators, served from counters instead of table scans.
+
+Every flush collects its deltas (see app/counters.py): the number of users,
+listings per status and orders per status (period 'all', moved between statuses as
+rows change), and trades, volume and notional per day, overall and per product.
+Placing an order or trading marks the user active for the day in user_activity.
+Writes that bypass the session report their own deltas: the bulk product import,
+the bulk order expiry and the inventory flusher, which marks sold-out listings.
+
+The deltas are not written in the order or trade transaction: every one of them
+would update the same few gauge and daily rows, and on PostgreSQL the row locks
+would serialise all writers until commit. Instead, a committed transaction's
+deltas are added to the PlatformStatsBuffer of the process (dropped on rollback),
+which a background thread writes every PLATFORM_STATS_FLUSH_INTERVAL_SECONDS, in
+one short transaction of its own, and at shutdown. The statistics of a process lag
+by at most one interval; admin_statistics() flushes its own process first.
+
+`flask compact-stats` is meant to run periodically (e.g. nightly from cron). It
+folds daily trade rows older than the retention window into monthly rows, records
+each finished day's active user count and drops activity rows older than the
+window, so the statistics tables stay small however long the platform runs. With
+--reconcile it also recounts the gauges from the tables, repairing drift from
+writes made outside the application.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+import click
+from flask import current_app, has_app_context
+from flask.cli import with_appcontext
+from sqlalchemy import delete, event, func, inspect, select
+
+from . import db
+from .counters import committed_values, increment, insert_missing
+from .db_routing import RoutingSession
+from .inventory import OPEN_ORDER_STATUSES
+from .models import HydrogenProduct, Order, PlatformStat, Trade, User, UserActivity
+
+logger = logging.getLogger(__name__)
+
+KEYS = ('name', 'period', 'period_start', 'dimension')
+ALL_TIME = date(1970, 1, 1) # period_start of the 'all' gauges
+DAY_RETENTION_DAYS = 35 # Daily rows and activity kept before compaction folds them (>= 30)
+DEFAULT_FLUSH_INTERVAL_SECONDS = 5.0
+PERIODS = ('day', 'month')
+_KG = Decimal('0.01')
+
+
+class _Deltas:
+    """PlatformStat rows keyed by (name, period, period_start, dimension), plus active users."""
+
+    def __init__(self):
+        self.rows = {}
+        self.active = set()
+
+    def add(self, name, period, period_start, dimension='', count=0, volume_kg=0, notional=0):
+        row = self.rows.setdefault((name, period, period_start, str(dimension)), dict(
+            name=name, period=period, period_start=period_start, dimension=str(dimension),
+            count=0, volume_kg=Decimal(0), notional=Decimal(0),
+        ))
+        row['count'] += count
+        row['volume_kg'] += Decimal(volume_kg)
+        row['notional'] += Decimal(notional)
+
+    def gauge(self, name, dimension, count):
+        self.add(name, 'all', ALL_TIME, dimension, count=count)
+
+    def merge(self, other):
+        for row in other.rows.values():
+            self.add(**row)
+        self.active |= other.active
+
+    def __bool__(self):
+        return bool(self.rows or self.active)
+
+    def trade(self, trade, today):
+        quantity = Decimal(trade.quantity_traded_kg)
+        notional = quantity * Decimal(trade.price_per_kg_agreed)
+        self.add('trades', 'day', today, count=1, volume_kg=quantity, notional=notional)
+        self.add('product_trades', 'day', today, trade.hydrogen_product_id, count=1, volume_kg=quantity, notional=notional)
+        self.active.update(((today, trade.buyer_id), (today, trade.seller_id)))
+
+    def write(self, connection=None):
+        rows = [row for row in self.rows.values() if row['count'] or row['volume_kg'] or row['notional']]
+        increment(PlatformStat, rows, keys=KEYS, connection=connection)
+        insert_missing(UserActivity, [{'activity_date': day, 'user_id': user_id} for day, user_id in self.active if user_id],
+                       keys=('activity_date', 'user_id'), connection=connection)
+
+
+class PlatformStatsBuffer:
+    """Committed deltas of one application process, written in batches (see module docstring)."""
+
+    def __init__(self, app):
+        self.app = app
+        self.flush_interval = app.config.get('PLATFORM_STATS_FLUSH_INTERVAL_SECONDS', DEFAULT_FLUSH_INTERVAL_SECONDS)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock() # Serialises flushes so a failed batch is put back before the next one
+        self._pending = _Deltas()
+        self._flusher = None
+        atexit.register(self._flush_at_exit)
+
+    def add(self, deltas):
+        """Adds the deltas of a committed transaction."""
+        with self._lock:
+            self._pending.merge(deltas)
+        self._ensure_flusher()
+
+    def reset(self):
+        """Discards the deltas not written yet (e.g. after the database was wiped)."""
+        with self._lock:
+            self._pending = _Deltas()
+
+    def flush(self):
+        """Writes the accumulated deltas in one transaction; returns the number of counter rows."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, _Deltas()
+            if not batch:
+                return 0
+            try:
+                with self.app.app_context():
+                    with db.engine.begin() as connection:
+                        batch.write(connection)
+            except Exception:
+                with self._lock: # Put the deltas back so the next flush retries them
+                    self._pending.merge(batch)
+                raise
+            logger.debug(f"Flushed {len(batch.rows)} platform stat delta(s).")
+            return len(batch.rows)
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._run_flusher, name='platform-stats-flusher', daemon=True)
+            self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush platform stats: {e}")
+
+    def _flush_at_exit(self):
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Failed to flush platform stats at exit: {e}")
+
+
+def get_platform_stats():
+    """The platform statistics buffer of the current application."""
+    return current_app.extensions['platform_stats']
+
+
+def _session_deltas(session):
+    """The deltas of the session's current transaction, added to the buffer on commit."""
+    return session.info.setdefault('platform_stats', _Deltas())
+
+
+def _status_changed(instance):
+    return bool(inspect(instance).attrs.status.history.added)
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def _record_platform_stats(session, flush_context, instances):
+    deltas = _Deltas() # Merged only once collected, so a failed collection adds nothing
+    today = datetime.utcnow().date()
+    for instance in session.new:
+        if isinstance(instance, User):
+            deltas.gauge('users', '', 1)
+        elif isinstance(instance, HydrogenProduct):
+            deltas.gauge('listings', instance.status or 'active', 1)
+        elif isinstance(instance, Order):
+            deltas.gauge('orders', instance.status or 'pending', 1)
+            deltas.active.add((today, instance.user_id))
+        elif isinstance(instance, Trade):
+            deltas.trade(instance, today)
+    for model, name in ((HydrogenProduct, 'listings'), (Order, 'orders')):
+        changed = [i for i in session.dirty if isinstance(i, model) and _status_changed(i)]
+        deleted = [i for i in session.deleted if isinstance(i, model)]
+        if not changed and not deleted:
+            continue
+        previous = committed_values(model, changed + deleted, ('status',))
+        for instance in changed:
+            deltas.gauge(name, previous[instance.id][0], -1)
+            deltas.gauge(name, instance.status, 1)
+        for instance in deleted:
+            deltas.gauge(name, previous[instance.id][0], -1)
+    for instance in session.deleted:
+        if isinstance(instance, User):
+            deltas.gauge('users', '', -1)
+    if deltas:
+        _session_deltas(session).merge(deltas)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _discard_platform_stats(session):
+    if session.in_nested_transaction(): # Only the savepoint was undone, not the deltas of the outer transaction
+        return
+    session.info.pop('platform_stats', None)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _buffer_platform_stats(session):
+    deltas = session.info.pop('platform_stats', None)
+    if deltas and has_app_context() and 'platform_stats' in current_app.extensions:
+        get_platform_stats().add(deltas)
+
+
+def record_imported_listings(rows):
+    """Counts listings inserted in bulk (rows of column values, as for INSERT) in the session's transaction."""
+    deltas = _session_deltas(db.session)
+    for row in rows:
+        deltas.gauge('listings', row.get('status') or 'active', 1)
+
+
+def record_status_changes(changes, name='orders'):
+    """Moves rows changed by a bulk UPDATE between statuses: changes are (old status, new status) pairs."""
+    deltas = _session_deltas(db.session)
+    for old, new in changes:
+        deltas.gauge(name, old, -1)
+        deltas.gauge(name, new, 1)
+
+
+def record_sold_out_listings(old_statuses):
+    """Counts listings the inventory flusher marked sold, once its own transaction committed."""
+    deltas = _Deltas()
+    for old in old_statuses:
+        deltas.gauge('listings', old, -1)
+        deltas.gauge('listings', 'sold', 1)
+    get_platform_stats().add(deltas)
+
+
+def _month(day):
+    return day.replace(day=1)
+
+
+def compact_platform_stats(keep_days=DAY_RETENTION_DAYS, reconcile=False, today=None):
+    """
+    Folds old daily rows into months, records finished days' active users and prunes activity.
+
+    Returns:
+        dict: Counts of the rows folded, days recorded and activity rows deleted.
+    """
+    get_platform_stats().flush() # This process's deltas first, so they are folded and reconciled too
+    keep_days = max(keep_days, 30) # The last-30-days active user count reads the activity rows
+    today = today or datetime.utcnow().date()
+    cutoff = today - timedelta(days=keep_days)
+
+    old_days = select(PlatformStat).where(PlatformStat.period == 'day', PlatformStat.name != 'active_users',
+                                          PlatformStat.period_start < cutoff)
+    months = _Deltas()
+    folded = 0
+    for row in db.session.scalars(old_days):
+        months.add(row.name, 'month', _month(row.period_start), row.dimension, row.count, row.volume_kg, row.notional)
+        folded += 1
+    months.write()
+    db.session.execute(delete(PlatformStat).where(PlatformStat.period == 'day', PlatformStat.name != 'active_users',
+                                                  PlatformStat.period_start < cutoff))
+
+    daily_active = db.session.execute(
+        select(UserActivity.activity_date, func.count()).where(UserActivity.activity_date < today)
+        .group_by(UserActivity.activity_date)
+    ).all()
+    insert_missing(PlatformStat, [
+        {'name': 'active_users', 'period': 'day', 'period_start': day, 'dimension': '', 'count': count,
+         'volume_kg': 0, 'notional': 0} for day, count in daily_active
+    ], keys=KEYS)
+    pruned = db.session.execute(delete(UserActivity).where(UserActivity.activity_date < cutoff)).rowcount
+
+    if reconcile:
+        db.session.execute(delete(PlatformStat).where(PlatformStat.period == 'all'))
+        gauges = _Deltas()
+        gauges.gauge('users', '', db.session.execute(select(func.count()).select_from(User)).scalar())
+        for name, model in (('listings', HydrogenProduct), ('orders', Order)):
+            for status, count in db.session.execute(select(model.status, func.count()).group_by(model.status)):
+                gauges.gauge(name, status, count)
+        gauges.write()
+    db.session.commit()
+    logger.info(f"Compacted platform stats: {folded} daily row(s) folded, {len(daily_active)} day(s) of active users, "
+                f"{pruned} activity row(s) pruned{', gauges reconciled' if reconcile else ''}.")
+    return {'folded': folded, 'active_days': len(daily_active), 'pruned': pruned}
+
+
+def _flows(row):
+    flows = {'trade_count': row['count'], 'volume_kg': str(Decimal(row['volume_kg']).quantize(_KG)),
+             'notional': str(Decimal(row['notional']).quantize(_KG))}
+    if 'active_users' in row:
+        flows['active_users'] = row['active_users']
+    return flows
+
+
+def admin_statistics(period='day', days=30, months=12, top=10, today=None):
+    """
+    The admin dashboard figures, read from the counters.
+
+    Args:
+        period (str): 'day' (the last `days` days) or 'month' (the last `months` months) for the trade series.
+        days (int): Window of the daily series and of the top products; at most DAY_RETENTION_DAYS.
+        months (int): Window of the monthly series.
+        top (int): Number of top products by traded volume.
+    """
+    get_platform_stats().flush() # The deltas of this process are visible at once; others lag by an interval
+    today = today or datetime.utcnow().date()
+    days = max(1, min(days, DAY_RETENTION_DAYS))
+    window_start = today - timedelta(days=days - 1)
+
+    gauges = defaultdict(dict)
+    for row in db.session.execute(select(PlatformStat.name, PlatformStat.dimension, PlatformStat.count)
+                                  .where(PlatformStat.period == 'all')):
+        if row.count:
+            gauges[row.name][row.dimension] = row.count
+
+    active = {}
+    for label, since in (('today', today), ('last_7_days', today - timedelta(days=6)), ('last_30_days', today - timedelta(days=29))):
+        active[label] = db.session.execute(
+            select(func.count(func.distinct(UserActivity.user_id))).where(UserActivity.activity_date >= since)
+        ).scalar()
+
+    series = defaultdict(lambda: {'count': 0, 'volume_kg': 0, 'notional': 0})
+    if period == 'day':
+        series_start = window_start
+    else:
+        series_start = _month(today)
+        for _ in range(max(1, months) - 1):
+            series_start = _month(series_start - timedelta(days=1))
+    for row in db.session.execute(select(PlatformStat).where(PlatformStat.name == 'trades',
+                                                             PlatformStat.period_start >= series_start)).scalars():
+        if period == 'day' and row.period != 'day':
+            continue
+        bucket = series[row.period_start if period == 'day' else _month(row.period_start)]
+        for name in ('count', 'volume_kg', 'notional'):
+            bucket[name] += getattr(row, name)
+
+    if period == 'day':
+        for row in db.session.execute(select(PlatformStat.period_start, PlatformStat.count).where(
+                PlatformStat.name == 'active_users', PlatformStat.period == 'day', PlatformStat.period_start >= series_start)):
+            series[row.period_start]['active_users'] = row.count
+        series[today]['active_users'] = active['today']
+
+    products = defaultdict(lambda: {'count': 0, 'volume_kg': 0, 'notional': 0})
+    for row in db.session.execute(select(PlatformStat).where(PlatformStat.name == 'product_trades', PlatformStat.period == 'day',
+                                                             PlatformStat.period_start >= window_start)).scalars():
+        for name in ('count', 'volume_kg', 'notional'):
+            products[row.dimension][name] += getattr(row, name)
+    ranked = sorted(products.items(), key=lambda item: (-item[1]['volume_kg'], int(item[0])))[:top]
+    listings = {p.id: p for p in db.session.scalars(select(HydrogenProduct).where(
+        HydrogenProduct.id.in_([int(product_id) for product_id, _ in ranked])))}
+
+    orders = gauges.get('orders', {})
+    return {
+        'generated_at': datetime.utcnow().isoformat(),
+        'users': {'total': gauges.get('users', {}).get('', 0), 'active': active},
+        'listings': {'by_status': gauges.get('listings', {}), 'total': sum(gauges.get('listings', {}).values())},
+        'orders': {'by_status': orders, 'open': sum(orders.get(status, 0) for status in OPEN_ORDER_STATUSES)},
+        'trading': {
+            'period': period,
+            'series': [{'period_start': start.isoformat(), **_flows(bucket)} for start, bucket in sorted(series.items())],
+        },
+        'top_products': {
+            'days': days,
+            'products': [{
+                'hydrogen_product_id': int(product_id),
+                'location_region': listings[int(product_id)].location_region if int(product_id) in listings else None,
+                'production_method': listings[int(product_id)].production_method if int(product_id) in listings else None,
+                **_flows(totals),
+            } for product_id, totals in ranked],
+        },
+    }
+
+
+@click.command('compact-stats')
+@click.option('--keep-days', type=int, default=DAY_RETENTION_DAYS, show_default=True,
+              help='Days of daily trade rows and user activity to keep.')
+@click.option('--reconcile', is_flag=True, help='Also recount users, listings and orders per status from the tables.')
+@with_appcontext
+def compact_stats_command(keep_days, reconcile):
+    """Compact the admin statistics counters (run periodically, e.g. nightly)."""
+    result = compact_platform_stats(keep_days, reconcile)
+    click.echo(f"Folded {result['folded']} daily row(s), recorded {result['active_days']} day(s) of active users, "
+               f"pruned {result['pruned']} activity row(s).")
@@ -0,0 +1,240 @@
+"""
+Positions and open-order exposure per user and product.
+
+Every flush that adds a Trade or inserts, changes or deletes an Order adds its deltas
+to the Position counters in the same transaction (one INSERT ... ON CONFLICT DO
+UPDATE, see app/counters.py), so the totals are exact whichever code path filled,
+cancelled, amended or expired the order. A Trade adds to the buyer's bought and the
+seller's sold quantity and notional. An open (pending or partially filled) order
+contributes its remaining quantity and quantity * limit price to its owner's open
+buy or sell exposure, and a change replaces the old contribution with the new one.
+The bulk expiry in app/inventory.py bypasses the session and calls
+record_closed_orders itself. These open-order counters are also the source of the
+credit exposure checked at order entry: the per-user open notional deltas are handed
+to app/exposure.py, which applies them to its in-memory totals on commit.
+
+Averages and P&L are derived on read from those additive counters (average price per
+side): the average buy and sell prices are notional / quantity, the closed quantity
+is min(bought, sold) and realized P&L is closed * (average sell - average buy). The
+open net quantity carries the average price of the side it is on. The dashboard
+endpoint reads a user's rows by primary key; `flask rebuild-positions` recomputes
+all of them from trades and open orders with one INSERT ... SELECT.
+"""
+import logging
+from decimal import Decimal
+
+import click
+from flask import Blueprint, jsonify, request
+from flask.cli import with_appcontext
+from flask_jwt_extended import get_jwt_identity, jwt_required
+from sqlalchemy import delete, event, func, insert, literal, select, union_all
+
+from . import db
+from .counters import committed_values, increment
+from .db_routing import RoutingSession, read_only
+from .exposure import record_exposure_changes
+from .inventory import OPEN_ORDER_STATUSES
+from .models import Order, Position, Trade, User
+
+bp = Blueprint('positions', __name__)
+logger = logging.getLogger(__name__)
+
+KEYS = ('user_id', 'hydrogen_product_id')
+COUNTERS = ('trade_count', 'bought_kg', 'bought_notional', 'sold_kg', 'sold_notional',
+            'open_order_count', 'open_buy_kg', 'open_buy_notional', 'open_sell_kg', 'open_sell_notional')
+_KG = Decimal('0.01')
+_PRICE = Decimal('0.0001')
+
+
+def get_current_user():
+    """Helper function to get the current authenticated user."""
+    user_identity = get_jwt_identity()
+    username = user_identity.get('username')
+    return User.query.filter_by(username=username).first()
+
+
+def _row(deltas, user_id, product_id):
+    return deltas.setdefault((user_id, product_id), dict(
+        user_id=user_id, hydrogen_product_id=product_id, **{name: 0 for name in COUNTERS}
+    ))
+
+
+def _add_open_order(deltas, user_id, product_id, order_type, status, quantity, price, sign):
+    """
+    Adds (sign=1) or removes (sign=-1) an order's contribution to its owner's open exposure.
+    Orders without a listing (criteria buys) get a row keyed by product None: it has no
+    Position row, but counts towards the credit exposure.
+    """
+    if user_id is None or (status or 'pending') not in OPEN_ORDER_STATUSES:
+        return
+    row = _row(deltas, user_id, product_id)
+    side = 'open_buy' if order_type == 'buy' else 'open_sell'
+    row['open_order_count'] += sign
+    row[f'{side}_kg'] += sign * Decimal(quantity)
+    row[f'{side}_notional'] += sign * Decimal(quantity) * Decimal(price)
+
+
+def _record(session, deltas):
+    """Writes the deltas and hands their open notional per user to the credit exposure ledger."""
+    rows = [row for row in deltas.values() if any(row[name] for name in COUNTERS)]
+    increment(Position, [row for row in rows if row['hydrogen_product_id'] is not None], keys=KEYS)
+    exposure = {}
+    for row in rows:
+        notional = row['open_buy_notional'] + row['open_sell_notional']
+        if notional:
+            exposure[row['user_id']] = exposure.get(row['user_id'], 0) + notional
+    record_exposure_changes(session, exposure)
+
+
+def _add_trade(deltas, trade):
+    quantity, notional = Decimal(trade.quantity_traded_kg), Decimal(trade.quantity_traded_kg) * Decimal(trade.price_per_kg_agreed)
+    buyer = _row(deltas, trade.buyer_id, trade.hydrogen_product_id)
+    buyer['trade_count'] += 1
+    buyer['bought_kg'] += quantity
+    buyer['bought_notional'] += notional
+    seller = _row(deltas, trade.seller_id, trade.hydrogen_product_id)
+    seller['trade_count'] += 1
+    seller['sold_kg'] += quantity
+    seller['sold_notional'] += notional
+
+
+_ORDER_FIELDS = ('user_id', 'hydrogen_product_id', 'order_type', 'status', 'quantity_kg', 'price_per_kg')
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def _record_position_changes(session, flush_context, instances):
+    deltas = {}
+    changed = [o for o in session.dirty if isinstance(o, Order) and session.is_modified(o)]
+    deleted = [o for o in session.deleted if isinstance(o, Order)]
+    committed = committed_values(Order, changed + deleted, _ORDER_FIELDS) if changed or deleted else {}
+    for instance in session.new:
+        if isinstance(instance, Trade):
+            _add_trade(deltas, instance)
+        elif isinstance(instance, Order):
+            _add_open_order(deltas, instance.user_id, instance.hydrogen_product_id, instance.order_type,
+                            instance.status, instance.quantity_kg, instance.price_per_kg, 1)
+    for order in changed:
+        _add_open_order(deltas, *committed[order.id], -1)
+        _add_open_order(deltas, order.user_id, order.hydrogen_product_id, order.order_type, order.status,
+                        order.quantity_kg, order.price_per_kg, 1)
+    for order in deleted:
+        _add_open_order(deltas, *committed[order.id], -1)
+    _record(session, deltas)
+
+
+def record_closed_orders(orders):
+    """Removes the open exposure of orders that were closed by a bulk UPDATE (status already changed)."""
+    deltas = {}
+    for order in orders:
+        _add_open_order(deltas, order.user_id, order.hydrogen_product_id, order.order_type, 'pending',
+                        order.quantity_kg, order.price_per_kg, -1)
+    _record(db.session, deltas)
+
+
+def rebuild_positions():
+    """Recomputes all positions from trades and open orders; returns the number of rows written."""
+    zero = literal(0)
+    notional = Trade.quantity_traded_kg * Trade.price_per_kg_agreed
+
+    def columns(user_id, product_id, **values):
+        return [user_id.label('user_id'), product_id.label('hydrogen_product_id')] + [
+            values.get(name, zero).label(name) for name in COUNTERS
+        ]
+
+    open_order = (Order.status.in_(OPEN_ORDER_STATUSES), Order.hydrogen_product_id.is_not(None))
+    sources = union_all(
+        select(*columns(Trade.buyer_id, Trade.hydrogen_product_id, trade_count=literal(1),
+                        bought_kg=Trade.quantity_traded_kg, bought_notional=notional)),
+        select(*columns(Trade.seller_id, Trade.hydrogen_product_id, trade_count=literal(1),
+                        sold_kg=Trade.quantity_traded_kg, sold_notional=notional)),
+        select(*columns(Order.user_id, Order.hydrogen_product_id, open_order_count=literal(1),
+                        open_buy_kg=Order.quantity_kg, open_buy_notional=Order.quantity_kg * Order.price_per_kg))
+        .where(Order.order_type == 'buy', *open_order),
+        select(*columns(Order.user_id, Order.hydrogen_product_id, open_order_count=literal(1),
+                        open_sell_kg=Order.quantity_kg, open_sell_notional=Order.quantity_kg * Order.price_per_kg))
+        .where(Order.order_type == 'sell', *open_order),
+    ).subquery()
+    totals = select(sources.c.user_id, sources.c.hydrogen_product_id,
+                    *(func.sum(sources.c[name]) for name in COUNTERS)) \
+        .group_by(sources.c.user_id, sources.c.hydrogen_product_id)
+    db.session.execute(delete(Position))
+    result = db.session.execute(insert(Position).from_select([*KEYS, *COUNTERS], totals))
+    db.session.commit()
+    return result.rowcount
+
+
+def _average(notional, quantity):
+    return notional / quantity if quantity else None
+
+
+def _quantized(value, quantum):
+    return str(value.quantize(quantum)) if value is not None else None
+
+
+def position_dict(position):
+    """Serializes a Position with its derived averages, net quantity and realized P&L."""
+    bought, sold = Decimal(position.bought_kg), Decimal(position.sold_kg)
+    average_buy = _average(Decimal(position.bought_notional), bought)
+    average_sell = _average(Decimal(position.sold_notional), sold)
+    closed = min(bought, sold)
+    net = bought - sold
+    return {
+        'hydrogen_product_id': position.hydrogen_product_id,
+        'trade_count': position.trade_count,
+        'bought_kg': _quantized(bought, _KG),
+        'sold_kg': _quantized(sold, _KG),
+        'net_kg': _quantized(net, _KG),
+        'average_buy_price': _quantized(average_buy, _PRICE),
+        'average_sell_price': _quantized(average_sell, _PRICE),
+        'average_price': _quantized(average_buy if net > 0 else average_sell if net < 0 else None, _PRICE),
+        'realized_pnl': _quantized(closed * (average_sell - average_buy) if closed else Decimal(0), _KG),
+        'open_orders': position.open_order_count,
+        'open_buy_kg': _quantized(Decimal(position.open_buy_kg), _KG),
+        'open_buy_notional': _quantized(Decimal(position.open_buy_notional), _KG),
+        'open_sell_kg': _quantized(Decimal(position.open_sell_kg), _KG),
+        'open_sell_notional': _quantized(Decimal(position.open_sell_notional), _KG),
+    }
+
+
+def get_positions(user_id, product_id=None):
+    """The user's non-empty positions, by product id."""
+    stmt = select(Position).where(Position.user_id == user_id, (Position.trade_count > 0) | (Position.open_order_count > 0))
+    if product_id is not None:
+        stmt = stmt.where(Position.hydrogen_product_id == product_id)
+    return [position_dict(position) for position in db.session.scalars(stmt.order_by(Position.hydrogen_product_id))]
+
+
+@bp.route('', methods=['GET'])
+@jwt_required()
+@read_only
+def list_positions():
+    """
+    The current user's positions and open-order exposure per product.
+    Query parameters: product_id; user_id (admins only).
+    """
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({"msg": "User not found"}), 404
+    user_id = current_user.id
+    if request.args.get('user_id', type=int) not in (None, current_user.id):
+        if 'admin' not in get_jwt_identity().get('roles', []):
+            return jsonify({"msg": "Admin access required to view other users' positions."}), 403
+        user_id = request.args.get('user_id', type=int)
+
+    positions = get_positions(user_id, request.args.get('product_id', type=int))
+    return jsonify({
+        'user_id': user_id,
+        'positions': positions,
+        'totals': {
+            name: str(sum((Decimal(p[name]) for p in positions), Decimal('0.00')))
+            for name in ('realized_pnl', 'open_buy_notional', 'open_sell_notional')
+        },
+    }), 200
+
+
+@click.command('rebuild-positions')
+@with_appcontext
+def rebuild_positions_command():
+    """Recompute all positions from the trade history and open orders."""
+    rows = rebuild_positions()
+    click.echo(f"Rebuilt positions: {rows} row(s).")
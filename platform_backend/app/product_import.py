@@ -0,0 +1,226 @@
+"""
+Bulk import of HydrogenProduct listings from CSV or NDJSON.
+
+All rows are validated in a single pass (collecting per-row errors) before anything
+is written, then inserted in chunks with one executemany per chunk, or with COPY
+when running on PostgreSQL through psycopg2.
+"""
+import csv
+import io
+import json
+import logging
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import insert
+
+from .models import User, HydrogenProduct, db
+from .platform_stats import record_imported_listings
+
+logger = logging.getLogger(__name__)
+
+# Rows per INSERT executemany / COPY round-trip.
+IMPORT_CHUNK_SIZE = 5000
+# Upper bound on rows accepted in one import request.
+MAX_IMPORT_ROWS = 100000
+
+REQUIRED_FIELDS = ['quantity_kg', 'price_per_kg', 'location_region', 'production_method']
+DECIMAL_FIELDS = {
+    # field: (max digits before the decimal point, allow zero)
+    'quantity_kg': (8, False),
+    'price_per_kg': (8, False),
+    'purity_percentage': (2, True),
+    'ghg_intensity_kgco2e_per_kgh2': (6, True),
+}
+TEXT_FIELDS = {
+    # field: max length (None for unbounded Text columns)
+    'location_region': 100,
+    'location_plant_id': 100,
+    'production_method': 100,
+    'delivery_terms': None,
+    'feedstock': 100,
+    'energy_source': 100,
+}
+IMPORT_STATUSES = ('active', 'inactive')
+
+# Column order used for COPY and for the inserted row dicts.
+IMPORT_COLUMNS = ['seller_id'] + list(DECIMAL_FIELDS) + list(TEXT_FIELDS) + ['available_from_date', 'status']
+
+
+def _blank(value):
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def parse_product_row(data, seller_id):
+    """
+    Validates one raw import row and converts it to HydrogenProduct column values.
+
+    Returns:
+        tuple[dict | None, list[str]]: the column values (None if invalid) and the errors found.
+    """
+    errors = []
+    row = {'seller_id': seller_id}
+
+    for field in REQUIRED_FIELDS:
+        if _blank(data.get(field)):
+            errors.append(f"Missing required field: {field}")
+
+    for field, (max_int_digits, allow_zero) in DECIMAL_FIELDS.items():
+        value = data.get(field)
+        if _blank(value):
+            row[field] = None
+            continue
+        try:
+            number = Decimal(str(value).strip())
+        except InvalidOperation:
+            errors.append(f"Invalid decimal value for {field}: {value!r}")
+            continue
+        if not number.is_finite() or number < 0 or (number == 0 and not allow_zero):
+            errors.append(f"{field} must be {'non-negative' if allow_zero else 'positive'}")
+        elif number.adjusted() >= max_int_digits:
+            errors.append(f"{field} is out of range: {value}")
+        row[field] = number
+
+    for field, max_length in TEXT_FIELDS.items():
+        value = data.get(field)
+        value = None if _blank(value) else str(value).strip()
+        if value is not None and max_length is not None and len(value) > max_length:
+            errors.append(f"{field} exceeds {max_length} characters")
+        row[field] = value
+
+    available_from = data.get('available_from_date')
+    row['available_from_date'] = None
+    if not _blank(available_from):
+        try:
+            row['available_from_date'] = date.fromisoformat(str(available_from).strip())
+        except ValueError:
+            errors.append(f"Date format error for available_from_date: {available_from!r}")
+
+    status = data.get('status')
+    row['status'] = 'active' if _blank(status) else str(status).strip().lower()
+    if row['status'] not in IMPORT_STATUSES:
+        errors.append(f"Invalid status '{status}'. Must be one of: {', '.join(IMPORT_STATUSES)}")
+
+    return (None if errors else row), errors
+
+
+def read_import_rows(stream, import_format):
+    """Yields raw row dicts from a text stream of CSV (with header) or NDJSON."""
+    if import_format == 'csv':
+        yield from csv.DictReader(stream)
+        return
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield {'__error__': f"Invalid JSON: {e}"}
+            continue
+        yield record if isinstance(record, dict) else {'__error__': "Each NDJSON line must be an object"}
+
+
+def validate_import(raw_rows, seller_id, max_rows=MAX_IMPORT_ROWS):
+    """
+    Validates all rows in one pass.
+
+    Returns:
+        tuple[list[dict], list[dict]]: valid rows and per-row errors ({'row': n, 'errors': [...]}),
+        with rows numbered from 1 in input order.
+    """
+    valid, row_errors = [], []
+    for number, data in enumerate(raw_rows, start=1):
+        if number > max_rows:
+            row_errors.append({'row': number, 'errors': [f"Import is limited to {max_rows} rows"]})
+            break
+        if '__error__' in data:
+            row_errors.append({'row': number, 'errors': [data['__error__']]})
+            continue
+        row, errors = parse_product_row(data, seller_id)
+        if errors:
+            row_errors.append({'row': number, 'errors': errors})
+        else:
+            valid.append(row)
+    return valid, row_errors
+
+
+def _copy_rows(rows):
+    """Streams rows into hydrogen_products with PostgreSQL COPY (psycopg2 only)."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['' if row[column] is None else row[column] for column in IMPORT_COLUMNS])
+    buffer.seek(0)
+    driver_connection = db.session.connection().connection.driver_connection
+    with driver_connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {HydrogenProduct.__tablename__} ({', '.join(IMPORT_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+            buffer
+        )
+
+
+def bulk_insert_products(rows, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Inserts validated product rows in chunks and commits once.
+
+    Returns:
+        int: The number of rows inserted.
+    """
+    engine = db.session.get_bind()
+    use_copy = engine.dialect.name == 'postgresql' and engine.dialect.driver == 'psycopg2'
+    try:
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            if use_copy:
+                _copy_rows(chunk)
+            else:
+                db.session.execute(insert(HydrogenProduct), chunk)
+        record_imported_listings(rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    logger.info(f"Bulk imported {len(rows)} product listing(s){' via COPY' if use_copy else ''}.")
+    return len(rows)
+
+
+def import_products(stream, import_format, seller_id, allow_partial=False):
+    """
+    Validates and imports listings for one seller.
+
+    Unless allow_partial is set, nothing is inserted when any row is invalid.
+
+    Returns:
+        dict: 'imported' count and per-row 'errors'.
+    """
+    valid, row_errors = validate_import(read_import_rows(stream, import_format), seller_id)
+    if row_errors and not allow_partial:
+        return {'imported': 0, 'errors': row_errors}
+    imported = bulk_insert_products(valid) if valid else 0
+    return {'imported': imported, 'errors': row_errors}
+
+
+@click.command('import-products')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--seller', required=True, help='Username of the seller that will own the listings.')
+@click.option('--format', 'import_format', type=click.Choice(['csv', 'ndjson']), default=None, help='Defaults to the file extension.')
+@click.option('--allow-partial', is_flag=True, help='Insert valid rows even if some rows are invalid.')
+@with_appcontext
+def import_products_command(path, seller, import_format, allow_partial):
+    """Bulk import HydrogenProduct listings from a CSV or NDJSON file."""
+    user = User.query.filter_by(username=seller).first()
+    if not user:
+        raise click.UsageError(f"Seller '{seller}' not found.")
+    import_format = import_format or ('csv' if path.lower().endswith('.csv') else 'ndjson')
+
+    with open(path, newline='') as fh:
+        result = import_products(fh, import_format, user.id, allow_partial)
+
+    for row_error in result['errors']:
+        click.echo(f"Row {row_error['row']}: {'; '.join(row_error['errors'])}", err=True)
+    click.echo(f"Imported {result['imported']} listing(s), {len(result['errors'])} invalid row(s).")
+    if result['errors'] and not allow_partial:
+        raise SystemExit(1)
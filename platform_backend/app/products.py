@@ -1,7 +1,15 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from .models import User, HydrogenProduct, db
+from .product_import import import_products
+from .db_routing import read_only
+from .inventory import get_inventory_ledger
+from .order_book import get_order_book
+from .idempotency import idempotent
+from .rate_limit import rate_limited
+from datetime import date
 from decimal import Decimal, InvalidOperation
+import io
 
 bp = Blueprint('products', __name__)
 
@@ -15,6 +23,8 @@ def get_current_user():
 
 @bp.route('', methods=['POST'])
 @jwt_required()
+@idempotent
+@rate_limited('products.create', group='products')
 def create_hydrogen_product():
     """Create a new hydrogen product listing."""
     current_user = get_current_user()
@@ -42,7 +52,7 @@ def create_hydrogen_product():
             ghg_intensity_kgco2e_per_kgh2=Decimal(data.get('ghg_intensity_kgco2e_per_kgh2')) if data.get('ghg_intensity_kgco2e_per_kgh2') else None,
             feedstock=data.get('feedstock'),
             energy_source=data.get('energy_source'),
-            available_from_date=data.get('available_from_date'), # Add date parsing if necessary
+            available_from_date=date.fromisoformat(data['available_from_date']) if data.get('available_from_date') else None,
             status=data.get('status', 'active')
         )
         db.session.add(product)
@@ -50,25 +60,67 @@ def create_hydrogen_product():
         return jsonify(product.to_dict()), 201
     except InvalidOperation:
         return jsonify({"msg": "Invalid decimal value for quantity, price, purity, or GHG intensity."}), 400
+    except ValueError as ve: # For date parsing errors
+        return jsonify({"msg": f"Date format error: {str(ve)}"}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({"msg": "Failed to create product", "error": str(e)}), 500
 
 
+@bp.route('/bulk', methods=['POST'])
+@jwt_required()
+@rate_limited('products.bulk', group='products')
+def bulk_import_hydrogen_products():
+    """
+    Bulk import hydrogen product listings from CSV (with header) or NDJSON.
+    The file can be sent as the raw request body or as a multipart 'file' field.
+    Format is taken from ?format= or the Content-Type. Pass ?allow_partial=true
+    to insert the valid rows even if some rows fail validation.
+    """
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({"msg": "User not found or token invalid"}), 401
+
+    upload = request.files.get('file')
+    import_format = request.args.get('format')
+    if not import_format:
+        content_type = upload.mimetype if upload else request.mimetype
+        import_format = 'csv' if content_type in ('text/csv', 'application/csv') else 'ndjson'
+    if import_format not in ('csv', 'ndjson'):
+        return jsonify({"msg": "Invalid format. Must be 'csv' or 'ndjson'."}), 400
+
+    stream = io.TextIOWrapper(upload.stream if upload else request.stream, encoding='utf-8', newline='')
+    allow_partial = request.args.get('allow_partial', 'false').lower() == 'true'
+
+    try:
+        result = import_products(stream, import_format, current_user.id, allow_partial)
+    except UnicodeDecodeError:
+        return jsonify({"msg": "Import file must be UTF-8 encoded."}), 400
+    except Exception as e:
+        return jsonify({"msg": "Failed to import products", "error": str(e)}), 500
+
+    if result['errors'] and not allow_partial:
+        return jsonify({"msg": "Import rejected: some rows are invalid. No listings were created.", **result}), 400
+    return jsonify(result), 201
+
+
 @bp.route('', methods=['GET'])
 # @jwt_required() # Making this public for now, can be changed
+@read_only
 def list_hydrogen_products():
     """Get a list of all available hydrogen products."""
     products = HydrogenProduct.query.filter_by(status='active').all() # Or filter as needed
-    return jsonify([product.to_dict() for product in products]), 200
+    ledger = get_inventory_ledger()
+    return jsonify([ledger.overlay(product.to_dict()) for product in products]), 200
 
 
 @bp.route('/<int:product_id>', methods=['GET'])
 # @jwt_required() # Making this public for now
+@read_only
 def get_hydrogen_product(product_id):
     """Get details of a specific hydrogen product."""
     product = HydrogenProduct.query.get_or_404(product_id)
-    return jsonify(product.to_dict()), 200
+    return jsonify(get_inventory_ledger().overlay(product.to_dict())), 200
 
 
 @bp.route('/<int:product_id>', methods=['PUT'])
@@ -85,8 +137,16 @@ def update_hydrogen_product(product_id):
     if not data:
         return jsonify({"msg": "Missing JSON in request"}), 400
 
+    ledger = get_inventory_ledger()
     try:
-        if 'quantity_kg' in data: product.quantity_kg = Decimal(data['quantity_kg'])
+        if 'quantity_kg' in data:
+            # Persist pending fills first so the new absolute quantity is not decremented twice
+            ledger.flush()
+            quantity_kg = Decimal(data['quantity_kg'])
+            reserved = ledger.reserved(product.id)
+            if quantity_kg < reserved:
+                return jsonify({"msg": f"Product quantity ({quantity_kg}kg) cannot be less than the quantity reserved by open sell orders ({reserved}kg)."}), 400
+            product.quantity_kg = quantity_kg
         if 'price_per_kg' in data: product.price_per_kg = Decimal(data['price_per_kg'])
         if 'location_region' in data: product.location_region = data['location_region']
         if 'production_method' in data: product.production_method = data['production_method']
@@ -95,13 +155,17 @@ def update_hydrogen_product(product_id):
         if 'ghg_intensity_kgco2e_per_kgh2' in data: product.ghg_intensity_kgco2e_per_kgh2 = Decimal(data.get('ghg_intensity_kgco2e_per_kgh2')) if data.get('ghg_intensity_kgco2e_per_kgh2') is not None else None
         if 'feedstock' in data: product.feedstock = data.get('feedstock')
         if 'energy_source' in data: product.energy_source = data.get('energy_source')
-        if 'available_from_date' in data: product.available_from_date = data.get('available_from_date') # Add date parsing
+        if 'available_from_date' in data: product.available_from_date = date.fromisoformat(data['available_from_date']) if data.get('available_from_date') else None
         if 'status' in data: product.status = data.get('status')
 
         db.session.commit()
+        if 'quantity_kg' in data:
+            ledger.forget(product.id) # Reload the counters from the new quantity on next use
         return jsonify(product.to_dict()), 200
     except InvalidOperation:
         return jsonify({"msg": "Invalid decimal value for quantity, price, purity, or GHG intensity."}), 400
+    except ValueError as ve: # For date parsing errors
+        return jsonify({"msg": f"Date format error: {str(ve)}"}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({"msg": "Failed to update product", "error": str(e)}), 500
@@ -125,6 +189,8 @@ def delete_hydrogen_product(product_id):
     try:
         db.session.delete(product)
         db.session.commit()
+        get_inventory_ledger().forget(product_id)
+        get_order_book().forget(product_id)
         return jsonify({"msg": "Product deleted successfully"}), 200
     except Exception as e:
         db.session.rollback()
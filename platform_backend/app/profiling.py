@@ -0,0 +1,245 @@
+"""
+Opt-in profiling of individual API requests.
+
+With PROFILING_ENABLED on, a request is profiled when an administrator sends the
+X-Profile header (any non-empty value, with a valid admin access token; the header
+is ignored for everyone else) or when it is drawn at PROFILING_SAMPLE_RATE (0 to 1,
+default 0). With it off, create_app() installs nothing at all: no request hooks and
+no engine events, so the disabled profiler costs nothing.
+
+A profiled request is recorded from before the view runs until its response is
+built, in one of two modes (PROFILING_MODE):
+  * 'sampling' (default): a background thread samples the request thread's stack
+    every PROFILING_INTERVAL_MS and writes the stacks in collapsed format
+    (`<profile>.folded`, one "frame;frame;... count" line per stack), ready for
+    flamegraph.pl, speedscope or inferno. The view runs at nearly full speed.
+  * 'cprofile': cProfile records every call (`<profile>.prof`, for pstats, snakeviz or
+    flameprof), at the cost of slowing the request down.
+Either way the SQL the request issued is recorded with per-statement timings, and
+`<profile>.json` holds the request, the trigger, the durations and the statements.
+The response carries the profile's name in X-Profile-Id.
+
+Files go to PROFILING_DIR (default: instance/profiles). After every write the oldest
+profiles beyond PROFILING_MAX_PROFILES, and those older than
+PROFILING_RETENTION_HOURS, are deleted.
+"""
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import g, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from sqlalchemy import event
+
+from . import db
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_ID_HEADER = 'X-Profile-Id'
+MODES = ('sampling', 'cprofile')
+DEFAULT_INTERVAL_MS = 5.0
+DEFAULT_MAX_PROFILES = 200
+DEFAULT_RETENTION_HOURS = 72.0
+MAX_RECORDED_STATEMENTS = 1000 # Per profile; the count and total time still cover all of them
+_EXTENSIONS = ('.json', '.folded', '.prof')
+
+
+class StackSampler(threading.Thread):
+    """Samples one thread's Python stack at a fixed interval into collapsed-stack counts."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name='request-profiler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class _Capture:
+    """One profiled request: the profiler and the SQL it issued."""
+
+    def __init__(self, trigger, mode, interval):
+        self.trigger = trigger
+        self.started = time.perf_counter()
+        self.statements = []
+        self.statement_count = 0
+        self.sql_seconds = 0.0
+        if mode == 'cprofile':
+            self.profiler, self.sampler = cProfile.Profile(), None
+            self.profiler.enable()
+        else:
+            self.profiler = None
+            self.sampler = StackSampler(threading.get_ident(), interval)
+            self.sampler.start()
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.started
+        if self.profiler is not None:
+            self.profiler.disable()
+        else:
+            self.sampler.stop()
+
+    def record_statement(self, statement, seconds, executemany):
+        self.statement_count += 1
+        self.sql_seconds += seconds
+        if len(self.statements) < MAX_RECORDED_STATEMENTS:
+            self.statements.append({'sql': statement, 'ms': round(seconds * 1000, 3), 'executemany': executemany})
+
+
+class RequestProfiler:
+    """Installs the request hooks and engine events of one application (see module docstring)."""
+
+    def __init__(self, app):
+        self.mode = app.config.get('PROFILING_MODE', 'sampling')
+        if self.mode not in MODES:
+            raise ValueError(f"PROFILING_MODE must be one of: {', '.join(MODES)}.")
+        self.sample_rate = app.config.get('PROFILING_SAMPLE_RATE', 0.0)
+        self.interval = app.config.get('PROFILING_INTERVAL_MS', DEFAULT_INTERVAL_MS) / 1000
+        self.max_profiles = app.config.get('PROFILING_MAX_PROFILES', DEFAULT_MAX_PROFILES)
+        self.retention_seconds = app.config.get('PROFILING_RETENTION_HOURS', DEFAULT_RETENTION_HOURS) * 3600
+        self.directory = app.config.get('PROFILING_DIR') or os.path.join(app.instance_path, 'profiles')
+        self._local = threading.local() # The capture of the request running on this thread
+        self._write_lock = threading.Lock()
+
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._abandon)
+        with app.app_context():
+            for engine in db.engines.values():
+                event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+                event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    # --- Request hooks ---
+
+    def _trigger(self):
+        if request.headers.get(PROFILE_HEADER):
+            try:
+                verify_jwt_in_request(optional=True)
+                identity = get_jwt_identity()
+            except Exception: # An invalid token is the view's business, not the profiler's
+                identity = None
+            if identity and 'admin' in identity.get('roles', []):
+                return 'header'
+        if self.sample_rate and random.random() < self.sample_rate:
+            return 'sample'
+        return None
+
+    def _start(self):
+        trigger = self._trigger()
+        if trigger:
+            g.profile_capture = self._local.capture = _Capture(trigger, self.mode, self.interval)
+
+    def _finish(self, response):
+        capture = g.pop('profile_capture', None)
+        if capture is None:
+            return response
+        self._local.capture = None
+        capture.stop()
+        try:
+            response.headers[PROFILE_ID_HEADER] = self._write(capture, response.status_code)
+        except OSError as e:
+            logger.error(f"Could not write the request profile: {e}")
+        return response
+
+    def _abandon(self, exc):
+        # The request failed before after_request; stop the sampler without writing
+        capture = g.pop('profile_capture', None)
+        if capture is not None:
+            self._local.capture = None
+            capture.stop()
+
+    # --- Engine events ---
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if getattr(self._local, 'capture', None) is not None:
+            conn.info.setdefault('profile_query_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        capture = getattr(self._local, 'capture', None)
+        starts = conn.info.get('profile_query_start')
+        if capture is not None and starts:
+            capture.record_statement(statement, time.perf_counter() - starts.pop(), executemany)
+
+    # --- Output ---
+
+    def _write(self, capture, status_code):
+        """Writes the profile's files and applies retention; returns the profile name."""
+        endpoint = re.sub(r'[^A-Za-z0-9_.-]+', '_', request.endpoint or request.path)
+        name = f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-{request.method}-{endpoint}"
+        summary = {
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'status': status_code,
+            'trigger': capture.trigger,
+            'mode': self.mode,
+            'duration_ms': round(capture.elapsed * 1000, 3),
+            'sql_statements': capture.statement_count,
+            'sql_ms': round(capture.sql_seconds * 1000, 3),
+            'statements': capture.statements,
+        }
+        with self._write_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, name)
+            if capture.profiler is not None:
+                capture.profiler.dump_stats(path + '.prof')
+            else:
+                summary['samples'] = sum(capture.sampler.stacks.values())
+                with open(path + '.folded', 'w') as fh:
+                    for stack, count in capture.sampler.stacks.most_common():
+                        fh.write(f"{stack} {count}\n")
+            with open(path + '.json', 'w') as fh:
+                json.dump(summary, fh, indent=2)
+            self._prune()
+        logger.info(f"Profiled {request.method} {request.path} ({capture.trigger}): {name}")
+        return name
+
+    def _prune(self):
+        """Deletes the profiles beyond max_profiles (oldest first) and those past the retention period."""
+        profiles = {}
+        for entry in os.scandir(self.directory):
+            stem, extension = os.path.splitext(entry.name)
+            if extension in _EXTENSIONS:
+                profiles.setdefault(stem, []).append(entry.path)
+        cutoff = time.time() - self.retention_seconds
+        # Names start with the UTC capture time, so they sort oldest first
+        names = sorted(profiles)
+        expired = set(names[:max(0, len(names) - self.max_profiles)])
+        for stem in names:
+            try:
+                captured = datetime.strptime(stem.split('-', 1)[0], '%Y%m%dT%H%M%S%f')
+            except ValueError:
+                continue
+            if (captured - datetime(1970, 1, 1)).total_seconds() < cutoff:
+                expired.add(stem)
+        for stem in expired:
+            for path in profiles[stem]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass # Removed by another process sharing the directory
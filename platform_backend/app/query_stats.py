@@ -0,0 +1,128 @@
+"""
+SQL statement counts and database time per request.
+
+Engine events (before/after_cursor_execute, on the primary and any replica engine)
+add every statement and its execution time to the QueryCounters active on the
+executing thread. Each request pushes one counter for its duration; after the
+response is built it is logged at DEBUG (at WARNING above SQL_STATS_WARN_STATEMENTS
+statements or SQL_STATS_WARN_MS milliseconds) and, with SQL_STATS_HEADER on (the
+default in the development and testing profiles), returned in the X-SQL-Queries
+and X-SQL-Time-Ms response headers. The counter of the current request is also
+available as g.sql_queries, which the query budget checks in tests/conftest.py read.
+
+count_queries() measures any block of code the same way, e.g. a CLI command or a
+test. Counters nest: a statement counts towards every active counter of its thread.
+SQL_STATS_ENABLED=off installs nothing.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+from sqlalchemy import event
+
+from . import db
+
+logger = logging.getLogger(__name__)
+
+COUNT_HEADER = 'X-SQL-Queries'
+TIME_HEADER = 'X-SQL-Time-Ms'
+DEFAULT_WARN_STATEMENTS = 100
+DEFAULT_WARN_MS = 500.0
+
+_local = threading.local()
+
+
+class QueryCounter:
+    """Statements executed and the time spent executing them."""
+
+    __slots__ = ('statements', 'seconds')
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+
+    @property
+    def milliseconds(self):
+        return self.seconds * 1000
+
+    def __repr__(self):
+        return f"<QueryCounter {self.statements} statement(s), {self.milliseconds:.1f} ms>"
+
+
+def _active():
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        counters = _local.counters = []
+    return counters
+
+
+@contextmanager
+def count_queries():
+    """Counts the statements this thread executes inside the block (see module docstring)."""
+    counter = QueryCounter()
+    counters = _active()
+    counters.append(counter)
+    try:
+        yield counter
+    finally:
+        counters.remove(counter)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_local, 'counters', None):
+        conn.info.setdefault('query_stats_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_stats_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    for counter in getattr(_local, 'counters', ()):
+        counter.statements += 1
+        counter.seconds += elapsed
+
+
+def install_query_stats(app):
+    """Counts SQL per request for app (engine events, request hooks, header and logs)."""
+    header = app.config.get('SQL_STATS_HEADER', app.debug or app.testing)
+    warn_statements = app.config.get('SQL_STATS_WARN_STATEMENTS', DEFAULT_WARN_STATEMENTS)
+    warn_ms = app.config.get('SQL_STATS_WARN_MS', DEFAULT_WARN_MS)
+
+    with app.app_context():
+        for engine in db.engines.values():
+            if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+                event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+                event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def _start_counting():
+        g.sql_queries = QueryCounter()
+        _active().append(g.sql_queries)
+
+    @app.after_request
+    def _report_queries(response):
+        counter = g.get('sql_queries')
+        if counter is None:
+            return response
+        _stop_counting(counter)
+        if header:
+            response.headers[COUNT_HEADER] = str(counter.statements)
+            response.headers[TIME_HEADER] = f"{counter.milliseconds:.3f}"
+        level = logging.WARNING if counter.statements > warn_statements or counter.milliseconds > warn_ms else logging.DEBUG
+        logger.log(level, f"{request.method} {request.path}: {counter.statements} SQL statement(s), {counter.milliseconds:.1f} ms")
+        return response
+
+    @app.teardown_request
+    def _abandon_counter(exc):
+        counter = g.get('sql_queries')
+        if counter is not None:
+            _stop_counting(counter)
+
+
+def _stop_counting(counter):
+    counters = _active()
+    if counter in counters:
+        counters.remove(counter)
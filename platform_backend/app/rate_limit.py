@@ -0,0 +1,226 @@
+"""
+Token-bucket rate limiting and admission control for write endpoints.
+
+Every limited request takes one token from two buckets:
+
+*   a per-user bucket for the endpoint (e.g. 'orders.create'), so one misbehaving
+    client cannot flood order entry, and
+*   a shared bucket for the endpoint's group (e.g. 'orders'), which caps the total
+    load admitted in front of the matching engine.
+
+Group buckets have two lanes. Normal requests (new orders, amendments) may only
+draw the bucket down to a reserve (RATE_LIMIT_PRIORITY_RESERVE of its capacity);
+priority requests (cancels) may also use the reserve, so they are still admitted
+when the group is saturated by new orders.
+
+Rejected requests get 429 with Retry-After and a retry_after hint in the body, and
+the scope of the bucket that ran out: 'user' or 'group'.
+Admitted/throttled counts are exported through app.metrics.
+
+Backends (RATE_LIMIT_BACKEND):
+    memory - in-process buckets (default; limits apply per process)
+    sqlite - buckets in a SQLite file (RATE_LIMIT_SQLITE_PATH) shared by every
+             process on the host; a local stand-in for a shared store such as Redis
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, jsonify
+from flask_jwt_extended import get_jwt_identity
+
+from .metrics import registry
+
+# endpoint -> (per-user burst capacity, per-user refill in tokens/second)
+DEFAULT_LIMITS = {
+    'orders.create': (50, 20.0),
+    'orders.update': (50, 20.0),
+    'orders.cancel': (100, 50.0),
+    'products.create': (20, 5.0),
+    'products.bulk': (5, 0.5),
+}
+# group -> (shared burst capacity, shared refill in tokens/second)
+DEFAULT_GROUP_LIMITS = {
+    'orders': (1000, 500.0),
+    'products': (200, 50.0),
+}
+DEFAULT_PRIORITY_RESERVE = 0.2 # Share of a group bucket only priority requests may use
+
+ADMITTED = registry.counter(
+    'ghx_rate_limit_admitted_total', 'Requests admitted by the rate limiter.', ('endpoint', 'lane')
+)
+THROTTLED = registry.counter(
+    'ghx_rate_limit_throttled_total', 'Requests rejected with 429 by the rate limiter.', ('endpoint', 'lane', 'scope')
+)
+
+
+def _refill(tokens, updated, capacity, rate, now):
+    return min(capacity, tokens + max(0.0, now - updated) * rate)
+
+
+def _decide(tokens, capacity, rate, cost, floor):
+    """(allowed, new token level, seconds until the request would be allowed)."""
+    if tokens - cost >= floor:
+        return True, tokens - cost, 0.0
+    if rate <= 0 or cost + floor > capacity:
+        return False, tokens, math.inf
+    return False, tokens, (cost + floor - tokens) / rate
+
+
+class MemoryBucketBackend:
+    """Token buckets in a dict guarded by one lock; idle full buckets are pruned."""
+
+    PRUNE_EVERY = 10000
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {} # key -> [tokens, updated, capacity, rate]
+        self._takes = 0
+
+    def take(self, key, capacity, rate, cost=1, floor=0.0):
+        now = self.clock()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            tokens = capacity if bucket is None else _refill(bucket[0], bucket[1], capacity, rate, now)
+            allowed, tokens, retry_after = _decide(tokens, capacity, rate, cost, floor)
+            self._buckets[key] = [tokens, now, capacity, rate]
+            self._takes += 1
+            if self._takes % self.PRUNE_EVERY == 0:
+                self._prune(now)
+            return allowed, retry_after, tokens
+
+    def refund(self, key, capacity, cost=1):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(capacity, bucket[0] + cost)
+
+    def _prune(self, now):
+        for key, (tokens, updated, capacity, rate) in list(self._buckets.items()):
+            if _refill(tokens, updated, capacity, rate, now) >= capacity:
+                del self._buckets[key] # A missing bucket is a full bucket
+
+
+class SQLiteBucketBackend:
+    """Token buckets in a SQLite file, updated atomically with BEGIN IMMEDIATE."""
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock # Wall clock: shared between processes
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit_buckets "
+                "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, capacity, rate, cost=1, floor=0.0):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            now = self.clock()
+            row = connection.execute("SELECT tokens, updated FROM rate_limit_buckets WHERE key = ?", (key,)).fetchone()
+            tokens = capacity if row is None else _refill(row[0], row[1], capacity, rate, now)
+            allowed, tokens, retry_after = _decide(tokens, capacity, rate, cost, floor)
+            connection.execute(
+                "INSERT INTO rate_limit_buckets (key, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                (key, tokens, now)
+            )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return allowed, retry_after, tokens
+
+    def refund(self, key, capacity, cost=1):
+        self._connection().execute(
+            "UPDATE rate_limit_buckets SET tokens = MIN(?, tokens + ?) WHERE key = ?", (capacity, cost, key)
+        )
+
+
+class RateLimiter:
+    """Applies the configured per-user and group limits using a bucket backend."""
+
+    def __init__(self, backend, limits=None, group_limits=None, priority_reserve=DEFAULT_PRIORITY_RESERVE):
+        self.backend = backend
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.group_limits = dict(DEFAULT_GROUP_LIMITS, **(group_limits or {}))
+        self.priority_reserve = priority_reserve
+
+    def admit(self, endpoint, user, group=None, priority=False):
+        """Returns (allowed, retry_after_seconds, scope, limit) for one request."""
+        capacity, rate = self.limits[endpoint]
+        user_key = f"user:{user}:{endpoint}"
+        allowed, retry_after, _ = self.backend.take(user_key, capacity, rate)
+        if not allowed:
+            return False, retry_after, 'user', capacity
+        if group is not None and group in self.group_limits:
+            group_capacity, group_rate = self.group_limits[group]
+            floor = 0.0 if priority else group_capacity * self.priority_reserve
+            allowed, retry_after, _ = self.backend.take(f"group:{group}", group_capacity, group_rate, floor=floor)
+            if not allowed:
+                self.backend.refund(user_key, capacity) # The request was not admitted after all
+                return False, retry_after, 'group', group_capacity
+        return True, 0.0, None, capacity
+
+
+def create_rate_limiter(config):
+    """Builds the limiter selected by RATE_LIMIT_BACKEND, or None when disabled."""
+    if not config.get('RATE_LIMIT_ENABLED', True):
+        return None
+    if config.get('RATE_LIMIT_BACKEND', 'memory') == 'sqlite':
+        backend = SQLiteBucketBackend(config['RATE_LIMIT_SQLITE_PATH'])
+    else:
+        backend = MemoryBucketBackend()
+    return RateLimiter(
+        backend,
+        limits=config.get('RATE_LIMITS'),
+        group_limits=config.get('RATE_LIMIT_GROUPS'),
+        priority_reserve=config.get('RATE_LIMIT_PRIORITY_RESERVE', DEFAULT_PRIORITY_RESERVE),
+    )
+
+
+def rate_limited(endpoint, group=None, priority=False):
+    """Admits the request through the user's and the group's token buckets (apply below @jwt_required)."""
+    lane = 'priority' if priority else 'normal'
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            limiter = current_app.extensions.get('rate_limiter')
+            if limiter is None:
+                return view(*args, **kwargs)
+            identity = get_jwt_identity()
+            user = identity.get('username') if isinstance(identity, dict) else 'anonymous'
+            allowed, retry_after, scope, limit = limiter.admit(endpoint, user, group=group, priority=priority)
+            if not allowed:
+                THROTTLED.inc(endpoint=endpoint, lane=lane, scope=scope)
+                retry_seconds = max(1, math.ceil(retry_after)) if math.isfinite(retry_after) else 60
+                response = jsonify({
+                    "msg": "Too many requests. Retry later." if scope == 'user' else "Order entry is busy. Retry later.",
+                    "retry_after": round(retry_after, 3) if math.isfinite(retry_after) else None,
+                    "scope": scope,
+                })
+                response.status_code = 429
+                response.headers['Retry-After'] = str(retry_seconds)
+                response.headers['X-RateLimit-Limit'] = str(limit)
+                return response
+            ADMITTED.inc(endpoint=endpoint, lane=lane)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,280 @@
+"""
+Deterministic replay of order streams through the matching engine.
+
+A stream is a list of events (NDJSON on disk), in the order they are applied:
+
+    {"seq": 1, "action": "place", "user": "u3", "product": "p1", "side": "buy",
+     "quantity_kg": "2.00", "price_per_kg": "5.10", "time_in_force": "GTC"}
+    {"seq": 2, "action": "cancel", "order": 1}
+    {"seq": 3, "action": "amend", "order": 1, "quantity_kg": "1.00", "price_per_kg": "5.20"}
+
+Users and products are names; the replayer creates them in a fresh database before
+the clock starts. Events refer to orders by the seq of their "place" event, and trades
+are fingerprinted by those seqs, so the digest is identical on every run of the same
+stream whatever ids the database hands out.
+
+Streams are generated (generate_stream, seeded) or captured from a database's order
+history (`flask capture-order-stream`). benchmarks/replay.py runs them and compares
+the results with a saved baseline.
+"""
+import hashlib
+import json
+import random
+import time
+from datetime import datetime
+from decimal import Decimal
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, insert, select, union_all
+
+from . import db
+from .inventory import get_inventory_ledger
+from .matching_engine import IMMEDIATE_TIME_IN_FORCE, amend_order, attempt_match_order, execute_immediate_order
+from .models import HydrogenProduct, Order, Trade, User
+from .notifications import enqueue_order_event
+
+# On-hand quantity of every replay listing, so sell orders are never rejected for inventory.
+LISTING_QUANTITY_KG = Decimal('99999999')
+OPEN_STATUSES = ('pending', 'partially_filled')
+
+
+def generate_stream(events=10000, products=4, users=50, seed=1, cancel_ratio=0.2, amend_ratio=0.05,
+                    immediate_ratio=0.1, tick=Decimal('0.05')):
+    """A reproducible synthetic stream: limit orders around a fixed mid price, plus cancels and amendments."""
+    rng = random.Random(seed)
+    stream = []
+    open_orders = []
+    for seq in range(1, events + 1):
+        roll = rng.random()
+        if open_orders and roll < cancel_ratio:
+            target = open_orders.pop(rng.randrange(len(open_orders)))
+            stream.append({'seq': seq, 'action': 'cancel', 'order': target})
+            continue
+        if open_orders and roll < cancel_ratio + amend_ratio:
+            target = open_orders[rng.randrange(len(open_orders))]
+            stream.append({'seq': seq, 'action': 'amend', 'order': target,
+                           'quantity_kg': str(Decimal(rng.randint(1, 20))),
+                           'price_per_kg': str(Decimal('5.00') + tick * rng.randint(-10, 10))})
+            continue
+        product = rng.randrange(products)
+        side = rng.choice(('buy', 'sell'))
+        # Sellers list their own products; buyers are everyone else
+        user = f"seller{product}" if side == 'sell' else f"buyer{rng.randrange(users)}"
+        offset = rng.randint(0, 10) * (1 if side == 'sell' else -1) + rng.randint(-2, 2)
+        time_in_force = rng.choice(IMMEDIATE_TIME_IN_FORCE) if rng.random() < immediate_ratio else 'GTC'
+        stream.append({'seq': seq, 'action': 'place', 'user': user, 'product': f"p{product}", 'side': side,
+                       'quantity_kg': str(Decimal(rng.randint(1, 20))),
+                       'price_per_kg': str(Decimal('5.00') + tick * offset), 'time_in_force': time_in_force})
+        if time_in_force == 'GTC':
+            open_orders.append(seq)
+    return stream
+
+
+def capture_stream(limit=None):
+    """
+    Rebuilds a stream from the orders table: every order placed, at its original size
+    (what is left plus what it traded), merged with the owners' cancellations by time.
+    Amendments are not recorded in the database, so orders are replayed with their
+    current price and without the amended quantity.
+    """
+    fills = union_all(
+        select(Trade.buy_order_id.label('order_id'), Trade.quantity_traded_kg.label('kg')),
+        select(Trade.sell_order_id, Trade.quantity_traded_kg),
+    ).subquery()
+    traded = select(fills.c.order_id, func.sum(fills.c.kg).label('kg')).group_by(fills.c.order_id).subquery()
+    stmt = select(Order.id, Order.user_id, Order.hydrogen_product_id, Order.order_type, Order.quantity_kg,
+                  Order.price_per_kg, Order.time_in_force, Order.status, Order.created_timestamp,
+                  Order.cancelled_timestamp, func.coalesce(traded.c.kg, 0).label('traded_kg')) \
+        .outerjoin(traded, traded.c.order_id == Order.id) \
+        .where(Order.hydrogen_product_id.is_not(None)).order_by(Order.created_timestamp, Order.id)
+    if limit:
+        stmt = stmt.limit(limit)
+    events = [] # (time, 0 for a place or 1 for a cancel, order id, event)
+    for row in db.session.execute(stmt):
+        # A filled order keeps the size of its last fill in quantity_kg; nothing is left of it
+        remaining = Decimal(0) if row.status == 'filled' else row.quantity_kg
+        events.append((row.created_timestamp or datetime.min, 0, row.id, {
+            'action': 'place', 'user': f"user{row.user_id}", 'product': f"p{row.hydrogen_product_id}",
+            'side': row.order_type, 'quantity_kg': str(remaining + Decimal(row.traded_kg)),
+            'price_per_kg': str(row.price_per_kg), 'time_in_force': row.time_in_force or 'GTC'}))
+        if row.cancelled_timestamp is not None:
+            events.append((row.cancelled_timestamp, 1, row.id, {'action': 'cancel'}))
+    stream, seq_by_id = [], {}
+    for _, kind, order_id, event in sorted(events, key=lambda entry: entry[:3]):
+        event = {'seq': len(stream) + 1, **event}
+        if kind == 0:
+            seq_by_id[order_id] = event['seq']
+        else:
+            event['order'] = seq_by_id[order_id]
+        stream.append(event)
+    return stream
+
+
+def read_stream(path):
+    with open(path) as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def write_stream(stream, path):
+    with open(path, 'w') as fh:
+        for event in stream:
+            fh.write(json.dumps(event) + '\n')
+
+
+def _percentiles(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    pick = lambda pct: samples[min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))]
+    return {'count': len(samples), 'p50_ms': pick(50), 'p95_ms': pick(95), 'p99_ms': pick(99), 'max_ms': samples[-1]}
+
+
+class Replayer:
+    """Applies a stream to the (empty) database of one application, one event at a time."""
+
+    def __init__(self, app, sample_every=1000):
+        self.app = app
+        self.sample_every = sample_every
+        self._users = {} # name -> user id
+        self._products = {} # name -> product id
+        self._orders = {} # place seq -> order id
+        self._seqs = {} # order id -> place seq
+
+    def _prepare(self, stream):
+        """Creates the stream's users and listings (a product is listed by its first seller)."""
+        sellers = {}
+        for event in stream:
+            if event['action'] == 'place':
+                self._users.setdefault(event['user'], None)
+                if event['side'] == 'sell':
+                    sellers.setdefault(event['product'], event['user'])
+                self._products.setdefault(event['product'], None)
+        for name in self._users:
+            self._users[name] = db.session.execute(insert(User).returning(User.id), {
+                'username': f"replay_{name}", 'email': f"replay_{name}@example.com", 'password_hash': 'unused'
+            }).scalar_one()
+        for name in self._products:
+            product = HydrogenProduct(seller_id=self._users[sellers.get(name, next(iter(self._users)))],
+                                      quantity_kg=LISTING_QUANTITY_KG, price_per_kg=Decimal('5'),
+                                      location_region='Replay', production_method='Electrolysis')
+            db.session.add(product)
+            db.session.flush()
+            self._products[name] = product.id
+        db.session.commit()
+
+    def _place(self, event):
+        quantity, price = Decimal(event['quantity_kg']), Decimal(event['price_per_kg'])
+        user_id, product_id = self._users[event['user']], self._products[event['product']]
+        time_in_force = event.get('time_in_force', 'GTC')
+        if time_in_force in IMMEDIATE_TIME_IN_FORCE:
+            order, _, _ = execute_immediate_order(user_id, event['side'], product_id, quantity, price, time_in_force)
+            if order is not None:
+                self._orders[event['seq']] = order.id
+                self._seqs[order.id] = event['seq']
+            return
+        # Same steps as POST /api/orders
+        ledger = get_inventory_ledger()
+        if event['side'] == 'sell':
+            ledger.load(product_id)
+        order = Order(user_id=user_id, order_type=event['side'], hydrogen_product_id=product_id,
+                      quantity_kg=quantity, price_per_kg=price, status='pending', time_in_force=time_in_force)
+        db.session.add(order)
+        db.session.flush()
+        if event['side'] == 'sell':
+            ledger.reserve(order.id, product_id, quantity)
+        enqueue_order_event(order)
+        db.session.commit()
+        self._orders[event['seq']] = order.id
+        self._seqs[order.id] = event['seq']
+        attempt_match_order(order.id)
+
+    def _cancel(self, event):
+        order = db.session.get(Order, self._orders.get(event['order'])) if event['order'] in self._orders else None
+        if order is None or order.status not in OPEN_STATUSES:
+            return
+        order.status = 'cancelled'
+        order.cancelled_timestamp = datetime.utcnow()
+        enqueue_order_event(order)
+        db.session.commit()
+        if order.order_type == 'sell':
+            get_inventory_ledger().release(order.id)
+
+    def _amend(self, event):
+        order = db.session.get(Order, self._orders.get(event['order'])) if event['order'] in self._orders else None
+        if order is None or order.status != 'pending':
+            return
+        ledger = get_inventory_ledger()
+        if order.order_type == 'sell':
+            ledger.load(order.hydrogen_product_id)
+        repriced = amend_order(order, Decimal(event['quantity_kg']) if event.get('quantity_kg') else None,
+                               Decimal(event['price_per_kg']) if event.get('price_per_kg') else None)
+        if order.order_type == 'sell':
+            ledger.reserve(order.id, order.hydrogen_product_id, order.quantity_kg)
+        enqueue_order_event(order)
+        db.session.commit()
+        if repriced:
+            attempt_match_order(order.id)
+
+    def _book_size(self):
+        counts = dict(db.session.execute(
+            select(Order.order_type, func.count()).where(Order.status == 'pending').group_by(Order.order_type)
+        ).all())
+        db.session.rollback()
+        return counts.get('buy', 0), counts.get('sell', 0)
+
+    def trade_digest(self):
+        """sha256 over every trade as (buy seq, sell seq, quantity, price), in execution order."""
+        digest = hashlib.sha256()
+        count = 0
+        for buy_id, sell_id, quantity, price in db.session.execute(
+            select(Trade.buy_order_id, Trade.sell_order_id, Trade.quantity_traded_kg, Trade.price_per_kg_agreed)
+            .order_by(Trade.id)
+        ):
+            digest.update(f"{self._seqs.get(buy_id)}|{self._seqs.get(sell_id)}|{quantity}|{price}\n".encode())
+            count += 1
+        return count, digest.hexdigest()
+
+    def run(self, stream):
+        """
+        Replays the stream and returns a report: throughput, latency percentiles per
+        action, book size every `sample_every` events, and the trade count and digest.
+        """
+        handlers = {'place': self._place, 'cancel': self._cancel, 'amend': self._amend}
+        with self.app.app_context():
+            self._prepare(stream)
+            latencies = {action: [] for action in handlers}
+            book = []
+            busy = 0.0
+            for index, event in enumerate(stream, 1):
+                start = time.perf_counter()
+                handlers[event['action']](event)
+                elapsed = time.perf_counter() - start
+                busy += elapsed
+                latencies[event['action']].append(elapsed * 1000)
+                if index % self.sample_every == 0 or index == len(stream):
+                    bids, asks = self._book_size()
+                    book.append({'events': index, 'resting_bids': bids, 'resting_asks': asks})
+            get_inventory_ledger().flush()
+            trades, digest = self.trade_digest()
+            db.session.rollback()
+        return {
+            'events': len(stream),
+            'seconds': busy,
+            'events_per_second': len(stream) / busy if busy else 0.0,
+            'latency': {action: _percentiles(samples) for action, samples in latencies.items() if samples},
+            'book_size': book,
+            'trades': trades,
+            'trade_digest': digest,
+        }
+
+
+@click.command('capture-order-stream')
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), required=True, help='NDJSON stream file to write.')
+@click.option('--limit', type=int, default=None, help='Capture at most this many orders (oldest first).')
+@with_appcontext
+def capture_order_stream_command(output, limit):
+    """Capture the order history as a replay stream (see benchmarks/replay.py)."""
+    stream = capture_stream(limit)
+    write_stream(stream, output)
+    click.echo(f"Captured {len(stream)} event(s) to {output}.")
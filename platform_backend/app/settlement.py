@@ -0,0 +1,222 @@
+"""
+Batch settlement of executed trades.
+
+Trades are read as plain integer columns (no ORM objects), netted per
+buyer/seller pair and product with NumPy, and their `settlement_status` is
+flipped to 'completed' or 'failed' with bulk UPDATE statements.
+"""
+import json
+import logging
+from datetime import datetime
+from decimal import Decimal
+from itertools import chain
+
+import click
+import numpy as np
+from flask.cli import with_appcontext
+from sqlalchemy import BigInteger, cast, func, select, update
+
+from .credits import settle_bundled_credits
+from .models import db, Trade
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per round-trip while streaming pending trades.
+DEFAULT_BATCH_SIZE = 50000
+# Number of ids per bulk UPDATE statement (kept well below SQLite's bound parameter limit).
+UPDATE_CHUNK_SIZE = 10000
+
+# Quantities and prices are Numeric(10, 2); they are loaded as integer hundredths
+# so that netting is exact integer arithmetic. Notional is therefore in 1/10000 units.
+_QTY_SCALE = 100
+_NOTIONAL_SCALE = _QTY_SCALE * _QTY_SCALE
+
+# Column order of the arrays built from each streamed batch.
+_ID, _BUYER, _SELLER, _PRODUCT, _QTY, _PRICE = range(6)
+
+
+class SettlementConflict(Exception):
+    """Trades in the batch were settled by a concurrent run before this one updated them."""
+
+    status_code = 409
+
+
+def _pending_trades_query(window_start=None, window_end=None):
+    """Selects pending trades in the window as integer columns only."""
+    stmt = select(
+        Trade.id,
+        Trade.buyer_id,
+        Trade.seller_id,
+        Trade.hydrogen_product_id,
+        cast(func.round(Trade.quantity_traded_kg * _QTY_SCALE), BigInteger),
+        cast(func.round(Trade.price_per_kg_agreed * _QTY_SCALE), BigInteger),
+    ).where(Trade.settlement_status == 'pending')
+    if window_start is not None:
+        stmt = stmt.where(Trade.trade_timestamp >= window_start)
+    if window_end is not None:
+        stmt = stmt.where(Trade.trade_timestamp < window_end)
+    return stmt.order_by(Trade.id)
+
+
+def net_trade_batch(trades):
+    """
+    Nets a batch of trades per (party_a, party_b, product), where party_a < party_b.
+
+    Args:
+        trades (np.ndarray): int64 array of shape (n, 6) with columns
+            id, buyer_id, seller_id, product_id, quantity (hundredths), price (hundredths).
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: unique keys of shape (k, 3),
+        net kg delivered from party_b to party_a (hundredths), net cash paid by party_a to
+        party_b (1/10000 units) and the number of trades behind each key.
+    """
+    buyer = trades[:, _BUYER]
+    seller = trades[:, _SELLER]
+    party_a = np.minimum(buyer, seller)
+    party_b = np.maximum(buyer, seller)
+    # +1 when party_a is the buyer (b delivers to a, a pays b), -1 otherwise.
+    direction = np.where(buyer == party_a, 1, -1).astype(np.int64)
+    signed_qty = trades[:, _QTY] * direction
+    signed_cash = trades[:, _QTY] * trades[:, _PRICE] * direction
+
+    order = np.lexsort((trades[:, _PRODUCT], party_b, party_a))
+    keys = np.column_stack((party_a[order], party_b[order], trades[order, _PRODUCT]))
+    boundaries = np.flatnonzero(np.any(np.diff(keys, axis=0) != 0, axis=1)) + 1
+    starts = np.concatenate(([0], boundaries))
+
+    net_qty = np.add.reduceat(signed_qty[order], starts)
+    net_cash = np.add.reduceat(signed_cash[order], starts)
+    counts = np.diff(np.append(starts, len(order)))
+    return keys[starts], net_qty, net_cash, counts
+
+
+def _invalid_trade_mask(trades):
+    """Trades that cannot be settled: non-positive quantity/price or buyer == seller."""
+    return (
+        (trades[:, _QTY] <= 0)
+        | (trades[:, _PRICE] <= 0)
+        | (trades[:, _BUYER] == trades[:, _SELLER])
+    )
+
+
+def _bulk_set_status(trade_ids, status):
+    """
+    Updates settlement_status for the given ids in chunked bulk UPDATE statements.
+
+    Only trades that are still pending are updated: another settlement run may have
+    settled some of them since they were read. Raises SettlementConflict if so; the
+    caller rolls back the whole batch and it can be run again.
+    """
+    for start in range(0, len(trade_ids), UPDATE_CHUNK_SIZE):
+        chunk = trade_ids[start:start + UPDATE_CHUNK_SIZE].tolist()
+        updated = db.session.execute(
+            update(Trade)
+            .where(Trade.id.in_(chunk), Trade.settlement_status == 'pending')
+            .values(settlement_status=status)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if updated != len(chunk):
+            raise SettlementConflict(
+                f"{len(chunk) - updated} trade(s) were settled by another run. Retry the batch."
+            )
+
+
+def _build_instructions(netted):
+    """Turns netted obligations into settlement instructions."""
+    instructions = []
+    for (party_a, party_b, product_id), (net_qty, net_cash, count) in sorted(netted.items()):
+        if net_qty == 0 and net_cash == 0:
+            continue # Fully offsetting obligations, nothing to settle
+        instruction = {
+            'hydrogen_product_id': product_id,
+            'trade_count': count,
+            'deliverer_id': party_b if net_qty >= 0 else party_a,
+            'receiver_id': party_a if net_qty >= 0 else party_b,
+            'net_quantity_kg': str(Decimal(abs(net_qty)) / _QTY_SCALE),
+            'payer_id': party_a if net_cash >= 0 else party_b,
+            'payee_id': party_b if net_cash >= 0 else party_a,
+            'net_amount': str((Decimal(abs(net_cash)) / _NOTIONAL_SCALE).quantize(Decimal('0.01'))),
+        }
+        instructions.append(instruction)
+    return instructions
+
+
+def run_settlement_batch(window_start=None, window_end=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Settles all pending trades executed within [window_start, window_end).
+
+    Pending trades are streamed in batches, validated and netted per buyer/seller pair
+    and product. Valid trades are marked 'completed', invalid ones 'failed', and one
+    settlement instruction is produced per non-zero netted obligation. Environmental
+    credits bundled with the trades are delivered to the buyers (or returned to the
+    sellers of failed trades) in the same transaction.
+
+    Args:
+        window_start (datetime, optional): Inclusive lower bound on trade_timestamp.
+        window_end (datetime, optional): Exclusive upper bound on trade_timestamp.
+        batch_size (int): Number of trade rows fetched per round-trip.
+
+    Returns:
+        dict: 'trades_completed', 'trades_failed', 'credits_delivered' and 'instructions'.
+    """
+    netted = {}
+    completed_ids = []
+    failed_ids = []
+
+    result = db.session.execute(
+        _pending_trades_query(window_start, window_end).execution_options(yield_per=batch_size)
+    )
+    for rows in result.partitions():
+        # fromiter over the flattened rows avoids NumPy probing each Row for the array protocol.
+        trades = np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=len(rows) * 6).reshape(-1, 6)
+        invalid = _invalid_trade_mask(trades)
+        failed_ids.append(trades[invalid, _ID])
+        valid = trades[~invalid]
+        if not len(valid):
+            continue
+        completed_ids.append(valid[:, _ID])
+
+        keys, net_qty, net_cash, counts = net_trade_batch(valid)
+        for key, qty, cash, count in zip(keys.tolist(), net_qty.tolist(), net_cash.tolist(), counts.tolist()):
+            totals = netted.setdefault(tuple(key), [0, 0, 0])
+            totals[0] += qty
+            totals[1] += cash
+            totals[2] += count
+
+    completed = np.concatenate(completed_ids) if completed_ids else np.empty(0, dtype=np.int64)
+    failed = np.concatenate(failed_ids) if failed_ids else np.empty(0, dtype=np.int64)
+
+    try:
+        _bulk_set_status(completed, 'completed')
+        _bulk_set_status(failed, 'failed')
+        credits_delivered = settle_bundled_credits(completed.tolist(), failed.tolist())
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Settlement batch failed, no trade statuses were changed: {e}")
+        raise
+
+    instructions = _build_instructions(netted)
+    logger.info(f"Settlement batch complete: {len(completed)} trade(s) completed, {len(failed)} failed, {len(instructions)} instruction(s).")
+    return {
+        'trades_completed': int(len(completed)),
+        'trades_failed': int(len(failed)),
+        'credits_delivered': credits_delivered,
+        'instructions': instructions,
+    }
+
+
+@click.command('settle')
+@click.option('--start', 'window_start', type=click.DateTime(), default=None, help='Inclusive start of the settlement window.')
+@click.option('--end', 'window_end', type=click.DateTime(), default=None, help='Exclusive end of the settlement window (defaults to now).')
+@click.option('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), default=None, help='Write settlement instructions as JSON to this file.')
+@with_appcontext
+def settle_command(window_start, window_end, batch_size, output):
+    """Settle pending trades and emit netted settlement instructions."""
+    result = run_settlement_batch(window_start, window_end or datetime.utcnow(), batch_size)
+    if output:
+        with open(output, 'w') as fh:
+            json.dump(result['instructions'], fh, indent=2)
+    click.echo(f"Completed: {result['trades_completed']}, failed: {result['trades_failed']}, credits delivered: {result['credits_delivered']}, instructions: {len(result['instructions'])}")
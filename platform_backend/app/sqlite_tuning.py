@@ -0,0 +1,154 @@
+"""
+High-concurrency settings for the SQLite fallback database.
+
+Every pooled connection is switched to WAL with a busy timeout, synchronous=NORMAL,
+a memory-mapped I/O window and a larger page cache, so readers never block on the
+writer. Writes are funnelled through a per-engine FIFO write queue: a transaction
+waits for its turn at its first write and then opens with BEGIN IMMEDIATE, so concurrent
+order entry queues up instead of failing with "database is locked". Reads never
+enter the queue and are served concurrently by the connection pool.
+"""
+import os
+import sqlite3
+import threading
+import weakref
+from collections import deque
+
+from sqlalchemy import event
+
+DEFAULT_BUSY_TIMEOUT_MS = 5000
+DEFAULT_CACHE_SIZE_KIB = 64000
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+DEFAULT_READER_POOL_SIZE = 8
+
+_write_queues = weakref.WeakKeyDictionary()
+
+
+class WriteQueue:
+    """FIFO lock granting one write transaction at a time, in arrival order."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._waiters = deque()
+        self._held = False
+
+    def acquire(self, timeout=None):
+        ticket = object()
+        with self._condition:
+            self._waiters.append(ticket)
+            granted = self._condition.wait_for(
+                lambda: not self._held and self._waiters[0] is ticket, timeout
+            )
+            if not granted:
+                self._waiters.remove(ticket)
+                self._condition.notify_all()
+                raise TimeoutError("Timed out waiting for the SQLite write queue.")
+            self._waiters.popleft()
+            self._held = True
+
+    def release(self):
+        with self._condition:
+            self._held = False
+            self._condition.notify_all()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._waiters)
+
+
+def sqlite_engine_options(config):
+    """Engine options sizing the reader pool for a file-backed SQLite database."""
+    pool_size = config.get('SQLITE_READER_POOL_SIZE', DEFAULT_READER_POOL_SIZE)
+    return {
+        'pool_size': pool_size,
+        'max_overflow': pool_size,
+        'connect_args': {
+            'timeout': config.get('SQLITE_BUSY_TIMEOUT_MS', DEFAULT_BUSY_TIMEOUT_MS) / 1000,
+            'check_same_thread': False,
+        },
+    }
+
+
+def _starts_write_transaction(context, statement):
+    """DML, or a SAVEPOINT (only opened by code about to write, e.g. the matching engine)."""
+    if context is not None and (context.isinsert or context.isupdate or context.isdelete):
+        return True
+    keyword = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+    return keyword in ('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'SAVEPOINT')
+
+
+def tune_sqlite_engine(engine, config):
+    """Applies the PRAGMAs and write queue to a file-backed SQLite engine."""
+    busy_timeout = config.get('SQLITE_BUSY_TIMEOUT_MS', DEFAULT_BUSY_TIMEOUT_MS)
+    cache_size = config.get('SQLITE_CACHE_SIZE_KIB', DEFAULT_CACHE_SIZE_KIB)
+    mmap_size = config.get('SQLITE_MMAP_SIZE', DEFAULT_MMAP_SIZE)
+    queue = _write_queues.setdefault(engine, WriteQueue())
+
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        # Take over transaction control from pysqlite so writes can start with BEGIN IMMEDIATE.
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout)}")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+        cursor.execute(f"PRAGMA cache_size=-{int(cache_size)}") # Negative value = KiB
+        cursor.close()
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _enter_write_queue(connection, cursor, statement, parameters, context, executemany):
+        # Like pysqlite's default mode, reads run outside a transaction and always see the
+        # latest commit; the transaction starts at the first write, after waiting our turn.
+        if connection.info.get('sqlite_write_queue') or not _starts_write_transaction(context, statement):
+            return
+        try:
+            queue.acquire(timeout=busy_timeout / 1000)
+        except TimeoutError:
+            # Surfaces like SQLite's own busy timeout, so callers retrying a locked database retry this too
+            raise sqlite3.OperationalError("database is locked") from None
+        connection.info['sqlite_write_queue'] = True
+        dbapi_connection = connection.connection.driver_connection
+        if not dbapi_connection.in_transaction:
+            try:
+                dbapi_connection.execute("BEGIN IMMEDIATE")
+            except Exception:
+                connection.info.pop('sqlite_write_queue', None)
+                queue.release()
+                raise
+
+    def _leave_write_queue(connection):
+        if connection.info.pop('sqlite_write_queue', False):
+            queue.release()
+
+    event.listen(engine, 'commit', _leave_write_queue)
+    event.listen(engine, 'rollback', _leave_write_queue)
+
+    @event.listens_for(engine, 'checkin')
+    def _release_on_checkin(dbapi_connection, connection_record):
+        # Safety net for connections returned to the pool without commit/rollback.
+        if connection_record.info.pop('sqlite_write_queue', False):
+            queue.release()
+
+    return engine
+
+
+def write_queue_for(engine):
+    """The write queue of a tuned engine, or None."""
+    return _write_queues.get(engine)
+
+
+def create_database_directory(engine):
+    """Creates the directory of a file-backed SQLite database on first connect instead of at every start."""
+    if engine.dialect.name != 'sqlite':
+        return engine
+
+    @event.listens_for(engine, 'do_connect')
+    def _create_directory(dialect, connection_record, cargs, cparams):
+        database = cargs[0] if cargs else cparams.get('database')
+        if database and database != ':memory:' and not database.startswith('file:'):
+            directory = os.path.dirname(os.path.abspath(database))
+            if not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok=True)
+
+    return engine
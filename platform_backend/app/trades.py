@@ -1,7 +1,9 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from .models import User, Trade, Order, HydrogenProduct, db
+from .db_routing import read_only
 import logging
+from decimal import Decimal
 
 bp = Blueprint('trades', __name__)
 logger = logging.getLogger(__name__)
@@ -16,6 +18,7 @@ def get_current_user():
 
 @bp.route('', methods=['GET'])
 @jwt_required()
+@read_only
 def list_user_trades():
     """
     Get a list of trades where the authenticated user is either the buyer or the seller.
@@ -33,6 +36,7 @@ def list_user_trades():
 
 @bp.route('/<int:trade_id>', methods=['GET'])
 @jwt_required()
+@read_only
 def get_trade_details(trade_id):
     """
     Get details of a specific trade, if the user is involved or is an admin.
@@ -57,6 +61,7 @@ def get_trade_details(trade_id):
 
 @bp.route('/product/<int:product_id>', methods=['GET'])
 @jwt_required() # Or make public/admin only depending on requirements
+@read_only
 def list_trades_for_product(product_id):
     """
     Get a list of all trades for a specific hydrogen product.
@@ -81,6 +86,7 @@ def list_trades_for_product(product_id):
 
 @bp.route('/orderbook/<int:product_id>', methods=['GET'])
 # @jwt_required() # Could be public or protected
+@read_only
 def get_product_order_book(product_id):
     """
     Gets the current order book (pending buy and sell orders) for a specific product.
@@ -94,3 +100,57 @@ def get_product_order_book(product_id):
 
     order_book = get_order_book_for_product(product_id)
     return jsonify(order_book), 200
+
+
+def _depth_arguments():
+    """The bins, min_price and max_price query parameters of the depth views (prices in 1 / SCALE units)."""
+    from .market_depth import DEFAULT_BINS, MAX_BINS
+    from .order_book import to_units
+
+    bins = min(max(request.args.get('bins', DEFAULT_BINS, type=int), 1), MAX_BINS)
+    low, high = (to_units(Decimal(request.args[name])) if request.args.get(name) else None
+                 for name in ('min_price', 'max_price'))
+    if low is not None and high is not None and high < low:
+        raise ValueError("max_price must not be below min_price.")
+    return bins, low, high
+
+
+@bp.route('/orderbook/<int:product_id>/depth', methods=['GET'])
+@read_only
+def get_product_depth(product_id):
+    """
+    Cumulative bid/ask depth per price level and a liquidity histogram of a product's book,
+    computed from the in-memory order book (see app/market_depth.py).
+    Query parameters: levels (per side, default 50), bins (default 20), min_price and max_price (histogram range).
+    """
+    from .market_depth import DEFAULT_LEVELS, MAX_LEVELS, product_depth
+
+    product = db.session.get(HydrogenProduct, product_id)
+    if not product:
+        return jsonify({"msg": f"Product with id {product_id} not found."}), 404
+    try:
+        bins, low, high = _depth_arguments()
+    except (ValueError, ArithmeticError) as e:
+        return jsonify({"msg": f"Invalid depth parameters: {e}"}), 400
+    levels = min(max(request.args.get('levels', DEFAULT_LEVELS, type=int), 1), MAX_LEVELS)
+    return jsonify(product_depth(product_id, levels, bins, low, high)), 200
+
+
+@bp.route('/orderbook/depth', methods=['GET'])
+@read_only
+def get_grouped_depth():
+    """
+    Resting liquidity of all active listings per price bin, grouped by region or production method.
+    Query parameters: group_by (region|production_method), region, production_method, bins, min_price and max_price.
+    """
+    from .market_depth import GROUP_BY, grouped_depth
+
+    group_by = request.args.get('group_by', 'region')
+    if group_by not in GROUP_BY:
+        return jsonify({"msg": f"Invalid group_by. Must be one of: {', '.join(GROUP_BY)}."}), 400
+    try:
+        bins, low, high = _depth_arguments()
+    except (ValueError, ArithmeticError) as e:
+        return jsonify({"msg": f"Invalid depth parameters: {e}"}), 400
+    return jsonify(grouped_depth(group_by, bins, low, high, request.args.get('region'),
+                                 request.args.get('production_method'))), 200
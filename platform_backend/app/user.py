@@ -1,6 +1,11 @@
-from flask import Blueprint, jsonify
+from decimal import Decimal, InvalidOperation
+
+from flask import Blueprint, jsonify, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from .models import User
+from .db_routing import read_only
+from .exposure import get_exposure_ledger
+from .models import CreditLimit, User, db
+from .platform_stats import PERIODS, admin_statistics
 
 bp = Blueprint('user', __name__)
 
@@ -21,12 +26,74 @@ def profile():
 # Example of a route requiring specific roles (more advanced)
 @bp.route('/admin/data', methods=['GET'])
 @jwt_required()
+@read_only
 def admin_data():
+    """
+    Platform statistics for administrators, read from counters maintained on writes.
+    Query parameters: period (day|month), days (daily series and top products window), months, top.
+    """
     current_user_identity = get_jwt_identity()
     roles = current_user_identity.get('roles', [])
 
     if 'admin' not in roles:
         return jsonify({"msg": "Admins only!"}), 403 # Forbidden
 
-    # Proceed with admin-specific logic
-    return jsonify(data="This is sensitive admin data.", user_roles=roles), 200
+    period = request.args.get('period', 'day')
+    if period not in PERIODS:
+        return jsonify({"msg": f"Invalid period. Must be one of: {', '.join(PERIODS)}."}), 400
+    stats = admin_statistics(period=period, days=request.args.get('days', 30, type=int),
+                             months=request.args.get('months', 12, type=int), top=request.args.get('top', 10, type=int))
+    return jsonify(user_roles=roles, stats=stats), 200
+
+
+def _credit(user_id):
+    """The account's open-order exposure and credit limits, as strings (None: unlimited)."""
+    exposure = get_exposure_ledger().exposure(user_id)
+    return {name: str(value) if value is not None else None for name, value in exposure.items()}
+
+
+@bp.route('/credit-limit', methods=['GET'])
+@jwt_required()
+def credit_limit():
+    """The current user's open-order notional and the credit limits orders are checked against."""
+    user = User.query.filter_by(username=get_jwt_identity().get('username')).first()
+    if not user:
+        return jsonify({"msg": "User not found"}), 404
+    return jsonify(user_id=user.id, **_credit(user.id)), 200
+
+
+@bp.route('/admin/credit-limits/<int:user_id>', methods=['GET', 'PUT', 'DELETE'])
+@jwt_required()
+def admin_credit_limit(user_id):
+    """
+    Administrators read (GET), set (PUT) or remove (DELETE, back to the configured defaults)
+    an account's credit limits. PUT takes max_open_notional and max_order_notional; null is unlimited.
+    """
+    if 'admin' not in get_jwt_identity().get('roles', []):
+        return jsonify({"msg": "Admins only!"}), 403
+    if not db.session.get(User, user_id):
+        return jsonify({"msg": "User not found"}), 404
+
+    limit = db.session.get(CreditLimit, user_id)
+    if request.method == 'PUT':
+        data = request.get_json() or {}
+        values = {}
+        try:
+            for name in ('max_open_notional', 'max_order_notional'):
+                values[name] = Decimal(str(data[name])) if data.get(name) is not None else None
+        except InvalidOperation:
+            return jsonify({"msg": "Invalid decimal value for a credit limit."}), 400
+        if any(value is not None and value < 0 for value in values.values()):
+            return jsonify({"msg": "Credit limits must not be negative."}), 400
+        if limit is None:
+            limit = CreditLimit(user_id=user_id)
+            db.session.add(limit)
+        limit.max_open_notional = values['max_open_notional']
+        limit.max_order_notional = values['max_order_notional']
+        db.session.commit()
+        get_exposure_ledger().set_limits(user_id, limit.max_open_notional, limit.max_order_notional)
+    elif request.method == 'DELETE' and limit is not None:
+        db.session.delete(limit)
+        db.session.commit()
+        get_exposure_ledger().clear_limits(user_id)
+    return jsonify(user_id=user_id, custom=db.session.get(CreditLimit, user_id) is not None, **_credit(user_id)), 200
@@ -0,0 +1,500 @@
+"""
+Webhook subscriptions and batched, signed, retrying delivery of order and trade events.
+
+Users register HTTPS endpoints (POST /api/webhooks) for 'order.updated' and/or
+'trade.executed' events. Events come from the transactional outbox: the outbox
+dispatcher (app/notifications.py) hands every new message to
+enqueue_webhook_deliveries(), which queues one WebhookDelivery per matching
+subscription in the same transaction that claims the message.
+
+A WebhookDeliverer per application drains due deliveries in the background:
+
+*   deliveries are grouped per endpoint and sent as one POST carrying up to
+    WEBHOOK_BATCH_SIZE events ({"events": [{"id", "type", "created_at", "data"}]});
+    the event id lets receivers drop duplicates (delivery is at least once),
+*   POSTs run on a worker pool; each worker keeps one keep-alive connection per
+    endpoint, so steady traffic does not pay a TCP/TLS handshake per batch,
+*   each body is signed: X-GHX-Signature is "sha256=" + the hex HMAC-SHA256 of
+    "<X-GHX-Timestamp>.<body>" keyed with the subscription secret,
+*   a failed POST (network error or non-2xx) is retried with exponential backoff
+    and jitter; after WEBHOOK_MAX_ATTEMPTS the delivery is moved to the dead-letter
+    queue (status 'dead'), which users can inspect and redrive,
+*   due deliveries are claimed (next_attempt_at pushed out by
+    WEBHOOK_CLAIM_TIMEOUT_SECONDS) and the claim committed before any POST, so no row
+    lock is held during network I/O; the outcome is recorded in a second, short
+    transaction.
+
+Endpoints are user-supplied URLs fetched from inside the network, so their host must
+resolve to public addresses only: private, loopback, link-local, reserved, multicast
+and unspecified addresses are rejected when the webhook is registered, and checked
+again when each connection is opened (the connection goes to the address that was
+checked, so a DNS answer that changes in between is not followed).
+WEBHOOK_ALLOW_PRIVATE_ADDRESSES turns the check off for development and tests.
+
+Throughput, failures, dead letters, connections opened and delivery lag are exported
+through app.metrics.
+"""
+import hashlib
+import hmac
+import http.client
+import ipaddress
+import json
+import logging
+import secrets
+import socket
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+from flask import Blueprint, current_app, jsonify, request
+from flask_jwt_extended import get_jwt_identity, jwt_required
+from sqlalchemy import insert, select, update
+
+from . import db
+from .metrics import registry
+from .models import User, WebhookDelivery, WebhookSubscription
+from .notifications import ORDER_UPDATED, TRADE_EXECUTED, backoff_seconds
+
+bp = Blueprint('webhooks', __name__)
+logger = logging.getLogger(__name__)
+
+EVENT_TYPES = (ORDER_UPDATED, TRADE_EXECUTED)
+SIGNATURE_HEADER = 'X-GHX-Signature'
+TIMESTAMP_HEADER = 'X-GHX-Timestamp'
+MAX_SUBSCRIPTIONS_PER_USER = 10
+DEFAULT_WORKERS = 4
+DEFAULT_BATCH_SIZE = 100 # Events per POST
+DEFAULT_CLAIM_SIZE = 1000 # Deliveries claimed per cycle
+DEFAULT_POLL_INTERVAL_SECONDS = 1.0
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_BACKOFF_BASE_SECONDS = 2.0
+DEFAULT_BACKOFF_MAX_SECONDS = 3600.0
+DEFAULT_TIMEOUT_SECONDS = 5.0
+DEFAULT_CLAIM_TIMEOUT_SECONDS = 300.0 # Longest a claimed batch may take to send
+
+EVENTS_DELIVERED = registry.counter('ghx_webhook_events_delivered_total', 'Webhook events delivered.')
+REQUESTS = registry.counter('ghx_webhook_requests_total', 'Webhook POSTs, by outcome.', ('outcome',))
+DEAD_LETTERS = registry.counter('ghx_webhook_dead_letters_total', 'Webhook events moved to the dead-letter queue.')
+CONNECTIONS_OPENED = registry.counter('ghx_webhook_connections_opened_total', 'HTTP connections opened to webhook endpoints.')
+LAG_SECONDS = registry.counter(
+    'ghx_webhook_delivery_lag_seconds_total', 'Sum of event-to-delivery lag of delivered events (divide by events delivered).'
+)
+LAST_LAG = registry.gauge('ghx_webhook_delivery_lag_seconds', 'Lag of the oldest event in the last delivered cycle.')
+
+
+class WebhookDeliveryError(Exception):
+    """Raised when an endpoint does not accept a batch."""
+
+
+class UnsafeWebhookAddress(WebhookDeliveryError):
+    """Raised when a webhook host does not resolve, or resolves to a non-public address."""
+
+
+def resolve_endpoint(hostname, port, allow_private=False):
+    """
+    The address to connect to for a webhook host, after checking every address it
+    resolves to; raises UnsafeWebhookAddress for a non-public one unless allow_private.
+    """
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(hostname, port, type=socket.SOCK_STREAM)]
+    except (socket.gaierror, UnicodeError) as e:
+        raise UnsafeWebhookAddress(f"Cannot resolve {hostname}: {e}") from e
+    if not addresses:
+        raise UnsafeWebhookAddress(f"Cannot resolve {hostname}")
+    if not allow_private:
+        for address in addresses:
+            ip = ipaddress.ip_address(address.split('%', 1)[0]) # Drop an IPv6 zone id
+            ip = getattr(ip, 'ipv4_mapped', None) or ip
+            if (ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved or ip.is_multicast
+                    or ip.is_unspecified):
+                raise UnsafeWebhookAddress(f"{hostname} resolves to a non-public address ({ip})")
+    return addresses[0]
+
+
+def sign(secret, timestamp, body):
+    """Value of the signature header for a request body."""
+    digest = hmac.new(secret.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
+
+
+def enqueue_webhook_deliveries(messages):
+    """Outbox fan-out: queues one delivery per message and matching active subscription."""
+    subscriptions = defaultdict(list)
+    rows = db.session.execute(
+        select(WebhookSubscription.id, WebhookSubscription.user_id, WebhookSubscription.event_types).where(
+            WebhookSubscription.user_id.in_({message.user_id for message in messages}),
+            WebhookSubscription.is_active.is_(True)
+        )
+    ).all()
+    for subscription_id, user_id, event_types in rows:
+        subscriptions[user_id].append((subscription_id, event_types.split(',')))
+    if not subscriptions:
+        return 0
+
+    now = datetime.utcnow()
+    deliveries = [
+        {
+            'subscription_id': subscription_id, 'event_id': message.id, 'event_type': message.topic,
+            'payload': message.payload, 'status': 'pending', 'attempts': 0,
+            'next_attempt_at': now, 'created_at': message.created_at or now,
+        }
+        for message in messages
+        for subscription_id, event_types in subscriptions.get(message.user_id, ())
+        if message.topic in event_types
+    ]
+    if deliveries:
+        db.session.execute(insert(WebhookDelivery), deliveries)
+    return len(deliveries)
+
+
+class _Connections:
+    """Keep-alive HTTP(S) connections, one per worker thread and endpoint."""
+
+    def __init__(self, timeout, allow_private=False):
+        self.timeout = timeout
+        self.allow_private = allow_private
+        self._local = threading.local()
+
+    def post(self, url, body, headers):
+        """POSTs body and returns the status code; a stale kept-alive connection is reopened once."""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+        connections = self._local.__dict__.setdefault('connections', {})
+        while True:
+            connection = connections.get(key)
+            reused = connection is not None
+            if not reused:
+                port = parts.port or (443 if parts.scheme == 'https' else 80)
+                address = resolve_endpoint(parts.hostname, port, self.allow_private)
+                connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+                connection = connection_class(parts.hostname, port, timeout=self.timeout)
+                # Connect to the checked address; TLS still verifies (and sends SNI for) the hostname
+                connection._create_connection = lambda _, *args, address=address, port=port: (
+                    socket.create_connection((address, port), *args)
+                )
+                connections[key] = connection
+                CONNECTIONS_OPENED.inc()
+            try:
+                connection.request('POST', path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read() # Drain the body so the connection can be reused
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest, ConnectionError) as e:
+                connection.close()
+                connections.pop(key, None)
+                if reused:
+                    continue # The endpoint closed an idle connection; retry on a fresh one
+                raise WebhookDeliveryError(f"Connection failed: {e}") from e
+            except Exception:
+                connection.close()
+                connections.pop(key, None)
+                raise
+            if response.will_close:
+                connection.close()
+                connections.pop(key, None)
+            return response.status
+
+
+class WebhookDeliverer:
+    """Drains due webhook deliveries of one application (see module docstring)."""
+
+    def __init__(self, app):
+        self.app = app
+        self.enabled = app.config.get('WEBHOOK_DELIVERY_ENABLED', True)
+        self.workers = app.config.get('WEBHOOK_WORKERS', DEFAULT_WORKERS)
+        self.batch_size = app.config.get('WEBHOOK_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+        self.claim_size = app.config.get('WEBHOOK_CLAIM_SIZE', DEFAULT_CLAIM_SIZE)
+        self.poll_interval = app.config.get('WEBHOOK_POLL_INTERVAL_SECONDS', DEFAULT_POLL_INTERVAL_SECONDS)
+        self.max_attempts = app.config.get('WEBHOOK_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)
+        self.backoff_base = app.config.get('WEBHOOK_BACKOFF_BASE_SECONDS', DEFAULT_BACKOFF_BASE_SECONDS)
+        self.backoff_max = app.config.get('WEBHOOK_BACKOFF_MAX_SECONDS', DEFAULT_BACKOFF_MAX_SECONDS)
+        self.claim_timeout = app.config.get('WEBHOOK_CLAIM_TIMEOUT_SECONDS', DEFAULT_CLAIM_TIMEOUT_SECONDS)
+        self.connections = _Connections(app.config.get('WEBHOOK_TIMEOUT_SECONDS', DEFAULT_TIMEOUT_SECONDS),
+                                        allow_private=app.config.get('WEBHOOK_ALLOW_PRIVATE_ADDRESSES', False))
+        self._lock = threading.Lock()
+        self._deliver_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._executor = None
+
+    def wake(self):
+        """Signals that deliveries were queued; never blocks the caller."""
+        if not self.enabled:
+            return
+        self._ensure_thread()
+        self._wakeup.set()
+
+    def deliver_due(self):
+        """Sends every due delivery; returns the number of events delivered."""
+        delivered = 0
+        with self._deliver_lock:
+            while True:
+                claimed, sent = self._deliver_batch()
+                delivered += sent
+                if claimed < self.claim_size:
+                    return delivered
+
+    def _deliver_batch(self):
+        with self.app.app_context():
+            rows = self._claim()
+        if not rows:
+            return 0, 0
+
+        # Per-endpoint batching: one POST per subscription and chunk of events, with the claim committed
+        by_subscription = defaultdict(list)
+        for row in rows:
+            by_subscription[row.subscription_id].append(row)
+        futures = []
+        for group in by_subscription.values():
+            for start in range(0, len(group), self.batch_size):
+                chunk = group[start:start + self.batch_size]
+                futures.append((chunk, self._pool().submit(self._post, chunk[0].url, chunk[0].secret, chunk)))
+
+        delivered, changes = [], []
+        now = datetime.utcnow()
+        for chunk, future in futures:
+            try:
+                future.result()
+                delivered.extend(chunk)
+            except Exception as e:
+                logger.warning(f"Webhook delivery to subscription {chunk[0].subscription_id} failed: {e}")
+                for row in chunk:
+                    attempts = row.attempts + 1 # Counted by the claim
+                    dead = attempts >= self.max_attempts
+                    if dead:
+                        DEAD_LETTERS.inc()
+                    retry_in = 0 if dead else backoff_seconds(attempts, self.backoff_base, self.backoff_max)
+                    changes.append({
+                        'id': row.id, 'status': 'dead' if dead else 'pending',
+                        'next_attempt_at': now + timedelta(seconds=retry_in),
+                        'last_error': str(e)[:1000], 'delivered_at': None,
+                    })
+
+        finished = datetime.utcnow()
+        changes.extend({
+            'id': row.id, 'status': 'delivered', 'next_attempt_at': finished, 'last_error': None,
+            'delivered_at': finished,
+        } for row in delivered)
+        with self.app.app_context():
+            db.session.execute(update(WebhookDelivery), changes) # ORM bulk UPDATE by primary key
+            db.session.commit()
+
+        if delivered:
+            lags = [max(0.0, (finished - row.created_at).total_seconds()) for row in delivered]
+            EVENTS_DELIVERED.inc(len(delivered))
+            LAG_SECONDS.inc(sum(lags))
+            LAST_LAG.set(round(max(lags), 3))
+        return len(rows), len(delivered)
+
+    def _claim(self):
+        """Claims a batch of due deliveries in one short transaction; other deliverers skip them until it runs out."""
+        now = datetime.utcnow()
+        rows = db.session.execute(
+            select(WebhookDelivery.id, WebhookDelivery.event_id, WebhookDelivery.event_type,
+                   WebhookDelivery.payload, WebhookDelivery.attempts, WebhookDelivery.created_at,
+                   WebhookDelivery.subscription_id, WebhookSubscription.url, WebhookSubscription.secret)
+            .join(WebhookSubscription, WebhookDelivery.subscription_id == WebhookSubscription.id)
+            .where(WebhookDelivery.status == 'pending', WebhookDelivery.next_attempt_at <= now)
+            .order_by(WebhookDelivery.id)
+            .limit(self.claim_size)
+            .with_for_update(skip_locked=True, of=WebhookDelivery)
+        ).all()
+        if not rows:
+            db.session.rollback()
+            return []
+        db.session.execute(
+            update(WebhookDelivery).where(WebhookDelivery.id.in_([row.id for row in rows]))
+            .values(attempts=WebhookDelivery.attempts + 1,
+                    next_attempt_at=now + timedelta(seconds=self.claim_timeout)),
+            execution_options={'synchronize_session': False}
+        )
+        db.session.commit()
+        return rows
+
+    def _post(self, url, secret, rows):
+        body = json.dumps({'events': [
+            {'id': row.event_id, 'type': row.event_type,
+             'created_at': row.created_at.isoformat() if row.created_at else None, 'data': row.payload}
+            for row in rows
+        ]}, separators=(',', ':')).encode()
+        timestamp = str(int(time.time()))
+        headers = {
+            'Content-Type': 'application/json',
+            'User-Agent': 'GHExchange-Webhooks/1.0',
+            TIMESTAMP_HEADER: timestamp,
+            SIGNATURE_HEADER: sign(secret, timestamp, body),
+        }
+        try:
+            status = self.connections.post(url, body, headers)
+        except Exception:
+            REQUESTS.inc(outcome='network_error')
+            raise
+        if not 200 <= status < 300:
+            REQUESTS.inc(outcome='http_error')
+            raise WebhookDeliveryError(f"Endpoint responded with HTTP {status}")
+        REQUESTS.inc(outcome='success')
+
+    def _pool(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='webhook-worker')
+        return self._executor
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='webhook-deliverer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                self.deliver_due()
+            except Exception as e:
+                logger.error(f"Failed to deliver webhooks: {e}")
+
+
+def get_webhook_deliverer():
+    """The webhook deliverer of the current application."""
+    return current_app.extensions['webhook_deliverer']
+
+
+# --- Subscription endpoints ---
+
+def get_current_user():
+    """Helper function to get the current authenticated user."""
+    user_identity = get_jwt_identity()
+    username = user_identity.get('username')
+    return User.query.filter_by(username=username).first()
+
+
+def _validate_url(url):
+    parts = urlsplit(url or '')
+    allowed = ('https', 'http') if current_app.config.get('WEBHOOK_ALLOW_HTTP') else ('https',)
+    try:
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+    except ValueError:
+        port = None
+    if parts.scheme not in allowed or not parts.hostname or port is None:
+        return f"Invalid webhook url. Must be an absolute {' or '.join(allowed)} URL."
+    try:
+        resolve_endpoint(parts.hostname, port, current_app.config.get('WEBHOOK_ALLOW_PRIVATE_ADDRESSES', False))
+    except UnsafeWebhookAddress as e:
+        return f"Invalid webhook url. {e}."
+    return None
+
+
+@bp.route('', methods=['POST'])
+@jwt_required()
+def create_subscription():
+    """Register an endpoint for order and trade events; the signing secret is only returned here."""
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({"msg": "User not found or token invalid"}), 401
+
+    data = request.get_json()
+    if not data:
+        return jsonify({"msg": "Missing JSON in request"}), 400
+    error = _validate_url(data.get('url'))
+    if error:
+        return jsonify({"msg": error}), 400
+    event_types = data.get('event_types') or list(EVENT_TYPES)
+    if not isinstance(event_types, list) or any(event_type not in EVENT_TYPES for event_type in event_types):
+        return jsonify({"msg": f"Invalid event_types. Allowed: {', '.join(EVENT_TYPES)}."}), 400
+    if WebhookSubscription.query.filter_by(user_id=current_user.id).count() >= MAX_SUBSCRIPTIONS_PER_USER:
+        return jsonify({"msg": f"A user can register at most {MAX_SUBSCRIPTIONS_PER_USER} webhooks."}), 400
+
+    subscription = WebhookSubscription(
+        user_id=current_user.id,
+        url=data['url'],
+        secret=secrets.token_hex(32),
+        event_types=','.join(dict.fromkeys(event_types)),
+    )
+    try:
+        db.session.add(subscription)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"msg": "Failed to create webhook", "error": str(e)}), 500
+    return jsonify({**subscription.to_dict(), 'secret': subscription.secret}), 201
+
+
+@bp.route('', methods=['GET'])
+@jwt_required()
+def list_subscriptions():
+    """List the authenticated user's webhooks."""
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({"msg": "User not found or token invalid"}), 401
+    subscriptions = WebhookSubscription.query.filter_by(user_id=current_user.id).order_by(WebhookSubscription.id).all()
+    return jsonify([subscription.to_dict() for subscription in subscriptions]), 200
+
+
+@bp.route('/<int:subscription_id>', methods=['DELETE'])
+@jwt_required()
+def delete_subscription(subscription_id):
+    """Remove a webhook and its queued deliveries."""
+    current_user = get_current_user()
+    subscription = WebhookSubscription.query.get_or_404(subscription_id)
+    if subscription.user_id != current_user.id:
+        return jsonify({"msg": "Not authorized to delete this webhook"}), 403
+    try:
+        WebhookDelivery.query.filter_by(subscription_id=subscription.id).delete(synchronize_session=False)
+        db.session.delete(subscription)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"msg": "Failed to delete webhook", "error": str(e)}), 500
+    return jsonify({"msg": "Webhook deleted successfully"}), 200
+
+
+def _own_dead_letters(user_id):
+    return WebhookDelivery.query.join(WebhookSubscription).filter(
+        WebhookSubscription.user_id == user_id, WebhookDelivery.status == 'dead'
+    )
+
+
+@bp.route('/dead-letters', methods=['GET'])
+@jwt_required()
+def list_dead_letters():
+    """Events that exhausted their retries (newest first, at most 100)."""
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({"msg": "User not found or token invalid"}), 401
+    deliveries = _own_dead_letters(current_user.id).order_by(WebhookDelivery.id.desc()).limit(100).all()
+    return jsonify([delivery.to_dict() for delivery in deliveries]), 200
+
+
+@bp.route('/dead-letters/redrive', methods=['POST'])
+@jwt_required()
+def redrive_dead_letters():
+    """Queue dead-lettered events again (all of them, or the given "ids")."""
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({"msg": "User not found or token invalid"}), 401
+    data = request.get_json(silent=True) or {}
+    requested = data.get('ids')
+    if requested is not None and (not isinstance(requested, list) or
+                                  not all(isinstance(i, int) and not isinstance(i, bool) for i in requested)):
+        return jsonify({"msg": "ids must be a list of delivery ids (integers)."}), 400
+    ids = [delivery_id for (delivery_id,) in _own_dead_letters(current_user.id).with_entities(WebhookDelivery.id)]
+    if requested is not None:
+        ids = sorted(set(ids) & set(requested))
+    if ids:
+        db.session.execute(
+            update(WebhookDelivery).where(WebhookDelivery.id.in_(ids))
+            .values(status='pending', attempts=0, next_attempt_at=datetime.utcnow(), last_error=None),
+            execution_options={'synchronize_session': False}
+        )
+        db.session.commit()
+        get_webhook_deliverer().wake()
+    return jsonify({"redriven": len(ids)}), 200
@@ -0,0 +1,76 @@
+"""
+Cold-start benchmark for the application factory.
+
+Starts fresh Python processes and measures, in each, the time to import the app
+package, to run create_app() and to serve the first requests (/health, then a
+listing query on a new SQLite file). Also reports which heavy optional modules were
+imported by the time the first request was served. Medians over all runs.
+
+Usage (from platform_backend/):
+    python -m benchmarks.cold_start --runs 10 --profile production
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HEAVY_MODULES = ('alembic', 'flask_migrate', 'numpy', 'pyarrow')
+
+# Runs in the child process; prints one JSON line of timings in milliseconds.
+CHILD = """
+import json, sys, time
+t0 = time.perf_counter()
+from app import create_app, db
+t1 = time.perf_counter()
+app = create_app(sys.argv[1])
+t2 = time.perf_counter()
+client = app.test_client()
+assert client.get('/health').status_code == 200
+t3 = time.perf_counter()
+with app.app_context():
+    db.create_all()
+t4 = time.perf_counter()
+assert client.get('/api/products').status_code == 200
+t5 = time.perf_counter()
+print(json.dumps({
+    'import_ms': (t1 - t0) * 1000,
+    'create_app_ms': (t2 - t1) * 1000,
+    'first_request_ms': (t3 - t2) * 1000,
+    'first_db_request_ms': (t5 - t4) * 1000,
+    'time_to_first_request_ms': (t3 - t0) * 1000,
+    'heavy_modules': sorted(name for name in %r if name in sys.modules),
+}))
+""" % (HEAVY_MODULES,)
+
+
+def run_once(profile, directory, index):
+    env = dict(os.environ)
+    env['DB_HOST'] = '' # Force the SQLite fallback regardless of any PostgreSQL settings in .env.
+    env['SQLITE_DATABASE_PATH'] = os.path.join(directory, f'cold_start_{index}.db')
+    env.pop('FLASK_RUN_FROM_CLI', None)
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD, profile], env=env, check=True, capture_output=True, text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10, help='Fresh processes to start.')
+    parser.add_argument('--profile', default='production', help='Configuration profile passed to create_app().')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='ghx_cold_start_')
+    results = [run_once(args.profile, directory, i) for i in range(args.runs)]
+    print(f"profile={args.profile} runs={args.runs} (medians)")
+    for key in ('import_ms', 'create_app_ms', 'first_request_ms', 'first_db_request_ms', 'time_to_first_request_ms'):
+        print(f"  {key:<26} {statistics.median(result[key] for result in results):8.1f}")
+    print(f"  heavy modules loaded       {', '.join(results[-1]['heavy_modules']) or 'none'}")
+
+
+if __name__ == '__main__':
+    main()
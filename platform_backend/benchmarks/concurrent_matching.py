@@ -0,0 +1,115 @@
+"""
+Concurrent matching benchmark.
+
+Seeds one product per market with resting 1kg asks and crossing 1kg bids, then runs
+attempt_match_order for every bid with a single thread and with a thread pool, and
+reports matches per second for both plus a double-fill check (every ask must be
+consumed at most once).
+
+Usage (from platform_backend/):
+    python -m benchmarks.concurrent_matching --threads 8 --markets 8 --orders 200
+"""
+import argparse
+import logging
+import os
+import tempfile
+import threading
+import time
+from decimal import Decimal
+
+# Force the SQLite fallback regardless of any PostgreSQL settings in .env.
+os.environ['DB_HOST'] = ''
+
+from sqlalchemy import func, insert # noqa: E402
+
+from app import create_app, db # noqa: E402
+from app.matching_engine import attempt_match_order # noqa: E402
+from app.models import User, HydrogenProduct, Order, Trade # noqa: E402
+
+
+def _setup(app, markets, orders):
+    """Returns the bid ids, interleaved across markets so threads contend for the same books."""
+    with app.app_context():
+        db.create_all()
+        seller_id, buyer_id = (
+            db.session.execute(insert(User).returning(User.id), {
+                'username': name, 'email': f'{name}@example.com', 'password_hash': 'unused'
+            }).scalar_one()
+            for name in ('bench_seller', 'bench_buyer')
+        )
+        bids_by_market = []
+        for _ in range(markets):
+            product = HydrogenProduct(seller_id=seller_id, quantity_kg=Decimal(orders), price_per_kg=Decimal('5'),
+                                      location_region='Bench', production_method='Electrolysis')
+            db.session.add(product)
+            db.session.flush()
+            db.session.execute(insert(Order), [
+                {'user_id': seller_id, 'order_type': 'sell', 'hydrogen_product_id': product.id,
+                 'quantity_kg': Decimal('1'), 'price_per_kg': Decimal('5'), 'status': 'pending'}
+                for _ in range(orders)
+            ])
+            bids = db.session.execute(insert(Order).returning(Order.id), [
+                {'user_id': buyer_id, 'order_type': 'buy', 'hydrogen_product_id': product.id,
+                 'quantity_kg': Decimal('1'), 'price_per_kg': Decimal('5'), 'status': 'pending'}
+                for _ in range(orders)
+            ]).scalars().all()
+            bids_by_market.append(bids)
+        db.session.commit()
+    return [bid for round_ in zip(*bids_by_market) for bid in round_]
+
+
+def run_workload(threads, markets, orders):
+    """Matches every bid using `threads` workers and returns a result dict."""
+    directory = tempfile.mkdtemp(prefix='ghx_matching_bench_')
+    os.environ['SQLITE_DATABASE_PATH'] = os.path.join(directory, 'bench.db')
+    app = create_app()
+    bid_ids = _setup(app, markets, orders)
+
+    def worker(order_ids):
+        with app.app_context():
+            for order_id in order_ids:
+                attempt_match_order(order_id)
+            db.session.remove()
+
+    pool = [threading.Thread(target=worker, args=(bid_ids[i::threads],)) for i in range(threads)]
+    started = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    duration = time.perf_counter() - started
+
+    with app.app_context():
+        trades = db.session.query(func.count(Trade.id)).scalar()
+        double_fills = db.session.query(Trade.sell_order_id).group_by(Trade.sell_order_id) \
+            .having(func.count(Trade.id) > 1).count()
+        db.session.remove()
+        db.engine.dispose()
+    return {
+        'threads': threads,
+        'matches': trades,
+        'matches_per_sec': trades / duration if duration else 0.0,
+        'double_fills': double_fills,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8, help='Concurrent matching threads.')
+    parser.add_argument('--markets', type=int, default=8, help='Products with their own order book.')
+    parser.add_argument('--orders', type=int, default=200, help='Asks (and crossing bids) per market.')
+    args = parser.parse_args()
+    logging.getLogger('app.matching_engine').setLevel(logging.WARNING) # Per-trade INFO logs dominate otherwise
+
+    baseline = None
+    for threads in (1, args.threads):
+        result = run_workload(threads, args.markets, args.orders)
+        baseline = baseline or result['matches_per_sec']
+        relative = result['matches_per_sec'] / baseline if baseline else 0.0
+        print(f"[threads={result['threads']:>2}] matches={result['matches']} "
+              f"throughput={result['matches_per_sec']:.1f} matches/s ({relative:.2f}x single-threaded) "
+              f"double_fills={result['double_fills']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Environmental credit registry benchmark.
+
+Issues a large lot of credits to one account on a fresh SQLite file, transfers and
+retires part of it, then times the balance endpoint, whose cost should not depend on
+the number of credits held.
+
+Usage (from platform_backend/):
+    python -m benchmarks.credit_registry --credits 100000 --queries 200
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+# Force the SQLite fallback regardless of any PostgreSQL settings in .env.
+os.environ['DB_HOST'] = ''
+
+from flask_jwt_extended import create_access_token # noqa: E402
+
+from app import create_app, db # noqa: E402
+from app.credits import issue_credits, retire_credits, transfer_credits # noqa: E402
+from app.models import User # noqa: E402
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    fn()
+    db.session.commit()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--credits', type=int, default=100_000, help='Credits issued in one lot.')
+    parser.add_argument('--moved', type=int, default=10_000, help='Credits transferred, then retired by the receiver.')
+    parser.add_argument('--queries', type=int, default=200, help='Balance requests to time.')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='ghx_credit_bench_')
+    os.environ['SQLITE_DATABASE_PATH'] = os.path.join(directory, 'bench.db')
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        holder = User(username='bench_holder', email='holder@example.com', password='password')
+        receiver = User(username='bench_receiver', email='receiver@example.com', password='password')
+        db.session.add_all([holder, receiver])
+        db.session.commit()
+        token = create_access_token(identity={'username': holder.username, 'roles': ['user']})
+
+        issue_s = _timed(lambda: issue_credits(holder.id, holder.id, 'GO', 2024, args.credits))
+        transfer_s = _timed(lambda: transfer_credits(holder.id, receiver.id, 'GO', 2024, args.moved))
+        retire_s = _timed(lambda: retire_credits(receiver.id, credit_type='GO', vintage=2024, count=args.moved))
+
+    client = app.test_client()
+    headers = {'Authorization': f'Bearer {token}'}
+    latencies = []
+    for _ in range(args.queries):
+        start = time.perf_counter()
+        response = client.get('/api/credits/balances', headers=headers)
+        latencies.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200
+    latencies.sort()
+
+    print(f"credits={args.credits} moved={args.moved}")
+    print(f"  issue      {issue_s:8.2f} s  ({args.credits / issue_s:,.0f} credits/s)")
+    print(f"  transfer   {transfer_s:8.2f} s")
+    print(f"  retire     {retire_s:8.2f} s")
+    print(f"  balances   p50 {statistics.median(latencies):.2f} ms  p99 {latencies[int(0.99 * (len(latencies) - 1))]:.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
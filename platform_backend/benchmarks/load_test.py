@@ -0,0 +1,406 @@
+"""
+End-to-end HTTP load test of the API.
+
+Starts the application on a local port (a threaded WSGI server on a fresh SQLite
+file) or targets a running server with --url, and drives it over real HTTP with
+virtual users. A few sellers list products first, so that sell orders have
+inventory. Each virtual user then logs in (new traders register first) and loops
+through a weighted mix of scenarios until the run ends:
+  * browse: list the products and poll one product's order book,
+  * trade: place a buy order, or a sell order on the user's own listing, and cancel
+    some of the orders still resting,
+  * poll: the user's trades and orders and a product's order book.
+
+With --rate the requests of all users are paced to that total rate (open loop) and
+latency is measured from each request's scheduled start, so a stalled server shows
+up in the percentiles rather than as a lower offered load; without it every user
+sends back to back (closed loop). Reports per endpoint the throughput, the error rate
+(5xx responses and transport failures; 4xx responses such as cancelling an order
+that has just filled are counted as rejections) and latency percentiles; the totals
+leave out the logins, which password hashing makes slow by design. With
+--baseline, fails if throughput, p99 latency or the error rate regressed beyond
+--tolerance against a report saved with --save-baseline.
+
+Usage (from platform_backend/):
+    python -m benchmarks.load_test --users 16 --duration 30 --save-baseline load_baseline.json
+    python -m benchmarks.load_test --users 16 --duration 30 --baseline load_baseline.json
+    python -m benchmarks.load_test --users 32 --rate 200 --duration 60
+    python -m benchmarks.load_test --url http://127.0.0.1:5000 --users 8 --duration 60
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+# Force the SQLite fallback regardless of any PostgreSQL settings in .env, and keep
+# background delivery workers from competing with the API for the database.
+os.environ['DB_HOST'] = ''
+os.environ['NOTIFICATION_DISPATCH_ENABLED'] = 'off'
+os.environ['WEBHOOK_DELIVERY_ENABLED'] = 'off'
+
+DEFAULT_MIX = 'browse=4,trade=3,poll=3'
+PRODUCT_QUANTITY_KG = 1_000_000
+PRICE = 5.00 # Orders are placed around this price, so a share of them match
+
+
+def percentiles(samples):
+    """Latency summary of samples in milliseconds."""
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    pick = lambda pct: samples[min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))]
+    return {'p50_ms': pick(50), 'p95_ms': pick(95), 'p99_ms': pick(99), 'max_ms': samples[-1]}
+
+
+class Stats:
+    """Latencies and outcomes per endpoint; scenario requests finishing before `start` (warm-up) are dropped."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = defaultdict(list)
+        self._errors = defaultdict(int)
+        self._rejected = defaultdict(int)
+        self._setup = set() # Endpoints of setup requests, left out of the totals
+        self.start = None
+
+    def record(self, endpoint, status, latency_ms, setup=False):
+        if not setup and (self.start is None or time.perf_counter() < self.start):
+            return
+        with self._lock:
+            if setup:
+                self._setup.add(endpoint)
+            self._latencies[endpoint].append(latency_ms)
+            if status == 0 or status >= 500:
+                self._errors[endpoint] += 1
+            elif status >= 400:
+                self._rejected[endpoint] += 1
+
+    def report(self, elapsed):
+        endpoints = {}
+        for endpoint in sorted(self._latencies):
+            samples = self._latencies[endpoint]
+            endpoints[endpoint] = {
+                'requests': len(samples),
+                'per_second': len(samples) / elapsed,
+                'errors': self._errors[endpoint],
+                'error_rate': self._errors[endpoint] / len(samples),
+                'rejected': self._rejected[endpoint],
+                **percentiles(samples),
+            }
+        scenario = [endpoint for endpoint in self._latencies if endpoint not in self._setup]
+        samples = [latency for endpoint in scenario for latency in self._latencies[endpoint]]
+        errors = sum(self._errors[endpoint] for endpoint in scenario)
+        total = {
+            'requests': len(samples),
+            'per_second': len(samples) / elapsed,
+            'errors': errors,
+            'error_rate': errors / len(samples) if samples else 0.0,
+            'rejected': sum(self._rejected[endpoint] for endpoint in scenario),
+            **percentiles(samples),
+        }
+        return {'elapsed_s': elapsed, 'total': total, 'endpoints': endpoints}
+
+
+class Pacer:
+    """Hands out request start times spaced 1 / rate apart across all users (no-op without a rate)."""
+
+    def __init__(self, rate):
+        self._interval = 1 / rate if rate else 0
+        self._next = None
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Sleeps until the caller's slot; returns the scheduled start (perf_counter)."""
+        now = time.perf_counter()
+        if not self._interval:
+            return now
+        with self._lock:
+            slot = now if self._next is None else self._next
+            self._next = slot + self._interval
+        if slot > now:
+            time.sleep(slot - now)
+        return slot
+
+
+class Client:
+    """One keep-alive HTTP connection per virtual user; records every measured request."""
+
+    def __init__(self, base_url, stats, pacer, timeout=30):
+        url = urlsplit(base_url)
+        self._host, self._port = url.hostname, url.port or 80
+        self._timeout = timeout
+        self._connection = None
+        self.stats, self.pacer = stats, pacer
+        self.token = None
+
+    def request(self, method, path, endpoint, body=None, measure=True, setup=False):
+        """
+        Returns (status, decoded JSON or None); status 0 for a transport failure.
+        Setup requests (logins) are neither paced nor dropped during the warm-up.
+        """
+        headers = {'Content-Type': 'application/json'}
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        payload = json.dumps(body) if body is not None else None
+        started = self.pacer.wait() if measure and not setup else time.perf_counter()
+        try:
+            if self._connection is None:
+                self._connection = http.client.HTTPConnection(self._host, self._port, timeout=self._timeout)
+            self._connection.request(method, path, body=payload, headers=headers)
+            response = self._connection.getresponse()
+            status, raw = response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            status, raw = 0, b''
+        if measure:
+            self.stats.record(endpoint, status, (time.perf_counter() - started) * 1000, setup)
+        try:
+            return status, json.loads(raw) if raw else None
+        except ValueError:
+            return status, None
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def parse_mix(text):
+    """'browse=4,trade=3,poll=3' -> ([scenario names], [weights])."""
+    weights = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in VirtualUser.SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name.strip()!r} (known: {', '.join(VirtualUser.SCENARIOS)})")
+        weights[name.strip()] = float(weight or 1)
+    return list(weights), list(weights.values())
+
+
+class VirtualUser(threading.Thread):
+    """Logs in, then runs scenarios picked by weight until the deadline."""
+
+    SCENARIOS = ('browse', 'trade', 'poll')
+
+    def __init__(self, index, client, credentials, product_ids, own_product_id, mix, deadline, seed, cancel_ratio):
+        super().__init__(name=f'vu-{index}', daemon=True)
+        self.client = client
+        self.credentials = credentials
+        self.product_ids = product_ids
+        self.own_product_id = own_product_id # Listing a seller places its sell orders on
+        self.scenarios, self.weights = mix
+        self.deadline = deadline
+        self.rng = random.Random(seed)
+        self.cancel_ratio = cancel_ratio
+        self.open_order_ids = []
+
+    def run(self):
+        try:
+            if not self.login():
+                return
+            while time.perf_counter() < self.deadline:
+                getattr(self, self.rng.choices(self.scenarios, self.weights)[0])()
+        finally:
+            self.client.close()
+
+    def login(self):
+        """Registers (traders) and logs in, once per user; password hashing makes these slow by design."""
+        username, password = self.credentials
+        if self.own_product_id is None:
+            self.client.request('POST', '/api/auth/register', 'POST /api/auth/register', {
+                'username': username, 'email': f'{username}@example.com', 'password': password}, setup=True)
+        status, body = self.client.request('POST', '/api/auth/login', 'POST /api/auth/login',
+                                           {'identifier': username, 'password': password}, setup=True)
+        if status != 200:
+            return False
+        self.client.token = body['access_token']
+        return True
+
+    def _order_book(self):
+        product_id = self.rng.choice(self.product_ids)
+        self.client.request('GET', f'/api/trades/orderbook/{product_id}', 'GET /api/trades/orderbook/<id>')
+
+    def browse(self):
+        self.client.request('GET', '/api/products', 'GET /api/products')
+        self._order_book()
+
+    def trade(self):
+        if self.open_order_ids and self.rng.random() < self.cancel_ratio:
+            order_id = self.open_order_ids.pop(self.rng.randrange(len(self.open_order_ids)))
+            self.client.request('DELETE', f'/api/orders/{order_id}', 'DELETE /api/orders/<id>')
+            return
+        selling = self.own_product_id is not None and self.rng.random() < 0.5
+        spread = self.rng.randint(-10, 10) / 100
+        status, body = self.client.request('POST', '/api/orders', 'POST /api/orders', {
+            'order_type': 'sell' if selling else 'buy',
+            'hydrogen_product_id': self.own_product_id if selling else self.rng.choice(self.product_ids),
+            'quantity_kg': str(self.rng.randint(1, 10)),
+            'price_per_kg': f'{PRICE + spread + (0.05 if selling else 0):.2f}',
+        })
+        if status == 201 and body['order']['status'] == 'pending':
+            self.open_order_ids.append(body['order']['id'])
+
+    def poll(self):
+        self.client.request('GET', '/api/trades', 'GET /api/trades')
+        self.client.request('GET', '/api/orders', 'GET /api/orders')
+        self._order_book()
+
+
+def start_local_server(rate_limit):
+    """Serves a fresh application on a free local port; returns (base URL, server)."""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    from app import create_app, db
+
+    class Handler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1' # Keep-alive, as behind a production proxy
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    if not rate_limit:
+        os.environ['RATE_LIMIT_ENABLED'] = 'off'
+    directory = tempfile.mkdtemp(prefix='ghx_load_test_')
+    os.environ['SQLITE_DATABASE_PATH'] = os.path.join(directory, 'load_test.db')
+    app = create_app('production')
+    with app.app_context():
+        db.create_all()
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=Handler)
+    threading.Thread(target=server.serve_forever, name='load-test-server', daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}', server
+
+
+def create_sellers(base_url, count, run_id):
+    """Registers sellers with one large listing each (not measured); returns [(credentials, product id)]."""
+    sellers = []
+    for index in range(count):
+        client = Client(base_url, Stats(), Pacer(None))
+        credentials = (f'load_seller_{run_id}_{index}', 'load-test-password')
+        status, body = client.request('POST', '/api/auth/register', None, {
+            'username': credentials[0], 'email': f'{credentials[0]}@example.com', 'password': credentials[1]},
+            measure=False)
+        if status != 201:
+            raise SystemExit(f"Could not register a seller ({status}): {body}")
+        client.token = body['access_token']
+        status, body = client.request('POST', '/api/products', None, {
+            'quantity_kg': str(PRODUCT_QUANTITY_KG), 'price_per_kg': f'{PRICE:.2f}',
+            'location_region': f'Load Region {index % 3}', 'production_method': 'Electrolysis'}, measure=False)
+        if status != 201:
+            raise SystemExit(f"Could not create a listing ({status}): {body}")
+        client.close()
+        sellers.append((credentials, body['id']))
+    return sellers
+
+
+def run(args):
+    server = None
+    base_url = args.url
+    if base_url is None:
+        base_url, server = start_local_server(args.rate_limit)
+    run_id = f'{int(time.time())}{random.randrange(1000):03d}' # Unique usernames against a reused server
+    sellers = create_sellers(base_url, min(args.sellers, args.users), run_id)
+    product_ids = [product_id for _, product_id in sellers]
+
+    stats = Stats()
+    pacer = Pacer(args.rate)
+    now = time.perf_counter()
+    stats.start = now + args.warmup
+    deadline = stats.start + args.duration
+    users = []
+    for index in range(args.users):
+        if index < len(sellers):
+            credentials, own_product_id = sellers[index]
+        else:
+            credentials, own_product_id = (f'load_trader_{run_id}_{index}', 'load-test-password'), None
+        users.append(VirtualUser(index, Client(base_url, stats, pacer), credentials, product_ids, own_product_id,
+                                 args.mix, deadline, args.seed + index, args.cancel_ratio))
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    elapsed = time.perf_counter() - stats.start
+    if server is not None:
+        server.shutdown()
+
+    report = stats.report(elapsed)
+    report.update(users=args.users, rate=args.rate, mix=args.mix_text, target=args.url or 'local')
+    return report
+
+
+def print_report(report):
+    print(f"{'endpoint':<34}{'requests':>9}{'req/s':>9}{'errors':>8}{'rejected':>9}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for name, stats in [*report['endpoints'].items(), ('total', report['total'])]:
+        if not stats['requests']:
+            continue
+        print(f"{name:<34}{stats['requests']:>9}{stats['per_second']:>9.1f}{stats['errors']:>8}{stats['rejected']:>9}"
+              f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}{stats['max_ms']:>9.1f}")
+    if report['rate'] and report['total']['per_second'] < report['rate'] * 0.9:
+        print(f"  offered rate not reached: {report['total']['per_second']:.1f}/s of {report['rate']}/s "
+              f"(add --users, or the server is saturated)")
+
+
+def compare(report, baseline, tolerance):
+    """Returns the regressions of report against baseline (empty when within tolerance)."""
+    problems = []
+    for name, stats in [*report['endpoints'].items(), ('total', report['total'])]:
+        before = baseline['total'] if name == 'total' else baseline['endpoints'].get(name)
+        if not before or not stats['requests']:
+            continue
+        if stats['per_second'] < before['per_second'] * (1 - tolerance):
+            problems.append(f"{name}: {stats['per_second']:.1f} req/s vs baseline {before['per_second']:.1f} req/s")
+        if stats['p99_ms'] > before['p99_ms'] * (1 + tolerance):
+            problems.append(f"{name}: p99 {stats['p99_ms']:.1f} ms vs baseline {before['p99_ms']:.1f} ms")
+        if stats['error_rate'] > before['error_rate'] + 0.01:
+            problems.append(f"{name}: error rate {stats['error_rate']:.1%} vs baseline {before['error_rate']:.1%}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default=None, help='Target a running server instead of starting one locally.')
+    parser.add_argument('--users', type=int, default=16, help='Concurrent virtual users.')
+    parser.add_argument('--sellers', type=int, default=4, help='Users that own a listing (also the number of products).')
+    parser.add_argument('--rate', type=float, default=None, help='Total requests per second (default: as fast as possible).')
+    parser.add_argument('--duration', type=float, default=30, help='Measured seconds.')
+    parser.add_argument('--warmup', type=float, default=3, help='Seconds before measuring starts.')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'Scenario weights (default: {DEFAULT_MIX}).')
+    parser.add_argument('--cancel-ratio', type=float, default=0.3, help='Share of trade steps cancelling a resting order.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--rate-limit', action='store_true', help='Keep API rate limiting on in the local server.')
+    parser.add_argument('--save-baseline', default=None, help='Write the report to this JSON file.')
+    parser.add_argument('--baseline', default=None, help='Compare with a report saved by --save-baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative regression against the baseline.')
+    args = parser.parse_args()
+    args.mix_text = args.mix
+    try:
+        args.mix = parse_mix(args.mix)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    logging.disable(logging.INFO) # The engine logs every match
+    report = run(args)
+    print_report(report)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as fh:
+            json.dump(report, fh, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as fh:
+            problems = compare(report, json.load(fh), args.tolerance)
+        for problem in problems:
+            print(f"REGRESSION: {problem}")
+        if problems:
+            sys.exit(1)
+        print("Within tolerance of the baseline.")
+
+
+if __name__ == '__main__':
+    main()
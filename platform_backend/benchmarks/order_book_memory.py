@@ -0,0 +1,132 @@
+"""
+Memory per resting order: ORM instances versus the compact order-book mirror.
+
+Measures, with tracemalloc, the bytes per resting order held by
+  * Order instances loaded into a session (identity map, instance state, Decimals),
+  * a __slots__ record per order in a dict keyed by order id,
+  * RestingOrders from app/order_book.py (NumPy columns, id -> slot dict, free list),
+then churns the compact store (remove and re-add a share of the orders) to show
+that freed slots are reused instead of growing the arrays.
+
+Usage (from platform_backend/):
+    python -m benchmarks.order_book_memory --orders 1000000 --orm-orders 50000
+"""
+import argparse
+import gc
+import os
+import random
+import tempfile
+import tracemalloc
+
+# Force the SQLite fallback regardless of any PostgreSQL settings in .env.
+os.environ['DB_HOST'] = ''
+
+import numpy # noqa: E402,F401 (RestingOrders imports it on first use; keep that out of the measurements)
+from sqlalchemy import insert, select # noqa: E402
+
+from app import create_app, db # noqa: E402
+from app.models import HydrogenProduct, Order, User # noqa: E402
+from app.order_book import BUY, SELL, RestingOrders # noqa: E402
+
+GB = 1024 ** 3
+
+
+class SlottedOrder:
+    __slots__ = ('order_id', 'product_id', 'user_id', 'side', 'price', 'quantity', 'priority', 'expires')
+
+    def __init__(self, order_id, product_id, user_id, side, price, quantity, priority, expires=0):
+        self.order_id = order_id
+        self.product_id = product_id
+        self.user_id = user_id
+        self.side = side
+        self.price = price
+        self.quantity = quantity
+        self.priority = priority
+        self.expires = expires
+
+
+def measure(build):
+    """Returns (object, bytes allocated by build and still alive)."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    held = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return held, after - before
+
+
+def synthetic_orders(count, seed=1):
+    rng = random.Random(seed)
+    start = 1_700_000_000_000_000
+    for order_id in range(1, count + 1):
+        yield (order_id, rng.randint(1, 50), rng.randint(1, 5000), rng.choice((BUY, SELL)),
+               rng.randint(400, 600), rng.randint(100, 100_000), start + order_id)
+
+
+def fill_store(rows):
+    store = RestingOrders()
+    for row in rows:
+        store.put(*row)
+    return store
+
+
+def orm_bytes_per_order(count):
+    directory = tempfile.mkdtemp(prefix='ghx_book_memory_')
+    os.environ['SQLITE_DATABASE_PATH'] = os.path.join(directory, 'bench.db')
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        user_id = db.session.execute(insert(User).returning(User.id), {
+            'username': 'bench', 'email': 'bench@example.com', 'password_hash': 'unused'}).scalar_one()
+        product = HydrogenProduct(seller_id=user_id, quantity_kg=1, price_per_kg=5, location_region='Bench',
+                                  production_method='Electrolysis')
+        db.session.add(product)
+        db.session.flush()
+        db.session.execute(insert(Order), [
+            {'user_id': user_id, 'order_type': 'buy', 'hydrogen_product_id': product.id, 'quantity_kg': 10,
+             'price_per_kg': 5, 'status': 'pending'} for _ in range(count)])
+        db.session.commit()
+        orders, used = measure(lambda: db.session.scalars(select(Order)).all())
+        assert len(orders) == count
+        del orders
+        db.session.rollback()
+    return used / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--orders', type=int, default=1_000_000, help='Resting orders in the compact and slotted stores.')
+    parser.add_argument('--orm-orders', type=int, default=50_000, help='Order rows loaded through the ORM.')
+    parser.add_argument('--churn', type=float, default=0.3, help='Share of orders removed and replaced by new ones.')
+    args = parser.parse_args()
+
+    # Rows are generated inside each measurement, so a representation is charged for the int objects it keeps
+    slotted, slotted_bytes = measure(lambda: {row[0]: SlottedOrder(*row) for row in synthetic_orders(args.orders)})
+    del slotted
+    store, store_bytes = measure(lambda: fill_store(synthetic_orders(args.orders)))
+    orm_per_order = orm_bytes_per_order(args.orm_orders)
+
+    print(f"{'representation':<28}{'bytes/order':>12}{'orders/GB':>16}")
+    for name, per_order in (
+        (f"ORM Order ({args.orm_orders:,})", orm_per_order),
+        (f"__slots__ + dict ({args.orders:,})", slotted_bytes / args.orders),
+        (f"RestingOrders ({args.orders:,})", store_bytes / args.orders),
+    ):
+        print(f"{name:<28}{per_order:>12,.0f}{GB / per_order:>16,.0f}")
+    print(f"  RestingOrders: {store.nbytes / args.orders:.0f} bytes/order in the arrays, capacity {store.capacity:,}")
+
+    churned = int(args.orders * args.churn)
+    capacity = store.capacity
+    rng = random.Random(2)
+    for order_id in rng.sample(range(1, args.orders + 1), churned):
+        store.remove(order_id)
+    for order_id, *rest in synthetic_orders(churned, seed=3):
+        store.put(args.orders + order_id, *rest)
+    print(f"  after churning {churned:,} orders: {len(store):,} held, capacity {store.capacity:,} "
+          f"({'unchanged' if store.capacity == capacity else 'grew'})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Deterministic order-stream replay for capacity planning and regression checks.
+
+Replays a recorded or generated order/cancel/amend stream (see app/replay.py) through
+the matching engine as fast as it will go, on a fresh SQLite file per run. Reports
+throughput, latency percentiles per action and book size over time, and checks that
+every run produced the same trades (by digest). With --baseline, fails if throughput
+or p99 latency regressed beyond --tolerance against a saved report.
+
+Usage (from platform_backend/):
+    python -m benchmarks.replay generate --events 20000 --seed 7 --output stream.ndjson
+    flask capture-order-stream --output stream.ndjson  # from a production copy
+    python -m benchmarks.replay run stream.ndjson --runs 2 --save-baseline baseline.json
+    python -m benchmarks.replay run stream.ndjson --baseline baseline.json
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+
+# Force the SQLite fallback regardless of any PostgreSQL settings in .env, and keep
+# background workers from competing with the engine for the database.
+os.environ['DB_HOST'] = ''
+os.environ['NOTIFICATION_DISPATCH_ENABLED'] = 'off'
+os.environ['WEBHOOK_DELIVERY_ENABLED'] = 'off'
+
+from app import create_app, db # noqa: E402
+from app.replay import Replayer, generate_stream, read_stream, write_stream # noqa: E402
+
+
+def run_once(stream, sample_every):
+    directory = tempfile.mkdtemp(prefix='ghx_replay_')
+    os.environ['SQLITE_DATABASE_PATH'] = os.path.join(directory, 'replay.db')
+    app = create_app('production')
+    with app.app_context():
+        db.create_all()
+    report = Replayer(app, sample_every=sample_every).run(stream)
+    with app.app_context():
+        db.engine.dispose()
+    return report
+
+
+def print_report(report):
+    print(f"  events {report['events']}  trades {report['trades']}  "
+          f"{report['events_per_second']:,.0f} events/s  digest {report['trade_digest'][:16]}")
+    for action, stats in report['latency'].items():
+        print(f"  {action:<7} n={stats['count']:<7} p50 {stats['p50_ms']:.2f} ms  p95 {stats['p95_ms']:.2f} ms  "
+              f"p99 {stats['p99_ms']:.2f} ms  max {stats['max_ms']:.2f} ms")
+    for sample in report['book_size']:
+        print(f"  after {sample['events']:>8} events: {sample['resting_bids']} bids, {sample['resting_asks']} asks resting")
+
+
+def compare(report, baseline, tolerance):
+    """Returns the regressions of report against baseline (empty when within tolerance)."""
+    problems = []
+    if report['trade_digest'] != baseline['trade_digest']:
+        problems.append("trades differ from the baseline (different stream or changed matching behaviour)")
+    if report['events_per_second'] < baseline['events_per_second'] * (1 - tolerance):
+        problems.append(f"throughput {report['events_per_second']:,.0f}/s vs baseline {baseline['events_per_second']:,.0f}/s")
+    for action, stats in report['latency'].items():
+        before = baseline['latency'].get(action)
+        if before and stats['p99_ms'] > before['p99_ms'] * (1 + tolerance):
+            problems.append(f"{action} p99 {stats['p99_ms']:.2f} ms vs baseline {before['p99_ms']:.2f} ms")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate = commands.add_parser('generate', help='Write a seeded synthetic stream.')
+    generate.add_argument('--events', type=int, default=10000)
+    generate.add_argument('--products', type=int, default=4)
+    generate.add_argument('--users', type=int, default=50)
+    generate.add_argument('--seed', type=int, default=1)
+    generate.add_argument('--output', required=True)
+
+    run = commands.add_parser('run', help='Replay a stream and report.')
+    run.add_argument('stream')
+    run.add_argument('--runs', type=int, default=2, help='Replays to run; their trade digests must match.')
+    run.add_argument('--sample-every', type=int, default=1000, help='Sample the book size every N events.')
+    run.add_argument('--save-baseline', default=None, help='Write the last report to this JSON file.')
+    run.add_argument('--baseline', default=None, help='Compare with a report saved by --save-baseline.')
+    run.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative regression against the baseline.')
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        stream = generate_stream(args.events, args.products, args.users, args.seed)
+        write_stream(stream, args.output)
+        print(f"Wrote {len(stream)} events to {args.output}")
+        return
+
+    logging.disable(logging.INFO) # The engine logs every match
+    stream = read_stream(args.stream)
+    reports = []
+    for index in range(args.runs):
+        print(f"run {index + 1}/{args.runs}")
+        reports.append(run_once(stream, args.sample_every))
+        print_report(reports[-1])
+    if len({report['trade_digest'] for report in reports}) != 1:
+        print("NON-DETERMINISTIC: runs produced different trades")
+        sys.exit(1)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as fh:
+            json.dump(reports[-1], fh, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as fh:
+            problems = compare(reports[-1], json.load(fh), args.tolerance)
+        for problem in problems:
+            print(f"REGRESSION: {problem}")
+        if problems:
+            sys.exit(1)
+        print("Within tolerance of the baseline.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+Concurrent order-entry benchmark for the SQLite fallback database.
+
+Runs the same workload against a fresh SQLite file with the default settings and
+with the high-concurrency mode (WAL, busy timeout, write queue), and reports
+throughput, latency percentiles and failed requests (e.g. "database is locked").
+
+Usage (from platform_backend/):
+    python -m benchmarks.sqlite_order_entry --threads 16 --orders 200
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+# Force the SQLite fallback regardless of any PostgreSQL settings in .env.
+os.environ['DB_HOST'] = ''
+# Measure the database, not the per-user order-entry rate limits.
+os.environ['RATE_LIMIT_ENABLED'] = 'off'
+
+from flask_jwt_extended import create_access_token # noqa: E402
+
+from app import create_app, db # noqa: E402
+from app.models import User, HydrogenProduct # noqa: E402
+
+
+def _percentile(samples, pct):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+    return samples[index]
+
+
+def _setup(app, threads):
+    """Creates one seller/product per worker; returns (token, own product id) per worker."""
+    with app.app_context():
+        db.create_all()
+        workers = []
+        for i in range(threads):
+            user = User(username=f'bench_{i}', email=f'bench_{i}@example.com', password='password')
+            db.session.add(user)
+            db.session.flush()
+            product = HydrogenProduct(seller_id=user.id, quantity_kg=10_000_000, price_per_kg=5,
+                                      location_region='Bench', production_method='Electrolysis')
+            db.session.add(product)
+            db.session.flush()
+            token = create_access_token(identity={'username': user.username, 'roles': ['user']})
+            workers.append((token, product.id))
+        db.session.commit()
+    return workers
+
+
+def run_workload(tuned, threads, orders_per_thread, readers):
+    """Runs the workload once and returns a result dict."""
+    directory = tempfile.mkdtemp(prefix='ghx_sqlite_bench_')
+    os.environ['SQLITE_DATABASE_PATH'] = os.path.join(directory, 'bench.db')
+    os.environ['SQLITE_TUNING'] = 'on' if tuned else 'off'
+    app = create_app()
+    workers = _setup(app, threads)
+    product_ids = [product_id for _, product_id in workers]
+
+    latencies, failures = [], []
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(threads + readers)
+    writers_done = threading.Event()
+    reads = [0]
+
+    def place_orders(index, token, own_product_id):
+        client = app.test_client()
+        headers = {'Authorization': f'Bearer {token}'}
+        other_product_id = product_ids[(index + 1) % len(product_ids)]
+        start_barrier.wait()
+        for n in range(orders_per_thread):
+            if n % 2:
+                body = {'order_type': 'sell', 'hydrogen_product_id': own_product_id, 'quantity_kg': '1', 'price_per_kg': '5.00'}
+            else:
+                body = {'order_type': 'buy', 'hydrogen_product_id': other_product_id, 'quantity_kg': '1', 'price_per_kg': '4.00'}
+            t0 = time.perf_counter()
+            response = client.post('/api/orders', json=body, headers=headers)
+            elapsed = time.perf_counter() - t0
+            with lock:
+                if response.status_code == 201:
+                    latencies.append(elapsed)
+                else:
+                    failures.append(response.get_json(silent=True) or response.status_code)
+
+    def poll_order_books():
+        client = app.test_client()
+        start_barrier.wait()
+        while not writers_done.is_set():
+            for product_id in product_ids:
+                client.get(f'/api/trades/orderbook/{product_id}')
+                with lock:
+                    reads[0] += 1
+
+    writer_threads = [threading.Thread(target=place_orders, args=(i, token, product_id))
+                      for i, (token, product_id) in enumerate(workers)]
+    reader_threads = [threading.Thread(target=poll_order_books) for _ in range(readers)]
+    started = time.perf_counter()
+    for thread in writer_threads + reader_threads:
+        thread.start()
+    for thread in writer_threads:
+        thread.join()
+    duration = time.perf_counter() - started
+    writers_done.set()
+    for thread in reader_threads:
+        thread.join()
+
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+    return {
+        'mode': 'tuned' if tuned else 'default',
+        'orders_ok': len(latencies),
+        'orders_failed': len(failures),
+        'orders_per_sec': len(latencies) / duration if duration else 0.0,
+        'p50_ms': _percentile(latencies, 50) * 1000,
+        'p99_ms': _percentile(latencies, 99) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000 if latencies else 0.0,
+        'reads': reads[0],
+        'sample_failure': failures[0] if failures else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16, help='Concurrent order-entry threads.')
+    parser.add_argument('--orders', type=int, default=100, help='Orders placed per thread.')
+    parser.add_argument('--readers', type=int, default=4, help='Concurrent order-book polling threads.')
+    args = parser.parse_args()
+
+    for tuned in (False, True):
+        result = run_workload(tuned, args.threads, args.orders, args.readers)
+        print(f"[{result['mode']:>7}] ok={result['orders_ok']} failed={result['orders_failed']} "
+              f"throughput={result['orders_per_sec']:.1f} orders/s p50={result['p50_ms']:.1f}ms "
+              f"p99={result['p99_ms']:.1f}ms reads={result['reads']}")
+        if result['sample_failure']:
+            print(f"          first failure: {result['sample_failure']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import pytest
-import os
+from flask import g, request as flask_request, request_finished
 from app import create_app, db
+from app.config import TestingConfig
 from app.models import User, HydrogenProduct, Order, Trade # Import all models
 from faker import Faker
 
@@ -8,38 +9,19 @@ from faker import Faker
 fake = Faker()
 
 @pytest.fixture(scope='session')
-def app():
+def app(tmp_path_factory):
     """
     Session-wide test Flask application.
-    Configured for testing with an in-memory SQLite database.
+    Configured for testing with a throwaway SQLite database file, so requests, worker
+    threads and a second app instance (see test_db_routing) all see the same data.
     """
-    # Set testing environment variables
     # Note: For a real PostgreSQL test setup, you'd point to a test PG database.
     # Using SQLite for simplicity in this POC.
-    os.environ['FLASK_ENV'] = 'testing'
-    
-    # Construct path for SQLite in-memory or a test file db
-    # For in-memory: SQLALCHEMY_DATABASE_URI = "sqlite:///:memory:"
-    # For a file-based test db (gets cleaned up):
-    # temp_db_path = os.path.join(os.path.dirname(__file__), 'test_app.db')
-    # SQLALCHEMY_DATABASE_URI = f"sqlite:///{temp_db_path}"
-
-    # For this POC, we'll modify the app config directly if create_app doesn't easily allow override
-    # This is a common pattern, but ideally, create_app would take a config object or name.
-    
-    app_config = {
-        'TESTING': True,
-        'SQLALCHEMY_DATABASE_URI': "sqlite:///:memory:", # In-memory SQLite for tests
-        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
-        'JWT_SECRET_KEY': 'test-secret-key', # Use a fixed secret for tests
-        'BCRYPT_LOG_ROUNDS': 4, # Speed up hashing for tests
-        'WTF_CSRF_ENABLED': False, # Disable CSRF for forms if any (not typical for API tests)
-    }
-
-    app_instance = create_app() # create_app should ideally take test_config
-    
-    # Override config for testing
-    app_instance.config.update(app_config)
+    app_instance = create_app(TestingConfig(
+        SQLITE_DATABASE_PATH=str(tmp_path_factory.mktemp('db') / 'test_app.db'),
+        JWT_SECRET_KEY='test-secret-key', # Use a fixed secret for tests
+        WTF_CSRF_ENABLED=False, # Disable CSRF for forms if any (not typical for API tests)
+    ))
 
     # Ensure the app context is pushed so that db operations can be performed.
     with app_instance.app_context():
@@ -50,9 +32,99 @@ def app():
     # Teardown:
     with app_instance.app_context():
         db.session.remove()
+        app_instance.extensions['platform_stats'].reset() # Nothing left to flush at exit
         db.drop_all() # Drop all tables
-    # if os.path.exists(temp_db_path):
-    #     os.unlink(temp_db_path) # Remove test db file if one was created
+        db.engine.dispose()
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers',
+        'query_budget(queries, db_ms=None, endpoints=None): fail the test if any request made while it runs '
+        'issues more than `queries` SQL statements (or `endpoints[endpoint]` for that view) or spends more '
+        'than `db_ms` milliseconds executing them',
+    )
+
+
+@pytest.hookimpl(hookwrapper=True, tryfirst=True)
+def pytest_runtest_makereport(item, call):
+    # Makes the outcome of each phase available to fixtures as item.rep_setup/rep_call
+    outcome = yield
+    report = outcome.get_result()
+    setattr(item, f'rep_{report.when}', report)
+
+
+@pytest.fixture(autouse=True)
+def query_budget(request):
+    """
+    Enforces the test's @pytest.mark.query_budget on every request it makes, fixtures
+    included, using the per-request counters of app/query_stats.py; checked once the
+    test has run, whatever its outcome. A budgeted test whose call never ran (e.g. a
+    fixture failed in setup) fails here too, so a budget cannot go unchecked. Yields
+    the measurements as (endpoint, method, path, statements, milliseconds) tuples.
+    """
+    marker = request.node.get_closest_marker('query_budget')
+    if marker is None:
+        yield None
+        return
+    budget = dict(zip(('queries', 'db_ms'), marker.args), **marker.kwargs)
+    app = request.getfixturevalue('app')
+    measured = []
+
+    def record(sender, response, **extra):
+        counter = g.get('sql_queries')
+        if counter is not None:
+            measured.append((flask_request.endpoint, flask_request.method, flask_request.path,
+                             counter.statements, counter.milliseconds))
+
+    request_finished.connect(record, app)
+    try:
+        yield measured
+    finally:
+        request_finished.disconnect(record, app)
+    call = getattr(request.node, 'rep_call', None)
+    if call is None:
+        pytest.fail("Query budget not checked: the test did not run", pytrace=False)
+    if call.skipped:
+        return
+    over = []
+    for endpoint, method, path, statements, milliseconds in measured:
+        limit = (budget.get('endpoints') or {}).get(endpoint, budget['queries'])
+        if statements > limit:
+            over.append(f"{method} {path} ({endpoint}): {statements} SQL statements, budget {limit}")
+        if budget.get('db_ms') is not None and milliseconds > budget['db_ms']:
+            over.append(f"{method} {path} ({endpoint}): {milliseconds:.1f} ms in SQL, budget {budget['db_ms']} ms")
+    if over:
+        pytest.fail("Query budget exceeded:\n  " + "\n  ".join(over), pytrace=False)
+
+
+@pytest.fixture(scope='function')
+def make_app(tmp_path):
+    """
+    Builds applications of their own, each on an empty SQLite file under tmp_path, for
+    tests that need settings or a database the session app cannot share. Keyword
+    arguments override the TestingConfig settings.
+    """
+    apps = []
+
+    def _make_app(**settings):
+        app_instance = create_app(TestingConfig(**{
+            'SQLITE_DATABASE_PATH': str(tmp_path / f'app{len(apps)}.db'),
+            'JWT_SECRET_KEY': 'test-secret-key',
+            'PROFILING_DIR': str(tmp_path / 'profiles'),
+            **settings,
+        }))
+        with app_instance.app_context():
+            db.create_all()
+        apps.append(app_instance)
+        return app_instance
+
+    yield _make_app
+    for app_instance in apps:
+        app_instance.extensions['platform_stats'].reset() # The files go with tmp_path, nothing to flush at exit
+        with app_instance.app_context():
+            db.session.remove()
+            db.engine.dispose()
 
 
 @pytest.fixture() # Default scope is 'function'
@@ -86,6 +158,10 @@ def init_database(app):
         for table in reversed(db.metadata.sorted_tables):
             db.session.execute(table.delete())
         db.session.commit()
+        app.extensions['inventory_ledger'].reset() # Row ids are reused once the tables are empty
+        app.extensions['order_book'].reset()
+        app.extensions['exposure_ledger'].reset()
+        app.extensions['platform_stats'].reset()
         # db.session.remove()
         # db.drop_all()
 
@@ -123,6 +199,18 @@ def new_user_with_token(client, new_user):
     token = response.json['access_token']
     return user_obj, token, plain_password
 
+
+@pytest.fixture(scope='function')
+def other_user_with_token(client, init_database):
+    """A second user, never the one of new_user, with an auth token (for ownership checks)."""
+    user = User(username=f"other_{fake.user_name()}", email=f"other_{fake.email()}", password='testpassword123',
+                organization_name=fake.company())
+    init_database.session.add(user)
+    init_database.session.commit()
+    response = client.post('/api/auth/login', json={'identifier': user.email, 'password': 'testpassword123'})
+    assert response.status_code == 200
+    return user, response.json['access_token'], 'testpassword123'
+
 # Fixture for creating a product (can be used by multiple tests)
 @pytest.fixture(scope='function')
 def new_product(init_database, new_user_with_token):
@@ -138,7 +226,7 @@ def new_product(init_database, new_user_with_token):
         "ghg_intensity_kgco2e_per_kgh2": "0.5",
         "feedstock": "Wind Power",
         "energy_source": "Dedicated Wind Farm",
-        "available_from_date": fake.future_date(end_date="+30d").isoformat(),
+        "available_from_date": fake.future_date(end_date="+30d"), # A date: the Date column does not parse strings
     }
     
     product = HydrogenProduct(
@@ -156,3 +244,41 @@ def new_product(init_database, new_user_with_token):
     db_instance.session.add(product)
     db_instance.session.commit()
     return product, seller, token # Return product and the seller with their token
+
+
+# Helpers for tests that trade through the API. Each fixture returns a function, so a
+# test can call it several times and also against a client of its own app.
+@pytest.fixture(scope='function')
+def register():
+    """Registers a user through the API; returns (user id, auth headers)."""
+    def _register(client, name, roles=None):
+        payload = {'username': name, 'email': f'{name}@example.com', 'password': 'password'}
+        if roles:
+            payload['roles'] = roles
+        response = client.post('/api/auth/register', json=payload)
+        assert response.status_code == 201
+        return response.json['user']['id'], {'Authorization': f"Bearer {response.json['access_token']}"}
+    return _register
+
+
+@pytest.fixture(scope='function')
+def create_listing():
+    """Adds an active listing for a seller directly to the database; returns its id."""
+    def _create_listing(seller_id, quantity=1000, price=5, region="Test Region", method="Electrolysis", **columns):
+        product = HydrogenProduct(seller_id=seller_id, quantity_kg=quantity, price_per_kg=price,
+                                  location_region=region, production_method=method, **columns)
+        db.session.add(product)
+        db.session.commit()
+        return product.id
+    return _create_listing
+
+
+@pytest.fixture(scope='function')
+def place_order():
+    """Places an order through the API; returns the response, whatever its status."""
+    def _place_order(client, headers, order_type, product_id, quantity="10.00", price="5.00", **extra):
+        return client.post('/api/orders', json={
+            "order_type": order_type, "hydrogen_product_id": product_id, "quantity_kg": quantity,
+            "price_per_kg": price, **extra
+        }, headers=headers)
+    return _place_order
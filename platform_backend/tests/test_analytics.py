@@ -0,0 +1,74 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+from app.analytics import intensity_band, rebuild_trade_analytics, record_trades
+from app.models import Order, Trade, TradeAnalytics, db
+
+
+def trade(client, seller, buyer, product_id, quantity, price):
+    for headers, order_type in ((seller, 'sell'), (buyer, 'buy')):
+        response = client.post('/api/orders', json={
+            "order_type": order_type, "hydrogen_product_id": product_id, "quantity_kg": quantity, "price_per_kg": price
+        }, headers=headers)
+        assert response.status_code == 201
+    assert len(response.json['trades_made']) == 1
+
+
+def test_intensity_bands():
+    assert [intensity_band(v) for v in (None, Decimal('0.1'), Decimal('0.45'), Decimal('3'), Decimal('9'))] == [
+        'unknown', '<0.45', '0.45-1.5', '2.5-4', '>=4'
+    ]
+
+
+def test_market_analytics_are_maintained_per_trade_and_rebuildable(client, init_database, register, create_listing):
+    seller_id, seller = register(client, 'analytics_seller')
+    _, buyer = register(client, 'analytics_buyer')
+    green = create_listing(seller_id, region='North', ghg_intensity_kgco2e_per_kgh2=Decimal('0.3'),
+                           energy_source='Wind')
+    blue = create_listing(seller_id, region='North', method='SMR+CCS', ghg_intensity_kgco2e_per_kgh2=Decimal('3.0'))
+    other = create_listing(seller_id, region='South')
+    trade(client, seller, buyer, green, '30.00', '6.00')
+    trade(client, seller, buyer, green, '10.00', '8.00')
+    trade(client, seller, buyer, blue, '60.00', '4.00')
+    trade(client, seller, buyer, other, '5.00', '5.00')
+
+    response = client.get('/api/analytics/market?region=North&period=total', headers=buyer)
+    assert response.status_code == 200
+    [north] = response.json['series']
+    assert (north['trade_count'], north['volume_kg']) == (3, '100.00')
+    assert north['vwap_price_per_kg'] == '5.00' # (30*6 + 10*8 + 60*4) / 100
+    assert north['volume_weighted_ghg_intensity'] == '1.9200' # (40*0.3 + 60*3) / 100
+    assert north['production_method_mix'] == {'SMR+CCS': '0.6000', 'Electrolysis': '0.4000'}
+    assert north['energy_source_mix'] == {'unknown': '0.6000', 'Wind': '0.4000'}
+    assert north['price_by_intensity_band'] == [
+        {'band': '<0.45', 'volume_kg': '40.00', 'vwap_price_per_kg': '6.50'},
+        {'band': '2.5-4', 'volume_kg': '60.00', 'vwap_price_per_kg': '4.00'},
+    ]
+
+    by_day = client.get('/api/analytics/market?period=day', headers=buyer).json['series']
+    assert [(s['region'], s['ghg_intensity_coverage']) for s in by_day] == [('North', '1.0000'), ('South', '0.0000')]
+    assert client.get('/api/analytics/market?period=week', headers=buyer).status_code == 400
+
+    before = client.get('/api/analytics/market?period=day', headers=buyer).json
+    db.session.execute(db.delete(TradeAnalytics))
+    db.session.commit()
+    assert rebuild_trade_analytics() == 3 # One row per region, mix and band
+    assert client.get('/api/analytics/market?period=day', headers=buyer).json == before
+
+
+def test_trades_count_on_the_day_of_their_timestamp(client, init_database, register, create_listing):
+    seller_id, _ = register(client, 'analytics_seller')
+    buyer_id, _ = register(client, 'analytics_buyer')
+    product_id = create_listing(seller_id, region='North')
+    orders = [Order(user_id=user_id, order_type=order_type, hydrogen_product_id=product_id, quantity_kg=0,
+                    price_per_kg=5, status='filled') for user_id, order_type in ((buyer_id, 'buy'), (seller_id, 'sell'))]
+    db.session.add_all(orders)
+    db.session.flush()
+    backfilled = Trade(buy_order_id=orders[0].id, sell_order_id=orders[1].id, hydrogen_product_id=product_id,
+                       quantity_traded_kg=2, price_per_kg_agreed=5, buyer_id=buyer_id, seller_id=seller_id,
+                       trade_timestamp=datetime(2024, 3, 31, 23, 59))
+    db.session.add(backfilled)
+    db.session.flush()
+    record_trades([backfilled])
+    db.session.commit()
+    assert [(row.trade_date, row.trade_count) for row in TradeAnalytics.query.all()] == [(date(2024, 3, 31), 1)]
@@ -145,7 +145,7 @@ def test_admin_route_access_by_admin(client, init_database):
         'Authorization': f'Bearer {admin_token}'
     })
     assert response.status_code == 200
-    assert 'This is sensitive admin data' in response.json['data']
+    assert response.json['stats']['users']['total'] == 1
 
 def test_admin_route_access_by_non_admin(client, new_user_with_token):
     """Test admin route access denied for non-admin user."""
@@ -0,0 +1,93 @@
+import threading
+import pytest
+from decimal import Decimal
+from sqlalchemy import insert
+
+from app import db
+from app.inventory import get_inventory_ledger
+from app.matching_engine import attempt_match_order
+from app.models import User, HydrogenProduct, Order, Trade
+
+SELL_ORDERS = 20
+BUY_ORDERS = 60
+THREADS = 8
+
+
+@pytest.fixture(params=['on', 'off'], ids=['tuned', 'default'])
+def stress_app(request, make_app):
+    """A file-backed SQLite app, so worker threads really run on separate connections."""
+    return make_app(SQLITE_TUNING=request.param == 'on')
+
+
+def add_user(username):
+    """Inserts a user without hashing a password (logins are not exercised here)."""
+    return db.session.execute(
+        insert(User).returning(User.id),
+        {'username': username, 'email': f'{username}@example.com', 'password_hash': 'unused'}
+    ).scalar_one()
+
+
+def seed_book(stress_app):
+    """One product with many 1kg asks, and more 1kg bids than there is supply."""
+    with stress_app.app_context():
+        seller_id = add_user('stress_seller')
+        product = HydrogenProduct(seller_id=seller_id, quantity_kg=Decimal(SELL_ORDERS), price_per_kg=Decimal('5'),
+                                  location_region='Stress', production_method='Electrolysis')
+        db.session.add(product)
+        db.session.flush()
+        for _ in range(SELL_ORDERS):
+            db.session.add(Order(user_id=seller_id, order_type='sell', hydrogen_product_id=product.id,
+                                 quantity_kg=Decimal('1'), price_per_kg=Decimal('5'), status='pending'))
+        buy_ids = []
+        for i in range(BUY_ORDERS):
+            order = Order(user_id=add_user(f'stress_buyer_{i}'), order_type='buy', hydrogen_product_id=product.id,
+                          quantity_kg=Decimal('1'), price_per_kg=Decimal('5'), status='pending')
+            db.session.add(order)
+            db.session.flush()
+            buy_ids.append(order.id)
+        db.session.commit()
+        return product.id, buy_ids
+
+
+def test_concurrent_matching_never_double_fills(stress_app):
+    product_id, buy_ids = seed_book(stress_app)
+    errors = []
+    barrier = threading.Barrier(THREADS)
+
+    def worker(order_ids):
+        with stress_app.app_context():
+            barrier.wait()
+            try:
+                for order_id in order_ids:
+                    attempt_match_order(order_id)
+            except Exception as e: # pragma: no cover - reported below
+                errors.append(e)
+            finally:
+                db.session.remove()
+
+    threads = [threading.Thread(target=worker, args=(buy_ids[i::THREADS],)) for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    with stress_app.app_context():
+        trades = Trade.query.all()
+        sell_fills = {}
+        buy_fills = {}
+        for trade in trades:
+            sell_fills[trade.sell_order_id] = sell_fills.get(trade.sell_order_id, 0) + trade.quantity_traded_kg
+            buy_fills[trade.buy_order_id] = buy_fills.get(trade.buy_order_id, 0) + trade.quantity_traded_kg
+
+        # No resting order was consumed twice, and no buyer was filled twice.
+        assert all(quantity == 1 for quantity in sell_fills.values())
+        assert all(quantity == 1 for quantity in buy_fills.values())
+        # Supply is exhausted exactly once and the product quantity agrees with the trades.
+        assert len(trades) == SELL_ORDERS
+        assert Order.query.filter_by(order_type='sell', status='filled').count() == SELL_ORDERS
+        assert Order.query.filter_by(order_type='buy', status='filled').count() == SELL_ORDERS
+        get_inventory_ledger().flush() # Fills reach the product row in batches
+        product = db.session.get(HydrogenProduct, product_id)
+        assert product.quantity_kg == 0
+        assert product.status == 'sold'
@@ -0,0 +1,129 @@
+from datetime import datetime
+
+from sqlalchemy import update
+
+from app import credits
+from app.models import CreditBalance, CreditTransaction, EnvironmentalCredit, HydrogenProduct, db
+from app.settlement import run_settlement_batch
+
+
+def issue(client, headers, owner_id, count, credit_type='GO', vintage=2024, quantity='1'):
+    response = client.post('/api/credits/issue', json={
+        'owner_id': owner_id, 'credit_type': credit_type, 'vintage': vintage, 'count': count, 'quantity': quantity
+    }, headers=headers)
+    assert response.status_code == 201, response.json
+    return response.json
+
+
+def balance(client, headers, credit_type='GO', vintage=2024):
+    for row in client.get('/api/credits/balances', headers=headers).json['balances']:
+        if (row['credit_type'], row['vintage']) == (credit_type, vintage):
+            return {status: totals['count'] for status, totals in row.items() if isinstance(totals, dict)}
+    return {}
+
+
+def test_bulk_issuance_maintains_balances(client, init_database, register):
+    _, admin = register(client, 'registry_admin', roles='admin,user')
+    producer_id, producer = register(client, 'credit_producer')
+    assert client.post('/api/credits/issue', json={'owner_id': producer_id, 'credit_type': 'GO', 'vintage': 2024, 'count': 5},
+                       headers=producer).status_code == 403
+    assert client.post('/api/credits/issue', json={'owner_id': producer_id, 'credit_type': 'bogus', 'vintage': 2024, 'count': 5},
+                       headers=admin).status_code == 400
+
+    created = issue(client, admin, producer_id, 12000, quantity='0.5') # Spans several insert chunks
+    issue(client, admin, producer_id, 3, credit_type='REC', vintage=2023)
+
+    assert created['transaction']['credit_count'] == 12000
+    assert created['last_credit_id'].endswith('-012000')
+    assert EnvironmentalCredit.query.filter_by(owner_id=producer_id).count() == 12003
+    balances = client.get('/api/credits/balances', headers=producer).json['balances']
+    assert balances == [
+        {'credit_type': 'GO', 'vintage': 2024, 'unit_of_measure': 'MWh', 'active': {'count': 12000, 'quantity': '6000.000'}},
+        {'credit_type': 'REC', 'vintage': 2023, 'unit_of_measure': 'MWh', 'active': {'count': 3, 'quantity': '3.000'}},
+    ]
+
+
+def test_transfer_and_retire_are_fifo_and_incremental(client, init_database, register):
+    _, admin = register(client, 'registry_admin', roles='admin,user')
+    seller_id, seller = register(client, 'credit_seller')
+    buyer_id, buyer = register(client, 'credit_buyer')
+    first = issue(client, admin, seller_id, 10)
+    issue(client, admin, seller_id, 10)
+
+    response = client.post('/api/credits/transfer', json={'to_user_id': buyer_id, 'credit_type': 'GO', 'count': 4}, headers=seller)
+    assert response.status_code == 200
+    assert response.json['transactions'][0]['credit_count'] == 4
+    owned = client.get('/api/credits', headers=buyer).json
+    assert [c['credit_id'] for c in owned] == [first['first_credit_id'][:-6] + f'{n:06d}' for n in range(1, 5)] # Oldest first
+    for limit in (0, -1): # At least one credit per page
+        assert [c['credit_id'] for c in client.get(f'/api/credits?limit={limit}', headers=buyer).json] == [owned[0]['credit_id']]
+
+    response = client.post('/api/credits/transfer', json={'to_user_id': buyer_id, 'credit_type': 'GO', 'count': 17}, headers=seller)
+    assert response.status_code == 400 # Only 16 left
+    response = client.post('/api/credits/retire', json={'credit_ids': [owned[0]['credit_id']]}, headers=seller)
+    assert response.status_code == 400 # No longer the seller's
+
+    response = client.post('/api/credits/retire', json={'credit_ids': [c['credit_id'] for c in owned[:3]]}, headers=buyer)
+    assert response.status_code == 200
+    assert balance(client, seller) == {'active': 16}
+    assert balance(client, buyer) == {'active': 1, 'retired': 3}
+    retired = EnvironmentalCredit.query.filter_by(status='retired').all()
+    assert {(c.owner_id, c.beneficiary_id) for c in retired} == {(buyer_id, buyer_id)}
+    assert [t.action for t in CreditTransaction.query.order_by(CreditTransaction.id)] == ['issue', 'issue', 'transfer', 'retire']
+
+
+def test_bundled_credits_settle_with_the_trade(client, init_database, register):
+    _, admin = register(client, 'registry_admin', roles='admin,user')
+    seller_id, seller = register(client, 'credit_seller')
+    buyer_id, buyer = register(client, 'credit_buyer')
+    product = HydrogenProduct(seller_id=seller_id, quantity_kg=100, price_per_kg=5,
+                              location_region="Credit Region", production_method="Electrolysis")
+    db.session.add(product)
+    db.session.commit()
+    issue(client, admin, seller_id, 5)
+
+    for headers, order_type in ((seller, 'sell'), (buyer, 'buy')):
+        response = client.post('/api/orders', json={
+            "order_type": order_type, "hydrogen_product_id": product.id, "quantity_kg": "2.00", "price_per_kg": "5.00"
+        }, headers=headers)
+    trade_id = response.json['trades_made'][0]['id']
+
+    bundle = {'trade_id': trade_id, 'credit_type': 'GO', 'count': 2}
+    assert client.post('/api/credits/bundle', json=bundle, headers=buyer).status_code == 400 # Not the seller
+    assert client.post('/api/credits/bundle', json=bundle, headers=seller).status_code == 200
+    assert balance(client, seller) == {'active': 3, 'bundled': 2}
+
+    result = run_settlement_batch(window_end=datetime.utcnow())
+    assert (result['trades_completed'], result['credits_delivered']) == (1, 2)
+    assert balance(client, seller) == {'active': 3}
+    assert balance(client, buyer) == {'active': 2}
+    delivered = EnvironmentalCredit.query.filter_by(owner_id=buyer_id).all()
+    assert {(c.status, c.trade_id) for c in delivered} == {('active', trade_id)}
+
+    # The running totals match a full recount
+    for row in CreditBalance.query.all():
+        assert row.credit_count == EnvironmentalCredit.query.filter_by(
+            owner_id=row.owner_id, credit_type=row.credit_type, vintage=row.vintage, status=row.status).count()
+
+
+def test_credits_moved_concurrently_are_not_moved_twice(client, init_database, monkeypatch, register):
+    _, admin = register(client, 'registry_admin', roles='admin,user')
+    owner_id, owner = register(client, 'credit_owner')
+    other_id, _ = register(client, 'credit_other')
+    issue(client, admin, owner_id, 3)
+    select_credits = credits._select_credits
+
+    def racing_select(*args, **kwargs):
+        rows = select_credits(*args, **kwargs)
+        # Another process retires one of the selected credits before this transfer updates them
+        with db.engine.begin() as connection:
+            connection.execute(update(EnvironmentalCredit).where(EnvironmentalCredit.id == rows[0].id)
+                               .values(status='retired'))
+        return rows
+    monkeypatch.setattr(credits, '_select_credits', racing_select)
+
+    response = client.post('/api/credits/transfer', json={'to_user_id': other_id, 'credit_type': 'GO', 'count': 3},
+                           headers=owner)
+    assert response.status_code == 409 and 'Retry' in response.json['msg']
+    assert EnvironmentalCredit.query.filter_by(owner_id=other_id).count() == 0 # Rolled back as a whole
+    assert CreditTransaction.query.filter_by(action='transfer').count() == 0
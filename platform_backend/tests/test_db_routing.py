@@ -0,0 +1,109 @@
+import pytest
+from decimal import Decimal
+
+from app import create_app, db
+from app.config import TestingConfig, _engine_options_from_env
+from app.db_routing import LAST_WRITE_HEADER, REPLICA_BIND_KEY, _last_write
+from app.models import User, HydrogenProduct
+
+
+@pytest.fixture()
+def replica_app(app, init_database, tmp_path):
+    """
+    A second app instance sharing the primary test database, with a separate
+    SQLite file standing in for the read replica.
+    """
+    environ = {'DB_REPLICA_URL': f"sqlite:///{tmp_path / 'replica.db'}", 'DB_REPLICA_MAX_LAG_SECONDS': '60'}
+    # Same database and test settings as the session app so tokens and users are interchangeable.
+    routed_app = create_app(TestingConfig(
+        environ, **{key: app.config[key] for key in ('SQLALCHEMY_DATABASE_URI', 'JWT_SECRET_KEY', 'BCRYPT_LOG_ROUNDS')}
+    ))
+    with routed_app.app_context():
+        db.metadata.create_all(db.engines[REPLICA_BIND_KEY])
+    yield routed_app
+    routed_app.extensions['platform_stats'].reset() # init_database wipes the shared tables
+    with routed_app.app_context():
+        db.metadata.drop_all(db.engines[REPLICA_BIND_KEY])
+    # Bind metadata is registered on the shared extension; drop it so the session app's
+    # drop_all() does not look for a replica bind it was never configured with.
+    db.metadatas.pop(REPLICA_BIND_KEY, None)
+
+
+def add_replica_only_product(routed_app, seller_id, region):
+    """Simulates a row that has already been replicated: it only exists in the replica."""
+    with routed_app.app_context():
+        with db.engines[REPLICA_BIND_KEY].begin() as connection:
+            connection.execute(HydrogenProduct.__table__.insert().values(
+                seller_id=seller_id, quantity_kg=Decimal("10"), price_per_kg=Decimal("5"),
+                location_region=region, production_method="Solar", status='active'
+            ))
+
+
+def test_engine_options_from_env():
+    environ = {'DB_POOL_SIZE': '15', 'DB_POOL_RECYCLE': '1800', 'DB_POOL_PRE_PING': 'true'}
+    assert _engine_options_from_env(environ) == {'pool_size': 15, 'pool_recycle': 1800, 'pool_pre_ping': True}
+
+
+def test_read_only_endpoints_use_replica(replica_app, new_user):
+    user, _ = new_user
+    add_replica_only_product(replica_app, user.id, "Replica Region")
+
+    client = replica_app.test_client()
+    response = client.get('/api/products')
+    assert response.status_code == 200
+    assert [p['location_region'] for p in response.json] == ["Replica Region"]
+
+
+def test_writes_go_to_primary(replica_app, new_user):
+    user, password = new_user
+    client = replica_app.test_client()
+    token = client.post('/api/auth/login', json={'identifier': user.email, 'password': password}).json['access_token']
+
+    response = client.post('/api/products', json={
+        "quantity_kg": "10", "price_per_kg": "5", "location_region": "Primary Region", "production_method": "Wind"
+    }, headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 201
+    assert db.session.get(HydrogenProduct, response.json['id']) is not None # Visible on the primary
+
+
+def test_recent_writer_reads_from_primary(replica_app, new_user):
+    user, password = new_user
+    add_replica_only_product(replica_app, user.id, "Replica Region")
+    client = replica_app.test_client()
+    token = client.post('/api/auth/login', json={'identifier': user.email, 'password': password}).json['access_token']
+    headers = {'Authorization': f'Bearer {token}'}
+
+    # Before writing, the authenticated user is served by the replica like anyone else.
+    assert [p['location_region'] for p in client.get('/api/products', headers=headers).json] == ["Replica Region"]
+
+    # Place a write, then read again inside the lag window: the read must see the write.
+    created = client.post('/api/products', json={
+        "quantity_kg": "10", "price_per_kg": "5", "location_region": "Fresh Region", "production_method": "Wind"
+    }, headers=headers)
+    assert created.status_code == 201
+    regions = [p['location_region'] for p in client.get('/api/products', headers=headers).json]
+    assert regions == ["Fresh Region"]
+
+    # Other clients are still served by the replica.
+    assert [p['location_region'] for p in replica_app.test_client().get('/api/products').json] == ["Replica Region"]
+
+
+def test_write_marker_keeps_the_client_on_the_primary_across_workers(replica_app, new_user):
+    user, password = new_user
+    add_replica_only_product(replica_app, user.id, "Replica Region")
+    client = replica_app.test_client()
+    token = client.post('/api/auth/login', json={'identifier': user.email, 'password': password}).json['access_token']
+    headers = {'Authorization': f'Bearer {token}'}
+    created = client.post('/api/products', json={
+        "quantity_kg": "10", "price_per_kg": "5", "location_region": "Fresh Region", "production_method": "Wind"
+    }, headers=headers)
+    assert created.status_code == 201
+    marker = created.headers[LAST_WRITE_HEADER]
+
+    # Another worker never saw the write; only the marker the client sends back routes it to the primary
+    _last_write.clear()
+    assert [p['location_region'] for p in client.get('/api/products').json] == ["Fresh Region"] # Cookie
+    other_client = replica_app.test_client()
+    assert [p['location_region'] for p in other_client.get('/api/products', headers={LAST_WRITE_HEADER: marker}).json] == ["Fresh Region"]
+    stale = {LAST_WRITE_HEADER: str(float(marker) - 3600)}
+    assert [p['location_region'] for p in other_client.get('/api/products', headers=stale).json] == ["Replica Region"]
@@ -0,0 +1,102 @@
+import csv
+import io
+import json
+import pytest
+from decimal import Decimal
+from datetime import datetime, timedelta
+
+from app.models import User, HydrogenProduct, Order, Trade, db
+
+
+def create_test_product(seller_id):
+    product = HydrogenProduct(seller_id=seller_id, quantity_kg=Decimal("1000"), price_per_kg=Decimal("10"),
+                              location_region="Test Region", production_method="Test Method")
+    db.session.add(product)
+    db.session.commit()
+    return product
+
+def create_test_trade(buyer_id, seller_id, product, quantity="10", price="5.00", timestamp=None):
+    buy_order = Order(user_id=buyer_id, hydrogen_product_id=product.id, order_type='buy',
+                      quantity_kg=Decimal(quantity), price_per_kg=Decimal(price), status='filled')
+    sell_order = Order(user_id=seller_id, hydrogen_product_id=product.id, order_type='sell',
+                       quantity_kg=Decimal(quantity), price_per_kg=Decimal(price), status='filled')
+    db.session.add_all([buy_order, sell_order])
+    db.session.flush()
+    trade = Trade(buy_order_id=buy_order.id, sell_order_id=sell_order.id, hydrogen_product_id=product.id,
+                  quantity_traded_kg=Decimal(quantity), price_per_kg_agreed=Decimal(price),
+                  buyer_id=buyer_id, seller_id=seller_id, trade_timestamp=timestamp or datetime.utcnow())
+    db.session.add(trade)
+    db.session.commit()
+    return trade
+
+
+@pytest.fixture()
+def trade_history(client, init_database, register):
+    seller_id, _ = register(client, 'export_seller')
+    buyer_id, buyer = register(client, 'export_buyer')
+    other_id, _ = register(client, 'export_other')
+    _, admin = register(client, 'export_admin', roles='admin,user')
+    product_a = create_test_product(seller_id)
+    product_b = create_test_product(seller_id)
+    trades = [
+        create_test_trade(buyer_id, seller_id, product_a, "10"),
+        create_test_trade(buyer_id, seller_id, product_b, "20"),
+        create_test_trade(other_id, seller_id, product_a, "30", timestamp=datetime.utcnow() - timedelta(days=10)),
+    ]
+    return {'trades': trades, 'product_a': product_a, 'buyer': buyer, 'admin': admin}
+
+
+def test_admin_exports_all_trades_as_csv(client, trade_history):
+    response = client.get('/api/exports/trades?format=csv', headers=trade_history['admin'])
+    assert response.status_code == 200
+    assert response.mimetype == 'text/csv'
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert [int(row['id']) for row in rows] == [trade.id for trade in trade_history['trades']]
+    assert Decimal(rows[1]['quantity_traded_kg']) == Decimal("20")
+
+
+def test_export_filters_by_product_and_date(client, trade_history):
+    start = (datetime.utcnow() - timedelta(days=1)).date().isoformat()
+    response = client.get(
+        f"/api/exports/trades?format=ndjson&product_id={trade_history['product_a'].id}&start={start}",
+        headers=trade_history['admin']
+    )
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [row['id'] for row in rows] == [trade_history['trades'][0].id]
+
+
+def test_non_admin_exports_only_own_trades(client, trade_history):
+    response = client.get('/api/exports/trades?format=ndjson', headers=trade_history['buyer'])
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert sorted(row['id'] for row in rows) == sorted(t.id for t in trade_history['trades'][:2])
+
+
+def test_export_rejects_unknown_format(client, trade_history):
+    response = client.get('/api/exports/orders?format=xml', headers=trade_history['admin'])
+    assert response.status_code == 400
+
+
+def test_export_rejects_a_non_integer_product_id(client, trade_history):
+    response = client.get('/api/exports/trades?product_id=abc', headers=trade_history['admin'])
+    assert response.status_code == 400
+    assert response.json['msg'] == "product_id must be an integer."
+
+
+def test_export_parquet(client, trade_history):
+    pq = pytest.importorskip('pyarrow.parquet')
+    response = client.get('/api/exports/trades?format=parquet', headers=trade_history['admin'])
+    assert response.status_code == 200
+    table = pq.read_table(io.BytesIO(response.get_data()))
+    assert table.num_rows == 3
+    assert table.column('quantity_traded_kg').to_pylist()[2] == Decimal("30.00")
+
+
+def test_export_cli_writes_orders(runner, trade_history, tmp_path):
+    output = tmp_path / 'orders.ndjson'
+    result = runner.invoke(args=['export', 'orders', '--format', 'ndjson', '--output', str(output), '--chunk-size', '2'])
+    assert result.exit_code == 0, result.output
+    rows = [json.loads(line) for line in output.read_text().splitlines()]
+    assert len(rows) == 6
+    assert {row['order_type'] for row in rows} == {'buy', 'sell'}
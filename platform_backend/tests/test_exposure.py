@@ -0,0 +1,114 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import update
+
+from app import db
+from app.exposure import get_exposure_ledger
+from app.inventory import expire_due_orders
+from app.models import CreditLimit, Order, Position
+
+
+def open_notional(client, headers):
+    response = client.get('/api/user/credit-limit', headers=headers)
+    assert response.status_code == 200
+    return Decimal(response.json['open_notional'])
+
+
+def test_orders_are_checked_against_the_account_limits(client, init_database, register, create_listing, place_order):
+    _, admin = register(client, 'limit_admin', roles='admin')
+    seller_id, seller = register(client, 'limit_seller')
+    buyer_id, buyer = register(client, 'limit_buyer')
+    product_id = create_listing(seller_id)
+    assert client.put(f'/api/user/admin/credit-limits/{buyer_id}', json={'max_open_notional': '150'},
+                      headers=buyer).status_code == 403
+    response = client.put(f'/api/user/admin/credit-limits/{buyer_id}',
+                          json={'max_open_notional': '150', 'max_order_notional': '100'}, headers=admin)
+    assert response.status_code == 200 and response.json['custom']
+
+    first = place_order(client, buyer, 'buy', product_id, "10.00", "5.00")
+    assert first.status_code == 201
+    rejected = place_order(client, buyer, 'buy', product_id, "30.00", "5.00") # 150 > 100 for one order
+    assert rejected.status_code == 400 and 'Order notional' in rejected.json['msg']
+    assert place_order(client, buyer, 'buy', product_id, "20.00", "4.00").status_code == 201
+    rejected = place_order(client, buyer, 'buy', product_id, "5.00", "5.00") # 130 + 25 open > 150
+    assert rejected.status_code == 400 and 'Open order notional' in rejected.json['msg']
+    assert open_notional(client, buyer) == Decimal('130')
+    assert db.session.query(Order).filter_by(user_id=buyer_id).count() == 2 # Rejected orders were rolled back
+
+    first_id = first.json['order']['id']
+    assert client.put(f'/api/orders/{first_id}', json={'quantity_kg': '15.00'}, headers=buyer).status_code == 400
+    assert client.put(f'/api/orders/{first_id}', json={'quantity_kg': '8.00'}, headers=buyer).status_code == 200
+    assert client.delete(f'/api/orders/{first_id}', headers=buyer).status_code == 200
+    assert open_notional(client, buyer) == Decimal('80')
+
+    # A fill reduces the remaining notional; the seller's own order counts against the seller
+    assert place_order(client, seller, 'sell', product_id, "5.00", "4.00").status_code == 201
+    assert open_notional(client, buyer) == Decimal('60')
+    assert open_notional(client, seller) == Decimal('0')
+
+    assert client.delete(f'/api/user/admin/credit-limits/{buyer_id}', headers=admin).json['max_open_notional'] is None
+    assert place_order(client, buyer, 'buy', product_id, "100.00", "5.00").status_code == 201 # Unlimited again
+
+
+def test_criteria_buys_count_towards_the_open_limit(client, init_database, register):
+    _, admin = register(client, 'limit_admin', roles='admin')
+    buyer_id, buyer = register(client, 'limit_buyer')
+    assert client.put(f'/api/user/admin/credit-limits/{buyer_id}', json={'max_open_notional': '150'},
+                      headers=admin).status_code == 200
+    criteria = {'order_type': 'buy', 'quantity_kg': '20.00', 'price_per_kg': '5.00', 'location_criteria': 'North'}
+    assert client.post('/api/orders', json=criteria, headers=buyer).status_code == 201 # No listing named
+    assert open_notional(client, buyer) == Decimal('100')
+    rejected = client.post('/api/orders', json=criteria, headers=buyer) # 100 + 100 open > 150
+    assert rejected.status_code == 400 and 'Open order notional' in rejected.json['msg']
+    assert get_exposure_ledger().reconcile() == 0 # The criteria buy is read back from the orders table
+
+
+def test_expired_orders_release_exposure(client, init_database, register, create_listing, place_order):
+    seller_id, _ = register(client, 'limit_seller')
+    buyer_id, buyer = register(client, 'limit_buyer')
+    product_id = create_listing(seller_id)
+    expires = (datetime.utcnow() + timedelta(hours=1)).isoformat()
+    placed = place_order(client, buyer, 'buy', product_id, "10.00", "5.00", expiration_timestamp=expires)
+    assert placed.status_code == 201
+    assert open_notional(client, buyer) == Decimal('50')
+    assert expire_due_orders(now=datetime.utcnow() + timedelta(hours=2)) == 1
+    assert open_notional(client, buyer) == Decimal('0')
+
+
+def test_reconcile_corrects_changes_made_behind_the_ledger(client, init_database, register, create_listing,
+                                                           place_order):
+    seller_id, _ = register(client, 'limit_seller')
+    buyer_id, buyer = register(client, 'limit_buyer')
+    product_id = create_listing(seller_id)
+    order_id = place_order(client, buyer, 'buy', product_id, "10.00", "5.00").json['order']['id']
+    place_order(client, buyer, 'buy', product_id, "2.00", "4.00")
+    ledger = get_exposure_ledger()
+    assert ledger.reconcile() == 0
+
+    # Another process cancels an order (its positions hook updates the Position row there) and sets
+    # a limit; this one only learns of it by reconciling
+    db.session.execute(update(Order).where(Order.id == order_id).values(status='cancelled'),
+                       execution_options={'synchronize_session': False})
+    db.session.execute(update(Position).where(Position.user_id == buyer_id, Position.hydrogen_product_id == product_id)
+                       .values(open_order_count=1, open_buy_kg=2, open_buy_notional=8),
+                       execution_options={'synchronize_session': False})
+    db.session.add(CreditLimit(user_id=buyer_id, max_order_notional=Decimal('20')))
+    db.session.commit()
+    assert ledger.exposure(buyer_id)['open_notional'] == Decimal('58')
+    assert ledger.reconcile() == 1
+    assert ledger.exposure(buyer_id) == {'open_notional': Decimal('8'), 'max_open_notional': None,
+                                         'max_order_notional': Decimal('20')}
+    assert ledger.reconcile() == 0
+
+
+def test_default_limits_apply_to_immediate_orders(make_app, register, create_listing, place_order):
+    app = make_app(CREDIT_MAX_ORDER_NOTIONAL=Decimal('40'))
+    with app.app_context():
+        client = app.test_client()
+        seller_id, _ = register(client, 'limit_seller')
+        _, buyer = register(client, 'limit_buyer')
+        product_id = create_listing(seller_id)
+        rejected = place_order(client, buyer, 'buy', product_id, "10.00", "5.00", time_in_force='IOC')
+        assert rejected.status_code == 400 and 'credit limit (40)' in rejected.json['msg']
+        assert place_order(client, buyer, 'buy', product_id, "8.00", "5.00").status_code == 201
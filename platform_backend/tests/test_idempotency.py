@@ -0,0 +1,111 @@
+import threading
+import pytest
+
+from app.idempotency import (
+    CLAIMED, IN_PROGRESS, MISMATCH, REPLAY, DatabaseIdempotencyStore, MemoryIdempotencyStore
+)
+from app.models import HydrogenProduct, Order, Trade
+
+PRODUCT = {"quantity_kg": "100.00", "price_per_kg": "8.00", "location_region": "Retry Region", "production_method": "Solar"}
+
+
+@pytest.fixture(params=['memory', 'database'])
+def store_backend(request, app, init_database, monkeypatch):
+    """Runs a test against both stores."""
+    store = MemoryIdempotencyStore() if request.param == 'memory' else DatabaseIdempotencyStore()
+    monkeypatch.setitem(app.extensions, 'idempotency_store', store)
+    return store
+
+
+def test_product_creation_is_replayed(client, store_backend, register):
+    _, headers = register(client, 'retry_seller')
+    headers['Idempotency-Key'] = 'listing-1'
+
+    first = client.post('/api/products', json=PRODUCT, headers=headers)
+    replay = client.post('/api/products', json=PRODUCT, headers=headers)
+    assert first.status_code == replay.status_code == 201
+    assert replay.json == first.json
+    assert replay.headers['Idempotent-Replayed'] == 'true'
+    assert HydrogenProduct.query.count() == 1
+
+    # A new key is a new request.
+    headers['Idempotency-Key'] = 'listing-2'
+    assert client.post('/api/products', json=PRODUCT, headers=headers).status_code == 201
+    assert HydrogenProduct.query.count() == 2
+
+
+def test_order_replay_does_not_rematch(client, store_backend, register):
+    _, seller = register(client, 'retry_seller')
+    _, buyer = register(client, 'retry_buyer')
+    product_id = client.post('/api/products', json=PRODUCT, headers=seller).json['id']
+    for _ in range(2): # Two resting asks, so a duplicate buy would fill again
+        client.post('/api/orders', json={"order_type": "sell", "hydrogen_product_id": product_id,
+                                          "quantity_kg": "10.00", "price_per_kg": "8.00"}, headers=seller)
+
+    buy = {"order_type": "buy", "hydrogen_product_id": product_id, "quantity_kg": "10.00", "price_per_kg": "8.00"}
+    buyer['Idempotency-Key'] = 'buy-1'
+    first = client.post('/api/orders', json=buy, headers=buyer)
+    replay = client.post('/api/orders', json=buy, headers=buyer)
+    assert len(first.json['trades_made']) == 1
+    assert replay.json == first.json
+    assert Order.query.filter_by(order_type='buy').count() == 1
+    assert Trade.query.count() == 1
+
+
+def test_validation_errors_are_replayed_and_key_reuse_rejected(client, store_backend, register):
+    _, headers = register(client, 'retry_seller')
+    headers['Idempotency-Key'] = 'bad-listing'
+
+    first = client.post('/api/products', json={"quantity_kg": "1"}, headers=headers)
+    assert first.status_code == 400
+    assert client.post('/api/products', json={"quantity_kg": "1"}, headers=headers).headers['Idempotent-Replayed'] == 'true'
+
+    reused = client.post('/api/products', json=PRODUCT, headers=headers)
+    assert reused.status_code == 422
+    assert HydrogenProduct.query.count() == 0
+
+
+def test_keys_are_scoped_per_user(client, store_backend, register):
+    _, first = register(client, 'retry_seller')
+    _, second = register(client, 'retry_seller_2')
+    first['Idempotency-Key'] = second['Idempotency-Key'] = 'same-key'
+    assert client.post('/api/products', json=PRODUCT, headers=first).status_code == 201
+    response = client.post('/api/products', json=PRODUCT, headers=second)
+    assert response.status_code == 201
+    assert 'Idempotent-Replayed' not in response.headers
+
+
+def test_memory_store_in_flight_bound_and_expiry():
+    store = MemoryIdempotencyStore(ttl_seconds=60, max_keys=2)
+    assert store.begin('a', 'body')[0] == CLAIMED
+    assert store.begin('a', 'body')[0] == IN_PROGRESS
+    assert store.begin('a', 'other')[0] == MISMATCH
+    store.complete('a', 201, b'{}', 'application/json')
+    outcome, stored = store.begin('a', 'body')
+    assert outcome == REPLAY and stored.status_code == 201
+
+    store.begin('b', 'body')
+    store.begin('c', 'body')
+    assert len(store) == 2 # Least recently used key evicted
+
+    expiring = MemoryIdempotencyStore(ttl_seconds=0)
+    expiring.begin('a', 'body')
+    expiring.complete('a', 201, b'{}', 'application/json')
+    assert expiring.begin('a', 'body')[0] == CLAIMED
+
+
+def test_memory_store_claims_once_under_concurrency():
+    store = MemoryIdempotencyStore()
+    outcomes = []
+    barrier = threading.Barrier(8)
+
+    def claim():
+        barrier.wait()
+        outcomes.append(store.begin('key', 'body')[0])
+
+    threads = [threading.Thread(target=claim) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert outcomes.count(CLAIMED) == 1
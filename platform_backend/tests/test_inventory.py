@@ -0,0 +1,115 @@
+import pytest
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import update
+
+from app.inventory import InsufficientInventory, get_inventory_ledger
+from app.models import User, HydrogenProduct, Order, db
+
+
+def test_open_sell_orders_cannot_overcommit_listing(client, init_database, register, create_listing, place_order):
+    seller_id, headers = register(client, 'ledger_seller')
+    product_id = create_listing(seller_id, quantity=100)
+
+    assert place_order(client, headers, 'sell', product_id, "60.00").status_code == 201
+    response = place_order(client, headers, 'sell', product_id, "60.00")
+    assert response.status_code == 400
+    assert "cannot exceed available product quantity (40.00kg)" in response.json['msg']
+    assert place_order(client, headers, 'sell', product_id, "40.00").status_code == 201
+
+    listing = client.get(f'/api/products/{product_id}').json
+    assert Decimal(listing['quantity_reserved_kg']) == Decimal("100")
+    assert Decimal(listing['quantity_available_kg']) == Decimal("0")
+
+
+def test_cancel_releases_reservation(client, init_database, register, create_listing, place_order):
+    seller_id, headers = register(client, 'ledger_seller')
+    product_id = create_listing(seller_id, quantity=100)
+    order_id = place_order(client, headers, 'sell', product_id, "100.00").json['order']['id']
+    assert place_order(client, headers, 'sell', product_id, "1.00").status_code == 400
+
+    assert client.delete(f'/api/orders/{order_id}', headers=headers).status_code == 200
+    assert get_inventory_ledger().reserved(product_id) == 0
+    assert place_order(client, headers, 'sell', product_id, "100.00").status_code == 201
+
+
+def test_amending_sell_quantity_resizes_reservation(client, init_database, register, create_listing, place_order):
+    seller_id, headers = register(client, 'ledger_seller')
+    product_id = create_listing(seller_id, quantity=100)
+    order_id = place_order(client, headers, 'sell', product_id, "50.00").json['order']['id']
+    assert place_order(client, headers, 'sell', product_id, "30.00").status_code == 201
+
+    response = client.put(f'/api/orders/{order_id}', json={"quantity_kg": "80.00"}, headers=headers)
+    assert response.status_code == 400
+    assert client.put(f'/api/orders/{order_id}', json={"quantity_kg": "70.00"}, headers=headers).status_code == 200
+    assert get_inventory_ledger().reserved(product_id) == Decimal("100")
+
+
+def test_fill_converts_reservation_and_persists_in_batches(client, init_database, register, create_listing,
+                                                           place_order):
+    seller_id, seller_headers = register(client, 'ledger_seller')
+    _, buyer_headers = register(client, 'ledger_buyer')
+    product_id = create_listing(seller_id, quantity=100)
+    assert place_order(client, seller_headers, 'sell', product_id, "70.00").status_code == 201
+
+    response = client.post('/api/orders', json={
+        "order_type": "buy", "hydrogen_product_id": product_id, "quantity_kg": "50.00", "price_per_kg": "8.00"
+    }, headers=buyer_headers)
+    assert len(response.json['trades_made']) == 1
+
+    ledger = get_inventory_ledger()
+    assert ledger.reserved(product_id) == Decimal("20") # 70 reserved - 50 filled
+    # Readers see the fill immediately, before the batch reaches the product row.
+    assert Decimal(client.get(f'/api/products/{product_id}').json['quantity_kg']) == Decimal("50")
+
+    ledger.flush()
+    product = db.session.get(HydrogenProduct, product_id)
+    db.session.refresh(product)
+    assert product.quantity_kg == Decimal("50")
+
+
+def test_ledger_loads_existing_open_orders(init_database, create_listing):
+    seller = User(username='ledger_seller', email='ledger_seller@example.com', password='password')
+    db.session.add(seller)
+    db.session.commit()
+    product_id = create_listing(seller.id, quantity=100)
+    db.session.add(Order(user_id=seller.id, order_type='sell', hydrogen_product_id=product_id,
+                         quantity_kg=Decimal("90"), price_per_kg=Decimal("8"), status='pending'))
+    db.session.commit()
+
+    with pytest.raises(InsufficientInventory):
+        get_inventory_ledger().reserve(order_id=999, product_id=product_id, quantity=Decimal("11"))
+
+
+def test_expire_orders_command_releases_reservations(client, runner, init_database, register, create_listing,
+                                                     place_order):
+    seller_id, headers = register(client, 'ledger_seller')
+    product_id = create_listing(seller_id, quantity=100)
+    past = (datetime.utcnow() - timedelta(minutes=1)).isoformat()
+    order_id = place_order(client, headers, 'sell', product_id, "100.00", expiration_timestamp=past).json['order']['id']
+
+    result = runner.invoke(args=['expire-orders'])
+    assert "Expired 1 order(s)." in result.output
+    assert db.session.get(Order, order_id).status == 'expired'
+    assert get_inventory_ledger().reserved(product_id) == 0
+
+
+def test_expiry_pass_releases_orders_closed_elsewhere(client, init_database, register, create_listing, place_order):
+    seller_id, headers = register(client, 'ledger_seller')
+    product_id = create_listing(seller_id, quantity=100)
+    past = (datetime.utcnow() - timedelta(minutes=1)).isoformat()
+    place_order(client, headers, 'sell', product_id, "30.00", expiration_timestamp=past)
+    cancelled_id = place_order(client, headers, 'sell', product_id, "20.00").json['order']['id']
+    kept_id = place_order(client, headers, 'sell', product_id, "10.00").json['order']['id']
+    ledger = get_inventory_ledger()
+    assert ledger.reserved(product_id) == Decimal('60')
+
+    # Another process cancels an order: the row changes, this process's counters do not
+    db.session.execute(update(Order).where(Order.id == cancelled_id).values(status='cancelled'),
+                       execution_options={'synchronize_session': False})
+    db.session.commit()
+    ledger.run_expiry()
+    assert ledger.reserved(product_id) == Decimal('10')
+    assert ledger.reserved_for(kept_id, product_id) == Decimal('10')
+    assert ledger.release_closed() == 0
@@ -0,0 +1,88 @@
+import numpy as np
+
+from app.market_depth import bin_edges, depth_curve
+from app.order_book import BUY, SELL, OrderBook
+
+
+def test_depth_curve_aggregates_levels_best_first():
+    price, quantity = np.array([490, 500, 490, 480]), np.array([100, 250, 50, 1000])
+    bids = depth_curve(price, quantity, BUY, levels=2)
+    assert bids == {'price': [5.0, 4.9], 'quantity': [2.5, 1.5], 'cumulative_quantity': [2.5, 4.0],
+                    'level_count': 3, 'quantity_kg': 14.0}
+    assert depth_curve(price, quantity, SELL)['price'] == [4.8, 4.9, 5.0]
+    assert depth_curve(price[:0], quantity[:0], SELL)['quantity_kg'] == 0.0
+    assert bin_edges(np.array([500]), bins=2).tolist() == [499, 500, 501]
+    assert bin_edges(price[:0]) is None
+
+
+def test_product_depth_endpoint(client, init_database, register, create_listing, place_order):
+    seller_id, seller = register(client, 'depth_seller')
+    _, buyer = register(client, 'depth_buyer')
+    product_id = create_listing(seller_id)
+    assert place_order(client, buyer, 'buy', product_id, "10.00", "4.80").status_code == 201
+    assert place_order(client, buyer, 'buy', product_id, "5.00", "4.90").status_code == 201
+    assert place_order(client, buyer, 'buy', product_id, "5.00", "4.90").status_code == 201
+    assert place_order(client, seller, 'sell', product_id, "20.00", "5.20").status_code == 201
+
+    response = client.get(f'/api/trades/orderbook/{product_id}/depth?bins=4')
+    assert response.status_code == 200
+    depth = response.json
+    assert (depth['best_bid'], depth['best_ask'], depth['spread']) == (4.9, 5.2, 0.3)
+    assert (depth['bid_orders'], depth['ask_orders']) == (3, 1)
+    assert depth['bids']['price'] == [4.9, 4.8] and depth['bids']['cumulative_quantity'] == [10.0, 20.0]
+    assert depth['asks']['price'] == [5.2] and depth['asks']['quantity_kg'] == 20.0
+    histogram = depth['histogram']
+    assert histogram['bin_edges'] == [4.8, 4.9, 5.0, 5.1, 5.2]
+    assert histogram['bids'] == [10.0, 10.0, 0.0, 0.0] and histogram['asks'] == [0.0, 0.0, 0.0, 20.0]
+
+    narrowed = client.get(f'/api/trades/orderbook/{product_id}/depth?levels=1&min_price=4.85&max_price=5.05&bins=1').json
+    assert narrowed['bids']['price'] == [4.9] and narrowed['bids']['level_count'] == 2
+    assert narrowed['histogram']['bids'] == [10.0] and narrowed['histogram']['asks'] == [0.0]
+
+    assert client.get(f'/api/trades/orderbook/{product_id}/depth?min_price=5&max_price=4').status_code == 400
+    assert client.get(f'/api/trades/orderbook/{product_id}/depth?min_price=abc').status_code == 400
+    assert client.get('/api/trades/orderbook/999999/depth').status_code == 404
+
+
+def test_grouped_depth_endpoint(client, init_database, register, create_listing, place_order):
+    seller_id, seller = register(client, 'depth_seller')
+    _, buyer = register(client, 'depth_buyer')
+    north = create_listing(seller_id, region="North")
+    north_blue = create_listing(seller_id, region="North", method="SMR with CCS")
+    south = create_listing(seller_id, region="South")
+    create_listing(seller_id, region="West") # No resting orders
+    assert place_order(client, buyer, 'buy', north, "10.00", "4.00").status_code == 201
+    assert place_order(client, buyer, 'buy', north_blue, "5.00", "4.50").status_code == 201
+    assert place_order(client, seller, 'sell', north_blue, "8.00", "6.00").status_code == 201
+    assert place_order(client, seller, 'sell', south, "2.00", "5.00").status_code == 201
+
+    response = client.get('/api/trades/orderbook/depth?bins=2')
+    assert response.status_code == 200
+    assert response.json['bin_edges'] == [4.0, 5.0, 6.0]
+    groups = {group['key']: group for group in response.json['groups']}
+    assert list(groups) == ["North", "South", "West"]
+    assert groups["North"]['product_count'] == 2
+    assert (groups["North"]['best_bid'], groups["North"]['best_ask']) == (4.5, 6.0)
+    assert groups["North"]['histogram'] == {'bids': [15.0, 0.0], 'asks': [0.0, 8.0]}
+    assert groups["South"]['histogram'] == {'bids': [0.0, 0.0], 'asks': [0.0, 2.0]}
+    assert groups["West"]['bid_orders'] == groups["West"]['ask_orders'] == 0 and groups["West"]['best_bid'] is None
+
+    by_method = client.get('/api/trades/orderbook/depth?group_by=production_method&region=North').json
+    assert [(group['key'], group['bid_quantity_kg'], group['ask_quantity_kg']) for group in by_method['groups']] == [
+        ("Electrolysis", 10.0, 0.0), ("SMR with CCS", 5.0, 8.0)]
+    assert client.get('/api/trades/orderbook/depth?group_by=seller').status_code == 400
+
+
+def test_grouped_depth_without_matching_listings(app, client, init_database, register, create_listing, monkeypatch):
+    # An empty marketplace, before any product was loaded into the book
+    monkeypatch.setitem(app.extensions, 'order_book', OrderBook(app))
+    empty = client.get('/api/trades/orderbook/depth')
+    assert empty.status_code == 200
+    assert empty.json == {'group_by': 'region', 'bin_edges': None, 'groups': []}
+
+    seller_id, _ = register(client, 'depth_seller')
+    create_listing(seller_id, region="North")
+    assert client.get('/api/trades/orderbook/depth').json['groups'][0]['key'] == "North"
+    nowhere = client.get('/api/trades/orderbook/depth?region=Nowhere')
+    assert nowhere.status_code == 200
+    assert nowhere.json['groups'] == []
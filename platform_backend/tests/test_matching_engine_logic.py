@@ -4,6 +4,7 @@ from datetime import datetime, timedelta
 
 from app.models import User, HydrogenProduct, Order, Trade, db
 from app.matching_engine import attempt_match_order
+from app.inventory import get_inventory_ledger
 
 # Note: These tests interact with the database via the matching_engine,
 # so they are more like integration tests for the matching_engine function
@@ -84,6 +85,7 @@ def test_exact_match_buy_order_first(init_database):
 
     db_instance.session.refresh(buy_order)
     db_instance.session.refresh(sell_order)
+    get_inventory_ledger().flush() # Fills reach the product row in batches
     db_instance.session.refresh(product)
 
     assert buy_order.status == "filled"
@@ -118,6 +120,7 @@ def test_exact_match_sell_order_first(init_database):
 
     db_instance.session.refresh(buy_order)
     db_instance.session.refresh(sell_order)
+    get_inventory_ledger().flush() # Fills reach the product row in batches
     db_instance.session.refresh(product)
 
     assert buy_order.status == "filled"
@@ -167,6 +170,7 @@ def test_partial_fill_incoming_order_larger(init_database):
 
     db_instance.session.refresh(buy_order)
     db_instance.session.refresh(sell_order)
+    get_inventory_ledger().flush() # Fills reach the product row in batches
     db_instance.session.refresh(product)
 
     assert buy_order.status == "partially_filled" # Buyer's order partially filled
@@ -197,6 +201,7 @@ def test_partial_fill_standing_order_larger(init_database):
 
     db_instance.session.refresh(buy_order)
     db_instance.session.refresh(sell_order)
+    get_inventory_ledger().flush() # Fills reach the product row in batches
     db_instance.session.refresh(product)
 
     assert buy_order.status == "filled" # Buyer's order fully filled
@@ -240,6 +245,7 @@ def test_multiple_matches_fill_incoming_order(init_database):
     db_instance.session.refresh(buy_order)
     db_instance.session.refresh(sell_order1)
     db_instance.session.refresh(sell_order2) # Should be untouched
+    get_inventory_ledger().flush() # Fills reach the product row in batches
     db_instance.session.refresh(product)
 
     assert buy_order.status == "partially_filled" # Matched 20kg out of 50kg
@@ -277,6 +283,7 @@ def test_product_quantity_update_and_sold_status(init_database):
     trades = attempt_match_order(sell_order.id) # Match the sell order
 
     assert len(trades) == 1
+    get_inventory_ledger().flush() # Fills reach the product row in batches
     db_instance.session.refresh(product)
     assert product.quantity_kg == Decimal("0.00")
     assert product.status == "sold"
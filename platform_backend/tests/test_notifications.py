@@ -0,0 +1,132 @@
+import pytest
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from app.models import OutboxMessage, Trade, db
+from app.notifications import TRADE_EXECUTED, get_notification_dispatcher, purge_sent_messages
+
+
+@pytest.fixture()
+def sent(app, init_database, monkeypatch):
+    """Records deliveries instead of logging them."""
+    deliveries = []
+    dispatcher = app.extensions['notification_dispatcher']
+    monkeypatch.setattr(dispatcher, 'sender', lambda user_id, topic, payloads: deliveries.append((user_id, topic, payloads)))
+    return deliveries
+
+
+def test_trade_and_confirmations_commit_together(client, sent, register, create_listing, place_order):
+    seller_id, seller = register(client, 'outbox_seller')
+    buyer_id, buyer = register(client, 'outbox_buyer')
+    product_id = create_listing(seller_id)
+    assert place_order(client, seller, 'sell', product_id, "1.00").status_code == 201
+    trade_id = place_order(client, buyer, 'buy', product_id, "1.00").json['trades_made'][0]['id']
+
+    messages = OutboxMessage.query.filter_by(topic=TRADE_EXECUTED).order_by(OutboxMessage.user_id).all()
+    assert [(m.user_id, m.topic, m.status) for m in messages] == [
+        (seller_id, TRADE_EXECUTED, 'pending'), (buyer_id, TRADE_EXECUTED, 'pending')
+    ]
+    assert {m.payload['trade_id'] for m in messages} == {trade_id}
+    assert sent == [] # Nothing is delivered while matching
+
+
+def test_fills_are_coalesced_per_user(client, sent, register, create_listing, place_order):
+    seller_id, seller = register(client, 'outbox_seller')
+    product_id = create_listing(seller_id)
+    for _ in range(3):
+        assert place_order(client, seller, 'sell', product_id, "1.00").status_code == 201
+    buyer_ids = []
+    for i in range(3):
+        buyer_id, buyer = register(client, f'outbox_buyer_{i}')
+        assert place_order(client, buyer, 'buy', product_id, "1.00").status_code == 201
+        buyer_ids.append(buyer_id)
+    assert Trade.query.count() == 3
+
+    assert get_notification_dispatcher().dispatch_pending() == 12 # 6 confirmations, 6 order events
+    by_user = {user_id: payloads for user_id, _, payloads in sent}
+    assert len(sent) == 4 # One notification per user
+    assert sorted(p['role'] for p in by_user[seller_id]) == ['seller'] * 3
+    assert all(len(by_user[buyer_id]) == 1 for buyer_id in buyer_ids)
+    assert {m.status for m in OutboxMessage.query.all()} == {'sent'}
+
+    assert get_notification_dispatcher().dispatch_pending() == 0
+
+
+def test_failed_deliveries_are_retried_then_given_up(app, client, sent, monkeypatch, register, create_listing,
+                                                     place_order):
+    seller_id, seller = register(client, 'outbox_seller')
+    buyer_id, buyer = register(client, 'outbox_buyer')
+    product_id = create_listing(seller_id)
+    assert place_order(client, seller, 'sell', product_id, "1.00").status_code == 201
+    assert place_order(client, buyer, 'buy', product_id, "1.00").status_code == 201
+
+    dispatcher = get_notification_dispatcher()
+    monkeypatch.setattr(dispatcher, 'max_attempts', 2)
+
+    def flaky(user_id, topic, payloads):
+        if user_id == buyer_id:
+            raise ConnectionError("mail relay down")
+        sent.append((user_id, topic, payloads))
+    monkeypatch.setattr(dispatcher, 'sender', flaky)
+
+    assert dispatcher.dispatch_pending() == 3 # The seller's confirmation and both order events
+    buyer_message = OutboxMessage.query.filter_by(user_id=buyer_id, topic=TRADE_EXECUTED).one()
+    assert (buyer_message.status, buyer_message.attempts, buyer_message.last_error) == ('pending', 1, 'mail relay down')
+
+    assert buyer_message.next_attempt_at > datetime.utcnow() # Backing off
+    assert dispatcher.dispatch_pending() == 0
+    assert [user_id for user_id, _, _ in sent] == [seller_id]
+
+    buyer_message.next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    assert dispatcher.dispatch_pending() == 0
+    db.session.refresh(buyer_message)
+    assert (buyer_message.status, buyer_message.attempts) == ('failed', 2)
+    assert [user_id for user_id, _, _ in sent] == [seller_id]
+
+
+def test_claims_are_committed_before_sending(client, sent, monkeypatch, register, create_listing, place_order):
+    seller_id, seller = register(client, 'outbox_seller')
+    _, buyer = register(client, 'outbox_buyer')
+    product_id = create_listing(seller_id)
+    assert place_order(client, seller, 'sell', product_id, "1.00").status_code == 201
+    assert place_order(client, buyer, 'buy', product_id, "1.00").status_code == 201
+    dispatcher = get_notification_dispatcher()
+    engine, seen = db.engine, []
+
+    def sender(user_id, topic, payloads):
+        # Another connection sees the claim while the notification is being sent
+        with engine.connect() as connection:
+            seen.extend(connection.execute(
+                select(OutboxMessage.attempts, OutboxMessage.next_attempt_at)
+                .where(OutboxMessage.topic == TRADE_EXECUTED, OutboxMessage.user_id == user_id)
+            ).all())
+    monkeypatch.setattr(dispatcher, 'sender', sender)
+
+    assert dispatcher.dispatch_pending() == 4 # Two confirmations, two order events
+    assert len(seen) == 2 and all(attempts == 1 and claimed_until > datetime.utcnow() for attempts, claimed_until in seen)
+    assert {(m.status, m.next_attempt_at) for m in OutboxMessage.query.all()} == {('sent', None)}
+
+
+def test_old_sent_messages_are_purged_in_batches(client, runner, sent, register, create_listing, place_order):
+    seller_id, seller = register(client, 'outbox_seller')
+    _, buyer = register(client, 'outbox_buyer')
+    product_id = create_listing(seller_id)
+    for _ in range(3):
+        assert place_order(client, seller, 'sell', product_id, "1.00").status_code == 201
+        assert place_order(client, buyer, 'buy', product_id, "1.00").status_code == 201
+    assert get_notification_dispatcher().dispatch_pending() == 12
+    old, recent = OutboxMessage.query.order_by(OutboxMessage.id).all()[:9], OutboxMessage.query.count() - 9
+    for message in old:
+        message.dispatched_at = datetime.utcnow() - timedelta(days=8)
+    old[0].status = 'failed' # Kept for inspection, however old
+    db.session.add(OutboxMessage(topic=TRADE_EXECUTED, user_id=seller_id, payload={}, status='pending'))
+    db.session.commit()
+
+    assert purge_sent_messages(batch_size=3) == 8
+    assert [m.status for m in OutboxMessage.query.order_by(OutboxMessage.id)] == ['failed'] + ['sent'] * recent + ['pending']
+    result = runner.invoke(args=['purge-outbox', '--keep-days', '0'])
+    assert result.exit_code == 0 and 'Purged 3 sent message(s).' in result.output, result.output
+    assert {m.status for m in OutboxMessage.query.all()} == {'failed', 'pending'}
+
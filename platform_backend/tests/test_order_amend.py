@@ -0,0 +1,74 @@
+from decimal import Decimal
+
+from app import orders
+from app.models import Order, db
+
+
+def amend(client, headers, order_id, **changes):
+    response = client.put(f'/api/orders/{order_id}', json=changes, headers=headers)
+    assert response.status_code == 200, response.json
+    return response.json
+
+
+def test_quantity_decrease_keeps_time_priority(client, init_database, register, create_listing, place_order):
+    _, first = register(client, 'amend_first')
+    _, second = register(client, 'amend_second')
+    seller_id, seller = register(client, 'amend_seller')
+    product_id = create_listing(seller_id)
+    resting = place_order(client, first, 'buy', product_id).json['order']['id']
+    assert place_order(client, second, 'buy', product_id).status_code == 201
+
+    amended = amend(client, first, resting, quantity_kg="4.00")
+    assert (amended['quantity_kg'], amended['status']) == ('4.00', 'pending')
+    # First in the queue still
+    trade = place_order(client, seller, 'sell', product_id, quantity="4.00").json['trades_made']
+    assert trade and trade[0]['buy_order_id'] == resting
+
+
+def test_quantity_increase_and_price_change_lose_priority(client, init_database, register, create_listing, place_order):
+    first_id, first = register(client, 'amend_first')
+    _, second = register(client, 'amend_second')
+    product_id = create_listing(first_id)
+    resting = place_order(client, first, 'buy', product_id).json['order']['id']
+    other = place_order(client, second, 'buy', product_id).json['order']['id']
+    before = db.session.get(Order, resting).priority_timestamp
+
+    amend(client, first, resting, quantity_kg="12.00")
+    assert db.session.get(Order, resting).priority_timestamp > before
+    assert db.session.get(Order, other).priority_timestamp < db.session.get(Order, resting).priority_timestamp
+    assert amend(client, second, other, price_per_kg="5.00")['status'] == 'pending' # Same price: no change
+    assert db.session.get(Order, other).priority_timestamp < db.session.get(Order, resting).priority_timestamp
+    amend(client, second, other, price_per_kg="4.90")
+    assert db.session.get(Order, other).priority_timestamp > db.session.get(Order, resting).priority_timestamp
+
+
+def test_crossing_price_amendment_rematches(client, init_database, register, create_listing, place_order):
+    seller_id, seller = register(client, 'amend_seller')
+    _, buyer = register(client, 'amend_buyer')
+    product_id = create_listing(seller_id)
+    bid = place_order(client, buyer, 'buy', product_id, price="5.00").json['order']['id']
+    ask = place_order(client, seller, 'sell', product_id, price="6.00").json
+    assert ask['trades_made'] == []
+
+    amended = amend(client, seller, ask['order']['id'], price_per_kg="5.00")
+    assert amended['status'] == 'filled'
+    assert db.session.get(Order, bid).status == 'filled'
+    assert client.put(f"/api/orders/{bid}", json={"quantity_kg": "0"}, headers=buyer).status_code == 400
+
+
+def test_invalid_status_is_rejected_before_amending(client, init_database, monkeypatch, register, create_listing,
+                                                    place_order):
+    amended = []
+    monkeypatch.setattr(orders, 'amend_order', lambda order, *args: amended.append(order.id))
+    seller_id, _ = register(client, 'amend_seller')
+    _, buyer = register(client, 'amend_buyer')
+    product_id = create_listing(seller_id)
+    bid = place_order(client, buyer, 'buy', product_id).json['order']
+    priority = db.session.get(Order, bid['id']).priority_timestamp
+    response = client.put(f"/api/orders/{bid['id']}", json={"quantity_kg": "20.00", "price_per_kg": "6.00",
+                                                             "status": "filled"}, headers=buyer)
+    assert response.status_code == 400 and amended == []
+    db.session.expire_all()
+    order = db.session.get(Order, bid['id'])
+    assert (order.quantity_kg, order.price_per_kg, order.status) == (Decimal('10.00'), Decimal('5.00'), 'pending')
+    assert order.priority_timestamp == priority
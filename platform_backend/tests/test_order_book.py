@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+
+from app.inventory import expire_due_orders
+from app.matching_engine import get_order_book_for_product
+from app.models import Order, db
+from app.order_book import BUY, SELL, RestingOrders, get_order_book
+
+
+def mirrored(product_id):
+    """The mirror's book as the (id, quantity, price) lists of the ORM order book."""
+    bids, asks = get_order_book().snapshot(product_id)
+    as_rows = lambda side: [(int(i), f"{q / 100:.2f}", f"{p / 100:.2f}") for i, q, p in zip(side.order_id, side.quantity, side.price)]
+    return as_rows(bids), as_rows(asks)
+
+
+def from_database(product_id):
+    book = get_order_book_for_product(product_id)
+    as_rows = lambda orders: [(o['id'], o['quantity_kg'], o['price_per_kg']) for o in orders]
+    return as_rows(book['bids']), as_rows(book['asks'])
+
+
+def test_resting_orders_reuse_freed_slots():
+    store = RestingOrders(capacity=2)
+    for order_id in range(1, 6):
+        store.put(order_id, 7, 1, BUY, 500 + order_id, 1000, order_id)
+    assert (len(store), store.capacity) == (5, 8)
+    assert store.remove(2) and store.remove(4) and not store.remove(4)
+    store.put(10, 7, 1, SELL, 490, 300, 10)
+    store.put(11, 7, 1, SELL, 490, 300, 9)
+    assert (len(store), store.capacity) == (5, 8) # Both new orders took freed slots
+    assert store.get(4) is None and store.get(10)['price'] == 490
+
+    bids, asks = store.side(7, BUY), store.side(7, SELL)
+    assert bids.order_id.tolist() == [5, 3, 1] # Highest bid first
+    assert asks.order_id.tolist() == [11, 10] # Same price: earlier priority first
+    assert store.remove_product(7) == 5 and len(store) == 0
+
+
+def test_mirror_follows_orders_placed_matched_cancelled_and_amended(client, init_database, register, create_listing,
+                                                                    place_order):
+    seller_id, seller = register(client, 'book_seller')
+    _, buyer = register(client, 'book_buyer')
+    product_id = create_listing(seller_id)
+    low = place_order(client, buyer, 'buy', product_id, quantity="10.00", price="4.90").json['order']['id']
+    assert mirrored(product_id) == from_database(product_id) # Loaded from the database on first use
+
+    assert place_order(client, buyer, 'buy', product_id, quantity="8.00", price="5.00").status_code == 201
+    ask = place_order(client, seller, 'sell', product_id, quantity="12.00", price="5.20").json['order']['id']
+    # Part-fills the 5.00 bid out of the book
+    assert place_order(client, seller, 'sell', product_id, quantity="3.00", price="5.00").status_code == 201
+    amended = client.put(f'/api/orders/{ask}', json={'price_per_kg': '5.10', 'quantity_kg': '11.00'}, headers=seller)
+    assert amended.status_code == 200
+    assert client.put(f'/api/orders/{low}', json={'status': 'cancelled'}, headers=buyer).status_code == 200
+    bid = place_order(client, buyer, 'buy', product_id, quantity="2.00", price="5.00").json['order']['id']
+
+    assert mirrored(product_id) == from_database(product_id) == ([(bid, "2.00", "5.00")], [(ask, "11.00", "5.10")])
+
+
+def test_mirror_drops_expired_orders(client, init_database, register, create_listing, place_order):
+    seller_id, _ = register(client, 'book_seller')
+    _, buyer = register(client, 'book_buyer')
+    product_id = create_listing(seller_id)
+    expires = (datetime.utcnow() + timedelta(hours=1)).isoformat()
+    expiring = place_order(client, buyer, 'buy', product_id, expiration_timestamp=expires).json
+    get_order_book().load(product_id)
+
+    later = datetime.utcnow() + timedelta(hours=2)
+    assert len(get_order_book().snapshot(product_id, now=later)[0].order_id) == 0 # Past its expiration
+    assert expire_due_orders(now=later) == 1
+    assert get_order_book().get(expiring['order']['id']) is None
+    assert db.session.get(Order, expiring['order']['id']).status == 'expired'
@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta
+
+from app.inventory import expire_due_orders, get_inventory_ledger
+from app.models import HydrogenProduct, PlatformStat, UserActivity, db
+from app.platform_stats import admin_statistics, compact_platform_stats, get_platform_stats
+
+
+def gauges():
+    return sorted((row.name, row.dimension, row.count) for row in db.session.scalars(
+        db.select(PlatformStat).where(PlatformStat.period == 'all')) if row.count)
+
+
+def test_admin_statistics_follow_writes(client, init_database, register, create_listing, place_order):
+    seller_id, seller = register(client, 'stats_seller')
+    _, buyer = register(client, 'stats_buyer')
+    _, admin = register(client, 'stats_admin', roles='admin,user')
+    small = create_listing(seller_id, quantity=10)
+    large = create_listing(seller_id)
+
+    assert place_order(client, seller, 'sell', small, "10.00", "5.00").status_code == 201
+    assert place_order(client, buyer, 'buy', small, "10.00", "5.00").status_code == 201 # Sells the small listing out
+    assert place_order(client, seller, 'sell', large, "20.00", "6.00").status_code == 201
+    assert place_order(client, buyer, 'buy', large, "5.00", "6.00").status_code == 201
+    cancelled = place_order(client, buyer, 'buy', large, "1.00", "4.00").json['order']['id']
+    assert client.put(f'/api/orders/{cancelled}', json={'status': 'cancelled'}, headers=buyer).status_code == 200
+    expiring = datetime.utcnow() + timedelta(hours=1)
+    expiring_order = place_order(client, buyer, 'buy', large, "1.00", "4.00", expiration_timestamp=expiring.isoformat())
+    assert expiring_order.status_code == 201
+    expire_due_orders(now=expiring + timedelta(minutes=1))
+    get_inventory_ledger().flush() # Marks the small listing sold
+
+    response = client.get('/api/user/admin/data', headers=admin)
+    assert response.status_code == 200
+    stats = response.json['stats']
+    assert stats['users'] == {'total': 3, 'active': {'today': 2, 'last_7_days': 2, 'last_30_days': 2}}
+    assert stats['listings'] == {'by_status': {'active': 1, 'sold': 1}, 'total': 2}
+    assert stats['orders'] == {'by_status': {'filled': 3, 'partially_filled': 1, 'cancelled': 1, 'expired': 1}, 'open': 1}
+    (today,) = stats['trading']['series']
+    assert today == {'period_start': datetime.utcnow().date().isoformat(), 'trade_count': 2, 'volume_kg': '15.00',
+                     'notional': '80.00', 'active_users': 2}
+    assert [(p['hydrogen_product_id'], p['volume_kg']) for p in stats['top_products']['products']] == [(small, '10.00'), (large, '5.00')]
+
+    # The incrementally maintained gauges match a full recount
+    incremental = gauges()
+    compact_platform_stats(reconcile=True)
+    assert gauges() == incremental
+    assert client.get('/api/user/admin/data?period=week', headers=admin).status_code == 400
+
+
+def test_compaction_folds_old_days_into_months(client, init_database, register, create_listing, place_order):
+    seller_id, seller = register(client, 'stats_seller')
+    _, buyer = register(client, 'stats_buyer')
+    product_id = create_listing(seller_id)
+    assert place_order(client, seller, 'sell', product_id, "4.00", "5.00").status_code == 201
+    assert place_order(client, buyer, 'buy', product_id, "4.00", "5.00").status_code == 201
+    today = datetime.utcnow().date()
+
+    later = today + timedelta(days=40)
+    assert compact_platform_stats(today=later) == {'folded': 2, 'active_days': 1, 'pruned': 2}
+    assert db.session.scalar(db.select(db.func.count()).select_from(UserActivity)) == 0
+    stats = admin_statistics(period='month', months=3, today=later)
+    assert [(row['period_start'], row['trade_count'], row['volume_kg']) for row in stats['trading']['series']] == [
+        (today.replace(day=1).isoformat(), 1, '4.00')]
+    assert admin_statistics(period='day', today=later)['trading']['series'][-1]['trade_count'] == 0
+    assert db.session.get(PlatformStat, ('active_users', 'day', today, '')).count == 2
+
+
+def test_deltas_are_written_in_batches_after_commit(client, init_database, register, create_listing, place_order):
+    seller_id, seller = register(client, 'stats_seller')
+    _, buyer = register(client, 'stats_buyer')
+    product_id = create_listing(seller_id)
+    assert place_order(client, seller, 'sell', product_id, "4.00", "5.00").status_code == 201
+    assert place_order(client, buyer, 'buy', product_id, "4.00", "5.00").status_code == 201
+    assert gauges() == [] # Nothing written in the order or trade transactions
+
+    db.session.add(HydrogenProduct(seller_id=seller_id, quantity_kg=1, price_per_kg=5, location_region="Test Region",
+                                   production_method="Electrolysis"))
+    db.session.flush()
+    db.session.rollback() # Uncommitted deltas are dropped, not buffered
+    assert get_platform_stats().flush() > 0
+    assert gauges() == [('listings', 'active', 1), ('orders', 'filled', 2), ('users', '', 2)]
+    assert get_platform_stats().flush() == 0
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from app.inventory import expire_due_orders
+from app.models import Position, Trade, db
+from app.positions import rebuild_positions
+
+
+def positions(client, headers, **params):
+    response = client.get('/api/positions', query_string=params, headers=headers)
+    assert response.status_code == 200
+    return response.json
+
+
+def counters():
+    columns = Position.__table__.columns
+    return sorted(tuple(str(getattr(p, c.name)) for c in columns)
+                  for p in db.session.scalars(db.select(Position)).all()
+                  if p.trade_count or p.open_order_count)
+
+
+def test_positions_follow_fills_cancels_and_amendments(client, init_database, register, create_listing, place_order):
+    seller_id, seller = register(client, 'position_seller')
+    trader_id, trader = register(client, 'position_trader')
+    product_id = create_listing(seller_id)
+
+    assert place_order(client, seller, 'sell', product_id, "10.00", "5.00").status_code == 201
+    assert place_order(client, trader, 'buy', product_id, "10.00", "5.00").status_code == 201 # Buys 10 @ 5.00
+    assert place_order(client, seller, 'sell', product_id, "20.00", "6.00").status_code == 201
+    bought = place_order(client, trader, 'buy', product_id, "5.00", "6.00").json # Buys 5 @ 6.00; the ask rests with 15
+    # Only the listing's seller may place sell orders, so the trader's sale is booked directly
+    # (as a backfill would be); positions follow any Trade added through the session.
+    db.session.add(Trade(buy_order_id=bought['order']['id'], sell_order_id=bought['order']['id'],
+                         hydrogen_product_id=product_id, quantity_traded_kg=Decimal('6.00'),
+                         price_per_kg_agreed=Decimal('7.00'), buyer_id=seller_id, seller_id=trader_id))
+    db.session.commit() # Sells 6 @ 7.00
+    resting = place_order(client, trader, 'buy', product_id, "4.00", "4.50").json['order']['id']
+
+    mine = positions(client, trader)
+    assert mine['user_id'] == trader_id
+    (position,) = mine['positions']
+    assert position == {
+        'hydrogen_product_id': product_id, 'trade_count': 3,
+        'bought_kg': '15.00', 'sold_kg': '6.00', 'net_kg': '9.00',
+        'average_buy_price': '5.3333', 'average_sell_price': '7.0000', 'average_price': '5.3333',
+        'realized_pnl': '10.00', # 6 kg closed at 7.00 against an average cost of 5.3333
+        'open_orders': 1, 'open_buy_kg': '4.00', 'open_buy_notional': '18.00',
+        'open_sell_kg': '0.00', 'open_sell_notional': '0.00',
+    }
+    assert positions(client, seller)['positions'][0]['open_sell_kg'] == '15.00'
+
+    assert client.put(f'/api/orders/{resting}', json={'quantity_kg': '2.00', 'price_per_kg': '4.00'},
+                      headers=trader).status_code == 200
+    assert positions(client, trader)['positions'][0]['open_buy_notional'] == '8.00'
+    assert client.put(f'/api/orders/{resting}', json={'status': 'cancelled'}, headers=trader).status_code == 200
+    assert positions(client, trader)['totals'] == {'realized_pnl': '10.00', 'open_buy_notional': '0.00',
+                                                   'open_sell_notional': '0.00'}
+
+    expiring = datetime.utcnow() + timedelta(hours=1)
+    expiring_order = place_order(client, trader, 'buy', product_id, "3.00", "4.00", expiration_timestamp=expiring.isoformat())
+    assert expiring_order.status_code == 201
+    assert positions(client, trader)['positions'][0]['open_orders'] == 1
+    expire_due_orders(now=expiring + timedelta(minutes=1))
+    assert positions(client, trader)['positions'][0]['open_orders'] == 0
+
+    incremental = counters()
+    rebuild_positions()
+    assert counters() == incremental
+
+
+def test_other_users_positions_require_admin(client, init_database, register):
+    user_id, user = register(client, 'position_user')
+    _, other = register(client, 'position_other')
+    _, admin = register(client, 'position_admin', roles='admin,user')
+    assert client.get(f'/api/positions?user_id={user_id}', headers=other).status_code == 403
+    assert positions(client, admin, user_id=user_id) == {
+        'user_id': user_id, 'positions': [],
+        'totals': {'realized_pnl': '0.00', 'open_buy_notional': '0.00', 'open_sell_notional': '0.00'},
+    }
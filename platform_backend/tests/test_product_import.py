@@ -0,0 +1,75 @@
+import io
+import json
+import pytest
+from decimal import Decimal
+from datetime import date
+
+from app.models import HydrogenProduct, db
+
+CSV_HEADER = "quantity_kg,price_per_kg,location_region,production_method,purity_percentage,available_from_date\n"
+
+
+def test_bulk_import_csv_success(client, new_user_with_token):
+    user, token, _ = new_user_with_token
+    body = CSV_HEADER + "".join(
+        f"{100 + i},5.{i:02d},North Europe,Electrolysis (Wind),99.99,2030-01-0{i % 9 + 1}\n" for i in range(25)
+    )
+    response = client.post('/api/products/bulk', data=body, content_type='text/csv', headers={
+        'Authorization': f'Bearer {token}'
+    })
+    assert response.status_code == 201
+    assert response.json == {'imported': 25, 'errors': []}
+
+    products = HydrogenProduct.query.filter_by(seller_id=user.id).order_by(HydrogenProduct.id).all()
+    assert len(products) == 25
+    assert products[3].quantity_kg == Decimal("103.00")
+    assert products[3].available_from_date == date(2030, 1, 4)
+    assert products[3].status == 'active'
+
+
+def test_bulk_import_reports_row_errors_and_inserts_nothing(client, new_user_with_token):
+    user, token, _ = new_user_with_token
+    lines = [
+        {"quantity_kg": "10", "price_per_kg": "5", "location_region": "EU", "production_method": "Solar"},
+        {"quantity_kg": "abc", "price_per_kg": "5", "location_region": "EU", "production_method": "Solar"},
+        {"quantity_kg": "10", "price_per_kg": "-1", "location_region": "EU"},
+    ]
+    body = "\n".join(json.dumps(line) for line in lines) + "\nnot json\n"
+    response = client.post('/api/products/bulk?format=ndjson', data=body, headers={
+        'Authorization': f'Bearer {token}'
+    })
+    assert response.status_code == 400
+    assert response.json['imported'] == 0
+    errors = {e['row']: e['errors'] for e in response.json['errors']}
+    assert sorted(errors) == [2, 3, 4]
+    assert "Invalid decimal value for quantity_kg" in errors[2][0]
+    assert any("price_per_kg must be positive" in e for e in errors[3])
+    assert any("Missing required field: production_method" in e for e in errors[3])
+    assert HydrogenProduct.query.filter_by(seller_id=user.id).count() == 0
+
+
+def test_bulk_import_allow_partial(client, new_user_with_token):
+    user, token, _ = new_user_with_token
+    body = CSV_HEADER + "10,5,EU,Solar,,\n10,5,EU,Solar,,not-a-date\n"
+    response = client.post('/api/products/bulk?allow_partial=true', data={
+        'file': (io.BytesIO(body.encode()), 'listings.csv', 'text/csv')
+    }, headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 201
+    assert response.json['imported'] == 1
+    assert response.json['errors'][0]['row'] == 2
+    assert HydrogenProduct.query.filter_by(seller_id=user.id).count() == 1
+
+
+def test_import_products_cli(runner, new_user, tmp_path):
+    user, _ = new_user
+    path = tmp_path / 'listings.ndjson'
+    path.write_text("\n".join(json.dumps({
+        "quantity_kg": "50", "price_per_kg": "4.25", "location_region": "Iberia", "production_method": "Solar",
+        "ghg_intensity_kgco2e_per_kgh2": "0.8"
+    }) for _ in range(3)))
+    result = runner.invoke(args=['import-products', str(path), '--seller', user.username])
+    assert result.exit_code == 0, result.output
+    assert "Imported 3 listing(s)" in result.output
+    products = HydrogenProduct.query.filter_by(seller_id=user.id).all()
+    assert len(products) == 3
+    assert products[0].ghg_intensity_kgco2e_per_kgh2 == Decimal("0.8")
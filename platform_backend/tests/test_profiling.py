@@ -0,0 +1,64 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.profiling import PROFILE_HEADER, PROFILE_ID_HEADER
+
+
+@pytest.fixture()
+def profiled_app(make_app):
+    return make_app(PROFILING_ENABLED=True, PROFILING_INTERVAL_MS=1)
+
+
+def profiles(app):
+    directory = app.config['PROFILING_DIR']
+    return sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+
+
+def test_admin_header_profiles_the_request_and_its_sql(profiled_app, register):
+    client = profiled_app.test_client()
+    _, admin = register(client, 'profile_admin', roles='admin')
+
+    response = client.get('/api/products', headers={**admin, PROFILE_HEADER: '1'})
+    assert response.status_code == 200
+    name = response.headers[PROFILE_ID_HEADER]
+    assert profiles(profiled_app) == [f'{name}.folded', f'{name}.json']
+
+    with open(os.path.join(profiled_app.config['PROFILING_DIR'], f'{name}.json')) as fh:
+        summary = json.load(fh)
+    assert summary['endpoint'] == 'products.list_hydrogen_products'
+    assert summary['trigger'] == 'header' and summary['status'] == 200
+    assert summary['sql_statements'] >= 1
+    assert any('FROM hydrogen_products' in statement['sql'] for statement in summary['statements'])
+
+
+def test_header_is_ignored_for_non_admins(profiled_app, register):
+    client = profiled_app.test_client()
+    _, user = register(client, 'profile_user')
+    response = client.get('/api/products', headers={**user, PROFILE_HEADER: '1'})
+    assert response.status_code == 200
+    assert PROFILE_ID_HEADER not in response.headers
+    assert client.get('/api/products', headers={PROFILE_HEADER: '1'}).status_code == 200 # Anonymous
+    assert profiles(profiled_app) == []
+
+
+def test_sampled_requests_in_cprofile_mode_with_retention(make_app):
+    app = make_app(PROFILING_ENABLED=True, PROFILING_MODE='cprofile', PROFILING_SAMPLE_RATE=1.0,
+                   PROFILING_MAX_PROFILES=2, PROFILING_RETENTION_HOURS=1)
+    os.makedirs(app.config['PROFILING_DIR'])
+    stale = (datetime.utcnow() - timedelta(hours=2)).strftime('%Y%m%dT%H%M%S%f') + '-GET-health.json'
+    open(os.path.join(app.config['PROFILING_DIR'], stale), 'w').close()
+    client = app.test_client()
+    names = [client.get('/health').headers[PROFILE_ID_HEADER] for _ in range(3)]
+    assert profiles(app) == sorted(f'{name}{extension}' for name in names[1:] for extension in ('.json', '.prof'))
+
+
+def test_disabled_profiler_installs_nothing(make_app):
+    app = make_app()
+    assert 'request_profiler' not in app.extensions
+    hooks = [*app.before_request_funcs[None], *app.after_request_funcs[None], *app.teardown_request_funcs[None]]
+    assert not any(hook.__module__ == 'app.profiling' for hook in hooks)
+    response = app.test_client().get('/health', headers={PROFILE_HEADER: '1'})
+    assert PROFILE_ID_HEADER not in response.headers
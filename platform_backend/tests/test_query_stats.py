@@ -0,0 +1,37 @@
+from sqlalchemy import text
+
+from app import db
+from app.query_stats import COUNT_HEADER, TIME_HEADER, count_queries
+
+
+def test_response_headers_report_the_requests_sql(client, init_database):
+    response = client.get('/api/products')
+    assert response.status_code == 200
+    assert int(response.headers[COUNT_HEADER]) >= 1
+    assert float(response.headers[TIME_HEADER]) >= 0
+
+    assert client.get('/health').headers[COUNT_HEADER] == '0'
+
+
+def test_count_queries_nests(app):
+    with app.app_context():
+        with count_queries() as outer:
+            db.session.execute(text('SELECT 1'))
+            with count_queries() as inner:
+                db.session.execute(text('SELECT 2'))
+                db.session.execute(text('SELECT 3'))
+        db.session.execute(text('SELECT 4')) # Outside both counters
+    assert (outer.statements, inner.statements) == (3, 2)
+    assert outer.seconds >= inner.seconds > 0
+
+
+def test_header_can_be_turned_off(make_app):
+    response = make_app(SQL_STATS_HEADER=False).test_client().get('/api/products')
+    assert COUNT_HEADER not in response.headers and TIME_HEADER not in response.headers
+
+
+def test_disabled_stats_install_nothing(make_app):
+    app = make_app(SQL_STATS_ENABLED=False)
+    hooks = [*app.before_request_funcs[None], *app.after_request_funcs[None], *app.teardown_request_funcs[None]]
+    assert not any(hook.__module__ == 'app.query_stats' for hook in hooks)
+    assert COUNT_HEADER not in app.test_client().get('/health').headers
@@ -0,0 +1,122 @@
+import threading
+import pytest
+
+from app.rate_limit import MemoryBucketBackend, RateLimiter, SQLiteBucketBackend
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture()
+def limiter(app, init_database, monkeypatch):
+    """A fresh limiter with small, slowly refilling buckets."""
+    limiter = RateLimiter(
+        MemoryBucketBackend(clock=FakeClock()),
+        limits={'orders.create': (3, 0.001), 'orders.cancel': (10, 0.001)},
+        group_limits={'orders': (10, 0.001)},
+        priority_reserve=0.2,
+    )
+    monkeypatch.setitem(app.extensions, 'rate_limiter', limiter)
+    return limiter
+
+
+def test_token_bucket_refills_over_time():
+    clock = FakeClock()
+    backend = MemoryBucketBackend(clock=clock)
+    assert [backend.take('k', 2, 1.0)[0] for _ in range(3)] == [True, True, False]
+    allowed, retry_after, _ = backend.take('k', 2, 1.0)
+    assert not allowed and retry_after == pytest.approx(1.0)
+    clock.now += 1.0
+    assert backend.take('k', 2, 1.0)[0]
+
+
+def test_priority_lane_uses_reserve():
+    backend = MemoryBucketBackend(clock=FakeClock())
+    # Normal requests must leave 2 of 10 tokens; priority requests may take them.
+    assert sum(backend.take('g', 10, 0.0, floor=2)[0] for _ in range(10)) == 8
+    assert backend.take('g', 10, 0.0)[0]
+    assert backend.take('g', 10, 0.0)[0]
+    assert not backend.take('g', 10, 0.0)[0]
+
+
+def test_per_user_limit_returns_429_with_retry_hint(client, limiter, register, create_listing, place_order):
+    seller_id, _ = register(client, 'limit_seller')
+    _, headers = register(client, 'limit_buyer')
+    product_id = create_listing(seller_id)
+
+    statuses = [place_order(client, headers, 'buy', product_id, "1.00", "1.00").status_code for _ in range(3)]
+    assert statuses == [201, 201, 201]
+    throttled = place_order(client, headers, 'buy', product_id, "1.00", "1.00")
+    assert throttled.status_code == 429
+    assert throttled.json['scope'] == 'user'
+    assert throttled.json['retry_after'] > 0
+    assert int(throttled.headers['Retry-After']) >= 1
+
+    # Another user still has their own budget.
+    _, other = register(client, 'limit_buyer_2')
+    assert place_order(client, other, 'buy', product_id, "1.00", "1.00").status_code == 201
+
+
+def test_cancels_admitted_when_orders_are_saturated(client, limiter, register, create_listing, place_order):
+    seller_id, _ = register(client, 'limit_seller')
+    product_id = create_listing(seller_id)
+    order_ids = []
+    for i in range(3): # 3 users x 3 orders, the group admits 8 normal requests (10 minus the reserve)
+        _, headers = register(client, f'limit_buyer_{i}')
+        for _ in range(3):
+            response = place_order(client, headers, 'buy', product_id, "1.00", "1.00")
+            if response.status_code == 201:
+                order_ids.append((headers, response.json['order']['id']))
+    assert len(order_ids) == 8
+
+    _, late = register(client, 'limit_late_buyer')
+    busy = place_order(client, late, 'buy', product_id, "1.00", "1.00")
+    assert busy.status_code == 429
+    assert busy.json['scope'] == 'group'
+
+    headers, order_id = order_ids[0]
+    assert client.delete(f'/api/orders/{order_id}', headers=headers).status_code == 200
+
+
+def test_throttled_requests_are_counted_in_metrics(client, limiter, register, create_listing, place_order):
+    seller_id, _ = register(client, 'limit_seller')
+    _, headers = register(client, 'limit_buyer')
+    product_id = create_listing(seller_id)
+    for _ in range(4):
+        place_order(client, headers, 'buy', product_id, "1.00", "1.00")
+
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'ghx_rate_limit_throttled_total{endpoint="orders.create",lane="normal",scope="user"}' in body
+    assert 'ghx_rate_limit_admitted_total{endpoint="orders.create",lane="normal"}' in body
+
+
+def test_sqlite_backend_is_shared_and_atomic(tmp_path):
+    path = str(tmp_path / 'buckets.db')
+    first, second = SQLiteBucketBackend(path), SQLiteBucketBackend(path) # e.g. two processes
+    results = []
+    barrier = threading.Barrier(8)
+
+    def take(backend):
+        barrier.wait()
+        for _ in range(10):
+            results.append(backend.take('shared', 50, 0.0)[0])
+
+    threads = [threading.Thread(target=take, args=((first, second)[i % 2],)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 50
+
+
+def test_refunds_never_overfill_a_bucket(tmp_path):
+    for backend in (MemoryBucketBackend(clock=FakeClock()), SQLiteBucketBackend(str(tmp_path / 'refund.db'))):
+        assert backend.take('k', 3, 0.0)[2] == 2
+        backend.refund('k', 3)
+        backend.refund('k', 3) # e.g. a refund racing a refill
+        assert backend.take('k', 3, 0.0)[2] == 2
@@ -0,0 +1,72 @@
+from app import db
+from app.models import Trade, User
+from app.replay import Replayer, capture_stream, generate_stream
+
+
+def replay(make_app, stream):
+    replay_app = make_app()
+    report = Replayer(replay_app, sample_every=100).run(stream)
+    return replay_app, report
+
+
+def test_generated_stream_is_reproducible():
+    assert generate_stream(500, seed=3) == generate_stream(500, seed=3)
+    assert generate_stream(500, seed=3) != generate_stream(500, seed=4)
+    actions = {event['action'] for event in generate_stream(500, seed=3)}
+    assert actions == {'place', 'cancel', 'amend'}
+
+
+def test_replays_produce_identical_trades(make_app):
+    stream = generate_stream(400, products=2, users=10, seed=11)
+    first_app, first = replay(make_app, stream)
+    _, second = replay(make_app, stream)
+
+    assert first['trades'] > 0
+    assert (first['trades'], first['trade_digest'], first['book_size']) == \
+           (second['trades'], second['trade_digest'], second['book_size'])
+    assert [sample['events'] for sample in first['book_size']] == [100, 200, 300, 400]
+    assert first['latency']['place']['count'] == sum(1 for e in stream if e['action'] == 'place')
+    assert first['events_per_second'] > 0
+
+    # A stream captured from the replayed database has one place event per stored order
+    with first_app.app_context():
+        captured = capture_stream()
+        assert sum(1 for e in captured if e['action'] == 'place') == db.session.query(db.func.count()).select_from(
+            db.metadata.tables['orders']).scalar()
+
+
+def traded(name_of):
+    """The trades in execution order as (buyer, seller, quantity, price), users named by name_of(user id)."""
+    rows = db.session.execute(db.select(Trade.buyer_id, Trade.seller_id, Trade.quantity_traded_kg,
+                                        Trade.price_per_kg_agreed).order_by(Trade.id))
+    return [(name_of(buyer), name_of(seller), str(quantity), str(price)) for buyer, seller, quantity, price in rows]
+
+
+def test_captured_stream_replays_the_original_trades(make_app, client, init_database, register, create_listing,
+                                                     place_order):
+    seller_id, seller = register(client, 'capture_seller')
+    first_buyer_id, first_buyer = register(client, 'capture_buyer1')
+    _, second_buyer = register(client, 'capture_buyer2')
+    product_id = create_listing(seller_id)
+    place_order(client, seller, 'sell', product_id, "10.00", "5.00")
+    place_order(client, first_buyer, 'buy', product_id, "4.00", "5.00") # Partially fills the ask
+    place_order(client, seller, 'sell', product_id, "5.00", "6.00")
+    bid = place_order(client, second_buyer, 'buy', product_id, "8.00", "4.00").json['order']['id']
+    assert client.delete(f'/api/orders/{bid}', headers=second_buyer).status_code == 200
+    place_order(client, seller, 'sell', product_id, "3.00", "4.00") # Would have hit the cancelled bid
+    place_order(client, first_buyer, 'buy', product_id, "5.00", "6.00") # Partially filled by the 4.00 ask
+    original = traded(lambda user_id: f"user{user_id}")
+    assert original == [(f"user{first_buyer_id}", f"user{seller_id}", '4.00', '5.00'),
+                        (f"user{first_buyer_id}", f"user{seller_id}", '3.00', '4.00')]
+
+    stream = capture_stream()
+    assert [event['action'] for event in stream] == ['place'] * 4 + ['cancel', 'place', 'place']
+    assert [event['quantity_kg'] for event in stream if event['action'] == 'place'] == [
+        '10.00', '4.00', '5.00', '8.00', '3.00', '5.00']
+
+    replay_app, report = replay(make_app, stream)
+    assert report['trades'] == len(original)
+    with replay_app.app_context():
+        names = {user_id: name.removeprefix('replay_') for user_id, name in db.session.execute(
+            db.select(User.id, User.username))}
+        assert traded(names.get) == original
@@ -0,0 +1,142 @@
+import pytest
+from decimal import Decimal
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+from app import settlement
+from app.models import User, HydrogenProduct, Order, Trade, db
+from app.settlement import SettlementConflict, run_settlement_batch
+
+
+def create_test_user(suffix):
+    user = User(username=f"settle_{suffix}", email=f"settle_{suffix}@example.com", password="password")
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+def create_test_product(seller):
+    product = HydrogenProduct(
+        seller_id=seller.id,
+        quantity_kg=Decimal("1000"),
+        price_per_kg=Decimal("10"),
+        location_region="Test Region",
+        production_method="Test Method"
+    )
+    db.session.add(product)
+    db.session.commit()
+    return product
+
+def create_test_trade(buyer, seller, product, quantity, price, timestamp=None):
+    buy_order = Order(user_id=buyer.id, hydrogen_product_id=product.id, order_type='buy',
+                      quantity_kg=Decimal(quantity), price_per_kg=Decimal(price), status='filled')
+    sell_order = Order(user_id=seller.id, hydrogen_product_id=product.id, order_type='sell',
+                       quantity_kg=Decimal(quantity), price_per_kg=Decimal(price), status='filled')
+    db.session.add_all([buy_order, sell_order])
+    db.session.flush()
+    trade = Trade(
+        buy_order_id=buy_order.id,
+        sell_order_id=sell_order.id,
+        hydrogen_product_id=product.id,
+        quantity_traded_kg=Decimal(quantity),
+        price_per_kg_agreed=Decimal(price),
+        buyer_id=buyer.id,
+        seller_id=seller.id,
+        trade_timestamp=timestamp or datetime.utcnow() - timedelta(minutes=5)
+    )
+    db.session.add(trade)
+    db.session.commit()
+    return trade
+
+
+def test_settlement_nets_bilateral_obligations(init_database):
+    """Opposite trades between the same pair and product are netted into one instruction."""
+    alice = create_test_user("alice")
+    bob = create_test_user("bob")
+    product = create_test_product(alice)
+
+    t1 = create_test_trade(bob, alice, product, "100", "5.00")   # bob buys 100kg from alice for 500
+    t2 = create_test_trade(bob, alice, product, "50", "6.00")    # bob buys 50kg from alice for 300
+    t3 = create_test_trade(alice, bob, product, "30", "5.50")    # alice buys 30kg back from bob for 165
+
+    result = run_settlement_batch(window_end=datetime.utcnow())
+
+    assert result['trades_completed'] == 3
+    assert result['trades_failed'] == 0
+    assert len(result['instructions']) == 1
+    instruction = result['instructions'][0]
+    assert instruction['hydrogen_product_id'] == product.id
+    assert instruction['trade_count'] == 3
+    assert instruction['deliverer_id'] == alice.id
+    assert instruction['receiver_id'] == bob.id
+    assert Decimal(instruction['net_quantity_kg']) == Decimal("120")
+    assert instruction['payer_id'] == bob.id
+    assert instruction['payee_id'] == alice.id
+    assert Decimal(instruction['net_amount']) == Decimal("635.00")
+
+    for trade in (t1, t2, t3):
+        db.session.refresh(trade)
+        assert trade.settlement_status == 'completed'
+
+
+def test_settlement_marks_invalid_trades_failed(init_database):
+    """Self-trades are not settled and are marked 'failed'."""
+    alice = create_test_user("self_a")
+    bob = create_test_user("self_b")
+    product = create_test_product(alice)
+
+    good = create_test_trade(bob, alice, product, "10", "5.00")
+    self_trade = create_test_trade(alice, alice, product, "10", "5.00")
+
+    result = run_settlement_batch(window_end=datetime.utcnow())
+
+    assert result['trades_completed'] == 1
+    assert result['trades_failed'] == 1
+    db.session.refresh(good)
+    db.session.refresh(self_trade)
+    assert good.settlement_status == 'completed'
+    assert self_trade.settlement_status == 'failed'
+
+
+def test_settlement_respects_window_and_batches(init_database):
+    """Only trades inside the window are settled, regardless of the streaming batch size."""
+    alice = create_test_user("win_a")
+    bob = create_test_user("win_b")
+    product = create_test_product(alice)
+    window_start = datetime.utcnow() - timedelta(hours=1)
+
+    inside = [create_test_trade(bob, alice, product, "1", "4.00") for _ in range(5)]
+    outside = create_test_trade(bob, alice, product, "1", "4.00", timestamp=window_start - timedelta(hours=1))
+
+    result = run_settlement_batch(window_start=window_start, window_end=datetime.utcnow(), batch_size=2)
+
+    assert result['trades_completed'] == 5
+    assert Decimal(result['instructions'][0]['net_quantity_kg']) == Decimal("5")
+    db.session.refresh(outside)
+    assert outside.settlement_status == 'pending'
+    for trade in inside:
+        db.session.refresh(trade)
+        assert trade.settlement_status == 'completed'
+
+
+def test_settlement_rolls_back_when_a_concurrent_run_settled_a_trade(init_database, monkeypatch):
+    """Trades settled by another run after they were read abort the batch instead of being settled twice."""
+    alice = create_test_user("race_a")
+    bob = create_test_user("race_b")
+    product = create_test_product(alice)
+    trades = [create_test_trade(bob, alice, product, "10", "5.00") for _ in range(3)]
+
+    bulk_set_status = settlement._bulk_set_status
+
+    def settled_concurrently(trade_ids, status):
+        # Another run completes one of the trades between the read and the UPDATE.
+        db.session.execute(update(Trade).where(Trade.id == trades[0].id).values(settlement_status='completed'))
+        bulk_set_status(trade_ids, status)
+
+    monkeypatch.setattr(settlement, '_bulk_set_status', settled_concurrently)
+    with pytest.raises(SettlementConflict):
+        run_settlement_batch(window_end=datetime.utcnow())
+
+    for trade in trades:
+        db.session.refresh(trade)
+        assert trade.settlement_status == 'pending'
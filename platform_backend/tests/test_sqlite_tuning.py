@@ -0,0 +1,110 @@
+import threading
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from app.matching_engine import _is_retryable_conflict
+from app.sqlite_tuning import WriteQueue, sqlite_engine_options, tune_sqlite_engine, write_queue_for
+
+
+@pytest.fixture()
+def tuned_engine(tmp_path):
+    config = {'SQLITE_BUSY_TIMEOUT_MS': 2000, 'SQLITE_READER_POOL_SIZE': 4}
+    engine = create_engine(f"sqlite:///{tmp_path / 'tuned.db'}", **sqlite_engine_options(config))
+    tune_sqlite_engine(engine, config)
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE entries (id INTEGER PRIMARY KEY, worker INTEGER, n INTEGER)"))
+    yield engine
+    engine.dispose()
+
+
+def test_pragmas_applied(tuned_engine):
+    with tuned_engine.connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == 'wal'
+        assert connection.execute(text("PRAGMA busy_timeout")).scalar() == 2000
+        assert connection.execute(text("PRAGMA synchronous")).scalar() == 1 # NORMAL
+        assert connection.execute(text("PRAGMA cache_size")).scalar() == -64000
+
+
+def test_concurrent_writers_do_not_lock(tuned_engine):
+    """Interleaved read-then-write transactions from many threads all succeed."""
+    errors = []
+
+    def writer(worker):
+        try:
+            for n in range(25):
+                with tuned_engine.begin() as connection:
+                    count = connection.execute(text("SELECT COUNT(*) FROM entries")).scalar()
+                    connection.execute(text("INSERT INTO entries (worker, n) VALUES (:w, :n)"), {'w': worker, 'n': count})
+        except Exception as e: # pragma: no cover - reported below
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    with tuned_engine.connect() as connection:
+        assert connection.execute(text("SELECT COUNT(*) FROM entries")).scalar() == 200
+    assert len(write_queue_for(tuned_engine)) == 0
+
+
+def test_rollback_releases_write_queue(tuned_engine):
+    connection = tuned_engine.connect()
+    transaction = connection.begin()
+    connection.execute(text("INSERT INTO entries (worker, n) VALUES (1, 1)"))
+    transaction.rollback()
+    connection.close()
+
+    # The queue is free again: another writer gets in immediately.
+    with tuned_engine.begin() as other:
+        other.execute(text("INSERT INTO entries (worker, n) VALUES (2, 2)"))
+    with tuned_engine.connect() as check:
+        assert check.execute(text("SELECT worker FROM entries")).scalars().all() == [2]
+
+
+def test_write_queue_timeout_is_a_retryable_lock_error(tmp_path):
+    config = {'SQLITE_BUSY_TIMEOUT_MS': 20}
+    engine = create_engine(f"sqlite:///{tmp_path / 'busy.db'}", **sqlite_engine_options(config))
+    tune_sqlite_engine(engine, config)
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE entries (id INTEGER PRIMARY KEY, worker INTEGER, n INTEGER)"))
+
+    with engine.begin() as holder:
+        holder.execute(text("INSERT INTO entries (worker, n) VALUES (1, 1)"))
+        with engine.connect() as waiting:
+            with pytest.raises(OperationalError) as excinfo:
+                waiting.execute(text("INSERT INTO entries (worker, n) VALUES (2, 2)"))
+            assert _is_retryable_conflict(excinfo.value)
+    with engine.begin() as connection: # Nothing was left holding the queue
+        connection.execute(text("INSERT INTO entries (worker, n) VALUES (3, 3)"))
+    assert len(write_queue_for(engine)) == 0
+    engine.dispose()
+
+
+def test_write_queue_is_fifo_and_times_out():
+    queue = WriteQueue()
+    queue.acquire()
+    order = []
+
+    def waiter(name):
+        queue.acquire()
+        order.append(name)
+        queue.release()
+
+    first = threading.Thread(target=waiter, args=('first',))
+    first.start()
+    while len(queue) < 1:
+        pass
+    second = threading.Thread(target=waiter, args=('second',))
+    second.start()
+    while len(queue) < 2:
+        pass
+    with pytest.raises(TimeoutError):
+        queue.acquire(timeout=0.01)
+    queue.release()
+    first.join()
+    second.join()
+    assert order == ['first', 'second']
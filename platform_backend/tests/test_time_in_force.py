@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from app.matching_engine import execute_immediate_order
+from app.models import CreditLimit, Order, OrderAuditRecord, PlatformStat, Trade, db
+from app.order_book import get_order_book
+from app.platform_stats import get_platform_stats
+
+
+def test_ioc_sweeps_the_book_and_never_rests(client, init_database, register, create_listing, place_order):
+    seller_id, seller = register(client, 'tif_seller')
+    _, buyer = register(client, 'tif_buyer')
+    product_id = create_listing(seller_id)
+    place_order(client, seller, 'sell', product_id, "3.00", "5.00")
+    place_order(client, seller, 'sell', product_id, "4.00", "6.00")
+    place_order(client, seller, 'sell', product_id, "5.00", "9.00") # Beyond the limit
+
+    response = place_order(client, buyer, 'buy', product_id, "10.00", "6.00", time_in_force="IOC")
+    assert response.status_code == 201
+    assert [(t['quantity_traded_kg'], t['price_per_kg_agreed']) for t in response.json['trades_made']] == [
+        ('3.00', '5.00'), ('4.00', '6.00')
+    ]
+    assert (response.json['order']['status'], response.json['order']['quantity_kg']) == ('cancelled', '3.00')
+    assert (response.json['execution']['outcome'], response.json['execution']['filled_kg']) == ('partially_filled', '7.00')
+    assert Order.query.filter_by(order_type='buy', status='pending').count() == 0
+
+    response = place_order(client, buyer, 'buy', product_id, "1.00", "6.00", time_in_force="IOC")
+    assert response.status_code == 200 # Nothing crosses any more: no order row at all
+    assert response.json['order'] is None
+    assert response.json['execution']['outcome'] == 'cancelled'
+    assert Order.query.filter_by(order_type='buy').count() == 1
+
+
+def test_fok_checks_depth_before_touching_the_book(client, init_database, register, create_listing, place_order):
+    seller_id, seller = register(client, 'tif_seller')
+    _, buyer = register(client, 'tif_buyer')
+    product_id = create_listing(seller_id)
+    place_order(client, seller, 'sell', product_id, "3.00", "5.00")
+    place_order(client, seller, 'sell', product_id, "4.00", "5.50")
+
+    killed = place_order(client, buyer, 'buy', product_id, "8.00", "6.00", time_in_force="FOK")
+    assert (killed.status_code, killed.json['order'], killed.json['execution']['outcome']) == (200, None, 'killed')
+    assert Trade.query.count() == 0
+    assert Order.query.filter_by(order_type='sell', status='pending').count() == 2
+
+    filled = place_order(client, buyer, 'buy', product_id, "7.00", "6.00", time_in_force="FOK")
+    assert filled.status_code == 201
+    assert filled.json['order']['status'] == 'filled'
+    assert len(filled.json['trades_made']) == 2
+    assert [r.outcome for r in OrderAuditRecord.query.order_by(OrderAuditRecord.id)] == ['killed', 'filled']
+
+
+def test_fok_kill_keeps_the_callers_transaction(client, init_database, register, create_listing, place_order):
+    seller_id, seller = register(client, 'tif_seller')
+    buyer_id, _ = register(client, 'tif_buyer')
+    product_id = create_listing(seller_id)
+    place_order(client, seller, 'sell', product_id, "3.00", "5.00")
+    get_order_book().load(product_id)
+
+    db.session.add(CreditLimit(user_id=buyer_id, max_order_notional=Decimal('100'))) # Pending work of the caller
+    resting = Order(user_id=buyer_id, hydrogen_product_id=product_id, order_type='buy', quantity_kg=Decimal('1.00'),
+                    price_per_kg=Decimal('1.00'), status='pending')
+    db.session.add(resting)
+    db.session.flush() # Collected for the book mirror and the statistics before the sweep's savepoint
+    order, trades, audit = execute_immediate_order(buyer_id, 'buy', product_id, Decimal('8.00'), Decimal('6.00'), 'FOK')
+    assert (order, trades, audit.outcome) == (None, [], 'killed')
+    db.session.commit()
+    assert CreditLimit.query.filter_by(user_id=buyer_id).count() == 1
+    assert Order.query.filter_by(order_type='sell', status='pending').count() == 1
+    assert get_order_book().get(resting.id) is not None
+    get_platform_stats().flush()
+    assert db.session.scalar(db.select(PlatformStat.count).filter_by(name='orders', period='all', dimension='pending')) == 2
+
+
+def test_gtd_requires_an_expiration_and_stops_matching_once_past_it(client, init_database, register, create_listing,
+                                                                    place_order):
+    seller_id, seller = register(client, 'tif_seller')
+    _, buyer = register(client, 'tif_buyer')
+    product_id = create_listing(seller_id)
+    assert place_order(client, seller, 'sell', product_id, "1.00", "5.00", time_in_force="GTD").status_code == 400
+    assert place_order(client, seller, 'sell', product_id, "1.00", "5.00", time_in_force="XYZ").status_code == 400
+
+    expires = (datetime.utcnow() + timedelta(hours=1)).isoformat()
+    resting = place_order(client, seller, 'sell', product_id, "1.00", "5.00",
+                          expiration_timestamp=expires).json['order']
+    assert resting['time_in_force'] == 'GTD'
+    db.session.get(Order, resting['id']).expiration_timestamp = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+
+    assert place_order(client, buyer, 'buy', product_id, "1.00", "5.00").json['trades_made'] == []
@@ -1,12 +1,18 @@
 import pytest
 from decimal import Decimal
-from app.models import User, HydrogenProduct, Order, Trade # Import all models
+from app.models import User, HydrogenProduct, Order, Trade, db # Import all models
 from faker import Faker
 
 fake = Faker()
 
+# SQL budgets per request (see the query_budget fixture in conftest.py). The statement
+# counts are what the endpoints issue today; raise them only for a deliberate change.
+# Database time is generous, so it only catches gross regressions such as table scans.
+DB_MS = 100
+
 # --- Product Listing Tests ---
 
+@pytest.mark.query_budget(queries=4, db_ms=DB_MS)
 def test_create_product_success(client, new_user_with_token):
     """Test successful creation of a hydrogen product."""
     user, token, _ = new_user_with_token
@@ -35,6 +41,7 @@ def test_create_product_success(client, new_user_with_token):
     assert product_in_db.seller_id == user.id
     assert product_in_db.price_per_kg == Decimal(product_data['price_per_kg'])
 
+@pytest.mark.query_budget(queries=1, db_ms=DB_MS)
 def test_create_product_missing_fields(client, new_user_with_token):
     """Test creating product with missing required fields."""
     _, token, _ = new_user_with_token
@@ -48,6 +55,7 @@ def test_create_product_missing_fields(client, new_user_with_token):
     assert "Missing required field" in response.json['msg']
 
 
+@pytest.mark.query_budget(queries=2, db_ms=DB_MS)
 def test_get_all_products_public(client, new_product): # new_product creates one product
     """Test retrieving all active products (public endpoint)."""
     # new_product fixture already creates a product
@@ -62,6 +70,7 @@ def test_get_all_products_public(client, new_product): # new_product creates one
     assert found
 
 
+@pytest.mark.query_budget(queries=1, db_ms=DB_MS)
 def test_get_specific_product_public(client, new_product):
     """Test retrieving a specific product by ID (public endpoint)."""
     product, _, _ = new_product
@@ -70,11 +79,13 @@ def test_get_specific_product_public(client, new_product):
     assert response.json['id'] == product.id
     assert response.json['location_region'] == product.location_region
 
+@pytest.mark.query_budget(queries=1, db_ms=DB_MS)
 def test_get_nonexistent_product(client, init_database):
     """Test retrieving a nonexistent product."""
     response = client.get('/api/products/99999')
     assert response.status_code == 404 # Assuming @app.errorhandler(404) or get_or_404 is used
 
+@pytest.mark.query_budget(queries=6, db_ms=DB_MS)
 def test_update_own_product(client, new_product):
     """Test updating a product successfully by its owner."""
     product, seller, token = new_product
@@ -95,10 +106,11 @@ def test_update_own_product(client, new_product):
     assert product.quantity_kg == Decimal("800.00")
     assert product.status == "inactive"
 
-def test_update_product_by_non_owner(client, new_product, new_user_with_token):
+@pytest.mark.query_budget(queries=1, db_ms=DB_MS)
+def test_update_product_by_non_owner(client, new_product, other_user_with_token):
     """Test updating a product by someone other than the owner."""
     product_owned, _, _ = new_product # Product owned by one user
-    _, other_user_token, _ = new_user_with_token # Token for a different user
+    _, other_user_token, _ = other_user_with_token # Token for a different user
 
     update_data = {"price_per_kg": "6.00"}
     response = client.put(f'/api/products/{product_owned.id}', json=update_data, headers={
@@ -107,6 +119,7 @@ def test_update_product_by_non_owner(client, new_product, new_user_with_token):
     assert response.status_code == 403 # Forbidden
 
 
+@pytest.mark.query_budget(queries=4, db_ms=DB_MS)
 def test_delete_own_product(client, new_product):
     """Test deleting a product by its owner."""
     product, _, token = new_product
@@ -119,9 +132,10 @@ def test_delete_own_product(client, new_product):
 
 # --- Order Creation Tests ---
 
-def test_create_buy_order_success(client, new_user_with_token, new_product):
+@pytest.mark.query_budget(queries=16, db_ms=DB_MS)
+def test_create_buy_order_success(client, other_user_with_token, new_product):
     """Test creating a buy order successfully."""
-    buyer, token, _ = new_user_with_token
+    buyer, token, _ = other_user_with_token
     product_to_buy, _, _ = new_product # Product available on the market
 
     # Ensure buyer is not the seller of product_to_buy
@@ -150,6 +164,7 @@ def test_create_buy_order_success(client, new_user_with_token, new_product):
     assert response.json['order']['hydrogen_product_id'] == product_to_buy.id
     assert response.json['order']['status'] == 'pending' # Assuming no immediate match for this test
 
+@pytest.mark.query_budget(queries=16, db_ms=DB_MS)
 def test_create_sell_order_success(client, new_product):
     """Test creating a sell order successfully by the product owner."""
     product_to_sell, seller, token = new_product # product_to_sell is owned by seller
@@ -168,13 +183,14 @@ def test_create_sell_order_success(client, new_product):
     assert response.json['order']['user_id'] == seller.id
     assert response.json['order']['status'] == 'pending'
 
-def test_create_sell_order_for_unowned_product(client, new_user_with_token, new_product):
+@pytest.mark.query_budget(queries=1, db_ms=DB_MS)
+def test_create_sell_order_for_unowned_product(client, other_user_with_token, new_product):
     """Test creating a sell order for a product not owned by the user."""
     # new_product creates a product owned by one user
     product_not_owned, _, _ = new_product
     
-    # new_user_with_token provides another user and their token
-    other_user, other_user_token, _ = new_user_with_token
+    # other_user_with_token provides another user and their token
+    other_user, other_user_token, _ = other_user_with_token
 
     # Ensure other_user is not the owner of product_not_owned
     if product_not_owned.seller_id == other_user.id:
@@ -193,6 +209,7 @@ def test_create_sell_order_for_unowned_product(client, new_user_with_token, new_
     assert response.status_code == 403 # Forbidden
     assert "You can only create sell orders for your own products" in response.json['msg']
 
+@pytest.mark.query_budget(queries=8, db_ms=DB_MS)
 def test_create_sell_order_exceeding_product_quantity(client, new_product):
     """Test creating a sell order with quantity exceeding available product quantity."""
     product, seller, token = new_product
@@ -211,6 +228,7 @@ def test_create_sell_order_exceeding_product_quantity(client, new_product):
 
 # --- Order Matching Test (High-Level API Test) ---
 
+@pytest.mark.query_budget(queries=4, endpoints={'orders.create_order': 26}, db_ms=DB_MS)
 def test_order_matching_creates_trade(client, init_database):
     """
     High-level test:
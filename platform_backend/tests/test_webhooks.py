@@ -0,0 +1,211 @@
+import hashlib
+import hmac
+import json
+import socket
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.metrics import registry
+from app.models import WebhookDelivery, db
+from app.notifications import get_notification_dispatcher
+from app.webhooks import SIGNATURE_HEADER, TIMESTAMP_HEADER, get_webhook_deliverer, resolve_endpoint
+
+
+class Receiver(ThreadingHTTPServer):
+    """Local stand-in for an ERP webhook endpoint."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), ReceiverHandler)
+        self.requests = [] # (client port, headers, raw body)
+        self.status = 200
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/hooks/ghx"
+
+    def events(self):
+        return [event for _, _, body in self.requests for event in json.loads(body)['events']]
+
+
+class ReceiverHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.client_address[1], dict(self.headers), body))
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def receiver():
+    server = Receiver()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def dns(monkeypatch):
+    """Resolves the hostnames put in the returned dict to the given address; others as usual."""
+    answers = {}
+    getaddrinfo = socket.getaddrinfo
+
+    def fake_getaddrinfo(host, port, *args, **kwargs):
+        if host in answers:
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (answers[host], port))]
+        return getaddrinfo(host, port, *args, **kwargs)
+    monkeypatch.setattr(socket, 'getaddrinfo', fake_getaddrinfo)
+    return answers
+
+
+def deliver():
+    get_notification_dispatcher().dispatch_pending()
+    return get_webhook_deliverer().deliver_due()
+
+
+def test_subscription_validation(app, client, init_database, monkeypatch, dns, register):
+    dns['erp.example.com'] = '93.184.215.14'
+    _, headers = register(client, 'erp_user')
+    assert client.post('/api/webhooks', json={'url': 'ftp://erp.example.com'}, headers=headers).status_code == 400
+    assert client.post('/api/webhooks', json={'url': 'https://erp.example.com/h', 'event_types': ['bogus']},
+                       headers=headers).status_code == 400
+    monkeypatch.setitem(app.config, 'WEBHOOK_ALLOW_HTTP', False)
+    assert client.post('/api/webhooks', json={'url': 'http://erp.example.com/h'}, headers=headers).status_code == 400
+
+    created = client.post('/api/webhooks', json={'url': 'https://erp.example.com/h'}, headers=headers)
+    assert created.status_code == 201
+    assert len(created.json['secret']) == 64
+    listed = client.get('/api/webhooks', headers=headers).json
+    assert listed == [{k: v for k, v in created.json.items() if k != 'secret'}]
+    assert 'secret' not in listed[0]
+
+
+def test_events_are_batched_signed_and_sent_over_one_connection(client, init_database, receiver, register,
+                                                                create_listing, place_order):
+    seller_id, seller = register(client, 'erp_seller')
+    _, buyer = register(client, 'erp_buyer')
+    subscription = client.post('/api/webhooks', json={'url': receiver.url}, headers=seller).json
+    product_id = create_listing(seller_id)
+
+    for _ in range(3):
+        assert place_order(client, seller, 'sell', product_id, "1.00").status_code == 201
+    assert deliver() == 3
+    for _ in range(2):
+        assert place_order(client, buyer, 'buy', product_id, "1.00").status_code == 201
+    assert deliver() == 2 # The seller's trades; the buyer has no webhook
+
+    assert len(receiver.requests) == 2 # One batched POST per cycle
+    assert len({port for port, _, _ in receiver.requests}) == 1 # Connection reused
+    events = receiver.events()
+    assert [e['type'] for e in events] == ['order.updated'] * 3 + ['trade.executed'] * 2
+    assert [e['data']['order_status'] for e in events[3:]] == ['filled', 'filled']
+    assert len({e['id'] for e in events}) == 5
+
+    _, headers, body = receiver.requests[0]
+    expected = hmac.new(subscription['secret'].encode(), f"{headers[TIMESTAMP_HEADER]}.".encode() + body,
+                        hashlib.sha256).hexdigest()
+    assert headers[SIGNATURE_HEADER] == f"sha256={expected}"
+    assert WebhookDelivery.query.filter_by(status='delivered').count() == 5
+
+    metrics = registry.render()
+    assert 'ghx_webhook_events_delivered_total' in metrics
+    assert 'ghx_webhook_delivery_lag_seconds ' in metrics
+
+
+def test_failures_back_off_then_dead_letter_and_redrive(app, client, init_database, receiver, monkeypatch, register,
+                                                        create_listing, place_order):
+    seller_id, seller = register(client, 'erp_seller')
+    client.post('/api/webhooks', json={'url': receiver.url, 'event_types': ['order.updated']}, headers=seller)
+    product_id = create_listing(seller_id)
+    assert place_order(client, seller, 'sell', product_id, "1.00").status_code == 201
+    deliverer = get_webhook_deliverer()
+    monkeypatch.setattr(deliverer, 'max_attempts', 2)
+
+    receiver.status = 503
+    assert deliver() == 0
+    delivery = WebhookDelivery.query.one()
+    assert (delivery.status, delivery.attempts) == ('pending', 1)
+    assert delivery.next_attempt_at > datetime.utcnow() # Backing off
+    assert deliverer.deliver_due() == 0
+    assert len(receiver.requests) == 1 # Not retried before it is due
+
+    db.session.execute(db.update(WebhookDelivery).values(next_attempt_at=datetime.utcnow() - timedelta(seconds=1)))
+    db.session.commit()
+    assert deliverer.deliver_due() == 0
+    dead = client.get('/api/webhooks/dead-letters', headers=seller).json
+    assert [(d['status'], d['attempts'], d['last_error']) for d in dead] == [('dead', 2, 'Endpoint responded with HTTP 503')]
+
+    receiver.status = 204
+    for ids in ('1', [delivery.id, 'x'], {'id': delivery.id}, [True]):
+        rejected = client.post('/api/webhooks/dead-letters/redrive', json={'ids': ids}, headers=seller)
+        assert rejected.status_code == 400
+    assert client.post('/api/webhooks/dead-letters/redrive', json={'ids': [delivery.id + 1]}, headers=seller).json == {
+        'redriven': 0}
+    assert client.post('/api/webhooks/dead-letters/redrive', headers=seller).json == {'redriven': 1}
+    assert deliverer.deliver_due() == 1
+    assert client.get('/api/webhooks/dead-letters', headers=seller).json == []
+
+
+def test_endpoints_must_resolve_to_public_addresses(app, client, init_database, receiver, monkeypatch, dns, register,
+                                                    create_listing, place_order):
+    for address in ('10.0.0.8', '127.0.0.1', '169.254.169.254', '::1', '::ffff:192.168.1.1', '224.0.0.1', '0.0.0.0'):
+        dns['internal.example.com'] = address
+        with pytest.raises(Exception, match='non-public'):
+            resolve_endpoint('internal.example.com', 443)
+    dns['erp.example.com'] = '93.184.215.14'
+    assert resolve_endpoint('erp.example.com', 443) == '93.184.215.14'
+
+    seller_id, seller = register(client, 'erp_seller')
+    monkeypatch.setitem(app.config, 'WEBHOOK_ALLOW_PRIVATE_ADDRESSES', False)
+    rejected = client.post('/api/webhooks', json={'url': 'https://internal.example.com/h'}, headers=seller)
+    assert rejected.status_code == 400 and 'non-public' in rejected.json['msg']
+    assert client.post('/api/webhooks', json={'url': receiver.url}, headers=seller).status_code == 400
+
+    # A host that resolved to a public address at registration is checked again on delivery
+    monkeypatch.setitem(app.config, 'WEBHOOK_ALLOW_PRIVATE_ADDRESSES', True)
+    dns['rebinding.example.com'] = '127.0.0.1'
+    url = receiver.url.replace('127.0.0.1', 'rebinding.example.com')
+    assert client.post('/api/webhooks', json={'url': url}, headers=seller).status_code == 201
+    product_id = create_listing(seller_id)
+    assert place_order(client, seller, 'sell', product_id, "1.00").status_code == 201
+    monkeypatch.setattr(get_webhook_deliverer().connections, 'allow_private', False)
+    assert deliver() == 0
+    assert receiver.requests == []
+    delivery = WebhookDelivery.query.one()
+    assert delivery.status == 'pending' and 'non-public' in delivery.last_error
+
+
+def test_deliveries_are_claimed_before_posting(client, init_database, receiver, monkeypatch, register, create_listing,
+                                               place_order):
+    seller_id, seller = register(client, 'erp_seller')
+    client.post('/api/webhooks', json={'url': receiver.url}, headers=seller)
+    product_id = create_listing(seller_id)
+    assert place_order(client, seller, 'sell', product_id, "1.00").status_code == 201
+    get_notification_dispatcher().dispatch_pending()
+    deliverer = get_webhook_deliverer()
+    engine, seen = db.engine, []
+    post = deliverer._post
+
+    def checking_post(url, secret, rows):
+        # Another connection sees the committed claim while the POST is in flight
+        with engine.begin() as connection:
+            seen.extend(connection.execute(db.select(WebhookDelivery.attempts, WebhookDelivery.next_attempt_at)).all())
+        return post(url, secret, rows)
+    monkeypatch.setattr(deliverer, '_post', checking_post)
+
+    assert deliverer.deliver_due() == 1
+    assert len(seen) == 1 and seen[0][0] == 1 and seen[0][1] > datetime.utcnow() + timedelta(seconds=60)
+    delivery = WebhookDelivery.query.one()
+    assert (delivery.status, delivery.attempts) == ('delivered', 1)